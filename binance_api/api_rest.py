@@ -1,42 +1,229 @@
 from __future__ import annotations
 
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
 
 import requests
 
+from binance_api.helpers import get_pair_for_symbol_type
 from woo.api_rest import KlineData, HistoricalKlineResponseMetaData
 
 BASE_URL = 'https://fapi.binance.com'
 HISTORICAL_KLINES = '/fapi/v1/continuousKlines'
+HISTORICAL_KLINES_DEFAULT_LIMIT = 500
+HISTORICAL_KLINES_MAX_LIMIT = 1500
+# binance allows 2400 request weight per minute per IP, keep some headroom for other callers
+REQUEST_WEIGHT_PER_MINUTE = 2000
+HISTORICAL_KLINES_MAX_WORKERS = 8
+HISTORICAL_KLINES_MAX_RETRIES = 3
+
+INTERVAL_UNIT_MS = {
+    'm': 60 * 1000,
+    'h': 60 * 60 * 1000,
+    'd': 24 * 60 * 60 * 1000,
+    'w': 7 * 24 * 60 * 60 * 1000,
+}
+
+
+class RequestWeightLimiter:
+    '''
+    Sliding one minute window of used request weight shared between the threads fetching pages.
+    '''
+
+    def __init__(self, weight_per_minute: int = REQUEST_WEIGHT_PER_MINUTE):
+        self._weight_per_minute = weight_per_minute
+        self._used: deque[tuple[float, int]] = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, weight: int):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._used and now - self._used[0][0] >= 60:
+                    self._used.popleft()
+                used = sum(w for _, w in self._used)
+                if used + weight <= self._weight_per_minute:
+                    self._used.append((now, weight))
+                    return
+                wait = 60 - (now - self._used[0][0])
+            time.sleep(wait)
 
 
 def request_historical_klines(
     symbol_type: str,
     start_time: int,
-    type: str | None = '1m'
+    type: str | None = '1m',
+    end_time: Optional[int] = None,
+    limit: int = HISTORICAL_KLINES_DEFAULT_LIMIT
 ) -> tuple[None, None] | tuple[list[KlineData], HistoricalKlineResponseMetaData]:
-    response = requests.get(
-        f'{BASE_URL}{HISTORICAL_KLINES}',
-        params={
-            "pair": "BTCUSDT",
-            "contractType": "PERPETUAL",
-            "interval": type,
-            'startTime': start_time * 1000,
-        }
-    )
-
-    data = response.json()
+    interval = type or '1m'
+    data = _request_klines_page(symbol_type, interval, start_time * 1000, _to_ms(end_time), limit)
 
     if data is None:
         print(f'ERROR: with response: {data}')
         return None, None
 
-    total = int((int(time.time()) - (data[0][0]/1000) if len(data) > 0 else 0) / 60)
+    # every kline of the range, the page holds the first limit of them
+    end_ms = _to_ms(end_time) if end_time is not None else int(time.time() * 1000)
+    total = get_kline_count(start_time * 1000, end_ms, get_interval_ms(interval))
+
+    return [_convert_to_kline_data(row, symbol_type) for row in data], {'total': total, 'records_per_page': limit, 'current_page': 1}
+
+
+def request_historical_klines_range(
+    symbol_type: str,
+    start_time: int,
+    end_time: Optional[int] = None,
+    type: str | None = '1m',
+    max_workers: int = HISTORICAL_KLINES_MAX_WORKERS,
+    limiter: Optional[RequestWeightLimiter] = None
+) -> tuple[None, None] | tuple[list[KlineData], HistoricalKlineResponseMetaData]:
+    '''
+    Fetches every kline between start_time and end_time (seconds, end exclusive) into one list.
+    Only meant for bounded ranges, use iter_historical_klines_range to go through long ones.
+    '''
+    rows: list[KlineData] = []
+    page_count = 0
+    for page in iter_historical_klines_range(symbol_type, start_time, end_time, type, max_workers, limiter):
+        if page is None:
+            return None, None
+        rows += page
+        page_count += 1
+
+    # every page of the range has been fetched, the last one is the current page
+    return rows, {
+        'total': len(rows),
+        'records_per_page': HISTORICAL_KLINES_MAX_LIMIT,
+        'current_page': page_count
+    }
+
+
+def iter_historical_klines_range(
+    symbol_type: str,
+    start_time: int,
+    end_time: Optional[int] = None,
+    type: str | None = '1m',
+    max_workers: int = HISTORICAL_KLINES_MAX_WORKERS,
+    limiter: Optional[RequestWeightLimiter] = None
+) -> Iterator[Optional[list[KlineData]]]:
+    '''
+    Streams the klines between start_time and end_time (seconds, end exclusive) a page of at most
+    HISTORICAL_KLINES_MAX_LIMIT rows at a time, in open time order. The range is split into max
+    size pages that are requested max_workers at a time within the request weight limit, so no
+    more than that many pages are held in memory. A failed page is yielded as None and ends the
+    stream.
+    '''
+    interval = type or '1m'
+    interval_ms = get_interval_ms(interval)
+    end_time = int(time.time()) if end_time is None else end_time
+    limiter = limiter or RequestWeightLimiter()
+
+    pages = get_page_ranges(start_time * 1000, end_time * 1000, interval_ms, HISTORICAL_KLINES_MAX_LIMIT)
+    window = max(1, min(max_workers, len(pages)))
+    last_open_time = None
+
+    def fetch(page: tuple[int, int]) -> Optional[list]:
+        page_start, page_end = page
+        limiter.acquire(get_request_weight(HISTORICAL_KLINES_MAX_LIMIT))
+        return _request_klines_page(symbol_type, interval, page_start, page_end - 1, HISTORICAL_KLINES_MAX_LIMIT)
+
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        for window_start in range(0, len(pages), window):
+            results = executor.map(fetch, pages[window_start:window_start + window])
+            for index, result in enumerate(results, window_start):
+                if result is None:
+                    print(f'ERROR: failed to fetch page {index + 1} of {len(pages)} pages')
+                    yield None
+                    return
+
+                rows = [row for row in merge_kline_pages([result]) if last_open_time is None or row[0] > last_open_time]
+                if len(rows) > 0:
+                    last_open_time = rows[-1][0]
+                yield [_convert_to_kline_data(row, symbol_type) for row in rows]
+
+
+def get_interval_ms(interval: str) -> int:
+    return int(interval[:-1]) * INTERVAL_UNIT_MS[interval[-1]]
+
+
+def get_kline_count(start_ms: int, end_ms: int, interval_ms: int) -> int:
+    '''
+    The number of klines opening between start_ms and end_ms, both inclusive.
+    '''
+    start_ms = start_ms - (start_ms % interval_ms)
+    return max(0, (end_ms - start_ms) // interval_ms + 1)
+
+
+def get_request_weight(limit: int) -> int:
+    if limit < 100:
+        return 1
+    if limit < 500:
+        return 2
+    if limit <= 1000:
+        return 5
+    return 10
+
+
+def get_page_ranges(start_ms: int, end_ms: int, interval_ms: int, limit: int) -> list[tuple[int, int]]:
+    start_ms = start_ms - (start_ms % interval_ms)
+    page_span = interval_ms * limit
+    return [(page_start, min(page_start + page_span, end_ms)) for page_start in range(start_ms, end_ms, page_span)]
+
+
+def merge_kline_pages(pages: list[list]) -> list[list]:
+    rows = {row[0]: row for page in pages for row in page}
+    return [rows[open_time] for open_time in sorted(rows)]
+
+
+def _request_klines_page(
+    symbol_type: str,
+    interval: str,
+    start_ms: int,
+    end_ms: Optional[int] = None,
+    limit: int = HISTORICAL_KLINES_DEFAULT_LIMIT
+) -> Optional[list]:
+    params = {
+        "pair": get_pair_for_symbol_type(symbol_type),
+        "contractType": "PERPETUAL",
+        "interval": interval,
+        'startTime': start_ms,
+        'limit': limit,
+    }
+
+    if end_ms is not None:
+        params['endTime'] = end_ms
+
+    for attempt in range(HISTORICAL_KLINES_MAX_RETRIES):
+        try:
+            response = requests.get(f'{BASE_URL}{HISTORICAL_KLINES}', params=params, timeout=(5.0, 30.0))
+        except requests.exceptions.RequestException as e:
+            print(f'ERROR: with request: {e}')
+            time.sleep(attempt + 1)
+            continue
+
+        if response.status_code in (418, 429):
+            time.sleep(int(response.headers.get('Retry-After', attempt + 1)))
+            continue
+
+        data = response.json()
+
+        if not isinstance(data, list):
+            print(f'ERROR: with response: {data}')
+            return None
+
+        return data
+
+    return None
+
 
-    return [_convert_to_kline_data(row) for row in data], {'total': total, 'records_per_page': 500, 'current_page': 1}
+def _to_ms(timestamp: Optional[int]) -> Optional[int]:
+    return None if timestamp is None else timestamp * 1000
 
 
-def _convert_to_kline_data(data: list) -> KlineData:
+def _convert_to_kline_data(data: list, symbol_type: str = 'PERP_BTC_USDT') -> KlineData:
     return {
         'start_timestamp': int(data[0]),
         'open': float(data[1]),
@@ -46,5 +233,5 @@ def _convert_to_kline_data(data: list) -> KlineData:
         'volume': float(data[5]),
         'end_timestamp': int(data[6]),
         'amount': float(data[7]),
-        'symbol': 'PERP_BTC_USDT'
-    }
\ No newline at end of file
+        'symbol': symbol_type
+    }
@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+from typing import TypedDict
+
+
+class BinanceKlineData(TypedDict):
+    t: int # Kline start time in milliseconds
+    T: int # Kline close time in milliseconds
+    i: str # Interval
+    f: int # First trade ID
+    L: int # Last trade ID
+    o: str # Open price
+    c: str # Close price
+    h: str # High price
+    l: str # Low price
+    v: str # Base asset volume
+    n: int # Number of trades
+    x: bool # Is this kline closed?
+    q: str # Quote asset volume
+    V: str # Taker buy base asset volume
+    Q: str # Taker buy quote asset volume
+    B: str # Ignore
+
+
+class BinanceKlineResponse(TypedDict):
+    e: str # Event type
+    E: int # Event time
+    ps: str # Pair i.e. "BTCUSDT"
+    ct: str # Contract type i.e. "PERPETUAL"
+    k: BinanceKlineData
@@ -1,40 +1,104 @@
+from __future__ import annotations
+
 import json
 from enum import Enum
-from typing import Callable
+from typing import Callable, Optional, TypedDict
 
 import websocket
 import rel
 
-MARKET_DATA_WS = 'wss://fstream.binance.com/ws/btcusdt_perpetual@continuousKline_1m'
+from common.util.tape import TapeRecorder
+
+MARKET_DATA_WS = 'wss://fstream.binance.com/stream'
+MAX_STREAMS_PER_CONNECTION = 200
+STREAM_MESSAGE_PREFIX = '{"stream":"'
 
 
 class MessageTypes(Enum):
-    SUBSCRIBE = 'subscribe'
+    SUBSCRIBE = 'SUBSCRIBE'
+    UNSUBSCRIBE = 'UNSUBSCRIBE'
     PING = 'ping'
     PONG = 'pong'
     KLINE = 'kline'
     CONTINUOUS_KLINE = 'continuous_kline'
-
-
-class BinanceWS():
-    def __init__(self, debug: bool = False, enable_trace: bool = False):
-        self.ws = None
+    CONTINUOUS_KLINE_STREAM = '{pair}_perpetual@continuousKline_{interval}'
+    KLINE_STREAM = '{symbol}@kline_{interval}'
+    BOOK_TICKER_STREAM = '{symbol}@bookTicker'
+
+
+class BinanceWSKwargs(TypedDict):
+    connect_callback: Optional[Callable]
+    error_callback: Optional[Callable]
+    close_callback: Optional[Callable]
+    recorder: Optional[TapeRecorder]
+
+
+class BinanceWS:
+    '''
+    Client for binance combined streams, every subscribed stream is multiplexed over one socket.
+    Messages are routed on the stream name before the payload is decoded so frames for streams
+    without a handler are never parsed.
+    '''
+
+    _ws: Optional[websocket.WebSocketApp]
+    _connected: bool
+    _request_id: int
+    _stream_callback_map: dict[str, list[Callable]]
+    _recorder: Optional[TapeRecorder]
+
+    def __init__(self, debug: bool = False, enable_trace: bool = False, **kwargs: BinanceWSKwargs):
+        self._ws = None
+        self._connected = False
+        self._request_id = 0
         self.debug = debug
         self.enable_trace = enable_trace
         self.message_callback_map = {}
+        self._stream_callback_map = {}
+        self._connect_callback = kwargs.get('connect_callback')
+        self._error_callback = kwargs.get('error_callback')
+        self._close_callback = kwargs.get('close_callback')
+        self._recorder = kwargs.get('recorder')
+
+    def attach_recorder(self, recorder: Optional[TapeRecorder]):
+        self._recorder = recorder
+
+    @property
+    def streams(self) -> list[str]:
+        return list(self._stream_callback_map.keys())
 
-    def connect(self, on_error: Callable = None, on_close: Callable = None):
+    def connect(self, on_error: Callable = None, on_close: Callable = None, dispatch: bool = True):
         websocket.enableTrace(self.enable_trace)
-        url = MARKET_DATA_WS
-        self.ws = websocket.WebSocketApp(url,
+        # connects without streams in the url, run_forever reconnects to the same url and streams
+        # unsubscribed since would come back. _on_open subscribes the current ones on every connect
+        self._ws = websocket.WebSocketApp(MARKET_DATA_WS,
              on_open=self._on_open,
              on_message=self._on_message,
              on_error=self._on_error if on_error is None else on_error,
              on_close=self._on_close if on_close is None else on_close)
 
-        self.ws.run_forever(dispatcher=rel, reconnect=5)
-        rel.signal(2, rel.abort)
-        rel.dispatch()
+        self._ws.run_forever(dispatcher=rel, reconnect=5)
+        # dispatch=False lets several clients share one rel loop, the caller runs rel.dispatch()
+        if dispatch:
+            rel.signal(2, rel.abort)
+            rel.dispatch()
+
+    def subscribe_to_continuous_kline(self, pair: str, interval: str = '1m', handler: Optional[Callable] = None):
+        self._subscribe(MessageTypes.CONTINUOUS_KLINE_STREAM, handler, [('pair', pair), ('interval', interval)])
+
+    def unsubscribe_from_continuous_kline(self, pair: str, interval: str = '1m', handler: Optional[Callable] = None):
+        self._unsubscribe(MessageTypes.CONTINUOUS_KLINE_STREAM, handler, [('pair', pair), ('interval', interval)])
+
+    def subscribe_to_kline(self, symbol: str, interval: str = '1m', handler: Optional[Callable] = None):
+        self._subscribe(MessageTypes.KLINE_STREAM, handler, [('symbol', symbol), ('interval', interval)])
+
+    def unsubscribe_from_kline(self, symbol: str, interval: str = '1m', handler: Optional[Callable] = None):
+        self._unsubscribe(MessageTypes.KLINE_STREAM, handler, [('symbol', symbol), ('interval', interval)])
+
+    def subscribe_to_book_ticker(self, symbol: str, handler: Optional[Callable] = None):
+        self._subscribe(MessageTypes.BOOK_TICKER_STREAM, handler, [('symbol', symbol)])
+
+    def unsubscribe_from_book_ticker(self, symbol: str, handler: Optional[Callable] = None):
+        self._unsubscribe(MessageTypes.BOOK_TICKER_STREAM, handler, [('symbol', symbol)])
 
     def register_message_callback(self, type: MessageTypes, callback: Callable):
         cb_list = self.message_callback_map.get(type) or []
@@ -50,13 +114,92 @@ class BinanceWS():
         except ValueError:
             pass
 
+    def _subscribe(
+        self,
+        msg_type: MessageTypes,
+        handler: Optional[Callable] = None,
+        params: list[tuple[str, str]] = None
+    ):
+        stream = get_stream_name(msg_type, params)
+        is_new_stream = stream not in self._stream_callback_map
+
+        if is_new_stream and len(self._stream_callback_map) >= MAX_STREAMS_PER_CONNECTION:
+            raise Exception(f'Cannot subscribe to more than {MAX_STREAMS_PER_CONNECTION} streams on one connection')
+
+        cb_list = self._stream_callback_map.setdefault(stream, [])
+
+        if handler is not None and handler not in cb_list:
+            cb_list.append(handler)
+
+        if is_new_stream and self._connected:
+            self._send_request(MessageTypes.SUBSCRIBE, [stream])
+
+    def _unsubscribe(
+        self,
+        msg_type: MessageTypes,
+        handler: Optional[Callable] = None,
+        params: list[tuple[str, str]] = None
+    ):
+        stream = get_stream_name(msg_type, params)
+        cb_list = self._stream_callback_map.get(stream)
+
+        if cb_list is None:
+            return
+
+        if handler is not None:
+            try:
+                cb_list.remove(handler)
+            except ValueError:
+                pass
+            if len(cb_list) > 0:
+                return
+
+        del self._stream_callback_map[stream]
+
+        if self._connected:
+            self._send_request(MessageTypes.UNSUBSCRIBE, [stream])
+
+    def _send_request(self, method: MessageTypes, streams: list[str]):
+        self._request_id += 1
+        self._ws.send(json.dumps({
+            'method': method.value,
+            'params': streams,
+            'id': self._request_id
+        }))
+
     def _on_open(self, ws: websocket.WebSocketApp):
         if self.debug:
             print("Opened connection")
+        self._connected = True
+        if len(self._stream_callback_map) > 0:
+            self._send_request(MessageTypes.SUBSCRIBE, self.streams)
+        if self._connect_callback is not None:
+            self._connect_callback()
 
     def _on_message(self, ws: websocket.WebSocketApp, message: str):
+        if self._recorder is not None:
+            self._recorder.record(message)
+
+        stream = _get_stream_from_message(message)
+        cb_list = self._stream_callback_map.get(stream) if stream is not None else None
+
+        if not cb_list and len(self.message_callback_map) == 0:
+            if self.debug:
+                print(f'unhandled message: {message[:100]}')
+            return
+
         msg: dict = json.loads(message)
-        msg_type: str = msg.get('e')
+        data: dict = msg.get('data', msg) if stream is not None else msg
+
+        if cb_list:
+            for cb in cb_list:
+                cb(data)
+
+        if len(self.message_callback_map) > 0:
+            self._dispatch_by_event_type(data)
+
+    def _dispatch_by_event_type(self, data: dict):
+        msg_type: str = data.get('e')
 
         if self.debug:
             print(f'message type: {msg_type}')
@@ -65,23 +208,42 @@ class BinanceWS():
             m_type = MessageTypes(msg_type)
         except ValueError:
             if self.debug:
-                print(f'ERROR: no type for message: {message}')
-            return
-
-        cb_list = self.message_callback_map.get(m_type)
-
-        if cb_list is None:
+                print(f'ERROR: no type for message: {data}')
             return
 
-        for cb in cb_list:
-            cb(msg)
+        for cb in self.message_callback_map.get(m_type) or []:
+            cb(data)
 
     def _on_error(self, ws: websocket.WebSocketApp, error):
         if self.debug:
             print(error)
+        if self._error_callback is not None:
+            self._error_callback(error)
 
     def _on_close(self, ws, close_status_code, close_msg):
+        self._connected = False
+        if self._recorder is not None:
+            self._recorder.flush()
         if self.debug:
             print("### closed ###")
             print(f'close_status_code: {close_status_code}')
             print(f'close_msg: {close_msg}')
+        if self._close_callback is not None:
+            self._close_callback(close_status_code, close_msg)
+
+
+def get_stream_name(msg_type: MessageTypes, params: list[tuple[str, str]] = None) -> str:
+    stream = msg_type.value
+    if params is not None:
+        stream = stream.format(**{k: v.lower() if k in ('pair', 'symbol') else v for k, v in params})
+    return stream
+
+
+def _get_stream_from_message(message: str) -> Optional[str]:
+    # combined stream frames always start with {"stream":"<name>", so the name can be read without decoding the frame
+    if not message.startswith(STREAM_MESSAGE_PREFIX):
+        return None
+    end = message.find('"', len(STREAM_MESSAGE_PREFIX))
+    if end == -1:
+        return None
+    return message[len(STREAM_MESSAGE_PREFIX):end]
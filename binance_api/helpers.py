@@ -0,0 +1,16 @@
+QUOTE_ASSETS = ['USDT', 'USDC', 'BUSD']
+
+
+def get_pair_for_symbol_type(symbol_type: str) -> str:
+    # PERP_BTC_USDT -> BTCUSDT
+    parts = symbol_type.split('_')
+    return ''.join(parts[1:]) if parts[0] == 'PERP' else symbol_type
+
+
+def get_symbol_type_for_pair(pair: str) -> str:
+    # BTCUSDT -> PERP_BTC_USDT
+    pair = pair.upper()
+    for quote in QUOTE_ASSETS:
+        if pair.endswith(quote):
+            return f'PERP_{pair[:-len(quote)]}_{quote}'
+    return pair
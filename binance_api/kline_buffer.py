@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import time
+from typing import Optional, TypedDict
+
+from binance_api.api_types import BinanceKlineData
+from us.helpers import get_symbol
+from us.models import WsKline
+
+WS_KLINE_UNIQUE_FIELDS = ['symbol', 'start_timestamp', 'end_timestamp']
+WS_KLINE_VALUE_FIELDS = ['open', 'close', 'low', 'high', 'volume', 'amount']
+
+
+class BufferedKline(TypedDict):
+    symbol: str
+    start_timestamp: int
+    end_timestamp: int
+    open: str
+    close: str
+    low: str
+    high: str
+    volume: str
+    amount: str
+    closed: bool
+
+
+class KlineBuffer:
+    '''
+    Holds the current (open) kline for each symbol in memory and only writes it
+    to the db when the kline closes or when flush_interval seconds have passed
+    since the last write. Writes are a single INSERT ... ON CONFLICT DO UPDATE.
+    '''
+
+    _flush_interval: Optional[float]
+    _klines: dict[str, BufferedKline]
+    _dirty: set[str]
+    _last_flush: dict[str, float]
+    _symbols: dict
+
+    def __init__(self, flush_interval: Optional[float] = None):
+        self._flush_interval = flush_interval
+        self._klines = {}
+        self._dirty = set()
+        self._last_flush = {}
+        self._symbols = {}
+
+    def update(self, symbol_type: str, data: BinanceKlineData) -> bool:
+        kline = _convert_to_buffered_kline(symbol_type, data)
+        current = self._klines.get(symbol_type)
+
+        if current is not None and current['start_timestamp'] != kline['start_timestamp']:
+            if not current['closed']:
+                print('kline created before previous closed')
+            self.flush(symbol_type)
+
+        self._klines[symbol_type] = kline
+        self._dirty.add(symbol_type)
+
+        if kline['closed'] or self._is_flush_due(symbol_type):
+            self.flush(symbol_type)
+            return True
+
+        return False
+
+    def get_open_kline(self, symbol_type: str) -> Optional[BufferedKline]:
+        kline = self._klines.get(symbol_type)
+        if kline is None or kline['closed']:
+            return None
+        return kline
+
+    def get_latest_kline(self, symbol_type: str) -> Optional[BufferedKline]:
+        return self._klines.get(symbol_type)
+
+    def flush(self, symbol_type: Optional[str] = None):
+        symbol_types = [symbol_type] if symbol_type is not None else list(self._dirty)
+        klines = [self._klines[st] for st in symbol_types if st in self._dirty]
+
+        if len(klines) == 0:
+            return
+
+        self._persist(klines)
+
+        now = time.monotonic()
+        for st in symbol_types:
+            self._dirty.discard(st)
+            self._last_flush[st] = now
+
+    def _is_flush_due(self, symbol_type: str) -> bool:
+        if self._flush_interval is None:
+            return False
+        last_flush = self._last_flush.get(symbol_type)
+        if last_flush is None:
+            self._last_flush[symbol_type] = time.monotonic()
+            return False
+        return time.monotonic() - last_flush >= self._flush_interval
+
+    def _get_symbol(self, symbol_type: str):
+        symbol = self._symbols.get(symbol_type)
+        if symbol is None:
+            symbol = get_symbol(symbol_type)
+            self._symbols[symbol_type] = symbol
+        return symbol
+
+    def _persist(self, klines: list[BufferedKline]):
+        WsKline.objects.bulk_create(
+            [
+                WsKline(
+                    symbol=self._get_symbol(kline['symbol']),
+                    start_timestamp=kline['start_timestamp'],
+                    end_timestamp=kline['end_timestamp'],
+                    **{field: kline[field] for field in WS_KLINE_VALUE_FIELDS}
+                ) for kline in klines
+            ],
+            update_conflicts=True,
+            unique_fields=WS_KLINE_UNIQUE_FIELDS,
+            update_fields=WS_KLINE_VALUE_FIELDS,
+        )
+
+
+def _convert_to_buffered_kline(symbol_type: str, data: BinanceKlineData) -> BufferedKline:
+    return {
+        'symbol': symbol_type,
+        'start_timestamp': int(data['t'] / 1000),
+        'end_timestamp': int((data['T'] + 1) / 1000),
+        'open': data['o'],
+        'close': data['c'],
+        'low': data['l'],
+        'high': data['h'],
+        'volume': data['v'],
+        'amount': data['q'],
+        'closed': data['x'],
+    }
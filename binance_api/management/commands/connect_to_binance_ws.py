@@ -1,70 +1,66 @@
-from typing import TypedDict
-
 from django.core.management.base import BaseCommand, CommandError
 
-from binance_api.api_ws import MessageTypes
-from us.helpers import get_symbol
-from us.models import WsKline
-
+import environ
 
-class BinanceKlineData(TypedDict):
-    t: int # Kline start time in milliseconds
-    T: int # Kline close time in milliseconds
-    i: str # Interval
-    f: int # First trade ID
-    L: int # Last trade ID
-    o: str # Open price
-    c: str # Close price
-    h: str # High price
-    l: str # Low price
-    v: str # Base asset volume
-    n: int # Number of trades
-    x: bool # Is this kline closed?
-    q: str # Quote asset volume
-    V: str # Taker buy base asset volume
-    Q: str # Taker buy quote asset volume
-    B: str # Ignore
+from binance_api.api_types import BinanceKlineResponse
+from binance_api.helpers import get_symbol_type_for_pair
+from binance_api.kline_buffer import KlineBuffer
+from common.util.tape import TapeRecorder
 
+env = environ.Env()
+environ.Env.read_env()
 
-class BinanceKlineResponse(TypedDict):
-    e: str # Event type
-    E: int # Event time
-    ps: str # Pair i.e. "BTCUSDT"
-    ct: str # Contract type i.e. "PERPETUAL"
-    k: BinanceKlineData
+# seconds between writes of the open kline, unset means only write when the kline closes
+BINANCE_KLINE_FLUSH_INTERVAL = env.float('BINANCE_KLINE_FLUSH_INTERVAL', None)
+BINANCE_WS_PAIRS = env.list('BINANCE_WS_PAIRS', default=['BTCUSDT'])
+# directory to record the raw ws frames to, unset disables recording
+BINANCE_WS_TAPE_DIR = env('BINANCE_WS_TAPE_DIR', default=None)
 
 
 class Command(BaseCommand):
     help = 'Sync 1m kline data and connect to binance ws API'
-    kline_closed = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--flush-interval', type=float, default=BINANCE_KLINE_FLUSH_INTERVAL)
+        parser.add_argument('--pairs', nargs='+', default=BINANCE_WS_PAIRS)
+        parser.add_argument('--tape-dir', default=BINANCE_WS_TAPE_DIR)
+        # read the klines from a local run_feed_broker process instead of opening an exchange socket
+        parser.add_argument('--broker-socket', default=None)
 
     def handle(self, *args, **options):
         from binance_api.api_ws import BinanceWS
-        ws = BinanceWS(debug=False)
-        ws.register_message_callback(MessageTypes.CONTINUOUS_KLINE, self._process_msg)
-        ws.connect()
+        self.kline_buffer = KlineBuffer(flush_interval=options.get('flush_interval'))
 
-    def _process_msg(self, message: BinanceKlineResponse):
-        data = message['k']
-        start_timestamp = int(data['t'] / 1000)
-        end_timestamp = int((data['T'] + 1 )/ 1000)
-        symbol = get_symbol('PERP_BTC_USDT')
+        if options.get('broker_socket'):
+            self._consume_from_broker(options['broker_socket'], options.get('pairs'))
+            return
 
-        kline, created = WsKline.objects.update_or_create(
-            symbol=symbol,
-            start_timestamp=start_timestamp,
-            end_timestamp=end_timestamp,
-            defaults={
-                'open': data['o'],
-                'close': data['c'],
-                'low': data['l'],
-                'high': data['h'],
-                'volume': data['v'],
-                'amount': data['q'],
-            }
-        )
+        tape_dir = options.get('tape_dir')
+        recorder = TapeRecorder(tape_dir, 'binance') if tape_dir else None
+        ws = BinanceWS(debug=False, recorder=recorder)
+        for pair in options.get('pairs'):
+            ws.subscribe_to_continuous_kline(pair, '1m', self._process_msg)
+        try:
+            ws.connect()
+        finally:
+            self.kline_buffer.flush()
+            if recorder is not None:
+                recorder.close()
 
-        if created and not self.kline_closed:
-            print('kline created before previous closed')
+    def _consume_from_broker(self, socket_path: str, pairs: list[str]):
+        from binance_api.api_ws import MessageTypes, get_stream_name
+        from common.util.feed_broker import FeedSubscriber
+        subscriber = FeedSubscriber(socket_path)
+        for pair in pairs:
+            stream = get_stream_name(MessageTypes.CONTINUOUS_KLINE_STREAM, [('pair', pair), ('interval', '1m')])
+            subscriber.subscribe(
+                f'binance:{stream}',
+                lambda topic, message: self._process_msg(message)
+            )
+        try:
+            subscriber.run()
+        finally:
+            self.kline_buffer.flush()
 
-        self.kline_closed = data['x']
\ No newline at end of file
+    def _process_msg(self, message: BinanceKlineResponse):
+        self.kline_buffer.update(get_symbol_type_for_pair(message['ps']), message['k'])
@@ -0,0 +1,95 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import environ
+
+from binance_api.api_types import BinanceKlineResponse
+from binance_api.helpers import get_symbol_type_for_pair
+from common.util.feed_broker import FeedBroker
+from common.util.market_data_shm import MarketDataWriter
+
+env = environ.Env()
+environ.Env.read_env()
+
+FEED_BROKER_SOCKET = env('FEED_BROKER_SOCKET', default='/tmp/trader-feed.sock')
+FEED_BROKER_MAX_PENDING_BYTES = env.int('FEED_BROKER_MAX_PENDING_BYTES', 4 * 1024 * 1024)
+BINANCE_WS_PAIRS = env.list('BINANCE_WS_PAIRS', default=['BTCUSDT'])
+WOO_WS_DEBUG = env.bool('WOO_WS_DEBUG', False)
+# also publish the latest candles and top of book for the binance pairs to shared memory
+FEED_BROKER_SHM = env.bool('FEED_BROKER_SHM', False)
+
+
+class Command(BaseCommand):
+    help = 'Hold the upstream woo and binance market data ws connections and fan the events out to local subscribers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=FEED_BROKER_SOCKET)
+        parser.add_argument('--binance-pairs', nargs='*', default=BINANCE_WS_PAIRS)
+        parser.add_argument('--no-woo', action='store_true')
+        parser.add_argument('--shm', action='store_true', default=FEED_BROKER_SHM)
+
+    def handle(self, *args, **options):
+        import rel
+        from binance_api.api_ws import BinanceWS, MessageTypes as BinanceMessageTypes, get_stream_name
+        from woo.api_rest import WOO_APP_ID, WOO_KEY
+        from woo.api_ws import WooWSClient, MessageTypes as WooMessageTypes
+
+        self.broker = FeedBroker(options['socket'], max_pending_bytes=FEED_BROKER_MAX_PENDING_BYTES)
+        self.broker.start()
+        self.shm_writers: dict[str, MarketDataWriter] = {}
+
+        try:
+            pairs = options.get('binance_pairs') or []
+            if len(pairs) > 0:
+                binance_ws = BinanceWS()
+                for pair in pairs:
+                    stream = get_stream_name(BinanceMessageTypes.CONTINUOUS_KLINE_STREAM, [('pair', pair), ('interval', '1m')])
+                    binance_ws.subscribe_to_continuous_kline(pair, '1m', self.broker.publisher(f'binance:{stream}'))
+                    if options.get('shm'):
+                        self._add_shm_writer(binance_ws, pair)
+                binance_ws.connect(dispatch=False)
+
+            if not options.get('no_woo'):
+                woo_ws = WooWSClient(
+                    app_id=WOO_APP_ID,
+                    app_key=WOO_KEY,
+                    debug=WOO_WS_DEBUG,
+                    connect_callback=lambda: woo_ws.subscribe_to_1m_kline(
+                        self.broker.publisher(f'woo:{WooMessageTypes.KLINE_1M.value}')
+                    )
+                )
+                woo_ws.connect(dispatch=False)
+
+            rel.signal(2, rel.abort)
+            rel.dispatch()
+        except CommandError as e:
+            print(e)
+        finally:
+            print(f'feed broker stats: {self.broker.stats()}')
+            self.broker.stop()
+            for writer in self.shm_writers.values():
+                writer.close(unlink=True)
+
+    def _add_shm_writer(self, binance_ws, pair: str):
+        writer = MarketDataWriter(get_symbol_type_for_pair(pair))
+        self.shm_writers[pair] = writer
+        binance_ws.subscribe_to_continuous_kline(pair, '1m', lambda message: self._write_kline(writer, message))
+        binance_ws.subscribe_to_book_ticker(
+            pair,
+            lambda message: writer.write_top_of_book(message['b'], message['B'], message['a'], message['A'])
+        )
+
+    def _write_kline(self, writer: MarketDataWriter, message: BinanceKlineResponse):
+        data = message['k']
+        candle = {
+            'start_timestamp': data['t'],
+            'open': data['o'],
+            'high': data['h'],
+            'low': data['l'],
+            'close': data['c'],
+            'volume': data['v'],
+            'amount': data['q'],
+        }
+        if data['x']:
+            writer.write_closed_candle(candle)
+        else:
+            writer.write_open_candle(candle)
@@ -1,3 +1,219 @@
+import json
+from unittest.mock import patch, MagicMock
+
 from django.test import TestCase
 
-# Create your tests here.
+from binance_api.api_rest import get_page_ranges, merge_kline_pages, request_historical_klines, \
+    request_historical_klines_range, iter_historical_klines_range, RequestWeightLimiter
+from binance_api.api_ws import BinanceWS
+from binance_api.helpers import get_pair_for_symbol_type, get_symbol_type_for_pair
+from binance_api.kline_buffer import KlineBuffer
+
+
+def get_mock_kline_data(start: int = 1700000000000, close: str = '100.0', closed: bool = False) -> dict:
+    return {
+        't': start,
+        'T': start + 59999,
+        'i': '1m',
+        'o': '99.0',
+        'c': close,
+        'h': '101.0',
+        'l': '98.0',
+        'v': '10.0',
+        'q': '1000.0',
+        'x': closed,
+    }
+
+
+class KlineBufferTests(TestCase):
+
+    def setUp(self):
+        self.patcher = patch.object(KlineBuffer, '_persist')
+        self.mock_persist = self.patcher.start()
+        self.addCleanup(self.patcher.stop)
+
+    def test_update__when_kline_is_open(self):
+        buffer = KlineBuffer()
+        self.assertFalse(buffer.update('PERP_BTC_USDT', get_mock_kline_data(close='100.0')))
+        self.assertFalse(buffer.update('PERP_BTC_USDT', get_mock_kline_data(close='100.5')))
+        self.assertEqual(self.mock_persist.call_count, 0)
+        kline = buffer.get_open_kline('PERP_BTC_USDT')
+        self.assertEqual(kline['close'], '100.5')
+        self.assertEqual(kline['start_timestamp'], 1700000000)
+        self.assertEqual(kline['end_timestamp'], 1700000060)
+
+    def test_update__when_kline_closes(self):
+        buffer = KlineBuffer()
+        buffer.update('PERP_BTC_USDT', get_mock_kline_data())
+        self.assertTrue(buffer.update('PERP_BTC_USDT', get_mock_kline_data(close='101.0', closed=True)))
+        self.assertEqual(self.mock_persist.call_count, 1)
+        self.assertEqual(self.mock_persist.call_args[0][0][0]['close'], '101.0')
+        self.assertIsNone(buffer.get_open_kline('PERP_BTC_USDT'))
+        self.assertEqual(buffer.get_latest_kline('PERP_BTC_USDT')['close'], '101.0')
+
+    def test_update__when_new_kline_starts_before_previous_closed(self):
+        buffer = KlineBuffer()
+        buffer.update('PERP_BTC_USDT', get_mock_kline_data())
+        buffer.update('PERP_BTC_USDT', get_mock_kline_data(start=1700000060000))
+        self.assertEqual(self.mock_persist.call_count, 1)
+        self.assertEqual(self.mock_persist.call_args[0][0][0]['start_timestamp'], 1700000000)
+
+    def test_update__when_flush_interval_has_passed(self):
+        buffer = KlineBuffer(flush_interval=5)
+        with patch('binance_api.kline_buffer.time.monotonic', side_effect=[0, 2, 6, 6]):
+            self.assertFalse(buffer.update('PERP_BTC_USDT', get_mock_kline_data()))
+            self.assertFalse(buffer.update('PERP_BTC_USDT', get_mock_kline_data()))
+            self.assertTrue(buffer.update('PERP_BTC_USDT', get_mock_kline_data()))
+        self.assertEqual(self.mock_persist.call_count, 1)
+
+    def test_flush__when_nothing_has_changed(self):
+        buffer = KlineBuffer()
+        buffer.update('PERP_BTC_USDT', get_mock_kline_data(closed=True))
+        buffer.flush()
+        self.assertEqual(self.mock_persist.call_count, 1)
+
+
+def get_mock_kline_row(open_time: int) -> list:
+    return [open_time, '1.0', '2.0', '0.5', '1.5', '10.0', open_time + 59999, '15.0', 10, '5.0', '7.5', '0']
+
+
+class HistoricalKlinesRangeTests(TestCase):
+
+    def test_get_page_ranges__when_range_spans_multiple_pages(self):
+        pages = get_page_ranges(30000, 60000 * 2500, 60000, 1500)
+        self.assertEqual(pages, [(0, 60000 * 1500), (60000 * 1500, 60000 * 2500)])
+
+    def test_get_page_ranges__when_range_is_empty(self):
+        self.assertEqual(get_page_ranges(60000, 60000, 60000, 1500), [])
+
+    def test_merge_kline_pages__when_pages_overlap_and_are_out_of_order(self):
+        rows = merge_kline_pages([
+            [get_mock_kline_row(120000), get_mock_kline_row(180000)],
+            [get_mock_kline_row(0), get_mock_kline_row(60000), get_mock_kline_row(120000)],
+        ])
+        self.assertEqual([row[0] for row in rows], [0, 60000, 120000, 180000])
+
+    @patch('binance_api.api_rest._request_klines_page')
+    def test_request_historical_klines_range(self, mock_request_page):
+        mock_request_page.side_effect = lambda symbol_type, interval, start_ms, end_ms, limit: [
+            get_mock_kline_row(open_time) for open_time in range(start_ms, end_ms + 1, 60000)
+        ]
+        rows, meta = request_historical_klines_range('PERP_BTC_USDT', 0, 2000 * 60, limiter=RequestWeightLimiter(10000))
+        self.assertEqual(mock_request_page.call_count, 2)
+        self.assertEqual(len(rows), 2000)
+        self.assertEqual(rows[0]['start_timestamp'], 0)
+        self.assertEqual(rows[-1]['start_timestamp'], 1999 * 60000)
+        self.assertEqual(rows[0]['symbol'], 'PERP_BTC_USDT')
+        self.assertEqual(meta, {'total': 2000, 'records_per_page': 1500, 'current_page': 2})
+
+    @patch('binance_api.api_rest._request_klines_page')
+    def test_request_historical_klines__when_the_range_has_more_klines_than_the_page(self, mock_request_page):
+        mock_request_page.return_value = [get_mock_kline_row(open_time) for open_time in range(0, 500 * 60000, 60000)]
+        rows, meta = request_historical_klines('PERP_BTC_USDT', 0, end_time=1999 * 60)
+        self.assertEqual(len(rows), 500)
+        self.assertEqual(meta, {'total': 2000, 'records_per_page': 500, 'current_page': 1})
+
+    @patch('binance_api.api_rest._request_klines_page')
+    def test_request_historical_klines_range__when_a_page_fails(self, mock_request_page):
+        mock_request_page.side_effect = [[get_mock_kline_row(0)], None]
+        self.assertEqual(
+            request_historical_klines_range('PERP_BTC_USDT', 0, 2000 * 60, max_workers=1, limiter=RequestWeightLimiter(10000)),
+            (None, None)
+        )
+
+    @patch('binance_api.api_rest._request_klines_page')
+    def test_iter_historical_klines_range__requests_a_window_of_pages_at_a_time(self, mock_request_page):
+        mock_request_page.side_effect = lambda symbol_type, interval, start_ms, end_ms, limit: [
+            get_mock_kline_row(open_time) for open_time in range(start_ms, end_ms + 1, 60000)
+        ]
+        pages = iter_historical_klines_range(
+            'PERP_BTC_USDT', 0, 1500 * 4 * 60, max_workers=2, limiter=RequestWeightLimiter(10000)
+        )
+        first_page = next(pages)
+        self.assertLessEqual(mock_request_page.call_count, 2)
+        self.assertEqual(len(first_page), 1500)
+
+        remaining_pages = list(pages)
+        self.assertEqual(mock_request_page.call_count, 4)
+        self.assertEqual([len(page) for page in remaining_pages], [1500, 1500, 1500])
+        self.assertEqual(remaining_pages[-1][-1]['start_timestamp'], (1500 * 4 - 1) * 60000)
+
+    @patch('binance_api.api_rest._request_klines_page')
+    def test_iter_historical_klines_range__when_a_page_fails__ends_the_stream(self, mock_request_page):
+        mock_request_page.side_effect = [[get_mock_kline_row(0)], None, [get_mock_kline_row(1500 * 2 * 60000)]]
+        pages = list(iter_historical_klines_range(
+            'PERP_BTC_USDT', 0, 1500 * 3 * 60, max_workers=1, limiter=RequestWeightLimiter(10000)
+        ))
+        self.assertEqual(len(pages), 2)
+        self.assertIsNone(pages[-1])
+        self.assertEqual(mock_request_page.call_count, 2)
+
+
+class BinanceWSTests(TestCase):
+
+    def test_subscribe__before_connecting(self):
+        ws = BinanceWS()
+        ws.subscribe_to_continuous_kline('BTCUSDT', '1m', lambda data: data)
+        ws.subscribe_to_continuous_kline('ETHUSDT', '5m', lambda data: data)
+        self.assertEqual(ws.streams, ['btcusdt_perpetual@continuousKline_1m', 'ethusdt_perpetual@continuousKline_5m'])
+
+    def test_subscribe__when_connected(self):
+        ws = BinanceWS()
+        ws._ws = MagicMock()
+        ws._on_open(ws._ws)
+        ws.subscribe_to_continuous_kline('BTCUSDT', '1m', lambda data: data)
+        request = json.loads(ws._ws.send.call_args[0][0])
+        self.assertEqual(request['method'], 'SUBSCRIBE')
+        self.assertEqual(request['params'], ['btcusdt_perpetual@continuousKline_1m'])
+
+    def test_on_open__when_reconnecting__subscribes_only_the_current_streams(self):
+        ws = BinanceWS()
+        ws._ws = MagicMock()
+        ws.subscribe_to_book_ticker('BTCUSDT', MagicMock())
+        ws.subscribe_to_book_ticker('ETHUSDT', MagicMock())
+        ws._on_open(ws._ws)
+        ws.unsubscribe_from_book_ticker('ETHUSDT')
+        ws._on_close(ws._ws, None, None)
+        ws._ws.send.reset_mock()
+
+        ws._on_open(ws._ws)
+
+        request = json.loads(ws._ws.send.call_args[0][0])
+        self.assertEqual(request['method'], 'SUBSCRIBE')
+        self.assertEqual(request['params'], ['btcusdt@bookTicker'])
+
+    def test_unsubscribe__when_stream_has_other_handlers(self):
+        ws = BinanceWS()
+        ws._ws = MagicMock()
+        ws._on_open(ws._ws)
+        handler1 = MagicMock()
+        handler2 = MagicMock()
+        ws.subscribe_to_book_ticker('BTCUSDT', handler1)
+        ws.subscribe_to_book_ticker('BTCUSDT', handler2)
+        ws.unsubscribe_from_book_ticker('BTCUSDT', handler1)
+        self.assertEqual(ws.streams, ['btcusdt@bookTicker'])
+        ws.unsubscribe_from_book_ticker('BTCUSDT', handler2)
+        self.assertEqual(ws.streams, [])
+        self.assertEqual(json.loads(ws._ws.send.call_args[0][0])['method'], 'UNSUBSCRIBE')
+
+    def test_on_message__routes_by_stream_name(self):
+        ws = BinanceWS()
+        btc_handler = MagicMock()
+        eth_handler = MagicMock()
+        ws.subscribe_to_continuous_kline('BTCUSDT', '1m', btc_handler)
+        ws.subscribe_to_continuous_kline('ETHUSDT', '1m', eth_handler)
+        data = {'e': 'continuous_kline', 'ps': 'ETHUSDT', 'k': get_mock_kline_data()}
+        ws._on_message(None, json.dumps({'stream': 'ethusdt_perpetual@continuousKline_1m', 'data': data}, separators=(',', ':')))
+        btc_handler.assert_not_called()
+        eth_handler.assert_called_once_with(data)
+
+    @patch('binance_api.api_ws.json.loads')
+    def test_on_message__does_not_decode_unsubscribed_streams(self, mock_loads):
+        ws = BinanceWS()
+        ws.subscribe_to_continuous_kline('BTCUSDT', '1m', MagicMock())
+        ws._on_message(None, '{"stream":"ethusdt_perpetual@continuousKline_1m","data":{}}')
+        mock_loads.assert_not_called()
+
+    def test_symbol_type_pair_conversion(self):
+        self.assertEqual(get_pair_for_symbol_type('PERP_BTC_USDT'), 'BTCUSDT')
+        self.assertEqual(get_symbol_type_for_pair('ETHUSDT'), 'PERP_ETH_USDT')
@@ -0,0 +1,130 @@
+import threading
+import time
+
+from django.db import connection
+from django.test import TestCase
+
+from common.util.advisory_locks import AdvisoryLocks, LocalLocks, acquire_locks, get_current_lock_scope, \
+    get_lock_stats, lock_scope, reset_lock_stats
+
+KEY = ('order_group', 1)
+OTHER_KEY = ('order_group', 2)
+
+
+class LocalLocksTests(TestCase):
+
+    def setUp(self):
+        self.locks = LocalLocks()
+
+    def try_from_thread(self, key, shared: bool = False) -> bool:
+        results = []
+
+        def try_acquire():
+            results.append(self.locks.try_acquire(key, shared))
+            if results[0]:
+                self.locks.release(key, shared)
+
+        thread = threading.Thread(target=try_acquire)
+        thread.start()
+        thread.join()
+        return results[0]
+
+    def test_try_acquire__when_another_thread_holds_the_key__fails(self):
+        self.locks.acquire(KEY)
+        self.assertFalse(self.try_from_thread(KEY))
+        self.assertFalse(self.try_from_thread(KEY, shared=True))
+        self.assertTrue(self.try_from_thread(OTHER_KEY))
+        self.locks.release(KEY)
+        self.assertTrue(self.try_from_thread(KEY))
+
+    def test_try_acquire__when_the_key_is_held_shared__only_fails_exclusive(self):
+        self.locks.acquire(KEY, shared=True)
+        self.assertTrue(self.try_from_thread(KEY, shared=True))
+        self.assertFalse(self.try_from_thread(KEY))
+
+    def test_acquire__when_the_thread_holds_the_key__takes_it_again(self):
+        self.locks.acquire(KEY, shared=True)
+        self.locks.acquire(KEY)
+        self.locks.acquire(KEY)
+        self.locks.release(KEY)
+        self.assertFalse(self.try_from_thread(KEY, shared=True))
+        self.locks.release(KEY)
+        self.assertTrue(self.try_from_thread(KEY, shared=True))
+        self.assertFalse(self.try_from_thread(KEY))
+        self.locks.release(KEY, shared=True)
+        self.assertTrue(self.try_from_thread(KEY))
+
+    def test_release__when_the_key_is_not_held__raises(self):
+        with self.assertRaises(Exception):
+            self.locks.release(KEY)
+
+
+class LockScopeTests(TestCase):
+
+    def setUp(self):
+        reset_lock_stats()
+
+    def run_in_scopes(self, keys: list) -> list[tuple[str, str, float]]:
+        '''
+        Runs a scope per key on its own thread, each holding its key for a moment, and returns
+        the enter and exit events in the order they happened.
+        '''
+        events = []
+        events_lock = threading.Lock()
+        start = threading.Barrier(len(keys))
+
+        def work(index, key):
+            start.wait()
+            with lock_scope(exclusive=[key]):
+                with events_lock:
+                    events.append(('enter', index))
+                time.sleep(0.05)
+                with events_lock:
+                    events.append(('exit', index))
+
+        threads = [threading.Thread(target=work, args=(index, key)) for index, key in enumerate(keys)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return events
+
+    def test_lock_scope__serializes_scopes_on_the_same_key(self):
+        events = self.run_in_scopes([KEY, KEY])
+        self.assertEqual([event[0] for event in events], ['enter', 'exit', 'enter', 'exit'])
+        stats = get_lock_stats()['order_group']
+        self.assertEqual((stats.acquisitions, stats.contended), (2, 1))
+        self.assertGreater(stats.max_wait_seconds, 0)
+
+    def test_lock_scope__runs_scopes_on_different_keys_together(self):
+        events = self.run_in_scopes([KEY, OTHER_KEY])
+        self.assertEqual([event[0] for event in events], ['enter', 'enter', 'exit', 'exit'])
+        self.assertEqual(get_lock_stats()['order_group'].contended, 0)
+
+    def test_lock_scope__holds_nested_keys_until_the_outer_scope_exits(self):
+        with lock_scope(exclusive=[KEY]) as scope:
+            with lock_scope(shared=[('account', 0)]):
+                acquire_locks([OTHER_KEY])
+            self.assertIs(get_current_lock_scope(), scope)
+            self.assertEqual(scope.held, [(KEY, False), (('account', 0), True), (OTHER_KEY, False)])
+        self.assertIsNone(get_current_lock_scope())
+        self.assertEqual(scope.held, [])
+
+    def test_acquire_locks__when_no_scope_is_active__raises(self):
+        with self.assertRaises(Exception):
+            acquire_locks([KEY])
+
+
+class AdvisoryLocksTests(TestCase):
+
+    def test_advisory_locks__take_and_release_the_key(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('advisory locks are postgres only')
+        locks = AdvisoryLocks()
+        self.assertTrue(locks.try_acquire(KEY))
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid()")
+            self.assertEqual(cursor.fetchone()[0], 1)
+        locks.release(KEY)
+        locks.acquire(KEY, shared=True)
+        locks.release(KEY, shared=True)
@@ -1,5 +1,53 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
+from common.util.cls import benchmark_map_data_to_class, compile_field_mapper, map_data_to_class, \
+    map_dict_to_class_attributes, _map_data_to_class_reflectively
 
-class TestCLSUtils(TestCase):
-    pass
+
+class Target:
+    status = None
+    create_time = None
+    trigger_time = None
+    trigger_price = None
+
+
+def value_converter(key, value):
+    if key == 'trigger_time':
+        return value / 1000
+    return value
+
+
+DATA = {'algoStatus': 'NEW', 'createdTime': 1, 'triggerTime': 2000, 'triggerPrice': '1.5', 'unknownKey': 3}
+KEY_MAP = {'algoStatus': 'status', 'createdTime': 'create_time'}
+
+
+class TestCLSUtils(SimpleTestCase):
+
+    def test_map_data_to_class__matches_the_reflective_mapping(self):
+        for key_map, converter in [(None, None), (KEY_MAP, None), (KEY_MAP, value_converter)]:
+            self.assertEqual(
+                map_data_to_class(Target, DATA, key_map, converter),
+                _map_data_to_class_reflectively(Target, DATA, key_map, converter)
+            )
+
+    def test_map_data_to_class__when_called_again__reuses_the_compiled_mapper(self):
+        map_data_to_class(Target, DATA, KEY_MAP, value_converter)
+        map_data_to_class(Target, DATA, dict(KEY_MAP), value_converter)
+        self.assertEqual(
+            map_data_to_class(Target, {'algoStatus': 'FILLED'}, KEY_MAP, value_converter),
+            {'status': 'FILLED'}
+        )
+
+    def test_map_dict_to_class_attributes__with_the_default_key_converter(self):
+        self.assertEqual(map_dict_to_class_attributes(Target, {'status': 'NEW', 'algoStatus': 'x'}), {'status': 'NEW'})
+
+    def test_compile_field_mapper__applies_field_converters(self):
+        mapper = compile_field_mapper(Target, KEY_MAP, {'trigger_price': float, 'trigger_time': lambda v: v / 1000})
+        self.assertEqual(
+            mapper(DATA),
+            {'status': 'NEW', 'create_time': 1, 'trigger_time': 2, 'trigger_price': 1.5}
+        )
+
+    def test_benchmark_map_data_to_class(self):
+        results = benchmark_map_data_to_class(Target, DATA, KEY_MAP, value_converter, iterations=10)
+        self.assertEqual(set(results), {'reflective', 'compiled'})
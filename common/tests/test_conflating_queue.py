@@ -0,0 +1,59 @@
+import threading
+
+from django.test import TestCase
+
+from common.util.conflating_queue import ConflatingHandler
+
+
+class TestConflatingHandler(TestCase):
+
+    def setUp(self):
+        self.received = []
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def blocking_handler(self, item):
+        self.started.set()
+        self.release.wait(5)
+        self.received.append(item)
+
+    def test_put__when_handler_is_busy__keeps_only_the_newest_item(self):
+        handler = ConflatingHandler(self.blocking_handler)
+        handler.put(1)
+        self.started.wait(5)
+        for i in range(2, 6):
+            handler.put(i)
+        self.release.set()
+        handler.stop(drain=True)
+
+        self.assertEqual(self.received, [1, 5])
+        self.assertEqual(handler.stats.received, 5)
+        self.assertEqual(handler.stats.conflated, 3)
+        self.assertEqual(handler.stats.delivered, 2)
+
+    def test_put__when_keys_differ__delivers_each_key_in_order(self):
+        handler = ConflatingHandler(self.blocking_handler, key=lambda item: item['key'])
+        handler.put({'key': 0, 'value': 0})
+        self.started.wait(5)
+        handler.put({'key': 1, 'value': 1})
+        handler.put({'key': 2, 'value': 2})
+        handler.put({'key': 1, 'value': 3})
+        self.release.set()
+        handler.stop(drain=True)
+
+        self.assertEqual([item['value'] for item in self.received], [0, 3, 2])
+        self.assertEqual(handler.stats.conflated, 1)
+
+    def test_handler__when_it_raises__keeps_running(self):
+        def handler_fn(item):
+            if item == 1:
+                raise ValueError('bad item')
+            self.received.append(item)
+
+        handler = ConflatingHandler(handler_fn, key=lambda item: item)
+        handler.put(1)
+        handler.put(2)
+        handler.stop(drain=True)
+
+        self.assertEqual(self.received, [2])
+        self.assertEqual(handler.stats.delivered, 2)
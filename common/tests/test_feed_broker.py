@@ -0,0 +1,68 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from django.test import TestCase
+
+from common.util.feed_broker import FeedBroker, FeedSubscriber
+
+
+def wait_for(condition, timeout: float = 2.0):
+    started = time.monotonic()
+    while not condition():
+        if time.monotonic() - started > timeout:
+            raise AssertionError('condition not met')
+        time.sleep(0.01)
+
+
+class TestFeedBroker(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.socket_path = os.path.join(self.tmp_dir.name, 'feed.sock')
+        self.broker = FeedBroker(self.socket_path, max_pending_bytes=64 * 1024)
+        self.broker.start()
+        self.addCleanup(self.broker.stop)
+
+    def start_subscriber(self, topic: str) -> list:
+        received = []
+        subscriber = FeedSubscriber(self.socket_path)
+        subscriber.subscribe(topic, lambda t, data: received.append((t, data)))
+        thread = threading.Thread(target=subscriber.run, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(subscriber.stop)
+        return received
+
+    def test_publish__only_to_matching_subscribers(self):
+        binance = self.start_subscriber('binance:*')
+        woo = self.start_subscriber('woo:PERP_BTC_USDT@kline_1m')
+        wait_for(lambda: self.broker.subscriber_count == 2)
+        time.sleep(0.1)
+
+        self.broker.publish('binance:btcusdt_perpetual@continuousKline_1m', {'c': '1'})
+        self.broker.publish('woo:PERP_BTC_USDT@kline_1m', {'close': 2})
+        self.broker.publish('woo:PERP_ETH_USDT@kline_1m', {'close': 3})
+
+        wait_for(lambda: len(binance) == 1 and len(woo) == 1)
+        time.sleep(0.1)
+        self.assertEqual(binance, [('binance:btcusdt_perpetual@continuousKline_1m', {'c': '1'})])
+        self.assertEqual(woo, [('woo:PERP_BTC_USDT@kline_1m', {'close': 2})])
+
+    def test_publish__disconnects_slow_consumer(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        sock.connect(self.socket_path)
+        sock.sendall(b'{"event": "subscribe", "topics": ["*"]}\n')
+        wait_for(lambda: self.broker.subscriber_count == 1)
+        time.sleep(0.1)
+
+        # the socket is never read so its buffers fill up and the broker has to drop it
+        for i in range(5000):
+            self.broker.publish('binance:test', {'i': i, 'padding': 'x' * 200})
+
+        wait_for(lambda: self.broker.subscriber_count == 0)
+        self.assertEqual(self.broker.stats()['slow_consumer_disconnects'], 1)
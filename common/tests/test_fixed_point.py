@@ -0,0 +1,35 @@
+from decimal import Decimal
+
+from django.test import SimpleTestCase
+
+from common.util.fixed_point import lots_to_decimal, lots_to_float, ms_to_seconds, seconds_to_ms, ticks_to_decimal, \
+    ticks_to_float, to_lots, to_ticks
+
+
+class FixedPointTests(SimpleTestCase):
+
+    def test_to_ticks__converts_floats_strings_and_decimals_exactly(self):
+        self.assertEqual(to_ticks(0.1), 1000)
+        self.assertEqual(to_ticks('91.25'), 912500)
+        self.assertEqual(to_ticks(Decimal('91.2500')), 912500)
+        self.assertEqual(to_ticks(91), 910000)
+        self.assertIsNone(to_ticks(None))
+
+    def test_to_lots__sums_without_float_drift(self):
+        self.assertNotEqual(0.1 + 0.2, 0.3)
+        self.assertEqual(to_lots(0.1) + to_lots(0.2), to_lots(0.3))
+        self.assertEqual(lots_to_float(to_lots(0.1) + to_lots(0.2)), 0.3)
+
+    def test_seconds_to_ms__round_trips_a_trigger_time(self):
+        self.assertEqual(seconds_to_ms(1699477397.398), 1699477397398)
+        self.assertEqual(ms_to_seconds(1699477397398), Decimal('1699477397.398'))
+
+    def test_seconds_to_ms__rounds_halves_away_from_zero_like_sql_round(self):
+        self.assertEqual(seconds_to_ms(Decimal('1699477397.3985')), 1699477397399)
+        self.assertEqual(seconds_to_ms(Decimal('1699477397.3975')), 1699477397398)
+        self.assertEqual(seconds_to_ms(Decimal('-0.0025')), -3)
+
+    def test_back_to_decimal_and_float(self):
+        self.assertEqual(ticks_to_decimal(912500), Decimal('91.25'))
+        self.assertEqual(lots_to_decimal(1000), Decimal('0.1'))
+        self.assertEqual(str(ticks_to_float(to_ticks(100) - to_ticks(9))), '91.0')
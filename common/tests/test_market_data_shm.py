@@ -0,0 +1,89 @@
+import uuid
+
+from django.test import TestCase
+
+from common.util.market_data_shm import (
+    MarketDataReader, MarketDataWriter, SeqlockReadError, COUNTER, SEQ_OFFSET, benchmark_read_latency
+)
+
+
+def make_candle(start_timestamp: int, close: float = 100.0):
+    return {
+        'start_timestamp': start_timestamp,
+        'open': close - 1,
+        'high': close + 1,
+        'low': close - 2,
+        'close': close,
+        'volume': 10.0,
+        'amount': 1000.0,
+    }
+
+
+class TestMarketDataShm(TestCase):
+
+    def setUp(self):
+        self.symbol_type = f'TEST_{uuid.uuid4().hex[:8]}'
+        self.writer = MarketDataWriter(self.symbol_type, capacity=5)
+        self.addCleanup(self.writer.close, True)
+        self.reader = MarketDataReader(self.symbol_type)
+        self.addCleanup(self.reader.close)
+
+    def test_empty_segment(self):
+        self.assertIsNone(self.reader.open_candle())
+        self.assertIsNone(self.reader.top_of_book())
+        self.assertIsNone(self.reader.latest_price())
+        self.assertEqual(self.reader.closed_candles(), [])
+
+    def test_open_candle(self):
+        self.writer.write_open_candle(make_candle(60000, 101.5))
+        self.assertEqual(self.reader.open_candle(), make_candle(60000, 101.5))
+        self.assertEqual(self.reader.latest_price(), 101.5)
+
+    def test_closed_candles__are_returned_oldest_first(self):
+        for i in range(3):
+            self.writer.write_closed_candle(make_candle((i + 1) * 60000, 100 + i))
+        self.assertEqual([c['start_timestamp'] for c in self.reader.closed_candles()], [60000, 120000, 180000])
+        self.assertEqual([c['start_timestamp'] for c in self.reader.closed_candles(2)], [120000, 180000])
+
+    def test_closed_candles__when_ring_wraps(self):
+        for i in range(8):
+            self.writer.write_closed_candle(make_candle((i + 1) * 60000, 100 + i))
+        candles = self.reader.closed_candles()
+        self.assertEqual(len(candles), 5)
+        self.assertEqual([c['close'] for c in candles], [103, 104, 105, 106, 107])
+
+    def test_closed_candle__when_closed_twice__overwrites(self):
+        self.writer.write_closed_candle(make_candle(60000, 100))
+        self.writer.write_closed_candle(make_candle(60000, 101))
+        candles = self.reader.closed_candles()
+        self.assertEqual(len(candles), 1)
+        self.assertEqual(candles[0]['close'], 101)
+
+    def test_closed_candle__clears_open_candle(self):
+        self.writer.write_open_candle(make_candle(60000, 100))
+        self.writer.write_closed_candle(make_candle(60000, 102))
+        self.assertIsNone(self.reader.open_candle())
+        self.assertEqual(self.reader.latest_price(), 102)
+
+    def test_top_of_book(self):
+        self.writer.write_top_of_book('100.1', '2', '100.2', '3')
+        book = self.reader.top_of_book()
+        self.assertEqual((book['bid'], book['bid_size'], book['ask'], book['ask_size']), (100.1, 2, 100.2, 3))
+        self.assertGreater(book['updated_at'], 0)
+
+    def test_read__when_writer_is_mid_update__raises(self):
+        COUNTER.pack_into(self.writer._buf, SEQ_OFFSET, self.writer._seq + 1)
+        with self.assertRaises(SeqlockReadError):
+            self.reader.open_candle()
+
+    def test_writer__when_segment_exists__keeps_candles(self):
+        self.writer.write_closed_candle(make_candle(60000, 100))
+        writer = MarketDataWriter(self.symbol_type, capacity=5)
+        writer.write_closed_candle(make_candle(120000, 101))
+        self.assertEqual([c['close'] for c in self.reader.closed_candles()], [100, 101])
+        writer.close()
+
+    def test_benchmark_read_latency(self):
+        self.writer.write_closed_candle(make_candle(60000, 100))
+        results = benchmark_read_latency(self.symbol_type, iterations=10)
+        self.assertEqual(set(results), {'latest_price', 'open_candle', 'top_of_book', 'closed_candles_60'})
@@ -0,0 +1,172 @@
+import multiprocessing
+import os
+import queue
+import time
+
+from django.test import TestCase
+
+from common.util.partitions import PartitionHandler, PartitionedWorkers, assign_partitions, get_partition
+
+PARTITION_COUNT = 16
+
+
+class RecordingHandler(PartitionHandler):
+
+    def __init__(self, records):
+        self.records = records
+        self.state: dict[int, list] = {}
+
+    def assign(self, partition: int):
+        self.state[partition] = []
+        self.records.put(('assign', os.getpid(), partition))
+
+    def release(self, partition: int):
+        self.records.put(('release', os.getpid(), partition, len(self.state.pop(partition))))
+
+    def handle(self, partition: int, event):
+        if partition not in self.state:
+            raise Exception(f'partition {partition} is not owned here')
+        self.state[partition].append(event)
+        if event.get('broadcast'):
+            self.broadcast({'key': event['key'], 'seq': event['seq'], 'forwarded': True}, partition)
+        if event.get('submit_to') is not None:
+            self.submit(event['submit_to'], {'key': event['submit_to'], 'seq': event['seq'], 'forwarded': True})
+        self.records.put(('event', os.getpid(), partition, event))
+
+
+class PartitionTests(TestCase):
+
+    def test_get_partition__is_stable_for_a_key(self):
+        self.assertEqual(get_partition(42, PARTITION_COUNT), get_partition(42, PARTITION_COUNT))
+        self.assertEqual({get_partition(key, PARTITION_COUNT) for key in range(1000)}, set(range(PARTITION_COUNT)))
+
+    def test_assign_partitions__only_moves_the_partitions_of_the_changed_worker(self):
+        before = assign_partitions([0, 1, 2], PARTITION_COUNT)
+        after = assign_partitions([0, 1, 2, 3], PARTITION_COUNT)
+        self.assertEqual(set().union(*after.values()), set(range(PARTITION_COUNT)))
+        for worker_id in (0, 1, 2):
+            self.assertTrue(after[worker_id] <= before[worker_id])
+        self.assertEqual(assign_partitions([0, 1, 2], PARTITION_COUNT), before)
+
+
+class PartitionedWorkersTests(TestCase):
+
+    def setUp(self):
+        self.records = multiprocessing.get_context('fork').Queue()
+
+    def create_workers(self, worker_count: int) -> PartitionedWorkers:
+        workers = PartitionedWorkers(
+            lambda: RecordingHandler(self.records),
+            worker_count,
+            PARTITION_COUNT,
+            ack_timeout=10
+        )
+        workers.start()
+        self.addCleanup(workers.stop)
+        return workers
+
+    def read_records(self) -> list[tuple]:
+        # the records and the drain acks go through different queues, records can land after the ack
+        records = []
+        while True:
+            try:
+                records.append(self.records.get(timeout=0.2))
+            except queue.Empty:
+                return records
+
+    def get_events(self, records: list[tuple]) -> list[tuple]:
+        return [record for record in records if record[0] == 'event']
+
+    def test_submit__handles_the_events_of_a_key_in_order_on_one_worker(self):
+        workers = self.create_workers(3)
+        for seq in range(30):
+            workers.submit(seq % 5, {'key': seq % 5, 'seq': seq})
+        workers.drain()
+
+        events = self.get_events(self.read_records())
+        self.assertEqual(len(events), 30)
+        for key in range(5):
+            key_events = [record for record in events if record[3]['key'] == key]
+            self.assertEqual([record[3]['seq'] for record in key_events], list(range(key, 30, 5)))
+            self.assertEqual(len({record[1] for record in key_events}), 1)
+            self.assertEqual({record[2] for record in key_events}, {get_partition(key, PARTITION_COUNT)})
+
+    def test_add_worker__moves_partitions_after_the_old_owner_released_them(self):
+        workers = self.create_workers(2)
+        for key in range(40):
+            workers.submit(key, {'key': key, 'seq': 0})
+        owners = {key: workers.get_owner(key) for key in range(40)}
+
+        new_worker_id = workers.add_worker()
+        for key in range(40):
+            workers.submit(key, {'key': key, 'seq': 1})
+        workers.drain()
+
+        moved = [key for key in range(40) if workers.get_owner(key) != owners[key]]
+        self.assertTrue(len(moved) > 0)
+        self.assertTrue(all(workers.get_owner(key) == new_worker_id for key in moved))
+        records = self.read_records()
+        for key in moved:
+            partition = get_partition(key, PARTITION_COUNT)
+            release = next(index for index, record in enumerate(records) if record[0] == 'release' and record[2] == partition)
+            assign = [index for index, record in enumerate(records) if record[0] == 'assign' and record[2] == partition][-1]
+            self.assertLess(release, assign)
+        self.assertEqual(len(self.get_events(records)), 80)
+
+    def test_remove_worker__handles_what_was_queued_for_it_and_hands_over_its_partitions(self):
+        workers = self.create_workers(3)
+        removed_id = workers.get_owner(0)
+        for seq in range(10):
+            workers.submit(0, {'key': 0, 'seq': seq})
+
+        workers.remove_worker(removed_id)
+        workers.submit(0, {'key': 0, 'seq': 10})
+        workers.drain()
+
+        self.assertNotIn(removed_id, workers.worker_ids)
+        events = [record for record in self.get_events(self.read_records()) if record[3]['key'] == 0]
+        self.assertEqual([record[3]['seq'] for record in events], list(range(11)))
+
+    def test_check_workers__when_a_worker_dies__hands_its_partitions_to_the_others(self):
+        workers = self.create_workers(2)
+        dead_id = workers.get_owner(0)
+        workers._workers[dead_id].process.kill()
+        workers._workers[dead_id].process.join()
+
+        self.assertEqual(workers.check_workers(), [dead_id])
+        workers.submit(0, {'key': 0, 'seq': 0})
+        workers.drain()
+
+        self.assertEqual(workers.stats.lost_workers, 1)
+        self.assertNotEqual(workers.get_owner(0), dead_id)
+        self.assertEqual(len(self.get_events(self.read_records())), 1)
+
+    def test_broadcast__from_a_handler__reaches_every_other_partition(self):
+        workers = self.create_workers(3)
+        workers.submit(0, {'key': 0, 'seq': 0, 'broadcast': True})
+        workers.drain()
+        # the forward goes out after the worker acked the drain, wait for it to land
+        deadline = time.monotonic() + 5
+        forwarded = []
+        while len(forwarded) < PARTITION_COUNT - 1 and time.monotonic() < deadline:
+            workers.drain()
+            forwarded += [record for record in self.get_events(self.read_records()) if record[3].get('forwarded')]
+
+        self.assertEqual(
+            sorted(record[2] for record in forwarded),
+            sorted(set(range(PARTITION_COUNT)) - {get_partition(0, PARTITION_COUNT)})
+        )
+
+    def test_submit__from_a_handler__reaches_the_owner_of_the_key(self):
+        workers = self.create_workers(3)
+        other_key = next(key for key in range(1, 100) if get_partition(key, PARTITION_COUNT) != get_partition(0, PARTITION_COUNT))
+        workers.submit(0, {'key': 0, 'seq': 0, 'submit_to': other_key})
+        deadline = time.monotonic() + 5
+        forwarded = []
+        while len(forwarded) == 0 and time.monotonic() < deadline:
+            workers.drain()
+            forwarded += [record for record in self.get_events(self.read_records()) if record[3].get('forwarded')]
+
+        self.assertEqual([(record[1], record[2]) for record in forwarded], [
+            (workers._workers[workers.get_owner(other_key)].process.pid, get_partition(other_key, PARTITION_COUNT))
+        ])
@@ -0,0 +1,99 @@
+import os
+import tempfile
+import threading
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from common.util.tape import TapeRecorder, TapeReplayer, TapeSegment, INDEX_SUFFIX, SEGMENT_SUFFIX
+
+
+class TestTape(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.directory = self.tmp_dir.name
+
+    def record_frames(self, count: int, block_frames: int = 10, **kwargs) -> TapeRecorder:
+        recorder = TapeRecorder(self.directory, 'test', block_frames=block_frames, block_seconds=60, **kwargs)
+        for i in range(count):
+            recorder.record(f'{{"i":{i}}}', received_at_ns=(i + 1) * 1_000_000_000)
+        recorder.close()
+        return recorder
+
+    def test_record_and_replay(self):
+        self.record_frames(25)
+        messages = []
+        stats = TapeReplayer.from_directory(self.directory).replay(messages.append, speed=None)
+        self.assertEqual(messages, [f'{{"i":{i}}}' for i in range(25)])
+        self.assertEqual(stats.frames, 25)
+
+    def test_index__has_an_entry_per_block(self):
+        recorder = self.record_frames(25)
+        segment = TapeSegment(recorder.segment_path)
+        self.assertEqual([entry.frames for entry in segment.index], [10, 10, 5])
+        self.assertEqual(segment.first_ns, 1_000_000_000)
+        self.assertEqual(segment.last_ns, 25_000_000_000)
+
+    def test_frames__seek_by_time(self):
+        self.record_frames(25)
+        frames = list(TapeReplayer.from_directory(self.directory).frames(start_ns=12_000_000_000, end_ns=14_000_000_000))
+        self.assertEqual([message for _, message in frames], ['{"i":11}', '{"i":12}', '{"i":13}'])
+
+    def test_frames__when_index_is_missing(self):
+        recorder = self.record_frames(15)
+        os.remove(recorder.segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX)
+        self.assertEqual(len(list(TapeSegment(recorder.segment_path).frames())), 15)
+
+    def get_index_path(self, recorder: TapeRecorder) -> str:
+        return recorder.segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+    def test_frames__when_index_ends_before_the_segment(self):
+        recorder = self.record_frames(25)
+        with open(self.get_index_path(recorder), encoding='utf-8') as file:
+            lines = file.readlines()
+        with open(self.get_index_path(recorder), 'w', encoding='utf-8') as file:
+            file.write(lines[0] + lines[1][:5])
+
+        segment = TapeSegment(recorder.segment_path)
+        self.assertEqual([entry.frames for entry in segment.index], [10, 10, 5])
+        self.assertEqual(len(list(segment.frames())), 25)
+
+    def test_frames__when_the_last_block_was_cut_short(self):
+        recorder = self.record_frames(25)
+        with open(self.get_index_path(recorder), encoding='utf-8') as file:
+            lines = file.readlines()
+        with open(self.get_index_path(recorder), 'w', encoding='utf-8') as file:
+            file.writelines(lines[:2])
+        with open(recorder.segment_path, 'r+b') as file:
+            file.truncate(os.path.getsize(recorder.segment_path) - 10)
+
+        segment = TapeSegment(recorder.segment_path)
+        self.assertEqual([entry.frames for entry in segment.index], [10, 10])
+        self.assertEqual(len(list(segment.frames())), 20)
+
+    def test_record__rotates_segments(self):
+        self.record_frames(25, segment_max_bytes=1)
+        replayer = TapeReplayer.from_directory(self.directory)
+        self.assertEqual(len(replayer.segments), 3)
+        self.assertEqual(len(list(replayer.frames())), 25)
+
+    def test_record__writes_the_blocks_on_another_thread(self):
+        recorder = TapeRecorder(self.directory, 'test', block_frames=2, block_seconds=60)
+        writing_threads = []
+        write_block = recorder._write_block
+
+        def capture(*args):
+            writing_threads.append(threading.get_ident())
+            write_block(*args)
+
+        with patch.object(recorder, '_write_block', side_effect=capture):
+            for i in range(4):
+                recorder.record(f'{{"i":{i}}}', received_at_ns=(i + 1) * 1_000_000_000)
+            recorder.flush()
+
+        self.assertEqual(len(writing_threads), 2)
+        self.assertNotIn(threading.get_ident(), writing_threads)
+        self.assertEqual(len(list(TapeSegment(recorder.segment_path).frames())), 4)
+        recorder.close()
@@ -0,0 +1,114 @@
+from unittest.mock import patch
+
+from django.db import DatabaseError, connection, transaction
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from common.util.unit_of_work import UnitOfWork, get_current_unit_of_work, get_flow_query_stats, in_unit_of_work, \
+    load_once, reset_flow_query_stats
+from woo.models import WooAlgoOrder
+from woo.tests.factory.woo_algo_order_factory import WooAlgoOrderFactory
+
+
+class UnitOfWorkTests(TestCase):
+
+    def setUp(self):
+        reset_flow_query_stats()
+
+    def test_unit_of_work__loads_one_instance_per_row(self):
+        algo_order = WooAlgoOrderFactory(order_id=1)
+        with UnitOfWork('test'):
+            first = WooAlgoOrder.objects.get(pk=algo_order.pk)
+            first.status = 'FILLED'
+            second = WooAlgoOrder.objects.filter(order_id=1).first()
+            self.assertIs(first, second)
+            self.assertEqual(second.status, 'FILLED')
+
+    def test_unit_of_work__defers_updates_until_it_exits(self):
+        algo_order = WooAlgoOrderFactory(order_id=1, status='NEW')
+        with UnitOfWork('test'):
+            with self.assertNumQueries(0):
+                algo_order.update(status='CANCELLED', quantity=0)
+            self.assertTrue(algo_order.is_dirty)
+        algo_order.refresh_from_db()
+        self.assertEqual(algo_order.status, 'CANCELLED')
+        self.assertEqual(algo_order.quantity_lots, 0)
+        self.assertFalse(algo_order.is_dirty)
+
+    def test_unit_of_work__writes_the_updates_before_their_table_is_read(self):
+        algo_order = WooAlgoOrderFactory(order_id=1, status='NEW')
+        with UnitOfWork('test'):
+            algo_order.update(status='CANCELLED')
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            self.assertTrue(algo_order.is_dirty)
+            self.assertEqual(WooAlgoOrder.objects.filter(status='NEW').count(), 0)
+            self.assertFalse(algo_order.is_dirty)
+
+    def test_unit_of_work__writes_rows_changing_the_same_fields_in_one_update(self):
+        algo_orders = [WooAlgoOrderFactory(order_id=order_id, status='NEW') for order_id in (1, 2, 3)]
+        with CaptureQueriesContext(connection) as context:
+            with UnitOfWork('test'):
+                for algo_order in algo_orders:
+                    algo_order.update(status='CANCELLED', quantity=0)
+        updates = [query['sql'] for query in context.captured_queries if query['sql'].startswith('UPDATE "woo_wooalgoorder"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(
+            list(WooAlgoOrder.objects.order_by('order_id').values_list('status', flat=True)),
+            ['CANCELLED', 'CANCELLED', 'CANCELLED']
+        )
+
+    def test_unit_of_work__when_the_flow_raises__still_writes_the_updates(self):
+        algo_order = WooAlgoOrderFactory(order_id=1, status='NEW')
+        with self.assertRaises(ValueError):
+            with UnitOfWork('test'):
+                algo_order.update(status='CANCELLED')
+                raise ValueError()
+        algo_order.refresh_from_db()
+        self.assertEqual(algo_order.status, 'CANCELLED')
+
+    def test_unit_of_work__when_the_flow_rolled_back__raises_the_flows_error(self):
+        algo_order = WooAlgoOrderFactory(order_id=1, status='NEW')
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                with UnitOfWork('test'):
+                    algo_order.update(status='CANCELLED')
+                    transaction.set_rollback(True)
+                    raise ValueError()
+        self.assertEqual(WooAlgoOrder.objects.get(pk=algo_order.pk).status, 'NEW')
+
+    def test_unit_of_work__when_writing_after_the_error_fails__raises_the_flows_error(self):
+        algo_order = WooAlgoOrderFactory(order_id=1, status='NEW')
+        with patch.object(UnitOfWork, 'flush', side_effect=DatabaseError()):
+            with self.assertRaises(ValueError):
+                with UnitOfWork('test'):
+                    algo_order.update(status='CANCELLED')
+                    raise ValueError()
+
+    def test_load_once__runs_the_loader_once_per_unit_of_work(self):
+        calls = []
+        with UnitOfWork('test'):
+            for _ in range(3):
+                load_once('key', lambda: calls.append(1))
+        load_once('key', lambda: calls.append(1))
+        self.assertEqual(len(calls), 2)
+
+    def test_in_unit_of_work__joins_the_active_unit_of_work_and_records_queries_per_flow(self):
+        WooAlgoOrderFactory(order_id=1)
+
+        @in_unit_of_work('inner')
+        def inner():
+            return get_current_unit_of_work()
+
+        @in_unit_of_work('outer')
+        def outer():
+            WooAlgoOrder.objects.get(order_id=1)
+            return get_current_unit_of_work(), inner()
+
+        outer_unit_of_work, inner_unit_of_work = outer()
+        self.assertIs(outer_unit_of_work, inner_unit_of_work)
+        self.assertIsNone(get_current_unit_of_work())
+        stats = get_flow_query_stats()
+        self.assertEqual(list(stats), ['outer'])
+        self.assertEqual(stats['outer'].calls, 1)
+        self.assertEqual(stats['outer'].last_queries, 1)
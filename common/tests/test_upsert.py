@@ -0,0 +1,59 @@
+from django.db import connection
+from django.test import TestCase
+
+from common.util.upsert import upsert
+from woo.models import WooAlgoOrder
+from woo.tests.factory.woo_algo_order_factory import WooAlgoOrderFactory
+
+
+def build_algo_order(order_id: int, **kwargs) -> WooAlgoOrder:
+    return WooAlgoOrder(order_id=order_id, symbol='PERP_BTC_USDT', side='BUY', quantity=0.1, trigger_price=100, **kwargs)
+
+
+class UpsertTests(TestCase):
+
+    def test_upsert__when_row_is_new__creates_it(self):
+        result, = upsert(WooAlgoOrder, [build_algo_order(1)], unique_fields=['order_id'], update_fields=['status'])
+        self.assertTrue(result.created)
+        self.assertEqual(result.previous, {})
+        self.assertIsNotNone(result.instance.id)
+        self.assertEqual(WooAlgoOrder.objects.get(order_id=1).id, result.instance.id)
+
+    def test_upsert__when_row_exists__updates_it_and_returns_previous_values(self):
+        existing = WooAlgoOrderFactory(order_id=2, status='NEW')
+        result, = upsert(
+            WooAlgoOrder,
+            [build_algo_order(2, status='FILLED')],
+            unique_fields=['order_id'],
+            update_fields=['status'],
+            previous_fields=['status']
+        )
+        self.assertFalse(result.created)
+        self.assertEqual(result.instance.id, existing.id)
+        self.assertEqual(result.instance.status, 'FILLED')
+        self.assertEqual(result.previous, {'status': 'NEW'})
+        existing.refresh_from_db()
+        self.assertEqual(existing.status, 'FILLED')
+
+    def test_upsert__without_update_fields__leaves_existing_rows_unchanged(self):
+        WooAlgoOrderFactory(order_id=3, status='CANCELLED')
+        results = upsert(WooAlgoOrder, [build_algo_order(4), build_algo_order(3)], unique_fields=['order_id'])
+        self.assertEqual([result.created for result in results], [True, False])
+        self.assertEqual(results[1].instance.status, 'CANCELLED')
+
+    def test_upsert__on_postgres__takes_one_query(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('the single statement path is postgres only')
+        WooAlgoOrderFactory(order_id=5)
+        with self.assertNumQueries(1):
+            upsert(
+                WooAlgoOrder,
+                [build_algo_order(5, status='FILLED'), build_algo_order(6)],
+                unique_fields=['order_id'],
+                update_fields=['status'],
+                previous_fields=['status']
+            )
+
+    def test_upsert__when_given_duplicate_keys__raises(self):
+        with self.assertRaises(Exception):
+            upsert(WooAlgoOrder, [build_algo_order(7), build_algo_order(7)], unique_fields=['order_id'])
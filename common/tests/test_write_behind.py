@@ -0,0 +1,74 @@
+import json
+import os
+import tempfile
+
+from django.test import TestCase
+
+from common.util.write_behind import WriteBehindQueue
+
+
+class TestWriteBehindQueue(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'journal')
+        self.applied = []
+
+    def test_put__applies_ops_in_order(self):
+        queue = WriteBehindQueue(self.path, self.applied.extend)
+        queue.start()
+        for i in range(5):
+            queue.put({'i': i})
+        self.assertTrue(queue.flush(5))
+        queue.stop()
+        self.assertEqual([op['i'] for op in self.applied], [0, 1, 2, 3, 4])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_start__replays_unapplied_ops_and_skips_torn_lines(self):
+        with open(self.path, 'w') as f:
+            for seq in (1, 2, 3):
+                f.write(json.dumps({'seq': seq, 'op': {'i': seq}}) + '\n')
+            f.write('{"seq": 4, "op"')
+        with open(self.path + '.applied', 'w') as f:
+            f.write('1')
+
+        queue = WriteBehindQueue(self.path, self.applied.extend)
+        self.assertEqual(queue.start(), 2)
+        queue.stop()
+        self.assertEqual(self.applied, [{'i': 2}, {'i': 3}])
+
+    def test_apply__when_it_raises__retries_the_batch(self):
+        attempts = []
+
+        def flaky_apply(ops):
+            attempts.append(ops)
+            if len(attempts) == 1:
+                raise ValueError('db is down')
+            self.applied.extend(ops)
+
+        queue = WriteBehindQueue(self.path, flaky_apply, retry_seconds=0)
+        queue.start()
+        queue.put({'i': 0})
+        self.assertTrue(queue.flush(5))
+        queue.stop()
+        self.assertEqual(self.applied, [{'i': 0}])
+        self.assertEqual(queue.stats.failures, 1)
+
+    def test_apply__when_an_op_keeps_failing__moves_it_to_the_dead_letter_file(self):
+        def apply(ops):
+            if any(op['i'] == 1 for op in ops):
+                raise ValueError('bad op')
+            self.applied.extend(ops)
+
+        queue = WriteBehindQueue(self.path, apply, retry_seconds=0, max_retries=2)
+        queue.start()
+        for i in range(3):
+            queue.put({'i': i})
+        self.assertTrue(queue.flush(5))
+        queue.stop()
+
+        self.assertEqual(sorted(op['i'] for op in self.applied), [0, 2])
+        self.assertEqual(queue.stats.dead_lettered, 1)
+        with open(queue.dead_letter_path) as f:
+            self.assertEqual([json.loads(line)['op'] for line in f], [{'i': 1}])
@@ -0,0 +1,238 @@
+'''
+Named locks that serialize the flows working on the same rows while flows on unrelated rows
+run in parallel, across processes on postgres through advisory locks and across the threads
+of one process otherwise.
+
+A key is a (namespace, id) pair. Locks are taken inside a scope and held until the outermost
+scope exits, like transaction level locks, so the unit of work a flow flushes on exit should
+run inside the scope. A key can be taken shared, shared holders only exclude exclusive ones.
+The holder of a key can take it again in either mode.
+
+Keys taken one at a time can deadlock when two flows take them in different orders. Callers
+take the keys of a scope together where they can, they are acquired in a fixed order, and
+otherwise keep to the namespace order they document.
+'''
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from django.db import connections
+
+from common.util.logging import log
+
+LockKey = tuple[str, int]
+
+
+@dataclass
+class LockStats:
+    acquisitions: int = 0
+    # acquisitions that had to wait for another holder
+    contended: int = 0
+    wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+
+
+_lock_stats: dict[str, LockStats] = {}
+_lock_stats_lock = threading.Lock()
+
+
+def get_lock_stats() -> dict[str, LockStats]:
+    with _lock_stats_lock:
+        return dict(_lock_stats)
+
+
+def reset_lock_stats():
+    with _lock_stats_lock:
+        _lock_stats.clear()
+
+
+def _record_acquisition(key: LockKey, contended: bool, wait_seconds: float):
+    with _lock_stats_lock:
+        stats = _lock_stats.setdefault(key[0], LockStats())
+        stats.acquisitions += 1
+        if not contended:
+            return
+        stats.contended += 1
+        stats.wait_seconds += wait_seconds
+        if wait_seconds > stats.max_wait_seconds:
+            # only new highs are logged, like the flow query counts
+            log('lock wait', f'{key[0]} {key[1]} waited {wait_seconds:.3f}s, up from at most {stats.max_wait_seconds:.3f}s')
+            stats.max_wait_seconds = wait_seconds
+
+
+class LocalLocks:
+    '''
+    Stand-in for the advisory locks within one process, for sqlite and the tests.
+    '''
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        # key -> (thread holding it exclusively, times taken)
+        self._exclusive: dict[LockKey, tuple[int, int]] = {}
+        # key -> thread -> times taken
+        self._shared: dict[LockKey, dict[int, int]] = {}
+
+    def _is_free(self, key: LockKey, thread_id: int, shared: bool) -> bool:
+        owner = self._exclusive.get(key)
+        if owner is not None and owner[0] != thread_id:
+            return False
+        if shared:
+            return True
+        return all(holder == thread_id for holder in self._shared.get(key, {}))
+
+    def _take(self, key: LockKey, thread_id: int, shared: bool):
+        if shared:
+            holders = self._shared.setdefault(key, {})
+            holders[thread_id] = holders.get(thread_id, 0) + 1
+        else:
+            owner = self._exclusive.get(key)
+            self._exclusive[key] = (thread_id, 1 if owner is None else owner[1] + 1)
+
+    def try_acquire(self, key: LockKey, shared: bool = False) -> bool:
+        thread_id = threading.get_ident()
+        with self._condition:
+            if not self._is_free(key, thread_id, shared):
+                return False
+            self._take(key, thread_id, shared)
+            return True
+
+    def acquire(self, key: LockKey, shared: bool = False):
+        thread_id = threading.get_ident()
+        with self._condition:
+            self._condition.wait_for(lambda: self._is_free(key, thread_id, shared))
+            self._take(key, thread_id, shared)
+
+    def release(self, key: LockKey, shared: bool = False):
+        thread_id = threading.get_ident()
+        with self._condition:
+            if shared:
+                holders = self._shared.get(key, {})
+                if holders.get(thread_id, 0) == 0:
+                    raise Exception(f'Lock {key} is not held shared by this thread')
+                holders[thread_id] -= 1
+                if holders[thread_id] == 0:
+                    del holders[thread_id]
+                if len(holders) == 0:
+                    self._shared.pop(key, None)
+            else:
+                owner = self._exclusive.get(key)
+                if owner is None or owner[0] != thread_id:
+                    raise Exception(f'Lock {key} is not held by this thread')
+                if owner[1] == 1:
+                    del self._exclusive[key]
+                else:
+                    self._exclusive[key] = (thread_id, owner[1] - 1)
+            self._condition.notify_all()
+
+
+class AdvisoryLocks:
+    '''
+    Session level postgres advisory locks on the thread's connection. The namespace is hashed
+    into the first of the two int keys, the id is the second. The server releases them when the
+    connection drops, a process that dies holding one doesn't block the others.
+    '''
+
+    def __init__(self, using: str = 'default'):
+        self.using = using
+
+    def _select(self, function: str, key: LockKey, shared: bool):
+        suffix = '_shared' if shared else ''
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(f'SELECT {function}{suffix}(%s, %s)', [_get_namespace_key(key[0]), key[1]])
+            return cursor.fetchone()[0]
+
+    def try_acquire(self, key: LockKey, shared: bool = False) -> bool:
+        return self._select('pg_try_advisory_lock', key, shared)
+
+    def acquire(self, key: LockKey, shared: bool = False):
+        self._select('pg_advisory_lock', key, shared)
+
+    def release(self, key: LockKey, shared: bool = False):
+        if not self._select('pg_advisory_unlock', key, shared):
+            log('advisory lock', f'{key} was not held when it was released')
+
+
+def _get_namespace_key(namespace: str) -> int:
+    # crc32 is stable across processes unlike hash(), shifted into postgres' signed int range
+    return zlib.crc32(namespace.encode()) - 2 ** 31
+
+
+_local_locks = LocalLocks()
+
+
+def get_locks(using: str = 'default'):
+    if connections[using].vendor == 'postgresql':
+        return AdvisoryLocks(using)
+    return _local_locks
+
+
+class LockScope:
+
+    def __init__(self, locks):
+        self._locks = locks
+        self._held: list[tuple[LockKey, bool]] = []
+
+    @property
+    def held(self) -> list[tuple[LockKey, bool]]:
+        return list(self._held)
+
+    def acquire(self, exclusive: Iterable[LockKey] = (), shared: Iterable[LockKey] = ()):
+        '''
+        Takes the keys in namespace and id order, each one only waits when another holder has it.
+        '''
+        keys = {key: True for key in shared}
+        keys.update({key: False for key in exclusive})
+        for key in sorted(keys):
+            is_shared = keys[key]
+            if self._locks.try_acquire(key, is_shared):
+                _record_acquisition(key, False, 0.0)
+            else:
+                started = time.monotonic()
+                self._locks.acquire(key, is_shared)
+                _record_acquisition(key, True, time.monotonic() - started)
+            self._held.append((key, is_shared))
+
+    def release(self):
+        while len(self._held) > 0:
+            key, is_shared = self._held.pop()
+            self._locks.release(key, is_shared)
+
+
+_current_scope: ContextVar[Optional[LockScope]] = ContextVar('current_lock_scope', default=None)
+
+
+def get_current_lock_scope() -> Optional[LockScope]:
+    return _current_scope.get()
+
+
+@contextmanager
+def lock_scope(exclusive: Iterable[LockKey] = (), shared: Iterable[LockKey] = (), using: str = 'default'):
+    '''
+    Holds the keys, and the ones taken with acquire_locks while it is active, until the
+    outermost scope exits. A nested scope adds its keys to the outer one.
+    '''
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.acquire(exclusive, shared)
+        yield scope
+        return
+
+    scope = LockScope(get_locks(using))
+    token = _current_scope.set(scope)
+    try:
+        scope.acquire(exclusive, shared)
+        yield scope
+    finally:
+        _current_scope.reset(token)
+        scope.release()
+
+
+def acquire_locks(exclusive: Iterable[LockKey] = (), shared: Iterable[LockKey] = ()):
+    scope = _current_scope.get()
+    if scope is None:
+        raise Exception('acquire_locks needs an active lock scope')
+    scope.acquire(exclusive, shared)
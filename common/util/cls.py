@@ -1,33 +1,138 @@
+import time
+from functools import lru_cache, partial
 from typing import Optional, Callable
 
 from inflection import underscore
 
 
+_UNRESOLVED = object()
+
+
 def _mappings_key_convertor(key_map: dict):
     def key_convertor(n: str) -> str:
         return underscore(key_map.get(n, n))
     return key_convertor
 
 
+def _identity(n):
+    return n
+
+
+class FieldMapper:
+    '''
+    A data to class attributes mapping compiled for one class, key converter and set of value
+    converters. Each data key is resolved against dir(cls) the first time it is seen, after
+    that mapping a dict is a table lookup and the field's converter per key.
+    field_converters take just the value and win over value_converter for their field.
+    '''
+
+    def __init__(
+        self,
+        cls,
+        key_converter: Callable = _identity,
+        value_converter: Optional[Callable] = None,
+        field_converters: Optional[dict[str, Callable]] = None
+    ):
+        self.cls_attrs = frozenset(dir(cls))
+        self.key_converter = key_converter
+        self.value_converter = value_converter
+        self.field_converters = field_converters or {}
+        self._table = {}
+
+    def _resolve(self, k: str) -> Optional[tuple[str, Optional[Callable]]]:
+        key = self.key_converter(k)
+        entry = None
+        if key in self.cls_attrs:
+            convert = self.field_converters.get(key)
+            if convert is None and self.value_converter is not None:
+                convert = partial(self.value_converter, key)
+            entry = (key, convert)
+        self._table[k] = entry
+        return entry
+
+    def __call__(self, data: dict) -> dict:
+        table = self._table
+        result = {}
+        for k, v in data.items():
+            entry = table.get(k, _UNRESOLVED)
+            if entry is _UNRESOLVED:
+                entry = self._resolve(k)
+            if entry is None:
+                continue
+            key, convert = entry
+            result[key] = v if convert is None else convert(v)
+        return result
+
+
+def compile_field_mapper(
+    cls,
+    key_map: Optional[dict] = None,
+    field_converters: Optional[dict[str, Callable]] = None
+) -> FieldMapper:
+    key_convertor = underscore if key_map is None else _mappings_key_convertor(key_map)
+    return FieldMapper(cls, key_convertor, field_converters=field_converters)
+
+
+@lru_cache(maxsize=128)
+def _get_data_mapper(cls, key_map_items: Optional[frozenset], value_converter: Optional[Callable]) -> FieldMapper:
+    key_convertor = underscore if key_map_items is None else _mappings_key_convertor(dict(key_map_items))
+    return FieldMapper(cls, key_convertor, value_converter)
+
+
+@lru_cache(maxsize=128)
+def _get_attributes_mapper(cls, key_converter: Callable, value_converter: Optional[Callable]) -> FieldMapper:
+    return FieldMapper(cls, key_converter, value_converter)
+
+
 def map_data_to_class(
     cls,
     data: dict,
     key_map: Optional[dict] = None,
-    value_converter: Callable = lambda k, v: v
+    value_converter: Optional[Callable] = None
 ) -> dict:
-    key_convertor = underscore
+    key_map_items = None if key_map is None else frozenset(key_map.items())
+    return _get_data_mapper(cls, key_map_items, value_converter)(data)
 
-    if key_map is not None:
-        key_convertor = _mappings_key_convertor(key_map)
 
-    return map_dict_to_class_attributes(cls, data, key_convertor, value_converter)
+def map_dict_to_class_attributes(
+    cls,
+    data: dict,
+    key_converter: Callable = _identity,
+    value_converter: Optional[Callable] = None
+) -> dict:
+    return _get_attributes_mapper(cls, key_converter, value_converter)(data)
 
 
-def map_dict_to_class_attributes(
+def _map_data_to_class_reflectively(
     cls,
     data: dict,
-    key_converter: Callable = lambda n: n,
-    value_converter: Callable = lambda k, v: v
+    key_map: Optional[dict] = None,
+    value_converter: Optional[Callable] = None
 ) -> dict:
+    # the mapping before FieldMapper, kept as the benchmark baseline
+    key_convertor = underscore if key_map is None else _mappings_key_convertor(key_map)
+    value_converter = value_converter or (lambda k, v: v)
     cls_attrs = dir(cls)
-    return {key: value_converter(key,v) for k, v in data.items() if (key:=key_converter(k)) in cls_attrs}
+    return {key: value_converter(key, v) for k, v in data.items() if (key := key_convertor(k)) in cls_attrs}
+
+
+def benchmark_map_data_to_class(
+    cls,
+    data: dict,
+    key_map: Optional[dict] = None,
+    value_converter: Optional[Callable] = None,
+    iterations: int = 10000
+) -> dict:
+    '''
+    Average ns per call of the reflective mapping and the cached compiled one, e.g. from manage.py shell.
+    '''
+    results = {}
+    for name, mapper in [
+        ('reflective', _map_data_to_class_reflectively),
+        ('compiled', map_data_to_class),
+    ]:
+        started = time.perf_counter_ns()
+        for _ in range(iterations):
+            mapper(cls, data, key_map, value_converter)
+        results[name] = (time.perf_counter_ns() - started) / iterations
+    return results
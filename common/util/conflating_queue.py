@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import threading
+from dataclasses import dataclass
+from typing import Callable, Hashable, Optional
+
+from common.util.logging import log
+
+
+@dataclass
+class ConflationStats:
+    received: int = 0
+    delivered: int = 0
+    conflated: int = 0
+
+
+class ConflatingHandler:
+    '''
+    Calls handler on its own thread with only the newest pending item per key.
+
+    Items put while the handler is busy replace any pending item with the same key, so a slow
+    handler always sees the latest value instead of working through a backlog of stale ones.
+    Pending items for different keys are delivered in the order their key first became pending.
+    '''
+
+    def __init__(self, handler: Callable, key: Optional[Callable] = None, name: str = 'conflating-handler'):
+        self.handler = handler
+        self.stats = ConflationStats()
+        self._key = key
+        self._pending: dict[Hashable, object] = {}
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def __call__(self, item):
+        self.put(item)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def put(self, item):
+        key = self._key(item) if self._key is not None else None
+        with self._condition:
+            self.stats.received += 1
+            if key in self._pending:
+                self.stats.conflated += 1
+                # keep the key's place in the queue, only the value is replaced
+                self._pending[key] = item
+            else:
+                self._pending[key] = item
+                self._condition.notify()
+
+    def stop(self, drain: bool = False):
+        with self._condition:
+            if not drain:
+                self._pending.clear()
+            self._running = False
+            self._condition.notify()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and len(self._pending) == 0:
+                    self._condition.wait()
+                if len(self._pending) == 0:
+                    return
+                key = next(iter(self._pending))
+                item = self._pending.pop(key)
+            try:
+                self.handler(item)
+            except Exception as e:
+                log('ERROR: conflated handler failed', e)
+            self.stats.delivered += 1
@@ -0,0 +1,104 @@
+from typing import Optional
+
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+
+from common.util.unit_of_work import get_current_unit_of_work
+
+
+class DirtyFieldsMixin(models.Model):
+    '''
+    Keeps the field values an instance was loaded or last saved with, so save() on an existing
+    row only writes the columns that changed and skips the query when none did. Passing
+    update_fields to save() still writes exactly those fields. Inside a UnitOfWork updates are
+    collected and written when it flushes.
+    '''
+
+    class Meta:
+        abstract = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loaded_values = {}
+        self.reset_dirty_fields()
+
+    def reset_dirty_fields(self, fields: Optional[set[str]] = None):
+        for field in self._meta.concrete_fields:
+            if fields is not None and field.name not in fields and field.attname not in fields:
+                continue
+            if field.attname in self.__dict__:
+                self._loaded_values[field.attname] = self.__dict__[field.attname]
+
+    def get_dirty_fields(self) -> set[str]:
+        dirty = set()
+        for field in self._meta.concrete_fields:
+            if field.attname not in self.__dict__:
+                # deferred and never loaded, so never set either
+                continue
+            value = self.__dict__[field.attname]
+            if field.attname not in self._loaded_values:
+                dirty.add(field.name)
+                continue
+            loaded = self._loaded_values[field.attname]
+            if value == loaded:
+                continue
+            # api payloads set strings and floats on decimal fields, compare them as the column would
+            try:
+                if value is not None and field.to_python(value) == loaded:
+                    continue
+            except ValidationError:
+                pass
+            dirty.add(field.name)
+        return dirty
+
+    @property
+    def is_dirty(self) -> bool:
+        return self._state.adding or len(self.get_dirty_fields()) > 0
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self.reset_dirty_fields(set(kwargs['fields']) if kwargs.get('fields') else None)
+
+    def get_changed_fields_for_save(self, save_kwargs: dict) -> Optional[set[str]]:
+        '''
+        The fields a save() with these kwargs writes, None when it writes the whole row.
+        '''
+        if save_kwargs.get('update_fields') is not None:
+            return set(save_kwargs['update_fields'])
+        if self._state.adding or save_kwargs.get('force_insert'):
+            return None
+        return self.get_dirty_fields()
+
+    def prepare_save(self):
+        '''
+        Sets the fields derived from others, called before the changed fields are worked out.
+        '''
+
+    def validate_changes(self, changed_fields: Optional[set[str]]):
+        '''
+        Raises ValidationError for invalid changes, changed_fields is None for the whole row.
+        '''
+
+    def defer_save(self, update_fields: Optional[set[str]] = None) -> bool:
+        '''
+        Hands the update to the active unit of work, False when there is none to write it.
+        '''
+        unit_of_work = get_current_unit_of_work()
+        if unit_of_work is None:
+            return False
+        return unit_of_work.defer_save(self, update_fields)
+
+    def save(self, *args, **kwargs):
+        self.prepare_save()
+        update_fields = None if args else self.get_changed_fields_for_save(kwargs)
+        if update_fields is not None:
+            if len(update_fields) == 0:
+                return
+            kwargs['update_fields'] = update_fields
+        self.validate_changes(update_fields)
+        if not args and kwargs.keys() <= {'update_fields'} and self.defer_save(update_fields):
+            return
+        # receivers keeping derived rows in sync run in the same transaction as the save
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+        self.reset_dirty_fields(update_fields)
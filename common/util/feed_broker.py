@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import json
+import os
+import selectors
+import socket
+import threading
+import time
+from fnmatch import fnmatchcase
+from typing import Callable, Optional
+
+from common.util.logging import log
+
+DEFAULT_MAX_PENDING_BYTES = 4 * 1024 * 1024
+RECV_SIZE = 64 * 1024
+
+
+def encode_event(topic: str, data) -> bytes:
+    return (json.dumps({'topic': topic, 'data': data}, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+class _BrokerSubscriber:
+
+    def __init__(self, sock: socket.socket, max_pending_bytes: int):
+        self.sock = sock
+        self.patterns: list[str] = []
+        self.max_pending_bytes = max_pending_bytes
+        self.outbound = bytearray()
+        self.inbound = bytearray()
+        self.sent = 0
+        self.is_slow = False
+        self._matches: dict[str, bool] = {}
+
+    def matches(self, topic: str) -> bool:
+        match = self._matches.get(topic)
+        if match is None:
+            match = any(fnmatchcase(topic, pattern) for pattern in self.patterns)
+            self._matches[topic] = match
+        return match
+
+    def set_patterns(self, patterns: list[str]):
+        self.patterns = patterns
+        self._matches = {}
+
+    def enqueue(self, payload: bytes) -> bool:
+        if len(self.outbound) + len(payload) > self.max_pending_bytes:
+            self.is_slow = True
+            return False
+        self.outbound += payload
+        self.sent += 1
+        return True
+
+    def send_pending(self) -> bool:
+        if len(self.outbound) == 0:
+            return True
+        try:
+            sent = self.sock.send(self.outbound)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        del self.outbound[:sent]
+        return True
+
+
+class FeedBroker:
+    '''
+    Republishes decoded upstream ws events to local subscribers over a unix socket.
+
+    Subscribers send newline delimited json requests, {"event": "subscribe", "topics": ["binance:*"]},
+    where topics are fnmatch patterns, and receive one {"topic": ..., "data": ...} line per event.
+    Each event is encoded once no matter how many subscribers receive it. A subscriber whose
+    unsent output grows past max_pending_bytes is treated as a slow consumer and disconnected
+    so it can't hold up the feed or grow the broker's memory.
+    '''
+
+    def __init__(self, socket_path: str, max_pending_bytes: int = DEFAULT_MAX_PENDING_BYTES, debug: bool = False):
+        self.socket_path = socket_path
+        self.max_pending_bytes = max_pending_bytes
+        self.debug = debug
+        self.published = 0
+        self.slow_consumer_disconnects = 0
+        self._subscribers: dict[socket.socket, _BrokerSubscriber] = {}
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._server: Optional[socket.socket] = None
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.socket_path)
+        self._server.listen()
+        self._server.setblocking(False)
+        self._selector.register(self._server, selectors.EVENT_READ)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name='feed-broker', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            for sock in list(self._subscribers):
+                self._remove_subscriber(sock)
+        self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+        if self._server is not None:
+            self._server.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def publish(self, topic: str, data):
+        payload = None
+        has_pending = False
+        with self._lock:
+            for sock, subscriber in self._subscribers.items():
+                if subscriber.is_slow or not subscriber.matches(topic):
+                    continue
+                payload = payload or encode_event(topic, data)
+                if not subscriber.enqueue(payload):
+                    # removed by the serve thread, the selector is only touched from there
+                    self.slow_consumer_disconnects += 1
+                    has_pending = True
+                    log('slow consumer', f'disconnecting subscriber {sock.fileno()} with {len(subscriber.outbound)} bytes pending')
+                    continue
+                if not subscriber.send_pending():
+                    subscriber.is_slow = True
+                has_pending = has_pending or subscriber.is_slow or len(subscriber.outbound) > 0
+            self.published += 1
+        # only wake the serve thread when it has output to drain or subscribers to drop
+        if has_pending:
+            self._wake()
+
+    def publisher(self, topic: str) -> Callable:
+        return lambda data: self.publish(topic, data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'published': self.published,
+                'subscribers': len(self._subscribers),
+                'slow_consumer_disconnects': self.slow_consumer_disconnects,
+                'pending_bytes': {sock.fileno(): len(sub.outbound) for sock, sub in self._subscribers.items()},
+            }
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def _serve(self):
+        while self._running:
+            with self._lock:
+                for sock in [sock for sock, subscriber in self._subscribers.items() if subscriber.is_slow]:
+                    self._remove_subscriber(sock)
+                for sock, subscriber in self._subscribers.items():
+                    events = selectors.EVENT_READ | (selectors.EVENT_WRITE if subscriber.outbound else 0)
+                    self._selector.modify(sock, events)
+
+            for key, events in self._selector.select(timeout=1):
+                sock = key.fileobj
+                if sock is self._server:
+                    self._accept()
+                elif sock is self._wake_r:
+                    try:
+                        self._wake_r.recv(RECV_SIZE)
+                    except BlockingIOError:
+                        pass
+                else:
+                    with self._lock:
+                        subscriber = self._subscribers.get(sock)
+                        if subscriber is None:
+                            continue
+                        if events & selectors.EVENT_WRITE and not subscriber.send_pending():
+                            self._remove_subscriber(sock)
+                            continue
+                        if events & selectors.EVENT_READ:
+                            self._read(sock, subscriber)
+
+    def _accept(self):
+        try:
+            sock, _ = self._server.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        with self._lock:
+            self._subscribers[sock] = _BrokerSubscriber(sock, self.max_pending_bytes)
+            self._selector.register(sock, selectors.EVENT_READ)
+        if self.debug:
+            log('subscriber connected', sock.fileno())
+
+    def _read(self, sock: socket.socket, subscriber: _BrokerSubscriber):
+        try:
+            data = sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if data == b'':
+            self._remove_subscriber(sock)
+            return
+
+        subscriber.inbound += data
+        while b'\n' in subscriber.inbound:
+            line, _, rest = bytes(subscriber.inbound).partition(b'\n')
+            subscriber.inbound = bytearray(rest)
+            self._handle_request(subscriber, line)
+
+    def _handle_request(self, subscriber: _BrokerSubscriber, line: bytes):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return
+        topics = request.get('topics') or []
+        if request.get('event') == 'subscribe':
+            subscriber.set_patterns(list(dict.fromkeys(subscriber.patterns + topics)))
+        elif request.get('event') == 'unsubscribe':
+            subscriber.set_patterns([pattern for pattern in subscriber.patterns if pattern not in topics])
+
+    def _remove_subscriber(self, sock: socket.socket):
+        self._subscribers.pop(sock, None)
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+
+
+class FeedSubscriber:
+    '''
+    Client side of FeedBroker. Handlers are registered against fnmatch topic patterns and are
+    called with (topic, data) for every matching event. Reconnects if the broker goes away.
+    '''
+
+    def __init__(self, socket_path: str, reconnect: float = 1.0, debug: bool = False):
+        self.socket_path = socket_path
+        self.reconnect = reconnect
+        self.debug = debug
+        self._handlers: dict[str, list[Callable]] = {}
+        self._sock: Optional[socket.socket] = None
+        self._running = False
+
+    def subscribe(self, topic: str, handler: Callable):
+        cb_list = self._handlers.setdefault(topic, [])
+        if handler not in cb_list:
+            cb_list.append(handler)
+        if self._sock is not None:
+            self._send_request('subscribe', [topic])
+
+    def unsubscribe(self, topic: str, handler: Optional[Callable] = None):
+        cb_list = self._handlers.get(topic)
+        if cb_list is None:
+            return
+        if handler is not None and handler in cb_list:
+            cb_list.remove(handler)
+            if len(cb_list) > 0:
+                return
+        del self._handlers[topic]
+        if self._sock is not None:
+            self._send_request('unsubscribe', [topic])
+
+    def run(self):
+        self._running = True
+        while self._running:
+            try:
+                self._connect()
+                self._read_forever()
+            except (ConnectionError, FileNotFoundError) as e:
+                if self.debug:
+                    log('feed broker connection error', e)
+            finally:
+                if self._sock is not None:
+                    self._sock.close()
+                    self._sock = None
+            if self._running:
+                time.sleep(self.reconnect)
+
+    def stop(self):
+        self._running = False
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        self._sock = sock
+        if len(self._handlers) > 0:
+            self._send_request('subscribe', list(self._handlers))
+
+    def _read_forever(self):
+        buffer = b''
+        while self._running:
+            data = self._sock.recv(RECV_SIZE)
+            if not data:
+                return
+            buffer += data
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                self._dispatch(json.loads(line))
+
+    def _dispatch(self, event: dict):
+        topic = event.get('topic')
+        for pattern, cb_list in list(self._handlers.items()):
+            if fnmatchcase(topic, pattern):
+                for cb in cb_list:
+                    cb(topic, event.get('data'))
+
+    def _send_request(self, event: str, topics: list[str]):
+        self._sock.sendall((json.dumps({'event': event, 'topics': topics}) + '\n').encode('utf-8'))
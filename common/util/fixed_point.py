@@ -0,0 +1,81 @@
+'''
+Integer fixed-point units for the order engine: prices in ticks, quantities in lots and times
+in epoch milliseconds. The scales match the decimal_places of the WooAlgoOrder DecimalFields,
+so every stored value converts exactly and the flows can add and compare plain ints.
+'''
+import time
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Optional, Union
+
+from django.db import models
+
+PRICE_SCALE = 10 ** 4
+QUANTITY_SCALE = 10 ** 4
+MS_PER_SECOND = 1000
+
+Number = Union[int, float, str, Decimal]
+
+
+def _to_fixed(value: Optional[Number], scale: int) -> Optional[int]:
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return value * scale
+    # str() of a float is its shortest repr, 0.1 becomes 1000 ticks and not 999.99...
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    # halves round away from zero like sql ROUND on numeric, so ToFixed gives the same units
+    return int((value * scale).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def _from_fixed(units: Optional[int], scale: int) -> Optional[Decimal]:
+    if units is None:
+        return None
+    return Decimal(units) / scale
+
+
+def to_ticks(price: Optional[Number]) -> Optional[int]:
+    return _to_fixed(price, PRICE_SCALE)
+
+
+def to_lots(quantity: Optional[Number]) -> Optional[int]:
+    return _to_fixed(quantity, QUANTITY_SCALE)
+
+
+def seconds_to_ms(seconds: Optional[Number]) -> Optional[int]:
+    return _to_fixed(seconds, MS_PER_SECOND)
+
+
+def ticks_to_decimal(ticks: Optional[int]) -> Optional[Decimal]:
+    return _from_fixed(ticks, PRICE_SCALE)
+
+
+def lots_to_decimal(lots: Optional[int]) -> Optional[Decimal]:
+    return _from_fixed(lots, QUANTITY_SCALE)
+
+
+def ms_to_seconds(ms: Optional[int]) -> Optional[Decimal]:
+    return _from_fixed(ms, MS_PER_SECOND)
+
+
+def ticks_to_float(ticks: int) -> float:
+    return ticks / PRICE_SCALE
+
+
+def lots_to_float(lots: int) -> float:
+    return lots / QUANTITY_SCALE
+
+
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+
+class ToFixed(models.Func):
+    '''
+    The db side of to_ticks, to_lots and seconds_to_ms, e.g. for backfills and annotations.
+    '''
+    template = 'CAST(ROUND(%(expressions)s * %(scale)s) AS bigint)'
+    output_field = models.BigIntegerField()
+
+    def __init__(self, expression, scale: int, **extra):
+        super().__init__(expression, scale=int(scale), **extra)
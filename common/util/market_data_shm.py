@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional, TypedDict
+
+'''
+Fixed layout shared memory segment per symbol, written by the feed process and read by any
+process on the host.
+
+    0    header      magic, version, capacity
+    16   seq         seqlock counter, odd while the writer is mid update
+    24   count       number of closed candles ever written
+    32   open candle the current (not yet closed) candle, start_timestamp 0 means none
+    88   top of book bid, bid size, ask, ask size, updated at (ns)
+    128  ring        the last `capacity` closed candles, slot = index % capacity
+
+Readers copy what they need straight out of the mapped buffer and retry if the seq counter was
+odd or changed while they were reading, so they never see a half written update and never block
+the writer.
+'''
+
+MAGIC = b'TMD1'
+VERSION = 1
+DEFAULT_CAPACITY = 1440
+
+HEADER = struct.Struct('<4sII')
+COUNTER = struct.Struct('<Q')
+CANDLE = struct.Struct('<q6d')
+BOOK = struct.Struct('<4dq')
+
+SEQ_OFFSET = 16
+COUNT_OFFSET = 24
+OPEN_CANDLE_OFFSET = 32
+BOOK_OFFSET = OPEN_CANDLE_OFFSET + CANDLE.size
+RING_OFFSET = 128
+
+MAX_READ_RETRIES = 1000
+
+# segments opened by a writer in this process, the resource tracker unlinks them when the writer exits
+_owned_segments: set[str] = set()
+
+
+class SharedCandle(TypedDict):
+    start_timestamp: int
+    open: float
+    high: float
+    low: float
+    close: float
+    volume: float
+    amount: float
+
+
+class SharedTopOfBook(TypedDict):
+    bid: float
+    bid_size: float
+    ask: float
+    ask_size: float
+    updated_at: int
+
+
+class SeqlockReadError(Exception):
+    pass
+
+
+def get_segment_name(symbol_type: str) -> str:
+    return f'trader_md_{symbol_type}'
+
+
+def get_segment_size(capacity: int) -> int:
+    return RING_OFFSET + capacity * CANDLE.size
+
+
+def _pack_candle(candle: SharedCandle) -> tuple:
+    return (
+        int(candle['start_timestamp']),
+        float(candle['open']),
+        float(candle['high']),
+        float(candle['low']),
+        float(candle['close']),
+        float(candle['volume']),
+        float(candle['amount']),
+    )
+
+
+def _unpack_candle(values: tuple) -> SharedCandle:
+    return {
+        'start_timestamp': values[0],
+        'open': values[1],
+        'high': values[2],
+        'low': values[3],
+        'close': values[4],
+        'volume': values[5],
+        'amount': values[6],
+    }
+
+
+class MarketDataWriter:
+    '''
+    Single writer per symbol, normally the process holding the upstream ws connection.
+    '''
+
+    def __init__(self, symbol_type: str, capacity: int = DEFAULT_CAPACITY):
+        self.symbol_type = symbol_type
+        self.capacity = capacity
+        name = get_segment_name(symbol_type)
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=get_segment_size(capacity))
+        except FileExistsError:
+            # left behind by a previous writer, reuse it if the layout matches
+            self._shm = shared_memory.SharedMemory(name=name)
+            magic, version, existing_capacity = HEADER.unpack_from(self._shm.buf, 0)
+            if magic != MAGIC or version != VERSION or existing_capacity != capacity:
+                self._shm.close()
+                self._shm.unlink()
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=get_segment_size(capacity))
+        _owned_segments.add(name)
+        self._buf = self._shm.buf
+        self._seq = COUNTER.unpack_from(self._buf, SEQ_OFFSET)[0] & ~1
+        self._count = COUNTER.unpack_from(self._buf, COUNT_OFFSET)[0]
+        self._last_closed_start = 0
+        if self._count > 0:
+            self._last_closed_start = CANDLE.unpack_from(self._buf, RING_OFFSET + ((self._count - 1) % capacity) * CANDLE.size)[0]
+        HEADER.pack_into(self._buf, 0, MAGIC, VERSION, capacity)
+        COUNTER.pack_into(self._buf, SEQ_OFFSET, self._seq)
+
+    def write_open_candle(self, candle: SharedCandle):
+        self._begin()
+        CANDLE.pack_into(self._buf, OPEN_CANDLE_OFFSET, *_pack_candle(candle))
+        self._end()
+
+    def write_closed_candle(self, candle: SharedCandle):
+        values = _pack_candle(candle)
+        self._begin()
+        if self._count > 0 and self._last_closed_start == values[0]:
+            # the same candle closed again, overwrite it rather than taking another slot
+            CANDLE.pack_into(self._buf, RING_OFFSET + ((self._count - 1) % self.capacity) * CANDLE.size, *values)
+        else:
+            CANDLE.pack_into(self._buf, RING_OFFSET + (self._count % self.capacity) * CANDLE.size, *values)
+            self._count += 1
+            COUNTER.pack_into(self._buf, COUNT_OFFSET, self._count)
+        self._last_closed_start = values[0]
+        # the open candle is the one that just closed, clear it until the next update arrives
+        CANDLE.pack_into(self._buf, OPEN_CANDLE_OFFSET, 0, 0, 0, 0, 0, 0, 0)
+        self._end()
+
+    def write_top_of_book(self, bid: float, bid_size: float, ask: float, ask_size: float):
+        self._begin()
+        BOOK.pack_into(self._buf, BOOK_OFFSET, float(bid), float(bid_size), float(ask), float(ask_size), time.time_ns())
+        self._end()
+
+    def close(self, unlink: bool = False):
+        self._buf = None
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+            _owned_segments.discard(self._shm.name)
+
+    def _begin(self):
+        self._seq += 1
+        COUNTER.pack_into(self._buf, SEQ_OFFSET, self._seq)
+
+    def _end(self):
+        self._seq += 1
+        COUNTER.pack_into(self._buf, SEQ_OFFSET, self._seq)
+
+
+class MarketDataReader:
+
+    def __init__(self, symbol_type: str):
+        self.symbol_type = symbol_type
+        name = get_segment_name(symbol_type)
+        self._shm = shared_memory.SharedMemory(name=name)
+        # attaching registers the segment with this process' resource tracker, which would unlink
+        # it when the reader exits even though the writer still owns it
+        if name not in _owned_segments:
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self._buf = self._shm.buf
+        magic, version, self.capacity = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{get_segment_name(symbol_type)} is not a market data segment')
+
+    def open_candle(self) -> Optional[SharedCandle]:
+        values = self._read(lambda buf: CANDLE.unpack_from(buf, OPEN_CANDLE_OFFSET))
+        return None if values[0] == 0 else _unpack_candle(values)
+
+    def top_of_book(self) -> Optional[SharedTopOfBook]:
+        bid, bid_size, ask, ask_size, updated_at = self._read(lambda buf: BOOK.unpack_from(buf, BOOK_OFFSET))
+        if updated_at == 0:
+            return None
+        return {'bid': bid, 'bid_size': bid_size, 'ask': ask, 'ask_size': ask_size, 'updated_at': updated_at}
+
+    def latest_price(self) -> Optional[float]:
+        open_candle = self.open_candle()
+        if open_candle is not None:
+            return open_candle['close']
+        closed = self.closed_candles(1)
+        return closed[0]['close'] if len(closed) > 0 else None
+
+    def closed_candles(self, limit: Optional[int] = None) -> list[SharedCandle]:
+        '''
+        Most recent closed candles, oldest first.
+        '''
+        def read(buf) -> list[tuple]:
+            count = COUNTER.unpack_from(buf, COUNT_OFFSET)[0]
+            available = min(count, self.capacity)
+            n = available if limit is None else min(limit, available)
+            return [
+                CANDLE.unpack_from(buf, RING_OFFSET + (index % self.capacity) * CANDLE.size)
+                for index in range(count - n, count)
+            ]
+        return [_unpack_candle(values) for values in self._read(read)]
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+
+    def _read(self, read):
+        buf = self._buf
+        for _ in range(MAX_READ_RETRIES):
+            seq = COUNTER.unpack_from(buf, SEQ_OFFSET)[0]
+            if seq & 1:
+                continue
+            values = read(buf)
+            if COUNTER.unpack_from(buf, SEQ_OFFSET)[0] == seq:
+                return values
+        raise SeqlockReadError(f'could not get a consistent read of {get_segment_name(self.symbol_type)}')
+
+
+def benchmark_read_latency(symbol_type: str, iterations: int = 100000) -> dict:
+    '''
+    Average read latency in ns for each reader call against a live segment, e.g. from manage.py shell.
+    '''
+    reader = MarketDataReader(symbol_type)
+    results = {}
+    try:
+        for name, read in [
+            ('latest_price', reader.latest_price),
+            ('open_candle', reader.open_candle),
+            ('top_of_book', reader.top_of_book),
+            ('closed_candles_60', lambda: reader.closed_candles(60)),
+        ]:
+            started = time.perf_counter_ns()
+            for _ in range(iterations):
+                read()
+            results[name] = (time.perf_counter_ns() - started) / iterations
+    finally:
+        reader.close()
+    return results
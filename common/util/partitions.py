@@ -0,0 +1,399 @@
+'''
+Spreads keyed work over worker processes. A key always hashes to the same partition and each
+partition is owned by one worker at a time, so the events of a key are handled one after the
+other, in the order they were submitted, by the process holding the partition's state.
+
+Partitions are assigned to the live workers by rendezvous hashing. When a worker joins or
+leaves only the partitions it gains or loses move, the old owner releases a partition before
+the new one is assigned it, so the new owner never reads state the old one hasn't written.
+'''
+from __future__ import annotations
+
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+from django.db import connections
+
+from common.util.logging import log
+
+DEFAULT_PARTITION_COUNT = 16
+DEFAULT_ACK_TIMEOUT = 30.0
+MONITOR_INTERVAL = 1.0
+
+
+def get_partition(key: Any, partition_count: int = DEFAULT_PARTITION_COUNT) -> int:
+    # crc32 is stable across processes unlike hash()
+    return zlib.crc32(str(key).encode()) % partition_count
+
+
+def assign_partitions(worker_ids: list[int], partition_count: int = DEFAULT_PARTITION_COUNT) -> dict[int, set[int]]:
+    '''
+    Every partition goes to the worker with the highest hash for it, a partition only moves
+    when its worker leaves or a joining worker out hashes it.
+    '''
+    assignment = {worker_id: set() for worker_id in worker_ids}
+    if len(worker_ids) == 0:
+        return assignment
+    for partition in range(partition_count):
+        owner = max(worker_ids, key=lambda worker_id: zlib.crc32(f'{worker_id}:{partition}'.encode()))
+        assignment[owner].add(partition)
+    return assignment
+
+
+class PartitionHandler:
+    '''
+    Created in each worker process by the pool's handler factory. assign and release are
+    called when the worker gains or loses a partition, release must leave nothing unwritten
+    that the next owner would read. Events of all the worker's partitions go through handle
+    one at a time.
+    '''
+    _outbox = None
+
+    def assign(self, partition: int):
+        pass
+
+    def release(self, partition: int):
+        pass
+
+    def handle(self, partition: int, event: Any):
+        raise Exception('PartitionHandler.handle must be implemented')
+
+    def close(self):
+        pass
+
+    def broadcast(self, event: Any, from_partition: Optional[int] = None):
+        '''
+        Sends the event to every partition but from_partition, whichever worker owns them.
+        '''
+        self._outbox.put(('broadcast', event, from_partition))
+
+    def submit(self, key: Any, event: Any):
+        '''
+        Sends the event to the partition of key, whichever worker owns it.
+        '''
+        self._outbox.put(('submit', key, event))
+
+
+@dataclass
+class PartitionedWorkerStats:
+    submitted: int = 0
+    broadcasts: int = 0
+    rebalances: int = 0
+    moved_partitions: int = 0
+    # workers that died and whose partitions were handed to the others
+    lost_workers: int = 0
+
+
+# raw connections inherited by a forked worker, kept referenced so they are never closed from the child
+_inherited_connections = []
+
+
+def _forget_inherited_connections():
+    for connection in connections.all(initialized_only=True):
+        if connection.connection is not None:
+            _inherited_connections.append(connection.connection)
+            connection.connection = None
+
+
+def _run_worker(worker_id: int, handler_factory: Callable[[], PartitionHandler], inbox, outbox):
+    _forget_inherited_connections()
+    handler = handler_factory()
+    handler._outbox = outbox
+    owned: set[int] = set()
+
+    while True:
+        message = inbox.get()
+        kind = message[0]
+        if kind == 'event':
+            _, partition, event = message
+            _handle(handler, partition, event)
+        elif kind == 'broadcast':
+            _, partitions, event = message
+            for partition in sorted(owned.intersection(partitions)):
+                _handle(handler, partition, event)
+        elif kind == 'assign':
+            for partition in sorted(message[1]):
+                handler.assign(partition)
+                owned.add(partition)
+        elif kind == 'release':
+            _, partitions, token = message
+            for partition in sorted(owned.intersection(partitions)):
+                handler.release(partition)
+                owned.discard(partition)
+            outbox.put(('ack', worker_id, token))
+        elif kind == 'ping':
+            outbox.put(('ack', worker_id, message[1]))
+        elif kind == 'stop':
+            for partition in sorted(owned):
+                handler.release(partition)
+            handler.close()
+            outbox.put(('ack', worker_id, message[1]))
+            return
+
+
+def _handle(handler: PartitionHandler, partition: int, event: Any):
+    try:
+        handler.handle(partition, event)
+    except Exception as e:
+        # one bad event mustn't stop the partition, the ones after it still need handling
+        log('partitioned worker', f'partition {partition} raised {e!r} handling {event!r}')
+
+
+class _Worker:
+
+    def __init__(self, worker_id: int, process, inbox):
+        self.id = worker_id
+        self.process = process
+        self.inbox = inbox
+
+
+class PartitionedWorkers:
+    '''
+    The dispatching side. submit() puts an event on the queue of the worker owning the key's
+    partition, add_worker() and remove_worker() rebalance, and a monitor thread hands the
+    partitions of a worker that died to the others. Events already queued for a dead worker
+    are lost, the handlers' journals cover the writes it had accepted.
+
+    Workers are forked so handler factories don't need to be picklable, db connections open in
+    the dispatcher are closed first unless a transaction holds them.
+    '''
+
+    def __init__(
+        self,
+        handler_factory: Callable[[], PartitionHandler],
+        worker_count: int,
+        partition_count: int = DEFAULT_PARTITION_COUNT,
+        ack_timeout: float = DEFAULT_ACK_TIMEOUT,
+        name: str = 'partitioned-worker'
+    ):
+        if worker_count < 1:
+            raise Exception('PartitionedWorkers needs at least one worker')
+        self.handler_factory = handler_factory
+        self.initial_worker_count = worker_count
+        self.partition_count = partition_count
+        self.ack_timeout = ack_timeout
+        self.name = name
+        self.stats = PartitionedWorkerStats()
+        self._context = multiprocessing.get_context('fork')
+        self._outbox = self._context.Queue()
+        self._workers: dict[int, _Worker] = {}
+        self._owners: dict[int, int] = {}
+        self._next_worker_id = 0
+        self._next_token = 0
+        # submit, rebalance and the monitor are serialized by this, the collector never takes it
+        self._lock = threading.RLock()
+        self._acks: set[tuple[int, int]] = set()
+        self._acks_condition = threading.Condition()
+        self._forwards: queue.Queue = queue.Queue()
+        self._running = False
+        self._threads: list[threading.Thread] = []
+
+    @property
+    def worker_ids(self) -> list[int]:
+        return sorted(self._workers)
+
+    def get_owner(self, key: Any) -> Optional[int]:
+        return self._owners.get(get_partition(key, self.partition_count))
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                raise Exception(f'{self.name} is already running')
+            self._running = True
+            for target, suffix in ((self._collect, 'collector'), (self._forward, 'forwarder'), (self._monitor, 'monitor')):
+                thread = threading.Thread(target=target, name=f'{self.name}-{suffix}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            for _ in range(self.initial_worker_count):
+                self._spawn()
+            self._rebalance()
+
+    def stop(self):
+        with self._lock:
+            if not self._running:
+                return
+            for worker in list(self._workers.values()):
+                self._stop_worker(worker)
+            self._workers = {}
+            self._owners = {}
+            self._running = False
+        self._forwards.put(None)
+        self._outbox.put(None)
+        for thread in self._threads:
+            thread.join(timeout=self.ack_timeout)
+        self._threads = []
+
+    def submit(self, key: Any, event: Any):
+        with self._lock:
+            partition = get_partition(key, self.partition_count)
+            worker = self._workers.get(self._owners.get(partition))
+            if worker is None:
+                raise Exception(f'{self.name} has no worker for partition {partition}')
+            worker.inbox.put(('event', partition, event))
+            self.stats.submitted += 1
+
+    def broadcast(self, event: Any, from_partition: Optional[int] = None):
+        with self._lock:
+            partitions = set(range(self.partition_count)) - {from_partition}
+            for worker in self._workers.values():
+                worker.inbox.put(('broadcast', partitions, event))
+            self.stats.broadcasts += 1
+
+    def drain(self):
+        '''
+        Returns once every worker has handled the events submitted before the call.
+        '''
+        with self._lock:
+            tokens = {worker.id: self._send(worker, 'ping') for worker in self._workers.values()}
+        for worker_id, token in tokens.items():
+            self._wait_for_ack(worker_id, token)
+
+    def add_worker(self) -> int:
+        with self._lock:
+            worker = self._spawn()
+            self._rebalance()
+            return worker.id
+
+    def remove_worker(self, worker_id: int):
+        with self._lock:
+            if len(self._workers) == 1:
+                raise Exception(f'{self.name} can\'t remove its last worker')
+            worker = self._workers[worker_id]
+            # the worker handles what is queued for it and releases its partitions before the others are assigned them
+            self._release(worker, {partition for partition, owner in self._owners.items() if owner == worker_id})
+            del self._workers[worker_id]
+            self._rebalance()
+            self._stop_worker(worker)
+
+    def check_workers(self) -> list[int]:
+        '''
+        Drops the workers that died and hands their partitions to the others, returns their ids.
+        '''
+        with self._lock:
+            dead = [worker for worker in self._workers.values() if not worker.process.is_alive()]
+            if len(dead) == 0:
+                return []
+            for worker in dead:
+                del self._workers[worker.id]
+                self.stats.lost_workers += 1
+                log(self.name, f'worker {worker.id} exited with {worker.process.exitcode}, its partitions move')
+            if len(self._workers) == 0:
+                self._spawn()
+            self._rebalance()
+            return [worker.id for worker in dead]
+
+    def _spawn(self) -> _Worker:
+        for connection in connections.all(initialized_only=True):
+            if not connection.in_atomic_block:
+                connection.close()
+        worker_id = self._next_worker_id
+        self._next_worker_id += 1
+        inbox = self._context.Queue()
+        process = self._context.Process(
+            target=_run_worker,
+            args=(worker_id, self.handler_factory, inbox, self._outbox),
+            name=f'{self.name}-{worker_id}',
+            daemon=True
+        )
+        process.start()
+        worker = _Worker(worker_id, process, inbox)
+        self._workers[worker_id] = worker
+        return worker
+
+    def _rebalance(self):
+        assignment = assign_partitions(self.worker_ids, self.partition_count)
+        moves: dict[int, set[int]] = {}
+        for worker_id, partitions in assignment.items():
+            for partition in partitions:
+                if self._owners.get(partition) != worker_id:
+                    moves.setdefault(worker_id, set()).add(partition)
+        if len(moves) == 0:
+            return
+
+        releases: dict[int, set[int]] = {}
+        for partitions in moves.values():
+            for partition in partitions:
+                owner = self._owners.get(partition)
+                if owner in self._workers:
+                    releases.setdefault(owner, set()).add(partition)
+        tokens = {owner: self._send(self._workers[owner], 'release', partitions) for owner, partitions in releases.items()}
+        for owner, token in tokens.items():
+            self._wait_for_ack(owner, token)
+
+        for worker_id, partitions in moves.items():
+            self._workers[worker_id].inbox.put(('assign', partitions))
+            for partition in partitions:
+                self._owners[partition] = worker_id
+        self.stats.rebalances += 1
+        self.stats.moved_partitions += sum(len(partitions) for partitions in moves.values())
+
+    def _release(self, worker: _Worker, partitions: set[int]):
+        self._wait_for_ack(worker.id, self._send(worker, 'release', partitions))
+        for partition in partitions:
+            self._owners.pop(partition, None)
+
+    def _stop_worker(self, worker: _Worker):
+        if worker.process.is_alive():
+            self._wait_for_ack(worker.id, self._send(worker, 'stop'))
+        worker.process.join(timeout=self.ack_timeout)
+
+    def _send(self, worker: _Worker, kind: str, *args) -> int:
+        self._next_token += 1
+        if kind == 'release':
+            worker.inbox.put((kind, args[0], self._next_token))
+        else:
+            worker.inbox.put((kind, self._next_token))
+        return self._next_token
+
+    def _wait_for_ack(self, worker_id: int, token: int):
+        deadline = time.monotonic() + self.ack_timeout
+        worker = self._workers.get(worker_id)
+        with self._acks_condition:
+            while (worker_id, token) not in self._acks:
+                if time.monotonic() > deadline:
+                    raise Exception(f'{self.name} worker {worker_id} didn\'t answer within {self.ack_timeout}s')
+                if worker is not None and not worker.process.is_alive():
+                    # a dead worker releases nothing, its partitions go to the others as they are
+                    return
+                self._acks_condition.wait(timeout=0.1)
+            self._acks.discard((worker_id, token))
+
+    def _collect(self):
+        while True:
+            message = self._outbox.get()
+            if message is None:
+                return
+            if message[0] == 'ack':
+                with self._acks_condition:
+                    self._acks.add((message[1], message[2]))
+                    self._acks_condition.notify_all()
+            elif message[0] in ('broadcast', 'submit'):
+                self._forwards.put(message)
+
+    def _forward(self):
+        # events from the workers take the lock, the collector has to stay free to pass on acks
+        while True:
+            forward = self._forwards.get()
+            if forward is None:
+                return
+            with self._lock:
+                if not self._running:
+                    continue
+                if forward[0] == 'submit':
+                    _, key, event = forward
+                    self.submit(key, event)
+                else:
+                    _, event, from_partition = forward
+                    self.broadcast(event, from_partition)
+
+    def _monitor(self):
+        while self._running:
+            time.sleep(MONITOR_INTERVAL)
+            with self._lock:
+                if self._running:
+                    self.check_workers()
@@ -0,0 +1,76 @@
+'''
+EXPLAIN for the queries a piece of code runs, to check the planner reads the big tables
+through an index. Postgres also reports the planner's cost, sqlite only the access paths.
+'''
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Callable, Optional, Type
+
+from django.db import connections, models
+from django.test.utils import CaptureQueriesContext
+
+_SQLITE_SCAN = re.compile(r'^SCAN (\w+)(?: AS \w+)?$')
+_SQLITE_INDEX_SCAN = re.compile(r'^SCAN (\w+)(?: AS \w+)? USING (?:COVERING )?INDEX')
+
+
+@dataclass
+class QueryPlan:
+    sql: str
+    # tables read row by row without an index
+    sequential_scans: list[str] = field(default_factory=list)
+    # tables read whole in index order, only cheap when a LIMIT stops the walk early, sqlite only
+    full_index_scans: list[str] = field(default_factory=list)
+    cost: Optional[float] = None
+
+
+def explain(sql: str, using: str = 'default') -> QueryPlan:
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}')
+            result = cursor.fetchone()[0]
+            plan = (json.loads(result) if isinstance(result, str) else result)[0]['Plan']
+            return QueryPlan(sql, _get_postgres_sequential_scans(plan), cost=plan['Total Cost'])
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            details = [row[-1] for row in cursor.fetchall()]
+            return QueryPlan(
+                sql,
+                [scan.group(1) for scan in map(_SQLITE_SCAN.match, details) if scan is not None],
+                [scan.group(1) for scan in map(_SQLITE_INDEX_SCAN.match, details) if scan is not None],
+            )
+    raise Exception(f'explain is not supported on {connection.vendor}')
+
+
+def _get_postgres_sequential_scans(plan: dict) -> list[str]:
+    scans = [plan['Relation Name']] if plan['Node Type'] == 'Seq Scan' else []
+    for child in plan.get('Plans', []):
+        scans += _get_postgres_sequential_scans(child)
+    return scans
+
+
+def explain_queries(func: Callable[[], object], using: str = 'default') -> list[QueryPlan]:
+    '''
+    Runs func and explains every select it ran.
+    '''
+    with CaptureQueriesContext(connections[using]) as context:
+        func()
+    return [
+        explain(query['sql'], using)
+        for query in context.captured_queries if query['sql'].lstrip().upper().startswith('SELECT')
+    ]
+
+
+def analyze(*model_classes: Type[models.Model], using: str = 'default'):
+    '''
+    Updates the postgres planner statistics, plans for freshly seeded tables are meaningless without them.
+    '''
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # sqlite keeps one average per index, a status where NEW is rare looks as common as
+            # FILLED to it, its defaults are closer to what postgres gets from per value stats
+            return
+        for model_class in model_classes:
+            cursor.execute(f'ANALYZE {connection.ops.quote_name(model_class._meta.db_table)}')
@@ -0,0 +1,82 @@
+'''
+Runs independent exchange calls at the same time and undoes the ones that went through when
+any of them failed, so a flow never keeps half of a set of orders that belong together.
+
+The actions run on worker threads. They should only talk to the exchange, the caller saves
+the results afterwards on its own thread and connection.
+'''
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from django.db import connections
+
+from common.util.logging import log
+
+
+@dataclass
+class SagaStep:
+    name: str
+    # returns the result of the call, None when it failed
+    action: Callable[[], Any]
+    # undoes a call that went through given its result, returns False when that failed too
+    compensate: Optional[Callable[[Any], bool]] = None
+
+
+@dataclass
+class SagaResult:
+    results: dict[str, Any] = field(default_factory=dict)
+    failed: list[str] = field(default_factory=list)
+    compensated: list[str] = field(default_factory=list)
+    # steps that went through and couldn't be undone, they need a look by hand
+    orphaned: list[str] = field(default_factory=list)
+
+    @property
+    def succeeded(self) -> bool:
+        return len(self.failed) == 0
+
+
+def _run_step(step: SagaStep) -> Any:
+    try:
+        return step.action()
+    except Exception as e:
+        log('saga', f'{step.name} raised {e!r}')
+        return None
+
+
+def _run_step_on_thread(step: SagaStep) -> Any:
+    try:
+        return _run_step(step)
+    finally:
+        # the thread may have opened its own connection, e.g. to record an api error
+        connections.close_all()
+
+
+def run_saga(steps: list[SagaStep]) -> SagaResult:
+    saga = SagaResult()
+    if len(steps) == 1:
+        # nothing to overlap with, the thread would only add latency
+        outcomes = [_run_step(steps[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=len(steps), thread_name_prefix='saga') as executor:
+            outcomes = list(executor.map(_run_step_on_thread, steps))
+
+    for step, outcome in zip(steps, outcomes):
+        if outcome is None:
+            saga.failed.append(step.name)
+        else:
+            saga.results[step.name] = outcome
+
+    if saga.succeeded:
+        return saga
+
+    for step in reversed(steps):
+        if step.name not in saga.results or step.compensate is None:
+            continue
+        if step.compensate(saga.results[step.name]):
+            saga.compensated.append(step.name)
+        else:
+            saga.orphaned.append(step.name)
+
+    log('saga', f'{", ".join(saga.failed)} failed, compensated {saga.compensated}, orphaned {saga.orphaned}')
+    return saga
@@ -0,0 +1,343 @@
+from __future__ import annotations
+
+import bisect
+import gzip
+import json
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional
+
+from common.util.logging import log
+
+# each frame is <received at (ns), payload length> followed by the utf-8 payload
+FRAME_HEADER = struct.Struct('<qI')
+SEGMENT_SUFFIX = '.tape.gz'
+INDEX_SUFFIX = '.idx'
+
+DEFAULT_SEGMENT_SECONDS = 60 * 60
+DEFAULT_SEGMENT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_BLOCK_FRAMES = 1000
+DEFAULT_BLOCK_SECONDS = 1.0
+
+
+@dataclass
+class TapeIndexEntry:
+    first_ns: int
+    last_ns: int
+    offset: int
+    frames: int
+
+
+@dataclass
+class ReplayStats:
+    frames: int = 0
+    bytes: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def frames_per_second(self) -> float:
+        return self.frames / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class TapeRecorder:
+    '''
+    Appends raw ws frames with their receive time to rotating gzip segment files.
+
+    Frames are compressed in blocks, each block is written as its own gzip member so the
+    file stays a valid .gz while every block can be decompressed on its own. The offset and
+    time range of every block is written to an index file next to the segment for seeking.
+    Full blocks are compressed, written and synced by a writer thread, so recording adds no
+    disk latency to the thread receiving the frames. Both files are synced after every block,
+    blocks a crash left out of the index are found again from the segment when it is read.
+    '''
+
+    def __init__(
+        self,
+        directory: str,
+        name: str,
+        segment_seconds: int = DEFAULT_SEGMENT_SECONDS,
+        segment_max_bytes: int = DEFAULT_SEGMENT_MAX_BYTES,
+        block_frames: int = DEFAULT_BLOCK_FRAMES,
+        block_seconds: float = DEFAULT_BLOCK_SECONDS,
+    ):
+        self._directory = directory
+        self._name = name
+        self._segment_seconds = segment_seconds
+        self._segment_max_bytes = segment_max_bytes
+        self._block_frames = block_frames
+        self._block_seconds = block_seconds
+        self._lock = threading.Lock()
+
+        self._segment_file = None
+        self._index_file = None
+        self._segment_started = 0.0
+        self._segment_path: Optional[str] = None
+
+        self._block = bytearray()
+        self._block_count = 0
+        self._block_first_ns = 0
+        self._block_last_ns = 0
+        self._block_started = 0.0
+
+        # (block, first ns, last ns, frames) for the writer thread, None stops it
+        self._blocks: queue.Queue[Optional[tuple[bytes, int, int, int]]] = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def segment_path(self) -> Optional[str]:
+        return self._segment_path
+
+    def record(self, message: str | bytes, received_at_ns: Optional[int] = None):
+        received_at_ns = time.time_ns() if received_at_ns is None else received_at_ns
+        payload = message.encode('utf-8') if isinstance(message, str) else message
+
+        with self._lock:
+            if self._block_count == 0:
+                self._block_first_ns = received_at_ns
+                self._block_started = time.monotonic()
+
+            self._block += FRAME_HEADER.pack(received_at_ns, len(payload))
+            self._block += payload
+            self._block_count += 1
+            self._block_last_ns = received_at_ns
+
+            if self._block_count >= self._block_frames or time.monotonic() - self._block_started >= self._block_seconds:
+                self._hand_off_block()
+
+    def flush(self):
+        '''
+        Returns once the frames recorded so far are on disk.
+        '''
+        with self._lock:
+            self._hand_off_block()
+        self._blocks.join()
+
+    def close(self):
+        with self._lock:
+            self._hand_off_block()
+            writer = self._writer
+            self._writer = None
+        if writer is not None:
+            self._blocks.put(None)
+            writer.join()
+        self._close_segment()
+
+    def _hand_off_block(self):
+        if self._block_count == 0:
+            return
+
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_blocks, name='tape-writer', daemon=True)
+            self._writer.start()
+        self._blocks.put((bytes(self._block), self._block_first_ns, self._block_last_ns, self._block_count))
+
+        self._block = bytearray()
+        self._block_count = 0
+
+    def _write_blocks(self):
+        while True:
+            block = self._blocks.get()
+            try:
+                if block is None:
+                    return
+                self._write_block(*block)
+            except Exception as e:
+                # the frames of the block are lost, the next blocks are still written
+                log('ERROR: tape', f'could not write a block of {self._name}: {e!r}')
+            finally:
+                self._blocks.task_done()
+
+    def _write_block(self, block: bytes, first_ns: int, last_ns: int, frames: int):
+        if self._should_rotate():
+            self._close_segment()
+            self._open_segment(first_ns)
+
+        offset = self._segment_file.tell()
+        self._segment_file.write(gzip.compress(block, compresslevel=6))
+        # the block is on disk before its index entry, so an index never points past the data
+        _sync(self._segment_file)
+        self._index_file.write(json.dumps([first_ns, last_ns, offset, frames]) + '\n')
+        _sync(self._index_file)
+
+    def _should_rotate(self) -> bool:
+        if self._segment_file is None:
+            return True
+        if time.monotonic() - self._segment_started >= self._segment_seconds:
+            return True
+        return self._segment_file.tell() >= self._segment_max_bytes
+
+    def _open_segment(self, first_ns: int):
+        base = os.path.join(self._directory, f'{self._name}-{first_ns}')
+        self._segment_path = f'{base}{SEGMENT_SUFFIX}'
+        self._segment_file = open(self._segment_path, 'ab')
+        self._index_file = open(f'{base}{INDEX_SUFFIX}', 'a', encoding='utf-8')
+        self._segment_started = time.monotonic()
+
+    def _close_segment(self):
+        if self._segment_file is None:
+            return
+        self._segment_file.close()
+        self._index_file.close()
+        self._segment_file = None
+        self._index_file = None
+
+
+class TapeSegment:
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = read_index(path)
+        self._first_ns = [entry.first_ns for entry in self.index]
+
+    @property
+    def first_ns(self) -> Optional[int]:
+        return self.index[0].first_ns if len(self.index) > 0 else None
+
+    @property
+    def last_ns(self) -> Optional[int]:
+        return self.index[-1].last_ns if len(self.index) > 0 else None
+
+    def frames(self, start_ns: Optional[int] = None, end_ns: Optional[int] = None) -> Iterator[tuple[int, str]]:
+        block = 0
+        if start_ns is not None:
+            block = max(0, bisect.bisect_right(self._first_ns, start_ns) - 1)
+
+        with open(self.path, 'rb') as file:
+            for entry in self.index[block:]:
+                if end_ns is not None and entry.first_ns > end_ns:
+                    return
+                file.seek(entry.offset)
+                for received_at_ns, payload in _read_block(file):
+                    if start_ns is not None and received_at_ns < start_ns:
+                        continue
+                    if end_ns is not None and received_at_ns > end_ns:
+                        return
+                    yield received_at_ns, payload
+
+
+class TapeReplayer:
+    '''
+    Feeds recorded frames back through a client's _on_message, e.g.
+
+        TapeReplayer(paths).replay(lambda msg: client._on_message(None, msg), speed=10)
+
+    speed=1 replays with the recorded gaps, speed=N is N times faster and speed=None replays
+    as fast as the handlers allow, which makes it a throughput benchmark for them.
+    '''
+
+    def __init__(self, paths: list[str]):
+        self.segments = sorted(
+            (segment for segment in (TapeSegment(path) for path in paths) if segment.first_ns is not None),
+            key=lambda segment: segment.first_ns
+        )
+
+    @classmethod
+    def from_directory(cls, directory: str, name: Optional[str] = None) -> 'TapeReplayer':
+        return cls([
+            os.path.join(directory, file_name) for file_name in os.listdir(directory)
+            if file_name.endswith(SEGMENT_SUFFIX) and (name is None or file_name.startswith(f'{name}-'))
+        ])
+
+    def frames(self, start_ns: Optional[int] = None, end_ns: Optional[int] = None) -> Iterator[tuple[int, str]]:
+        for segment in self.segments:
+            if start_ns is not None and segment.last_ns < start_ns:
+                continue
+            if end_ns is not None and segment.first_ns > end_ns:
+                return
+            yield from segment.frames(start_ns, end_ns)
+
+    def replay(
+        self,
+        on_message: Callable[[str], None],
+        speed: Optional[float] = 1.0,
+        start_ns: Optional[int] = None,
+        end_ns: Optional[int] = None
+    ) -> ReplayStats:
+        stats = ReplayStats()
+        started = time.perf_counter()
+        first_ns = None
+
+        for received_at_ns, message in self.frames(start_ns, end_ns):
+            if speed:
+                if first_ns is None:
+                    first_ns = received_at_ns
+                delay = (received_at_ns - first_ns) / 1e9 / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+            on_message(message)
+            stats.frames += 1
+            stats.bytes += len(message)
+
+        stats.elapsed = time.perf_counter() - started
+        return stats
+
+
+def read_index(segment_path: str) -> list[TapeIndexEntry]:
+    index_path = segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+    if not os.path.exists(index_path):
+        return _rebuild_index(segment_path)
+
+    index = []
+    with open(index_path, encoding='utf-8') as file:
+        for line in file:
+            try:
+                index.append(TapeIndexEntry(*json.loads(line)))
+            except ValueError:
+                # a line cut short by a crash, the blocks after it are read from the segment
+                break
+    return _rebuild_index(segment_path, index)
+
+
+def _rebuild_index(segment_path: str, index: Optional[list[TapeIndexEntry]] = None) -> list[TapeIndexEntry]:
+    '''
+    Adds the blocks of the segment after the last one in index, all of them without an index.
+    '''
+    index = list(index or [])
+    with open(segment_path, 'rb') as file:
+        if len(index) > 0:
+            file.seek(index[-1].offset)
+            _read_block(file)
+        while True:
+            offset = file.tell()
+            frames = _read_block(file)
+            if len(frames) == 0:
+                return index
+            index.append(TapeIndexEntry(frames[0][0], frames[-1][0], offset, len(frames)))
+
+
+def _read_block(file) -> list[tuple[int, str]]:
+    # decompress a single gzip member starting at the current file position
+    decompressor = zlib.decompressobj(wbits=31)
+    data = bytearray()
+    while not decompressor.eof:
+        chunk = file.read(64 * 1024)
+        if not chunk:
+            break
+        data += decompressor.decompress(chunk)
+    if not decompressor.eof:
+        # the last block was cut short by a crash, its frames can't be trusted
+        return []
+    # leave the file positioned at the start of the next member
+    file.seek(-len(decompressor.unused_data), os.SEEK_CUR)
+
+    frames = []
+    position = 0
+    while position + FRAME_HEADER.size <= len(data):
+        received_at_ns, length = FRAME_HEADER.unpack_from(data, position)
+        position += FRAME_HEADER.size
+        frames.append((received_at_ns, data[position:position + length].decode('utf-8')))
+        position += length
+    return frames
+
+
+def _sync(file):
+    file.flush()
+    os.fsync(file.fileno())
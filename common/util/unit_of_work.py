@@ -0,0 +1,346 @@
+'''
+A unit of work scoped to one flow invocation, e.g. the handling of one signal or execution
+report. While it is active
+
+- querysets built on UnitOfWorkQuerySet hand back one instance per row, so a row loaded
+  through different managers or relations is the same object with the same pending changes,
+- updates to existing DirtyFieldsMixin rows are collected and written in one transaction with
+  one bulk_update per model and set of changed fields, before the next query that reads one
+  of their tables and at the latest when the unit of work exits,
+- the queries it ran are counted and recorded per flow name.
+
+Inserts are not deferred, the flows need the new primary keys straight away. Filters and
+annotations are evaluated by the db, writing the collected updates before a query on their
+tables keeps them from reading rows the flow has already changed.
+'''
+from contextvars import ContextVar
+from dataclasses import dataclass
+from functools import wraps
+from typing import Any, Callable, Hashable, Optional, Type
+
+from django.db import DatabaseError, connection, models, transaction
+from django.db.models.query import ModelIterable
+from django.db.models.signals import post_save
+
+from common.util.logging import log
+
+_current_unit_of_work: ContextVar[Optional['UnitOfWork']] = ContextVar('current_unit_of_work', default=None)
+
+_NOT_LOADED = object()
+
+
+@dataclass
+class FlowQueryStats:
+    calls: int = 0
+    queries: int = 0
+    max_queries: int = 0
+    last_queries: int = 0
+
+
+_flow_query_stats: dict[str, FlowQueryStats] = {}
+
+
+def get_flow_query_stats() -> dict[str, FlowQueryStats]:
+    return dict(_flow_query_stats)
+
+
+def reset_flow_query_stats():
+    _flow_query_stats.clear()
+
+
+def _record_flow_queries(name: str, queries: int):
+    stats = _flow_query_stats.setdefault(name, FlowQueryStats())
+    stats.calls += 1
+    stats.queries += queries
+    stats.last_queries = queries
+    if queries > stats.max_queries:
+        if stats.calls > 1:
+            # only new highs are logged, a flow that starts querying more shows up once
+            log('flow queries', f'{name} ran {queries} queries, up from at most {stats.max_queries}')
+        stats.max_queries = queries
+
+
+class UnitOfWork:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.query_count = 0
+        self._instances: dict[tuple[Type[models.Model], Any], models.Model] = {}
+        self._loaded: dict[Hashable, Any] = {}
+        # (model, pk) -> (instance, fields a save asked for, None for all changed fields)
+        self._pending: dict[tuple[Type[models.Model], Any], tuple[models.Model, Optional[set[str]]]] = {}
+        self._after_flush: dict[Hashable, tuple[Callable[[list], None], list]] = {}
+        self._flushing = False
+        self._token = None
+        self._execute_wrapper = None
+
+    @property
+    def is_flushing(self) -> bool:
+        return self._flushing
+
+    def __enter__(self) -> 'UnitOfWork':
+        if self._token is not None:
+            raise Exception(f'Unit of work {self.name} is already active')
+        self._token = _current_unit_of_work.set(self)
+        self._execute_wrapper = connection.execute_wrapper(self._count_query)
+        self._execute_wrapper.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+            else:
+                self._flush_after_error(exc_value)
+        finally:
+            self._execute_wrapper.__exit__(None, None, None)
+            _current_unit_of_work.reset(self._token)
+            self._token = None
+            _record_flow_queries(self.name, self.query_count)
+
+    def _flush_after_error(self, error: BaseException):
+        '''
+        The collected updates mirror exchange calls that were already made, they are written
+        even when the flow failed part way through, unless the failure left the transaction
+        unusable. The flow's error is the one raised either way.
+        '''
+        if len(self._pending) == 0 and len(self._after_flush) == 0:
+            return
+        if not _is_connection_usable(error):
+            log('unit of work', f'{self.name} failed with {error!r}, dropped {len(self._pending)} updates')
+            self._pending = {}
+            self._after_flush = {}
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            log('unit of work', f'{self.name} failed with {error!r}, writing its updates failed with {e!r}')
+
+    def _count_query(self, execute, sql, params, many, context):
+        self.query_count += 1
+        if not self._flushing and self._reads_pending_table(sql):
+            self.flush()
+        return execute(sql, params, many, context)
+
+    def _reads_pending_table(self, sql: str) -> bool:
+        if len(self._pending) == 0 or not isinstance(sql, str):
+            return False
+        return any(model._meta.db_table in sql for model, _ in self._pending)
+
+    def _key(self, instance: models.Model) -> tuple[Type[models.Model], Any]:
+        return instance._meta.concrete_model, instance.pk
+
+    def get(self, model: Type[models.Model], pk) -> Optional[models.Model]:
+        return self._instances.get((model._meta.concrete_model, pk))
+
+    def merge(self, instance: models.Model, annotations: tuple[str, ...] = ()) -> models.Model:
+        '''
+        Returns the instance already in the identity map for this row, or adds this one. A
+        mapped instance keeps its field values, it may hold changes the db doesn't have yet,
+        and takes the annotations and related objects loaded with the new one.
+        '''
+        if instance.pk is None:
+            return instance
+
+        for field in instance._meta.concrete_fields:
+            if field.is_relation and field.is_cached(instance):
+                related = field.get_cached_value(instance)
+                if related is not None:
+                    field.set_cached_value(instance, self.merge(related))
+
+        key = self._key(instance)
+        mapped = self._instances.get(key)
+        if mapped is None:
+            self._instances[key] = instance
+            self._link_related(instance)
+            return instance
+        if mapped is instance:
+            return instance
+
+        for name in annotations:
+            if name in instance.__dict__:
+                mapped.__dict__[name] = instance.__dict__[name]
+        if hasattr(instance, '_prefetched_objects_cache'):
+            mapped._prefetched_objects_cache = {
+                **getattr(mapped, '_prefetched_objects_cache', {}),
+                **instance._prefetched_objects_cache,
+            }
+        for field in instance._meta.concrete_fields:
+            if field.is_relation and field.is_cached(instance) and not field.is_cached(mapped):
+                related = field.get_cached_value(instance)
+                if related is None or getattr(mapped, field.attname) == related.pk:
+                    field.set_cached_value(mapped, related)
+        return mapped
+
+    def _link_related(self, instance: models.Model):
+        # foreign keys to rows already in the map resolve without a query
+        for field in instance._meta.concrete_fields:
+            if not field.is_relation or field.is_cached(instance):
+                continue
+            value = getattr(instance, field.attname)
+            if value is None:
+                continue
+            related = self._instances.get((field.related_model._meta.concrete_model, value))
+            if related is not None:
+                field.set_cached_value(instance, related)
+
+    def load_once(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        '''
+        Runs loader the first time key is asked for and returns its result after that.
+        '''
+        result = self._loaded.get(key, _NOT_LOADED)
+        if result is _NOT_LOADED:
+            result = loader()
+            if isinstance(result, models.Model):
+                result = self.merge(result)
+            self._loaded[key] = result
+        return result
+
+    def forget(self, key: Hashable):
+        self._loaded.pop(key, None)
+
+    def defer_save(self, instance: models.Model, update_fields: Optional[set[str]] = None) -> bool:
+        '''
+        Collects the update of an existing row, returns False when it has to be saved now.
+        '''
+        if self._flushing or instance._state.adding or instance.pk is None:
+            return False
+        key = self._key(instance)
+        if self._instances.setdefault(key, instance) is not instance:
+            # a second instance of a mapped row, saving it later could overwrite the mapped one
+            return False
+        pending = self._pending.get(key)
+        if pending is not None and pending[1] is not None and update_fields is not None:
+            update_fields = pending[1] | set(update_fields)
+        elif pending is not None or update_fields is None:
+            update_fields = None
+        self._pending[key] = (instance, None if update_fields is None else set(update_fields))
+        return True
+
+    def after_flush(self, key: Hashable, callback: Callable[[list], None], item: Any = None):
+        '''
+        While flushing, callbacks are collected by key and called once with every item given
+        for that key after the last row is written. Otherwise callback([item]) runs now.
+        '''
+        if not self._flushing:
+            callback([item])
+            return
+        if key not in self._after_flush:
+            self._after_flush[key] = (callback, [])
+        self._after_flush[key][1].append(item)
+
+    def flush(self):
+        if self._flushing or (len(self._pending) == 0 and len(self._after_flush) == 0):
+            return
+        self._flushing = True
+        try:
+            with transaction.atomic():
+                batches: dict[tuple[Type[models.Model], frozenset], list[models.Model]] = {}
+                for instance, requested_fields in self._pending.values():
+                    instance.prepare_save()
+                    fields = instance.get_changed_fields_for_save(
+                        {} if requested_fields is None else {'update_fields': requested_fields}
+                    )
+                    if len(fields) == 0:
+                        continue
+                    batches.setdefault((type(instance), frozenset(fields)), []).append(instance)
+                self._pending = {}
+
+                for (model, fields), instances in batches.items():
+                    self._write(model, fields, instances)
+
+                while len(self._after_flush) > 0:
+                    key = next(iter(self._after_flush))
+                    callback, items = self._after_flush.pop(key)
+                    callback(items)
+        finally:
+            self._flushing = False
+            self._pending = {}
+            self._after_flush = {}
+
+    def _write(self, model: Type[models.Model], fields: frozenset, instances: list[models.Model]):
+        # the saves that were deferred already validated the changes, only the rows are left to write
+        if len(instances) == 1:
+            instance = instances[0]
+            model._base_manager.filter(pk=instance.pk).update(**{
+                model._meta.get_field(name).attname: getattr(instance, model._meta.get_field(name).attname)
+                for name in fields
+            })
+        else:
+            model._base_manager.bulk_update(instances, sorted(fields))
+        for instance in instances:
+            instance.reset_dirty_fields(set(fields))
+            # bulk_update sends no signals, the receivers keeping derived rows in sync need them
+            post_save.send(
+                sender=model,
+                instance=instance,
+                created=False,
+                update_fields=fields,
+                raw=False,
+                using=instance._state.db,
+            )
+
+
+def _is_connection_usable(error: BaseException) -> bool:
+    # an atomic block marked for rollback takes no more queries
+    if connection.needs_rollback:
+        return False
+    # on postgres a failed statement aborts the transaction it ran in, is_usable tries a query
+    if isinstance(error, DatabaseError):
+        return connection.connection is not None and connection.is_usable()
+    return True
+
+
+def get_current_unit_of_work() -> Optional[UnitOfWork]:
+    return _current_unit_of_work.get()
+
+
+def in_unit_of_work(name: str):
+    '''
+    Runs the decorated flow in a unit of work, or in the caller's when one is already active.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if get_current_unit_of_work() is not None:
+                return func(*args, **kwargs)
+            with UnitOfWork(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def load_once(key: Hashable, loader: Callable[[], Any]) -> Any:
+    unit_of_work = get_current_unit_of_work()
+    if unit_of_work is None:
+        return loader()
+    return unit_of_work.load_once(key, loader)
+
+
+def forget(key: Hashable):
+    unit_of_work = get_current_unit_of_work()
+    if unit_of_work is not None:
+        unit_of_work.forget(key)
+
+
+def run_after_flush(key: Hashable, callback: Callable[[list], None], item: Any = None):
+    unit_of_work = get_current_unit_of_work()
+    if unit_of_work is None:
+        callback([item])
+        return
+    unit_of_work.after_flush(key, callback, item)
+
+
+class UnitOfWorkQuerySet(models.QuerySet):
+    '''
+    Hands the model instances it loads inside a unit of work through its identity map.
+    '''
+
+    def _fetch_all(self):
+        fetched = self._result_cache is None
+        super()._fetch_all()
+        unit_of_work = get_current_unit_of_work()
+        if not fetched or unit_of_work is None or not issubclass(self._iterable_class, ModelIterable):
+            return
+        annotations = tuple(self.query.annotations)
+        self._result_cache = [unit_of_work.merge(instance, annotations) for instance in self._result_cache]
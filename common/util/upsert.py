@@ -0,0 +1,163 @@
+'''
+Insert-or-update in one statement. On Postgres this is a single
+INSERT ... ON CONFLICT ... DO UPDATE ... RETURNING round trip that also reports whether each
+row was created and, for chosen columns, the value the row had before the statement. Other
+backends fall back to a locked select and a save per object, like update_or_create.
+'''
+from typing import NamedTuple, Optional, Type
+
+from django.db import connections, models, router, transaction
+
+
+class UpsertResult(NamedTuple):
+    instance: models.Model
+    created: bool
+    # values of previous_fields before the upsert, empty for created rows
+    previous: dict
+
+
+def upsert(
+    model: Type[models.Model],
+    objs: list[models.Model],
+    unique_fields: list[str],
+    update_fields: Optional[list[str]] = None,
+    previous_fields: Optional[list[str]] = None,
+) -> list[UpsertResult]:
+    '''
+    Inserts objs, or updates update_fields of the rows matching them on unique_fields, which
+    must be covered by a unique constraint. With no update_fields existing rows are returned
+    unchanged, i.e. get_or_create. Results are in the order of objs.
+
+    Like bulk_create, the Postgres path doesn't call save() or send signals, callers that rely
+    on either should do that work themselves.
+    '''
+    if len(objs) == 0:
+        return []
+
+    update_fields = list(update_fields or [])
+    previous_fields = list(previous_fields or [])
+    using = router.db_for_write(model)
+    connection = connections[using]
+    meta = model._meta
+
+    # auto_now columns are set by save() on updates too
+    update_fields += [
+        field.name for field in meta.concrete_fields
+        if getattr(field, 'auto_now', False) and field.name not in update_fields
+    ]
+
+    keys = [_get_key(meta, obj, unique_fields) for obj in objs]
+    if len(set(keys)) != len(keys):
+        raise Exception(f'upsert of {meta.label} was given more than one object per {unique_fields}')
+
+    if connection.vendor != 'postgresql':
+        return _upsert_with_save(model, objs, unique_fields, update_fields, previous_fields, using)
+
+    returned = _upsert_returning(model, objs, unique_fields, update_fields, previous_fields, connection)
+    return [returned[key] for key in keys]
+
+
+def _get_key(meta, obj: models.Model, unique_fields: list[str]) -> tuple:
+    key = []
+    for name in unique_fields:
+        field = meta.get_field(name)
+        key.append(field.to_python(getattr(obj, field.attname)))
+    return tuple(key)
+
+
+def _upsert_returning(model, objs, unique_fields, update_fields, previous_fields, connection) -> dict:
+    meta = model._meta
+    qn = connection.ops.quote_name
+    table = qn(meta.db_table)
+    insert_fields = [field for field in meta.concrete_fields if field is not meta.auto_field]
+    returned_fields = list(meta.concrete_fields)
+    unique_columns = [qn(meta.get_field(name).column) for name in unique_fields]
+    previous_columns = [qn(meta.get_field(name).column) for name in previous_fields]
+
+    params = []
+    sql = ''
+
+    if previous_columns:
+        unique_rows = ', '.join(['(' + ', '.join(['%s'] * len(unique_columns)) + ')'] * len(objs))
+        for obj in objs:
+            params += [
+                meta.get_field(name).get_db_prep_value(value, connection)
+                for name, value in zip(unique_fields, _get_key(meta, obj, unique_fields))
+            ]
+        sql += (
+            f'WITH previous AS ('
+            f'SELECT {", ".join(unique_columns + previous_columns)} FROM {table} '
+            f'WHERE ({", ".join(unique_columns)}) IN (VALUES {unique_rows}) FOR UPDATE) '
+        )
+
+    value_rows = []
+    for obj in objs:
+        value_rows.append('(' + ', '.join(['%s'] * len(insert_fields)) + ')')
+        params += [field.get_db_prep_save(field.pre_save(obj, True), connection) for field in insert_fields]
+
+    if update_fields:
+        assignments = [
+            f'{column} = EXCLUDED.{column}'
+            for column in (qn(meta.get_field(name).column) for name in update_fields)
+        ]
+    else:
+        # a no-op update so RETURNING includes the existing row
+        assignments = [f'{unique_columns[0]} = EXCLUDED.{unique_columns[0]}']
+
+    previous_selects = [
+        f'(SELECT previous.{column} FROM previous WHERE '
+        + ' AND '.join(f'previous.{unique} = {table}.{unique}' for unique in unique_columns)
+        + ')'
+        for column in previous_columns
+    ]
+
+    sql += (
+        f'INSERT INTO {table} ({", ".join(qn(field.column) for field in insert_fields)}) '
+        f'VALUES {", ".join(value_rows)} '
+        f'ON CONFLICT ({", ".join(unique_columns)}) DO UPDATE SET {", ".join(assignments)} '
+        f'RETURNING {", ".join(f"{table}.{qn(field.column)}" for field in returned_fields)}, '
+        + ', '.join([f'({table}.xmax = 0)'] + previous_selects)
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    results = {}
+    for row in rows:
+        values = [_from_db(field, value, connection) for field, value in zip(returned_fields, row)]
+        instance = model.from_db(connection.alias, [field.attname for field in returned_fields], values)
+        created = row[len(returned_fields)]
+        previous = {} if created else {
+            name: _from_db(meta.get_field(name), value, connection)
+            for name, value in zip(previous_fields, row[len(returned_fields) + 1:])
+        }
+        results[_get_key(meta, instance, unique_fields)] = UpsertResult(instance, created, previous)
+    return results
+
+
+def _from_db(field: models.Field, value, connection):
+    for converter in field.get_db_converters(connection):
+        value = converter(value, field, connection)
+    return value
+
+
+def _upsert_with_save(model, objs, unique_fields, update_fields, previous_fields, using) -> list[UpsertResult]:
+    meta = model._meta
+    results = []
+    with transaction.atomic(using=using):
+        for obj in objs:
+            lookup = {meta.get_field(name).attname: value for name, value in zip(unique_fields, _get_key(meta, obj, unique_fields))}
+            existing = model._default_manager.using(using).select_for_update().filter(**lookup).first()
+            if existing is None:
+                obj.save(force_insert=True, using=using)
+                results.append(UpsertResult(obj, True, {}))
+                continue
+            previous = {name: getattr(existing, meta.get_field(name).attname) for name in previous_fields}
+            if update_fields:
+                for name in update_fields:
+                    attname = meta.get_field(name).attname
+                    setattr(existing, attname, getattr(obj, attname))
+                existing.save(update_fields=update_fields, using=using)
+            results.append(UpsertResult(existing, False, previous))
+    return results
@@ -0,0 +1,243 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from common.util.logging import log
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_RETRY_SECONDS = 1.0
+# retries double the wait up to MAX_RETRY_SECONDS, ten of them take a few minutes
+DEFAULT_MAX_RETRIES = 10
+MAX_RETRY_SECONDS = 60.0
+# the journal is truncated once the thread has caught up and it holds at least this many ops
+COMPACT_AFTER_OPS = 10000
+CHECKPOINT_SUFFIX = '.applied'
+DEAD_LETTER_SUFFIX = '.dead'
+
+
+@dataclass
+class WriteBehindStats:
+    enqueued: int = 0
+    applied: int = 0
+    replayed: int = 0
+    batches: int = 0
+    failures: int = 0
+    dead_lettered: int = 0
+
+
+class WriteBehindQueue:
+    '''
+    Durable FIFO of write operations applied by a background thread.
+
+    put() appends the op to a journal and fsyncs it before returning, so an op that was put is
+    never lost even if the process dies before it is applied. The thread hands ops to apply in
+    batches, in the order they were put, and records the sequence number of the last applied op
+    in a checkpoint file. Ops journaled after the checkpoint are replayed by start(), so apply
+    must be idempotent. A batch that raises is retried max_retries times, later ops are never
+    applied ahead of it. After that its ops are applied one at a time and the ones that still
+    raise are appended to the dead letter file next to the journal, so one bad op doesn't hold
+    up the rest. Dead letters are the ops as they were put and can be put again once fixed.
+    '''
+
+    def __init__(
+        self,
+        path: str,
+        apply: Callable[[list[dict]], None],
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        retry_seconds: float = DEFAULT_RETRY_SECONDS,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        name: str = 'write-behind'
+    ):
+        self.path = path
+        self.stats = WriteBehindStats()
+        self._apply = apply
+        self._batch_size = batch_size
+        self._retry_seconds = retry_seconds
+        self._max_retries = max_retries
+        self._name = name
+        self._pending: list[tuple[int, dict]] = []
+        self._condition = threading.Condition()
+        self._journal = None
+        self._seq = 0
+        self._applied_seq = 0
+        # sequence numbers restart when the journal is compacted, these never do
+        self._put_total = 0
+        self._applied_total = 0
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def start(self) -> int:
+        '''
+        Applies the ops left in the journal by a previous process and starts the thread,
+        returns the number of ops replayed.
+        '''
+        replayed = self._read_unapplied()
+        if len(replayed) > 0:
+            self._apply_with_retry([op for _, op in replayed])
+            self._applied_seq = replayed[-1][0]
+            self.stats.replayed += len(replayed)
+        self._seq = self._applied_seq
+        self._compact()
+
+        self._journal = open(self.path, 'a', encoding='utf-8')
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+        self._thread.start()
+        return len(replayed)
+
+    def put(self, op: dict):
+        if self._journal is None:
+            raise Exception('WriteBehindQueue must be started before ops are put')
+        with self._condition:
+            self._seq += 1
+            self._journal.write(json.dumps({'seq': self._seq, 'op': op}, default=str) + '\n')
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._pending.append((self._seq, op))
+            self._put_total += 1
+            self.stats.enqueued += 1
+            self._condition.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        '''
+        Blocks until every op put so far has been applied, returns False on timeout.
+        '''
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            target = self._put_total
+            while self._applied_total < target:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stop(self, drain: bool = True):
+        '''
+        Stops the thread, without drain the pending ops stay in the journal for the next start.
+        '''
+        with self._condition:
+            if not drain:
+                self._pending.clear()
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            self._thread.join()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if drain:
+            self._compact()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and len(self._pending) == 0:
+                    self._condition.wait()
+                if len(self._pending) == 0:
+                    return
+                batch = self._pending[:self._batch_size]
+
+            self._apply_with_retry([op for _, op in batch])
+
+            with self._condition:
+                del self._pending[:len(batch)]
+                self._applied_total += len(batch)
+                self._applied_seq = batch[-1][0]
+                if self._applied_seq == self._seq and self._seq >= COMPACT_AFTER_OPS:
+                    self._journal.truncate(0)
+                    os.fsync(self._journal.fileno())
+                    self._seq = 0
+                    self._applied_seq = 0
+                self._write_checkpoint()
+                self._condition.notify_all()
+
+    @property
+    def dead_letter_path(self) -> str:
+        return self.path + DEAD_LETTER_SUFFIX
+
+    def _apply_with_retry(self, ops: list[dict]):
+        error = self._try_apply(ops, self._max_retries)
+        if error is None:
+            return
+        if len(ops) == 1:
+            self._dead_letter(ops[0], error)
+            return
+        # the batch has run out of retries, find the ops that fail on their own
+        for op in ops:
+            error = self._try_apply([op], 0)
+            if error is not None:
+                self._dead_letter(op, error)
+
+    def _try_apply(self, ops: list[dict], retries: int) -> Optional[Exception]:
+        for attempt in range(retries + 1):
+            try:
+                self._apply(ops)
+                self.stats.applied += len(ops)
+                self.stats.batches += 1
+                return None
+            except Exception as e:
+                self.stats.failures += 1
+                error = e
+                if attempt < retries:
+                    log(f'ERROR: {self._name} batch failed, retrying', e)
+                    time.sleep(min(self._retry_seconds * 2 ** attempt, MAX_RETRY_SECONDS))
+        return error
+
+    def _dead_letter(self, op: dict, error: Exception):
+        log(f'ERROR: {self._name} op failed, moved to {self.dead_letter_path}', error)
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'op': op, 'error': repr(error), 'time': time.time()}, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.stats.dead_lettered += 1
+
+    def _read_unapplied(self) -> list[tuple[int, dict]]:
+        self._applied_seq = self._read_checkpoint()
+        if not os.path.exists(self.path):
+            return []
+        ops = []
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # a torn last line means put() never returned for it
+                    continue
+                if entry['seq'] > self._applied_seq:
+                    ops.append((entry['seq'], entry['op']))
+        return ops
+
+    def _read_checkpoint(self) -> int:
+        try:
+            with open(self.path + CHECKPOINT_SUFFIX, encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_checkpoint(self):
+        tmp_path = self.path + CHECKPOINT_SUFFIX + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(str(self._applied_seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path + CHECKPOINT_SUFFIX)
+
+    def _compact(self):
+        # everything journaled has been applied, start both files again from zero
+        if self._applied_seq < self._seq:
+            return
+        for path in (self.path, self.path + CHECKPOINT_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+        self._seq = 0
+        self._applied_seq = 0
@@ -2,17 +2,18 @@ from __future__ import annotations
 
 import json
 import csv
-from typing import Type, Optional, TypedDict, Callable
+from typing import Type, Optional, TypedDict
 
 from typing_extensions import NotRequired
 
 from us.helpers import get_symbol, get_timeframe_of, get_klines_for_timeframe, calculate_timeframe_kline_values
 from us.models import Kline, WsKline, Timeframe, convert_epoch_timestamp_to_readable_datetime, TimeframeKline, \
-    get_default_symbol, TimeframeKlineStats, BaseKline, KlineTypes
+    get_default_symbol, TimeframeKlineStats, BaseKline, KlineTypes, Symbol
 from us.utilities import clear_timeframe_klines_from_for, create_timeframe_klines_for, create_timeframe_kline_stats_for
 from us_diagnostics.models import KlineDiagnosticsResult
 from woo.api_rest import request_historical_klines as woo_request_historical_klines, KlineData, HistoricalKlineResponseMetaData
-from binance_api.api_rest import request_historical_klines as binance_request_historical_klines
+from binance_api.api_rest import iter_historical_klines_range as binance_iter_historical_klines_range, \
+    HISTORICAL_KLINES_MAX_LIMIT as BINANCE_HISTORICAL_KLINES_MAX_LIMIT
 
 
 class TradingViewKlineData(KlineData):
@@ -41,31 +42,66 @@ def compare_saved_klines_with_historical_data(
     symbol_type: str,
     start_time: int,
     kline_cls: Type[Kline | WsKline],
-    exchange: Optional[str] = 'woo'
+    exchange: Optional[str] = 'woo',
+    end_time: Optional[int] = None
 ) -> tuple[None, None] | tuple[list[KlineComparisonStats], HistoricalKlineResponseMetaData]:
 
-    request_func: Callable = woo_request_historical_klines if exchange == 'woo' else binance_request_historical_klines
-    rows, meta = request_func(symbol_type, start_time)
-    if rows is None:
-        print(f'ERROR: raw_klines_data is None')
-        return None, None
     symbol = get_symbol(symbol_type)
     incorrect_klines: list[KlineComparisonStats] = []
 
+    if exchange == 'woo':
+        rows, meta = woo_request_historical_klines(symbol_type, start_time)
+        if rows is None:
+            print(f'ERROR: raw_klines_data is None')
+            return None, None
+        incorrect_klines += compare_saved_klines_with_rows(symbol, kline_cls, rows)
+        return incorrect_klines, meta
+
+    # the binance range can cover everything since start_time, it is compared a page at a time
+    total = 0
+    page_count = 0
+    for rows in binance_iter_historical_klines_range(symbol_type, start_time, end_time):
+        if rows is None:
+            print(f'ERROR: raw_klines_data is None')
+            return None, None
+        incorrect_klines += compare_saved_klines_with_rows(symbol, kline_cls, rows)
+        total += len(rows)
+        page_count += 1
+
+    # every page of the range has been compared, the last one is the current page
+    return incorrect_klines, {
+        'total': total,
+        'records_per_page': BINANCE_HISTORICAL_KLINES_MAX_LIMIT,
+        'current_page': page_count
+    }
+
+
+def compare_saved_klines_with_rows(
+    symbol: Symbol,
+    kline_cls: Type[Kline | WsKline],
+    rows: list[KlineData]
+) -> list[KlineComparisonStats]:
+    incorrect_klines: list[KlineComparisonStats] = []
+
+    start_timestamps = [int(row.get('start_timestamp') / 1000) for row in rows]
+    klines = {
+        int(kline.start_timestamp): kline
+        for kline in kline_cls.objects.filter(symbol=symbol, start_timestamp__in=start_timestamps)
+    }
+
     for row in rows:
-        try:
-            kline = kline_cls.objects.get(symbol=symbol, start_timestamp=row.get('start_timestamp') / 1000)
-            comp_stats = compare_klines(kline, row)
+        kline = klines.get(int(row.get('start_timestamp') / 1000))
+        if kline is None:
+            continue
 
-            if len(comp_stats) == 2 or (len(comp_stats) == 3 and comp_stats.get('amount') is not None):
-                continue
+        comp_stats = compare_klines(kline, row)
 
-            incorrect_klines.append(comp_stats)
+        if len(comp_stats) == 2 or (len(comp_stats) == 3 and comp_stats.get('amount') is not None):
+            continue
 
-        except kline_cls.DoesNotExist:
-            pass
+        incorrect_klines.append(comp_stats)
 
-    return incorrect_klines, meta
+    return incorrect_klines
 
 
 def compare_klines(kline: BaseKline, kline_data: KlineData) -> KlineComparisonStats:
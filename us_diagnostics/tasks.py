@@ -25,11 +25,12 @@ def kline_diagnostics(
     current_time: Optional[int] = None,
     kline_type: Optional[str] = None,
     exchange: str = 'woo',
+    end_time: Optional[int] = None,
     **kwargs
 ):
     current_time = [current_time, start_time][current_time is None]
     kline_cls = get_kline_cls(kline_type)
-    return compare_saved_klines_with_historical_data(symbol_type, current_time, kline_cls, exchange)
+    return compare_saved_klines_with_historical_data(symbol_type, current_time, kline_cls, exchange, end_time)
 
 
 @signals.task_success.connect(sender=kline_diagnostics)
@@ -72,13 +73,15 @@ def kline_diagnostic_success(**kwargs):
         incorrect_klines = create_or_update_diagnostics_file(file_path, incorrect_klines)
         incorrect_total = len(incorrect_klines)
 
-    current_time += int(meta['records_per_page']) * 60
+    # the pages up to the current one have been compared
+    compared = int(meta['current_page']) * int(meta['records_per_page'])
+    current_time += compared * 60
     kline_cls = get_kline_cls(kline_type)
     symbol = get_symbol(symbol_type)
     last_kline = kline_cls.objects.filter(symbol=symbol).order_by('-end_timestamp').first()
     finished = False
 
-    if int(meta['records_per_page']) >= int(meta['total']):
+    if compared >= int(meta['total']):
         finished = True
     elif last_kline is not None and current_time > last_kline.end_timestamp:
         finished = True
@@ -4,8 +4,12 @@ from django.contrib import admin
 from django.urls import resolve
 
 from common.util.admin import linkify
+from us_orders.models.algo_order_route import AlgoOrderRoute
 from us_orders.models.order import Order
 from us_orders.models.order_group import OrderGroup
+from us_orders.models.order_archive import ArchivedAlgoOrder, ArchivedOrder, ArchivedOrderGroup
+from us_orders.models.order_group_state import OrderGroupState
+from us_orders.models.order_placement import OrderPlacement
 from woo.admin import get_trigger_time
 from woo.models import WooAlgoOrder
 
@@ -20,6 +24,9 @@ class OrderAdmin(admin.ModelAdmin):
         'get_stop_trigger_time', linkify('stop', 'pk'), 'created_at'
     ]
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_state()
+
     @admin.display(description='Filled at')
     def get_trigger_time(self, obj):
         return get_trigger_time(obj.order)
@@ -45,6 +52,9 @@ class OrderGroupAdmin(admin.ModelAdmin):
     readonly_fields = ['id']
     list_display = ['id', 'side', 'quantity', 'is_active', 'is_pending', 'is_closed', 'has_stop', 'created_at']
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_state()
+
     def get_order_group(self, request):
         resolved = resolve(request.path_info)
         if resolved.kwargs.get('object_id'):
@@ -66,3 +76,53 @@ class OrderGroupAdmin(admin.ModelAdmin):
             if order_group:
                 kwargs['queryset'] = Order.objects.get_all_orders_for_side(order_group.side)
         return super().formfield_for_manytomany(db_field, request, **kwargs)
+
+
+@admin.register(OrderGroupState)
+class OrderGroupStateAdmin(admin.ModelAdmin):
+    readonly_fields = ['id', 'updated_at']
+    list_filter = ['side', 'state']
+    list_display = ['id', 'group', 'side', linkify('order_group', 'pk'), 'state', 'filled_quantity', 'last_fill_time', 'updated_at']
+
+
+@admin.register(AlgoOrderRoute)
+class AlgoOrderRouteAdmin(admin.ModelAdmin):
+    readonly_fields = ['id']
+    list_filter = ['role']
+    search_fields = ['algo_order_id']
+    list_display = ['id', 'algo_order_id', 'role', linkify('order', 'pk'), linkify('order_group', 'pk')]
+
+
+@admin.register(OrderPlacement)
+class OrderPlacementAdmin(admin.ModelAdmin):
+    list_filter = ['state', 'created_at']
+    readonly_fields = ['id', 'created_at', 'updated_at']
+    list_display = ['id', 'signal_id', linkify('order_group', 'pk'), 'state', 'results', 'created_at', 'updated_at']
+
+
+@admin.register(ArchivedOrderGroup)
+class ArchivedOrderGroupAdmin(admin.ModelAdmin):
+    list_filter = ['side', 'created_at']
+    list_select_related = ['stop']
+    readonly_fields = ['id', 'archived_at']
+    list_display = ['id', 'group_id', 'side', linkify('stop', 'pk'), 'created_at', 'archived_at']
+
+
+@admin.register(ArchivedOrder)
+class ArchivedOrderAdmin(admin.ModelAdmin):
+    list_filter = ['created_at']
+    list_select_related = ['order_group', 'order', 'stop']
+    readonly_fields = ['id', 'archived_at']
+    list_display = [
+        'id', linkify('order_group', 'pk'), linkify('order', 'pk'), linkify('stop', 'pk'), 'force_close', 'created_at', 'archived_at'
+    ]
+
+
+@admin.register(ArchivedAlgoOrder)
+class ArchivedAlgoOrderAdmin(admin.ModelAdmin):
+    list_filter = ['side', 'status', 'reduce_only', 'created_at']
+    readonly_fields = ['id', 'archived_at']
+    search_fields = ['order_id']
+    list_display = [
+        'id', 'order_id', 'order_tag', 'side', 'quantity', 'reduce_only', 'trigger_price', 'status', 'created_at', 'archived_at'
+    ]
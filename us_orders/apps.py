@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class UsOrdersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'us_orders'
+
+    def ready(self):
+        # registers the receivers keeping OrderGroupState and AlgoOrderRoute in sync and the archive and placement models
+        import us_orders.models.order_group_state  # noqa: F401
+        import us_orders.models.algo_order_route  # noqa: F401
+        import us_orders.models.order_archive  # noqa: F401
+        import us_orders.models.order_placement  # noqa: F401
@@ -1,128 +1,235 @@
 from typing import Optional
 
+from common.util.saga import SagaResult, SagaStep, run_saga
+from common.util.unit_of_work import in_unit_of_work
 from us.models import TimeframeKlineSignal, StrategyVariables
 
 from us_orders.models.order import Order
 from us_orders.models.order_group import OrderGroup
-from us_orders.helpers import get_or_create_latest_order_group_for_side, is_order_group_allowing_orders, update_algo_order, \
-    create_order, create_algo_order, get_attributes_for_order, update_order
-
+from us_orders.models.order_group_state import OrderGroupState
+from us_orders.models.order_placement import OrderPlacement, PlacementStateChoices
+from us_orders.locks import with_timeframe_group_lock
+from us_orders.routing import get_group_order_tag, get_group_stop_tag
+from us_orders.helpers import get_or_create_latest_order_group_for_side, is_order_group_allowing_orders, \
+    get_attributes_for_order, get_opposite_side
+
+from woo.api_types import AlgoOrderRequestParams, AlgoOrderResponseData
+from woo.helpers import create_algo_order_params, get_open_algo_orders, send_algo_order_cancel, send_algo_order_edit, \
+    send_new_algo_order_with_params
 from woo.models import WooAlgoOrder
 
+# saga step names of the new order and the stop of the opposite active group
+ORDER_STEP = 'order'
+STOP_STEP = 'stop'
+
 
+@with_timeframe_group_lock
+@in_unit_of_work('handle_new_signal')
 def handle_new_signal(
     timeframe_group_id: int,
     sgnl: TimeframeKlineSignal,
     strategy_vars: StrategyVariables
 ):
-    # TODO - do i need to rethink the order in which this is executed? If any of the API calls fail
-    # it can end up in an inconsistent state. Empty group with no order. Or active group with no stop order
-    # Maybe this should just be a get not an or create?
+    # Maybe this should just be a get not an or create? An empty group is all a failed placement leaves behind
     order_group = get_or_create_latest_order_group_for_side(sgnl.type, timeframe_group_id)
 
     if not is_order_group_allowing_orders(order_group):
         return
 
+    order_attributes = get_attributes_for_order(sgnl, strategy_vars)
+    pending_order = order_group.current_pending_order
+    placements = [get_order_placement(order_attributes, order_group.id, pending_order)]
+
     # if the new order is part of an active group
     # if the group has a stop order it only needs to be updated once an order on this side is filled
-    if order_group.is_active:
-        order, created = create_or_update_order(
-            sgnl,
-            strategy_vars,
-            order_group.id,
-            order_group.current_pending_order
-        )
-        if created:
-            order_group.orders.add(order)
-    else:
-
-        # this should be 'get_group_for_side(opposite side to sgnl)' then if not None and active, create or update stop
-        active_group = OrderGroup.objects.get_current_active_group()
-        stop_created = False
-        stop = None
-        '''
-        There's an issue here - the way in which group.is_active is calculated
-        is different to the way in which OrderGroup.objects.get_current_active_group is determined.
-
-        OrderGroup.objects.get_current_active_group is incorrect as it calculates the active group
-        by getting the latest FILLED order on that side.
-
-        This creates a problem here as the active_group returned can be the same as order_group
-        even though order_group.is_active is False.
-        '''
-        if active_group is not None and active_group != order_group:
-            stop, stop_created = create_or_update_stop_order_for_group(active_group, sgnl, strategy_vars)
-
-        order, order_created = create_or_update_order(
-            sgnl,
-            strategy_vars,
-            order_group.id,
-            order_group.current_pending_order
-        )
-
-        if order_created:
-            order_group.orders.add(order)
-
-        if stop_created:
-            active_group.set_stop(stop)
-
+    active_group = None
+    if not order_group.is_active:
+        # the active group on the opposite side of this timeframe group, it is under the same lock
+        active_group = OrderGroupState.objects.get_active_group_for_side(timeframe_group_id, get_opposite_side(sgnl.type))
+        if active_group is not None:
+            placements.append(get_stop_placement(order_attributes, active_group))
+
+    saga = place_orders(sgnl, order_group, [placement for placement in placements if placement is not None])
+    if not saga.succeeded:
+        return
 
-def create_or_update_order(
-    sgnl: TimeframeKlineSignal,
-    strategy_vars: StrategyVariables,
+    # the exchange has every order now, the rows follow on this thread
+    if pending_order is None:
+        order = Order.objects.create(indicator=sgnl, order=WooAlgoOrder.objects.create(**saga.results[ORDER_STEP]))
+        order_group.add_orders([order])
+    else:
+        if ORDER_STEP in saga.results:
+            pending_order.order.update(**saga.results[ORDER_STEP])
+        pending_order.update_indicator(sgnl)
+
+    if active_group is not None and STOP_STEP in saga.results:
+        if active_group.stop is None:
+            active_group.set_stop(WooAlgoOrder.objects.create(**saga.results[STOP_STEP]))
+        else:
+            active_group.stop.update(**saga.results[STOP_STEP])
+
+
+def place_orders(sgnl: TimeframeKlineSignal, order_group: OrderGroup, placements: list[tuple[dict, SagaStep]]) -> SagaResult:
+    '''
+    Records the exchange calls, sends them at the same time and cancels or reverts the ones that
+    went through if any of them failed.
+    '''
+    if len(placements) == 0:
+        return SagaResult()
+
+    placement = OrderPlacement.objects.create(
+        signal=sgnl,
+        order_group=order_group,
+        operations=[operation for operation, _ in placements]
+    )
+    saga = run_saga([step for _, step in placements])
+
+    operations = {operation['step']: operation for operation, _ in placements}
+    placement.results = {
+        name: result['order_id'] if operations[name]['action'] == 'create' else operations[name]['order_id']
+        for name, result in saga.results.items()
+    }
+    if saga.succeeded:
+        placement.state = PlacementStateChoices.COMPLETED
+    elif len(saga.orphaned) > 0:
+        placement.state = PlacementStateChoices.ORPHANED
+    else:
+        placement.state = PlacementStateChoices.COMPENSATED
+    placement.save(update_fields=['results', 'state', 'updated_at'])
+    return saga
+
+
+def reconcile_pending_placements() -> int:
+    '''
+    Undoes the exchange calls of placements a process died in the middle of, the same way a
+    failed saga does. Their rows were never written, the orders they created are found on the
+    exchange by their order tags. Returns the number of placements undone.
+    '''
+    placements = list(OrderPlacement.objects.filter(state=PlacementStateChoices.PENDING).select_related('order_group'))
+    if len(placements) == 0:
+        return 0
+
+    rows = get_open_algo_orders()
+    if rows is None:
+        print(f'Could not get the open algo orders, {len(placements)} placements are left pending')
+        return 0
+
+    # the orders undone so far, another pending placement of the same group mustn't undo them again
+    undone_order_ids = set()
+    reconciled = 0
+    for placement in placements:
+        if placement.order_group is None:
+            reconciled += _reconcile_pending_placement(placement, rows, undone_order_ids)
+        else:
+            reconciled += _reconcile_pending_placement_with_lock(
+                placement.order_group.group_id, placement, rows, undone_order_ids
+            )
+    return reconciled
+
+
+@with_timeframe_group_lock
+def _reconcile_pending_placement_with_lock(
+    timeframe_group_id: int,
+    placement: OrderPlacement,
+    rows: list[AlgoOrderResponseData],
+    undone_order_ids: set[int]
+) -> bool:
+    # a signal flow of another process may have been placing it, it finished before the lock was taken
+    placement.refresh_from_db(fields=['state'])
+    if placement.state != PlacementStateChoices.PENDING:
+        return False
+    return _reconcile_pending_placement(placement, rows, undone_order_ids)
+
+
+def _reconcile_pending_placement(
+    placement: OrderPlacement,
+    rows: list[AlgoOrderResponseData],
+    undone_order_ids: set[int]
+) -> bool:
+    # read under the lock, the orders left are the ones only a pending placement knows of
+    known_order_ids = set(WooAlgoOrder.objects.filter(
+        order_id__in=[row['algoOrderId'] for row in rows]
+    ).values_list('order_id', flat=True)) | undone_order_ids
+
+    results = {}
+    orphaned = []
+    for operation in placement.operations:
+        name = operation['step']
+        if operation['action'] == 'create':
+            order_tag = operation['params'].get('orderTag')
+            for row in rows:
+                if order_tag is None or row.get('orderTag') != order_tag or row['algoOrderId'] in known_order_ids:
+                    continue
+                results[name] = row['algoOrderId']
+                if not send_algo_order_cancel(row['algoOrderId']):
+                    orphaned.append(name)
+                undone_order_ids.add(row['algoOrderId'])
+        else:
+            previous_trigger_price = float(operation['previous_params']['triggerPrice'])
+            for row in rows:
+                if row['algoOrderId'] != operation['order_id'] or float(row['triggerPrice']) == previous_trigger_price:
+                    continue
+                results[name] = operation['order_id']
+                if not send_algo_order_edit(operation['order_id'], operation['previous_params']):
+                    orphaned.append(name)
+
+    placement.results = results
+    placement.state = PlacementStateChoices.ORPHANED if len(orphaned) > 0 else PlacementStateChoices.COMPENSATED
+    placement.save(update_fields=['results', 'state', 'updated_at'])
+    print(f'Reconciled pending placement {placement.id}: {placement.state}, undone {results}, orphaned {orphaned}')
+    return True
+
+
+def get_order_placement(
+    order_attributes: dict,
     order_group_id: int,
     order: Optional[Order] = None
-) -> (Order, bool):
-
-    order_attributes = get_attributes_for_order(sgnl, strategy_vars)
-    created = False
-
-    if order:
-        order = update_order(
-            sgnl,
-            order,
-            order_attributes
-        )
-
-    else:
-        order = create_order(
-            sgnl,
-            order_tag=f'group-{order_group_id}-order',
-            **order_attributes
-        )
-        created = True
-
-    return order, created
-
-
-def create_or_update_stop_order_for_group(
-    order_group: OrderGroup,
-    sgnl: TimeframeKlineSignal,
-    strategy_vars: StrategyVariables
-) -> (WooAlgoOrder, bool):
+) -> Optional[tuple[dict, SagaStep]]:
+    if order is None:
+        return _get_create_placement(ORDER_STEP, create_algo_order_params(
+            order_attributes['symbol'],
+            order_attributes['side'],
+            str(order_attributes['quantity']),
+            False,
+            str(order_attributes['trigger_price']),
+            get_group_order_tag(order_group_id)
+        ))
+    return _get_edit_placement(ORDER_STEP, order.order, order_attributes['trigger_price'])
 
-    order_attributes = get_attributes_for_order(sgnl, strategy_vars)
-    stop = order_group.stop
-    created = False
 
+def get_stop_placement(order_attributes: dict, order_group: OrderGroup) -> Optional[tuple[dict, SagaStep]]:
     if order_group.side == order_attributes['side']:
         raise Exception('Order must be on the opposite side to the group')
 
-    if stop is not None:
-        updated_trigger_price = order_attributes['trigger_price']
-        if stop.trigger_price != updated_trigger_price:
-            update_algo_order(stop, {
-                'triggerPrice': updated_trigger_price
-            })
-    else:
-        stop = create_algo_order(
+    if order_group.stop is None:
+        return _get_create_placement(STOP_STEP, create_algo_order_params(
             order_attributes['symbol'],
             order_attributes['side'],
             str(order_group.quantity),
             True,
             str(order_attributes['trigger_price']),
-            f'group-{order_group.id}-closer'
-        )
-        created = True
-
-    return stop, created
\ No newline at end of file
+            get_group_stop_tag(order_group.id)
+        ))
+    return _get_edit_placement(STOP_STEP, order_group.stop, order_attributes['trigger_price'])
+
+
+def _get_create_placement(name: str, params: AlgoOrderRequestParams) -> tuple[dict, SagaStep]:
+    return {'step': name, 'action': 'create', 'params': params}, SagaStep(
+        name,
+        lambda: send_new_algo_order_with_params(params),
+        lambda fields: send_algo_order_cancel(fields['order_id'])
+    )
+
+
+def _get_edit_placement(name: str, algo_order: WooAlgoOrder, trigger_price: float) -> Optional[tuple[dict, SagaStep]]:
+    if algo_order.trigger_price == trigger_price:
+        return None
+    order_id = algo_order.order_id
+    params = {'triggerPrice': trigger_price}
+    previous_params = {'triggerPrice': float(algo_order.trigger_price)}
+    operation = {'step': name, 'action': 'edit', 'order_id': order_id, 'params': params, 'previous_params': previous_params}
+    return operation, SagaStep(
+        name,
+        lambda: params if send_algo_order_edit(order_id, params) else None,
+        lambda _: send_algo_order_edit(order_id, previous_params)
+    )
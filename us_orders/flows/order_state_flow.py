@@ -0,0 +1,64 @@
+'''
+The order_status_change_flow decisions run with an OrderStateEngine as their store, the db is only
+written through the engine's write-behind queue.
+'''
+from common.util.advisory_locks import lock_scope
+from us_orders.flows.order_status_change_flow import handle_filled_entry_order, handle_filled_stop
+from us_orders.helpers import cancel_all_pending_orders_for_side, cancel_all_pending_stop_orders_for_side
+from us_orders.locks import get_timeframe_group_keys
+from us_orders.order_state import OrderStateEngine
+from us_orders.routing import get_timeframe_group_id_for_report
+
+from woo.api_types import AlgoOrderResponseData, AlgoOrderStatus
+
+
+def handle_algo_order_updates(engine: OrderStateEngine, data_list: list[AlgoOrderResponseData]):
+    for data, status in engine.apply_reports(data_list):
+        if status == AlgoOrderStatus.FILLED:
+            handle_filled_order(engine, data.get('algoOrderId'), data)
+
+
+def handle_algo_order_updates_with_locks(engine: OrderStateEngine, data_list: list[AlgoOrderResponseData]):
+    '''
+    Holds the keys of the reports' timeframe groups, like the db execution report flow, so the
+    signal flows of those timeframe groups in tv and celery wait for it. What those flows
+    changed since the engine loaded the groups is reloaded first. The writes stay on the
+    write-behind queue, the db is only waited for before the engine reads it, so a signal flow
+    can read rows the engine's queued writes haven't reached yet.
+    '''
+    timeframe_group_ids = get_engine_report_timeframe_group_ids(engine, data_list)
+    with lock_scope(exclusive=get_timeframe_group_keys(timeframe_group_ids)):
+        engine.reconcile(timeframe_group_ids)
+        handle_algo_order_updates(engine, data_list)
+
+
+def get_engine_report_timeframe_group_ids(engine: OrderStateEngine, data_list: list[AlgoOrderResponseData]) -> list[int]:
+    '''
+    Tracked orders know their timeframe group, only the others are looked up in the db.
+    '''
+    timeframe_group_ids = set()
+    for data in data_list:
+        if data.get('algoOrderId') is None:
+            continue
+        timeframe_group_id = engine.get_timeframe_group_id(data.get('algoOrderId'))
+        if timeframe_group_id is None:
+            timeframe_group_id = get_timeframe_group_id_for_report(data)
+        if timeframe_group_id is not None:
+            timeframe_group_ids.add(timeframe_group_id)
+    return sorted(timeframe_group_ids)
+
+
+def handle_filled_order(engine: OrderStateEngine, order_id: int, data: AlgoOrderResponseData):
+    reduce_only = data.get('reduceOnly')
+    if reduce_only is True:
+        handle_filled_stop(order_id, data, engine)
+    elif reduce_only is False:
+        handle_filled_entry_order(order_id, data, engine)
+
+
+def cancel_pending_orders_for_side(engine: OrderStateEngine, group_id: int, side: str):
+    cancel_all_pending_orders_for_side(group_id, side, engine)
+
+
+def cancel_pending_stops_for_side(engine: OrderStateEngine, group_id: int, side: str):
+    cancel_all_pending_stop_orders_for_side(group_id, side, engine)
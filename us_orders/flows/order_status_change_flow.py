@@ -1,15 +1,25 @@
 from typing import Optional
 
+from django.db import transaction
+
+from common.util.advisory_locks import lock_scope
+from common.util.unit_of_work import in_unit_of_work
 from us_orders.models.order import Order
 from us_orders.models.order_group import OrderGroup
+from us_orders.models.order_group_state import OrderGroupState, algo_order_in_order_group
+from us_orders.locks import get_report_keys, with_report_locks
+from us_orders.order_store import OrderStore, db_order_store
 from us_orders.helpers import create_stop_for_order, get_opposite_side_to_order, \
     cancel_all_pending_stop_orders_for_side, cancel_all_pending_orders_for_side, \
     cancel_pending_order_group_stop, update_or_cancel_order_group_stop
 from woo.helpers import map_woo_algo_order_data
 
+from woo.algo_order_version_guard import AlgoOrderVersionGuard, algo_order_version_guard
 from woo.models import WooAlgoOrder
 from woo.api_types import AlgoOrderResponseData, AlgoOrderStatus
 
+NON_UPDATABLE_ALGO_ORDER_FIELDS = ('id', 'pk', 'order_id', 'created_at')
+
 
 def handle_market_order(data: dict):
     if data.get('reduceOnly') is True:
@@ -18,6 +28,7 @@ def handle_market_order(data: dict):
         handle_non_reduce_only_market_order(data)
 
 
+@in_unit_of_work('handle_reduce_only_market_order')
 def handle_reduce_only_market_order(data: dict):
     # get active order group
     # does group have stop?
@@ -27,7 +38,7 @@ def handle_reduce_only_market_order(data: dict):
     # if yes, create stop
     # is stop filled?
     # cancel all pending stop orders for side
-    active_group = OrderGroup.objects.get_current_active_group()
+    active_group = OrderGroupState.objects.get_current_active_group()
 
     if active_group is None:
         return
@@ -42,6 +53,7 @@ def handle_non_reduce_only_market_order(data: dict):
     pass
 
 
+@with_report_locks(lambda data: [data])
 def handle_algo_order_update(data: AlgoOrderResponseData):
 
     status = get_new_status(data)
@@ -49,6 +61,22 @@ def handle_algo_order_update(data: AlgoOrderResponseData):
     if status is None:
         return
 
+    handle_algo_order_status_change(data, status)
+
+
+def handle_algo_order_updates(data_list: list[AlgoOrderResponseData]):
+    '''
+    Handles every report in an algoexecutionreportv2 push, the status changes are persisted
+    together first and then handled in the order they were received. Resent reports are dropped
+    before the timeframe groups of the others are locked.
+    '''
+    data_list = algo_order_version_guard.filter([data for data in data_list if data.get('algoOrderId') is not None])
+    with lock_scope(exclusive=get_report_keys(data_list)):
+        for data, status in _get_new_statuses(data_list, algo_order_version_guard):
+            handle_algo_order_status_change(data, status)
+
+
+def handle_algo_order_status_change(data: AlgoOrderResponseData, status: AlgoOrderStatus):
     order_id = data.get('algoOrderId')
 
     if status == AlgoOrderStatus.FILLED:
@@ -60,11 +88,101 @@ def handle_algo_order_update(data: AlgoOrderResponseData):
 
 
 def get_new_status(data: AlgoOrderResponseData) -> Optional[AlgoOrderStatus]:
-    order_id = data.get('algoOrderId')
+    statuses = get_new_statuses([data])
 
-    if order_id is None:
+    if len(statuses) == 0:
         return None
 
+    return statuses[0][1]
+
+
+def get_new_statuses(
+    data_list: list[AlgoOrderResponseData],
+    version_guard: Optional[AlgoOrderVersionGuard] = None
+) -> list[tuple[AlgoOrderResponseData, AlgoOrderStatus]]:
+    '''
+    Applies a batch of algo order reports to their WooAlgoOrder rows with one select and one
+    bulk update of the rows and fields the reports changed, returning the reports that changed their order's status in the order received.
+    With a version_guard, resent and out of order reports are dropped before the db is queried.
+    The OrderGroupState rows of groups whose orders changed status are refreshed in the same
+    transaction as the update, the select tells which orders are in a group.
+    '''
+    data_list = [data for data in data_list if data.get('algoOrderId') is not None]
+
+    if version_guard is not None:
+        data_list = version_guard.filter(data_list)
+
+    return _get_new_statuses(data_list, version_guard)
+
+
+def _get_new_statuses(
+    data_list: list[AlgoOrderResponseData],
+    version_guard: Optional[AlgoOrderVersionGuard] = None
+) -> list[tuple[AlgoOrderResponseData, AlgoOrderStatus]]:
+    # the reports the version guard let through, it only records them
+    if len(data_list) == 0:
+        return []
+
+    algo_orders = WooAlgoOrder.objects.annotate(in_order_group=algo_order_in_order_group()).in_bulk(
+        {data.get('algoOrderId') for data in data_list},
+        field_name='order_id'
+    )
+
+    changes = []
+    changed_ids = set()
+    updated_fields = set()
+    dirty_algo_orders = {}
+
+    for data in data_list:
+        algo_order = algo_orders.get(data.get('algoOrderId'))
+
+        if algo_order is None:
+            continue
+
+        new_status = normalise_algo_order_status(data)
+        current_status = algo_order.status
+
+        mapped_data = map_woo_algo_order_data(data)
+        for field in NON_UPDATABLE_ALGO_ORDER_FIELDS:
+            mapped_data.pop(field, None)
+        for field, value in mapped_data.items():
+            setattr(algo_order, field, value)
+        algo_order.sync_fixed_point()
+        dirty_fields = algo_order.get_dirty_fields()
+        if len(dirty_fields) > 0:
+            dirty_algo_orders[algo_order.id] = algo_order
+            updated_fields.update(dirty_fields)
+
+        if version_guard is not None:
+            version_guard.record(data)
+
+        if current_status is None or current_status == new_status:
+            continue
+
+        changes.append((data, new_status))
+        if algo_order.in_order_group:
+            changed_ids.add(algo_order.id)
+
+    if len(changed_ids) > 0:
+        # bulk_update sends no post_save, refresh the group states in the same transaction
+        with transaction.atomic():
+            _bulk_update_algo_orders(dirty_algo_orders.values(), updated_fields)
+            OrderGroupState.objects.refresh_for_algo_orders(sorted(changed_ids))
+    elif len(updated_fields) > 0:
+        _bulk_update_algo_orders(dirty_algo_orders.values(), updated_fields)
+
+    return changes
+
+
+def _bulk_update_algo_orders(algo_orders, fields: set[str]):
+    # only the rows and columns a report actually changed
+    algo_orders = list(algo_orders)
+    WooAlgoOrder.objects.bulk_update(algo_orders, sorted(fields))
+    for algo_order in algo_orders:
+        algo_order.reset_dirty_fields(fields)
+
+
+def normalise_algo_order_status(data: AlgoOrderResponseData) -> Optional[str]:
     status = data.get('algoStatus')
 
     # dirty fix for missing woo ws status updates ###############
@@ -77,31 +195,15 @@ def get_new_status(data: AlgoOrderResponseData) -> Optional[AlgoOrderStatus]:
     if status == AlgoOrderStatus.REPLACED:
         data['algoStatus'] = AlgoOrderStatus.NEW.value
 
-    new_status = data.get('algoStatus')
-
-    try:
-        algo_order = WooAlgoOrder.objects.get(order_id=order_id)
-        current_status = algo_order.status
-    except WooAlgoOrder.DoesNotExist:
-        return None
-
-    WooAlgoOrder.objects.update_or_create(
-        order_id=order_id,
-        defaults=map_woo_algo_order_data(data)
-    )
-
-    if current_status is None or current_status == new_status:
-        return None
-
-    return new_status
+    return data.get('algoStatus')
 
 
 def handle_filled_order(order_id: int, data: AlgoOrderResponseData):
     reduce_only = data.get('reduceOnly')
     if reduce_only is True:
-        handle_filled_reduce_only_order_update(order_id)
+        handle_filled_reduce_only_order_update(order_id, data)
     elif reduce_only is False:
-        handle_filled_non_reduce_only_order_update(order_id)
+        handle_filled_non_reduce_only_order_update(order_id, data)
 
 
 def handle_cancelled_order(order_id: int, data: AlgoOrderResponseData):
@@ -112,38 +214,58 @@ def handle_rejected_order(order_id: int, data: AlgoOrderResponseData):
     pass
 
 
-def handle_filled_reduce_only_order_update(order_id: int):
-    order = Order.objects.get_order_by_order_id(order_id)
+@with_report_locks(lambda order_id, data=None: [data or {'algoOrderId': order_id}])
+@in_unit_of_work('handle_filled_reduce_only_order_update')
+def handle_filled_reduce_only_order_update(order_id: int, data: Optional[AlgoOrderResponseData] = None):
+    handle_filled_stop(order_id, data)
+
+
+@with_report_locks(lambda order_id, data=None: [data or {'algoOrderId': order_id}])
+@in_unit_of_work('handle_filled_non_reduce_only_order_update')
+def handle_filled_non_reduce_only_order_update(order_id: int, data: Optional[AlgoOrderResponseData] = None):
+    handle_filled_entry_order(order_id, data)
+
+
+def handle_filled_stop(
+    order_id: int,
+    data: Optional[AlgoOrderResponseData] = None,
+    store: OrderStore = db_order_store
+):
+    order = store.get_order_by_stop_order_id(order_id, data)
     if order:
-        handle_filled_stop_for_individual_order(order)
-        return
-    order_group = OrderGroup.objects.get_group_by_stop_order_id(order_id)
-    if order_group is None:
+        handle_filled_stop_for_individual_order(order, store)
         return
-    handle_filled_stop_for_order_group(order_group)
+    order_group = store.get_group_by_stop_order_id(order_id, data)
+    if order_group is not None:
+        handle_filled_stop_for_order_group(order_group, store)
 
 
-def handle_filled_non_reduce_only_order_update(order_id: int):
-    order = Order.objects.get_order_by_order_id(order_id)
+def handle_filled_entry_order(
+    order_id: int,
+    data: Optional[AlgoOrderResponseData] = None,
+    store: OrderStore = db_order_store
+):
+    order = store.get_order_by_order_id(order_id, data)
     if order is None:
         return
-    side = get_opposite_side_to_order(order)
-    cancel_all_pending_orders_for_side(side)
-    cancel_pending_order_group_stop(order.order_groups.first())
-    create_stop_for_order(order)
+    order_group = store.get_order_group(order)
+    if order_group is not None:
+        cancel_all_pending_orders_for_side(order_group.group_id, get_opposite_side_to_order(order), store)
+    cancel_pending_order_group_stop(order_group, store)
+    create_stop_for_order(order, store)
 
 
-def handle_filled_stop_for_individual_order(order: Order):
-    order_group = OrderGroup.objects.get_group_by_order(order)
+def handle_filled_stop_for_individual_order(order: Order, store: OrderStore = db_order_store):
+    order_group = store.get_order_group(order)
     if order_group is None:
         return
     if order_group.has_reached_max_consecutive_order_stops_limit:
         # TODO - handle reverse
         return
     if order_group.has_stop and (order_group.is_active or order_group.is_closed):
-        update_or_cancel_order_group_stop(order_group)
+        update_or_cancel_order_group_stop(order_group, store)
 
 
-def handle_filled_stop_for_order_group(order_group: OrderGroup):
+def handle_filled_stop_for_order_group(order_group: OrderGroup, store: OrderStore = db_order_store):
     stop = order_group.stop
-    cancel_all_pending_stop_orders_for_side(stop.side)
+    cancel_all_pending_stop_orders_for_side(order_group.group_id, stop.side, store)
@@ -1,5 +1,12 @@
+from typing import Optional
+
+from common.util.tape import TapeRecorder
+from woo.account_store import account_store
 from woo.api_ws import WooWSClient
-from us_orders.flows.order_status_change_flow import handle_algo_order_update, handle_market_order
+from us_orders.flows import order_state_flow
+from us_orders.flows.order_status_change_flow import handle_algo_order_updates, handle_market_order
+from us_orders.order_state import OrderStateEngine
+from us_orders.partitioned_flows import PartitionedFlowDispatcher
 
 
 class PrivateWooWSHandler:
@@ -8,6 +15,9 @@ class PrivateWooWSHandler:
     app_key: str
     app_secret: str
     debug: bool
+    recorder: Optional[TapeRecorder]
+    engine: Optional[OrderStateEngine]
+    dispatcher: Optional[PartitionedFlowDispatcher]
 
     ws: WooWSClient
 
@@ -16,12 +26,18 @@ class PrivateWooWSHandler:
         app_id: str,
         app_key: str,
         app_secret: str,
-        debug: bool = False
+        debug: bool = False,
+        recorder: Optional[TapeRecorder] = None,
+        engine: Optional[OrderStateEngine] = None,
+        dispatcher: Optional[PartitionedFlowDispatcher] = None
     ):
         self.app_id = app_id
         self.app_key = app_key
         self.app_secret = app_secret
         self.debug = debug
+        self.recorder = recorder
+        self.engine = engine
+        self.dispatcher = dispatcher
 
     def connect(self):
         self.ws = WooWSClient(
@@ -30,7 +46,8 @@ class PrivateWooWSHandler:
             app_secret=self.app_secret,
             debug=self.debug,
             private=True,
-            connect_callback=self._connected
+            connect_callback=self._connected,
+            recorder=self.recorder
         )
         self.ws.connect()
 
@@ -38,10 +55,19 @@ class PrivateWooWSHandler:
         self.ws.subscribe_to_execution_report(
             lambda order: handle_market_order(order)
         )
-        self.ws.subscribe_to_algo_execution_report_v2(
-            lambda message: handle_algo_order_update(message[0])
-        )
-        # subscribe so debug will print
-        self.ws.subscribe_to_position(lambda message: message)
-        # subscribe so debug will print
-        self.ws.subscribe_to_balance(lambda message: message)
+        if self.dispatcher is not None:
+            self.ws.subscribe_to_algo_execution_report_v2(self.dispatcher.handle_algo_order_updates)
+        elif self.engine is not None:
+            self.ws.subscribe_to_algo_execution_report_v2(
+                lambda message: order_state_flow.handle_algo_order_updates_with_locks(self.engine, message)
+            )
+        else:
+            self.ws.subscribe_to_algo_execution_report_v2(
+                lambda message: handle_algo_order_updates(message)
+            )
+        # only the latest position and balance matter, a burst of pushes doesn't hold up the reports
+        self.ws.subscribe_to_position(account_store.update_positions, conflate=True)
+        self.ws.subscribe_to_balance(account_store.update_balances, conflate=True)
+        # seed after subscribing so no push is missed, pushes older than the seed are dropped by version.
+        # the REST calls run off the ws thread, the execution reports don't wait for them
+        account_store.seed_in_background()
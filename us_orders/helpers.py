@@ -1,35 +1,44 @@
 from typing import Optional
 
+from common.util.fixed_point import lots_to_float, ticks_to_float
 from us.models import TimeframeKlineSignal, StrategyVariables
 from us_orders.models.order import Order
 from us_orders.models.order_group import OrderGroup
+from us_orders.models.order_group_state import LifecycleStateChoices, OrderGroupState
+from us_orders.order_store import OrderStore, db_order_store
+from us_orders.routing import get_order_stop_tag
 
 from woo.api_types import OrderSide
-from woo.helpers import create_algo_order, update_algo_order, cancel_algo_order
+from woo.helpers import create_algo_order, send_algo_order_cancel, send_algo_order_edit, send_new_algo_order, \
+    update_algo_order
+from woo.models import WooAlgoOrder
 
 
 def remove_none_values_from_dict(d: dict):
     return {k: v for k, v in d.items() if v is not None}
 
 
+def get_opposite_side(side: str) -> OrderSide:
+    return [OrderSide.BUY, OrderSide.SELL][side == 'BUY']
+
+
 def get_opposite_side_to_order(order: Order) -> OrderSide:
-    return [OrderSide.BUY, OrderSide.SELL][order.side == 'BUY']
+    return get_opposite_side(order.side)
 
 
 def get_trigger_price_for_order(side: OrderSide, low: float, high: float, diff: float)-> float:
     return [low - diff, high + diff][side == OrderSide.BUY]
 
 
-def get_trigger_price_for_stop_order(order: Order) -> float:
-    order_group = OrderGroup.objects.get_group_by_order(order)
+def get_trigger_price_for_stop_order(order: Order, order_group: OrderGroup) -> float:
     algo_order = order.order
-    trigger_trade_price = 0 if algo_order.trigger_trade_price is None else algo_order.trigger_trade_price
-    order_trigger_price = float(trigger_trade_price) if trigger_trade_price != 0 else float(algo_order.trigger_price)
-    diff = order_group.group.strategy_variables.stop_loss_difference
+    trigger_trade_price_ticks = algo_order.trigger_trade_price_ticks or 0
+    order_trigger_price_ticks = trigger_trade_price_ticks if trigger_trade_price_ticks != 0 else algo_order.trigger_price_ticks
+    diff_ticks = order_group.stop_loss_difference_ticks
     side = get_opposite_side_to_order(order)
     if side == OrderSide.BUY:
-        diff = -diff
-    return order_trigger_price - diff
+        diff_ticks = -diff_ticks
+    return ticks_to_float(order_trigger_price_ticks - diff_ticks)
 
 
 def get_attributes_for_order(sgnl: TimeframeKlineSignal,strategy_vars: StrategyVariables):
@@ -47,9 +56,14 @@ def get_attributes_for_order(sgnl: TimeframeKlineSignal,strategy_vars: StrategyV
 
 
 def get_or_create_latest_order_group_for_side(side: str, timeframe_group_id: int) -> OrderGroup:
-    order_group: Optional[OrderGroup] = OrderGroup.objects.get_latest_group_for_side(side)
-
-    if not order_group or order_group.is_closed:
+    '''
+    The latest group of the timeframe group on this side, groups of other timeframe groups are
+    not considered.
+    '''
+    state = OrderGroupState.objects.get_state_for_group_and_side(timeframe_group_id, side)
+    order_group: Optional[OrderGroup] = state.order_group if state is not None else None
+
+    if not order_group or state.state == LifecycleStateChoices.CLOSED:
         order_group = OrderGroup.objects.create(
             group_id=timeframe_group_id,
             side=side
@@ -104,43 +118,62 @@ def update_order(
     return order
 
 
-def create_stop_for_order(order: Order):
-    side = get_opposite_side_to_order(order)
-    trigger_price = get_trigger_price_for_stop_order(order)
+def create_stop_for_order(order: Order, store: OrderStore = db_order_store):
+    order_group = store.get_order_group(order)
+    if order_group is None:
+        print(f'Order {order.id} has no group, no stop loss difference to place its stop with')
+        return
 
-    stop = create_algo_order(
+    fields = send_new_algo_order(
         order.order.symbol,
-        side,
+        get_opposite_side_to_order(order),
         str(order.quantity),
         True,
-        str(trigger_price),
-        f'stop-for-{order.order_id}'
+        str(get_trigger_price_for_stop_order(order, order_group)),
+        get_order_stop_tag(order.order.order_id)
     )
 
-    order.set_stop(stop)
+    if fields is None:
+        return
+
+    store.order_stop_created(order, fields)
 
 
-def cancel_all_pending_stop_orders_for_side(side: str):
-    for ordr in Order.objects.get_all_pending_reduce_only_orders_for_side(side):
-        cancel_algo_order(ordr.stop)
+def cancel_all_pending_stop_orders_for_side(group_id: int, side: str, store: OrderStore = db_order_store):
+    '''
+    Cancels the pending stops on this side of the groups of the TimeframeGroup group_id.
+    '''
+    for ordr in store.pending_stops_for_side(group_id, side):
+        cancel_store_algo_order(ordr.stop, store)
 
 
-def cancel_all_pending_orders_for_side(side: str):
-    for ordr in Order.objects.get_all_pending_non_reduce_only_orders_for_side(side):
-        cancel_algo_order(ordr.order)
+def cancel_all_pending_orders_for_side(group_id: int, side: str, store: OrderStore = db_order_store):
+    '''
+    Cancels the pending orders on this side of the groups of the TimeframeGroup group_id.
+    '''
+    for ordr in store.pending_orders_for_side(group_id, side):
+        cancel_store_algo_order(ordr.order, store)
 
 
-def cancel_pending_order_group_stop(order_group: OrderGroup):
+def cancel_pending_order_group_stop(order_group: Optional[OrderGroup], store: OrderStore = db_order_store):
+    if order_group is None:
+        return
     stop = order_group.stop
     if stop is None or stop.status != 'NEW':
         return
-    cancel_algo_order(stop)
+    cancel_store_algo_order(stop, store)
 
 
-def update_or_cancel_order_group_stop(order_group: OrderGroup):
+def update_or_cancel_order_group_stop(order_group: OrderGroup, store: OrderStore = db_order_store):
     stop = order_group.stop
-    if order_group.quantity == 0:
-        order_group.set_stop(None)
-        cancel_algo_order(stop)
-    else:
-        update_algo_order(stop, {'quantity': order_group.quantity})
+    quantity_lots = order_group.quantity_lots
+    if quantity_lots == 0:
+        store.group_stop_removed(order_group)
+        cancel_store_algo_order(stop, store)
+    elif send_algo_order_edit(stop.order_id, {'quantity': lots_to_float(quantity_lots)}):
+        store.quantity_edited(stop, quantity_lots)
+
+
+def cancel_store_algo_order(algo_order: WooAlgoOrder, store: OrderStore = db_order_store):
+    if send_algo_order_cancel(algo_order.order_id):
+        store.cancelled(algo_order)
@@ -0,0 +1,63 @@
+'''
+The locks the order flows take, see common.util.advisory_locks.
+
+A timeframe group key serializes the flows changing the groups of one timeframe group, the
+signals of that timeframe group and the execution reports of its orders and stops. Every
+decision a flow makes, the stop it moves and the orders it cancels, stays within one
+timeframe group, so flows of different timeframe groups run in parallel. A batch of reports
+takes the keys of all the timeframe groups it touches together.
+'''
+from functools import wraps
+from typing import Callable, Iterable
+
+from common.util.advisory_locks import LockKey, get_current_lock_scope, lock_scope
+from us_orders.routing import get_timeframe_group_id_for_report
+from woo.api_types import AlgoOrderResponseData
+
+
+def get_timeframe_group_key(timeframe_group_id: int) -> LockKey:
+    return 'timeframe_group', timeframe_group_id
+
+
+def get_timeframe_group_keys(timeframe_group_ids: Iterable[int]) -> list[LockKey]:
+    return [get_timeframe_group_key(timeframe_group_id) for timeframe_group_id in set(timeframe_group_ids)]
+
+
+def get_report_keys(data_list: Iterable[AlgoOrderResponseData]) -> list[LockKey]:
+    '''
+    The keys of the timeframe groups of the reports' algo orders, orders of no group take none.
+    '''
+    timeframe_group_ids = [
+        get_timeframe_group_id_for_report(data) for data in data_list if data.get('algoOrderId') is not None
+    ]
+    return get_timeframe_group_keys(
+        timeframe_group_id for timeframe_group_id in timeframe_group_ids if timeframe_group_id is not None
+    )
+
+
+def with_timeframe_group_lock(func):
+    '''
+    For flows taking the timeframe group id as their first argument.
+    '''
+    @wraps(func)
+    def wrapper(timeframe_group_id: int, *args, **kwargs):
+        with lock_scope(exclusive=[get_timeframe_group_key(timeframe_group_id)]):
+            return func(timeframe_group_id, *args, **kwargs)
+    return wrapper
+
+
+def with_report_locks(get_reports: Callable[..., list[AlgoOrderResponseData]]):
+    '''
+    For flows handling execution reports, get_reports is called with the flow's arguments and
+    returns the reports whose timeframe groups are locked. Called from within another flow's
+    scope the flow handles a report that flow has locked already.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if get_current_lock_scope() is not None:
+                return func(*args, **kwargs)
+            with lock_scope(exclusive=get_report_keys(get_reports(*args, **kwargs))):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'move closed order groups with their orders and algo orders into the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='only archive groups created more than this many days ago')
+        parser.add_argument('--batch-size', type=int, default=100, help='order groups moved per transaction')
+
+    def handle(self, *args, **options):
+        from us_orders.models.order_archive import ArchivedOrderGroup
+
+        stats = ArchivedOrderGroup.objects.archive_closed(
+            older_than=timedelta(days=options['days']),
+            batch_size=options['batch_size']
+        )
+        print(
+            f'archived {stats.order_groups} order groups, {stats.orders} orders and {stats.algo_orders} algo orders '
+            f'in {stats.batches} batches, skipped {stats.skipped}'
+        )
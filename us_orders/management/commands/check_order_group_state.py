@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'verify the order group state table against the order rows, optionally rebuilding it first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='recompute every row before verifying')
+
+    def handle(self, *args, **options):
+        from us_orders.models.order_group_state import OrderGroupState
+
+        if options['rebuild']:
+            count = OrderGroupState.objects.rebuild()
+            print(f'rebuilt {count} order group states')
+
+        errors = OrderGroupState.objects.verify()
+        for error in errors:
+            print(error)
+
+        if len(errors) > 0:
+            raise CommandError(f'{len(errors)} order group state mismatches')
+
+        print('order group states match')
@@ -10,6 +10,15 @@ WOO_SECRET = env('WOO_TRADE_SECRET')
 WOO_APP_ID = env('WOO_TRADE_APP_ID')
 WOO_WS_DEBUG = env.bool('WOO_WS_DEBUG', False)
 WOO_WS_ENABLE_TRACE = env.bool('WOO_WS_ENABLE_TRACE', False)
+# directory to record the raw ws frames to, unset disables recording
+WOO_WS_TAPE_DIR = env('WOO_WS_TAPE_DIR', default=None)
+# journal of the order state engine's pending db writes, unset keeps the flows on the db
+WOO_ORDER_JOURNAL = env('WOO_ORDER_JOURNAL', default=None)
+# worker processes the flows are partitioned over by timeframe group, 0 runs them in this process
+WOO_FLOW_WORKERS = env.int('WOO_FLOW_WORKERS', default=0)
+WOO_FLOW_PARTITIONS = env.int('WOO_FLOW_PARTITIONS', default=16)
+# directory of the partitions' write-behind journals, needed with WOO_FLOW_WORKERS
+WOO_FLOW_JOURNAL_DIR = env('WOO_FLOW_JOURNAL_DIR', default=None)
 
 
 class Command(BaseCommand):
@@ -18,16 +27,71 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         try:
             import websocket
+            from common.util.tape import TapeRecorder
             from us_orders.handlers.private_woo_ws_handler import PrivateWooWSHandler
+            from common.util.write_behind import WriteBehindQueue
+            from us_orders.order_state import OrderStateEngine, apply_write_ops
+            from us_orders.flows.new_order_flow import reconcile_pending_placements
+            from woo.algo_order_version_guard import algo_order_version_guard
 
             websocket.enableTrace(WOO_WS_ENABLE_TRACE)
 
+            # orders a process placed before dying mid placement are undone before the state is read
+            reconciled = reconcile_pending_placements()
+            print(f'pending placements: reconciled {reconciled}')
+
+            # reports resent after a reconnect are dropped without touching the db
+            algo_order_version_guard.warm()
+
+            recorder = TapeRecorder(WOO_WS_TAPE_DIR, 'woo-private') if WOO_WS_TAPE_DIR else None
+
+            engine = None
+            workers = None
+            dispatcher = None
+            if WOO_FLOW_WORKERS > 0:
+                from functools import partial
+                from common.util.partitions import PartitionedWorkers
+                from us_orders.partitioned_flows import FlowPartitionHandler, PartitionedFlowDispatcher
+
+                if not WOO_FLOW_JOURNAL_DIR:
+                    raise CommandError('WOO_FLOW_JOURNAL_DIR is needed to run the flows on workers')
+                workers = PartitionedWorkers(
+                    partial(FlowPartitionHandler, WOO_FLOW_JOURNAL_DIR, WOO_FLOW_PARTITIONS),
+                    WOO_FLOW_WORKERS,
+                    WOO_FLOW_PARTITIONS,
+                    name='flow-worker'
+                )
+                workers.start()
+                dispatcher = PartitionedFlowDispatcher(workers, algo_order_version_guard)
+                print(f'flow workers: {WOO_FLOW_WORKERS} workers, {WOO_FLOW_PARTITIONS} partitions')
+            elif WOO_ORDER_JOURNAL:
+                write_queue = WriteBehindQueue(WOO_ORDER_JOURNAL, apply_write_ops, name='order-write-behind')
+                # writes journaled by a previous run are applied before the state is read
+                replayed = write_queue.start()
+                engine = OrderStateEngine(write_queue, algo_order_version_guard)
+                groups = engine.hydrate()
+                print(f'order state engine: replayed {replayed} writes, hydrated {groups} groups')
+
             self.woo_ws_handler = PrivateWooWSHandler(
                 app_id=WOO_APP_ID,
                 app_key=WOO_KEY,
                 app_secret=WOO_SECRET,
-                debug=WOO_WS_DEBUG
+                debug=WOO_WS_DEBUG,
+                recorder=recorder,
+                engine=engine,
+                dispatcher=dispatcher
             )
-            self.woo_ws_handler.connect()
+            try:
+                self.woo_ws_handler.connect()
+            finally:
+                if recorder is not None:
+                    recorder.close()
+                if workers is not None:
+                    workers.stop()
+                    print(f'flow workers: {workers.stats}')
+                if engine is not None:
+                    engine.write_queue.stop(drain=True)
+                    print(f'order state engine: {engine.stats()}, writes: {engine.write_queue.stats}')
+                print(f'algo order version guard: {algo_order_version_guard.stats()}')
         except CommandError as e:
             print(e)
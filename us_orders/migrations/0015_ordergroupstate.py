@@ -0,0 +1,35 @@
+# Generated by Django 4.2.4 on 2026-10-19 10:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('us', '0015_alter_timeframegroup_strategy_variables'),
+        ('us_orders', '0014_order_note'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderGroupState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('side', models.CharField(choices=[('BUY', 'BUY'), ('SELL', 'SELL')], max_length=4)),
+                ('state', models.CharField(choices=[('EMPTY', 'Empty'), ('PENDING', 'Pending'), ('ACTIVE', 'Active'), ('INACTIVE', 'Inactive'), ('CLOSED', 'Closed')], default='EMPTY', max_length=10)),
+                ('filled_quantity', models.DecimalField(decimal_places=6, default=0, max_digits=20)),
+                ('last_fill_time', models.DecimalField(blank=True, decimal_places=4, max_digits=20, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='us.timeframegroup')),
+                ('order_group', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='current_state', to='us_orders.ordergroup')),
+            ],
+            options={
+                'verbose_name_plural': 'Order Group States',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='ordergroupstate',
+            constraint=models.UniqueConstraint(fields=('group', 'side'), name='order_group_state_group_side_unique_constraint'),
+        ),
+    ]
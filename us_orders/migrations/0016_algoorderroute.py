@@ -0,0 +1,50 @@
+# Generated by Django 4.2.4 on 2026-10-19 14:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_routes(apps, schema_editor):
+    AlgoOrderRoute = apps.get_model('us_orders', 'AlgoOrderRoute')
+    Order = apps.get_model('us_orders', 'Order')
+    OrderGroup = apps.get_model('us_orders', 'OrderGroup')
+
+    routes = {}
+    for order in Order.objects.select_related('order', 'stop').prefetch_related('order_groups'):
+        order_group = next(iter(order.order_groups.all()), None)
+        routes[order.order.order_id] = AlgoOrderRoute(
+            algo_order_id=order.order.order_id, role='ORDER', order=order, order_group=order_group
+        )
+        if order.stop is not None:
+            routes[order.stop.order_id] = AlgoOrderRoute(
+                algo_order_id=order.stop.order_id, role='ORDER_STOP', order=order, order_group=order_group
+            )
+    for order_group in OrderGroup.objects.select_related('stop').filter(stop__isnull=False):
+        routes[order_group.stop.order_id] = AlgoOrderRoute(
+            algo_order_id=order_group.stop.order_id, role='GROUP_STOP', order_group=order_group
+        )
+    AlgoOrderRoute.objects.bulk_create(routes.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('us_orders', '0015_ordergroupstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlgoOrderRoute',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('algo_order_id', models.IntegerField(unique=True)),
+                ('role', models.CharField(choices=[('ORDER', 'Order'), ('ORDER_STOP', 'Order Stop'), ('GROUP_STOP', 'Group Stop')], max_length=10)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='routes', to='us_orders.order')),
+                ('order_group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='routes', to='us_orders.ordergroup')),
+            ],
+            options={
+                'verbose_name_plural': 'Algo Order Routes',
+            },
+        ),
+        migrations.RunPython(create_routes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 4.2.4 on 2026-10-19 18:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('us', '0015_alter_timeframegroup_strategy_variables'),
+        ('us_orders', '0016_algoorderroute'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedAlgoOrder',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('order_id', models.IntegerField(unique=True)),
+                ('symbol', models.CharField(max_length=20)),
+                ('type', models.CharField(max_length=20)),
+                ('algo_type', models.CharField(max_length=20)),
+                ('side', models.CharField(max_length=4)),
+                ('quantity', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('reduce_only', models.BooleanField(default=False)),
+                ('is_triggered', models.BooleanField(default=False)),
+                ('trigger_price', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('trigger_price_type', models.CharField(max_length=20)),
+                ('trigger_trade_price', models.DecimalField(blank=True, decimal_places=4, max_digits=20, null=True)),
+                ('trigger_status', models.CharField(blank=True, max_length=20, null=True)),
+                ('trigger_time', models.DecimalField(blank=True, decimal_places=4, max_digits=20, null=True)),
+                ('status', models.CharField(max_length=20)),
+                ('order_tag', models.CharField(blank=True, max_length=20, null=True)),
+                ('trade_id', models.IntegerField(blank=True, null=True)),
+                ('create_time', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('updated_time', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('total_executed_quantity', models.DecimalField(blank=True, decimal_places=4, max_digits=20, null=True)),
+                ('average_executed_price', models.DecimalField(blank=True, decimal_places=4, max_digits=20, null=True)),
+                ('realized_pnl', models.DecimalField(blank=True, decimal_places=4, max_digits=20, null=True)),
+                ('created_at', models.DateTimeField()),
+                ('quantity_lots', models.BigIntegerField(blank=True, null=True)),
+                ('trigger_price_ticks', models.BigIntegerField(blank=True, null=True)),
+                ('trigger_trade_price_ticks', models.BigIntegerField(blank=True, null=True)),
+                ('trigger_time_ms', models.BigIntegerField(blank=True, null=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Archived Algo Orders',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedOrderGroup',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('side', models.CharField(choices=[('BUY', 'BUY'), ('SELL', 'SELL')], max_length=4)),
+                ('created_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('group', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='us.timeframegroup')),
+                ('stop', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='order_group_stop', to='us_orders.archivedalgoorder')),
+            ],
+            options={
+                'verbose_name_plural': 'Archived Order Groups',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedOrder',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('previous_indicator_ids', models.JSONField(blank=True, default=list)),
+                ('force_close', models.BooleanField(default=False)),
+                ('note', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('indicator', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='us.timeframeklinesignal')),
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='us_orders.archivedalgoorder')),
+                ('order_group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='orders', to='us_orders.archivedordergroup')),
+                ('stop', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='us_orders.archivedalgoorder')),
+            ],
+            options={
+                'verbose_name_plural': 'Archived Orders',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
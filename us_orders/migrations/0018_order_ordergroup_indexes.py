@@ -0,0 +1,32 @@
+# Generated by Django 4.2.4 on 2026-10-19 19:05
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the tables are large, the indexes are built without blocking the writes of the running flows
+    atomic = False
+
+    dependencies = [
+        ('us_orders', '0017_archivedalgoorder_archivedordergroup_archivedorder'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(fields=['-created_at'], name='order_created_at_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='ordergroup',
+            index=models.Index(fields=['group', 'side', '-created_at'], name='order_group_group_side_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='ordergroup',
+            index=models.Index(fields=['side', '-created_at'], name='order_group_side_created_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='ordergroup',
+            index=models.Index(fields=['-created_at'], name='order_group_created_at_idx'),
+        ),
+    ]
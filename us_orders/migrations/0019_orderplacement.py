@@ -0,0 +1,32 @@
+# Generated by Django 4.2.4 on 2026-10-19 20:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('us', '0015_alter_timeframegroup_strategy_variables'),
+        ('us_orders', '0018_order_ordergroup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderPlacement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operations', models.JSONField(default=list)),
+                ('results', models.JSONField(blank=True, default=dict)),
+                ('state', models.CharField(choices=[('PENDING', 'Pending'), ('COMPLETED', 'Completed'), ('COMPENSATED', 'Compensated'), ('ORPHANED', 'Orphaned')], default='PENDING', max_length=12)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('order_group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='us_orders.ordergroup')),
+                ('signal', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='us.timeframeklinesignal')),
+            ],
+            options={
+                'verbose_name_plural': 'Order Placements',
+                'indexes': [models.Index(condition=models.Q(('state', 'COMPLETED'), _negated=True), fields=['state'], name='order_placement_open_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,84 @@
+from typing import Optional
+
+from django.db import models
+from django.db.models.signals import m2m_changed, post_save
+from django.dispatch import receiver
+
+from common.util.upsert import upsert
+from us_orders.models.order import Order
+from us_orders.models.order_group import OrderGroup
+
+
+class AlgoOrderRoleChoices(models.TextChoices):
+    ORDER = 'ORDER'
+    ORDER_STOP = 'ORDER_STOP'
+    GROUP_STOP = 'GROUP_STOP'
+
+
+class AlgoOrderRouteManager(models.Manager):
+
+    def get_route_by_algo_order_id(self, algo_order_id: int) -> Optional['AlgoOrderRoute']:
+        return self.filter(algo_order_id=algo_order_id).first()
+
+    def set_route(
+        self,
+        algo_order_id: int,
+        role: str,
+        order: Optional[Order] = None,
+        order_group: Optional[OrderGroup] = None
+    ) -> 'AlgoOrderRoute':
+        return upsert(
+            self.model,
+            [self.model(algo_order_id=algo_order_id, role=role, order=order, order_group=order_group)],
+            unique_fields=['algo_order_id'],
+            update_fields=['role', 'order', 'order_group'],
+        )[0].instance
+
+
+class AlgoOrderRoute(models.Model):
+    '''
+    The role an algo order plays and the order and group it belongs to, keyed by the exchange
+    order id. Only read for execution reports whose orderTag doesn't say this already.
+    '''
+    algo_order_id = models.IntegerField(unique=True)
+    role = models.CharField(max_length=10, choices=AlgoOrderRoleChoices.choices)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='routes', null=True, blank=True)
+    order_group = models.ForeignKey(OrderGroup, on_delete=models.CASCADE, related_name='routes', null=True, blank=True)
+
+    objects = AlgoOrderRouteManager()
+
+    def __str__(self):
+        return f'{self.algo_order_id} - {self.role} - {self.order_id} - {self.order_group_id}'
+
+    class Meta:
+        verbose_name_plural = 'Algo Order Routes'
+
+
+@receiver(post_save, sender=Order)
+def set_routes_for_order(sender, instance: Order, update_fields=None, **kwargs):
+    if update_fields is not None and update_fields.isdisjoint(('order', 'stop')):
+        return
+    order_group = instance.get_order_group()
+    AlgoOrderRoute.objects.set_route(instance.order.order_id, AlgoOrderRoleChoices.ORDER, instance, order_group)
+    if instance.stop is not None:
+        AlgoOrderRoute.objects.set_route(instance.stop.order_id, AlgoOrderRoleChoices.ORDER_STOP, instance, order_group)
+
+
+@receiver(post_save, sender=OrderGroup)
+def set_route_for_order_group_stop(sender, instance: OrderGroup, update_fields=None, **kwargs):
+    if update_fields is not None and 'stop' not in update_fields:
+        return
+    if instance.stop is not None:
+        AlgoOrderRoute.objects.set_route(instance.stop.order_id, AlgoOrderRoleChoices.GROUP_STOP, order_group=instance)
+
+
+@receiver(m2m_changed, sender=OrderGroup.orders.through)
+def set_routes_for_order_group_orders(sender, action, instance, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove'):
+        return
+    if reverse:
+        order_group_id = next(iter(pk_set), None) if action == 'post_add' else None
+        AlgoOrderRoute.objects.filter(order=instance).update(order_group_id=order_group_id)
+        return
+    order_group_id = instance.id if action == 'post_add' else None
+    AlgoOrderRoute.objects.filter(order_id__in=pk_set or []).update(order_group_id=order_group_id)
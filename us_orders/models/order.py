@@ -3,6 +3,8 @@ from typing import Optional
 from django.core.exceptions import ValidationError
 from django.db import models
 
+from common.util.dirty_fields import DirtyFieldsMixin
+from common.util.unit_of_work import UnitOfWorkQuerySet, load_once
 from us.models import TimeframeKlineSignal
 
 from woo.models import WooAlgoOrder
@@ -19,7 +21,72 @@ class OrderValidationErrors:
     STOP_SIDE_IS_THE_SAME_AS_ORDER_SIDE = 'Stop side is the same as order side'
 
 
-class OrderQuerySet(models.QuerySet):
+# a group stop in any of these states closes every order in the group
+GROUP_STOPPED_OUT_STATUSES = ['FILLED', 'CANCELLED', 'REJECTED']
+
+ORDER_STATE_ANNOTATIONS = ('state_group_stopped_out',)
+
+# unit of work key of Order.get_order_group
+ORDER_GROUP_FOR_ORDER = 'order_group_for_order'
+
+
+class OrderStatusMixin:
+    '''
+    The status rules of an order, shared by Order and OrderStateEngine's OrderEntry. Needs order,
+    stop, force_close and _is_group_stopped_out.
+    '''
+    __slots__ = ()
+
+    @property
+    def status(self):
+        return 'CLOSED' if self.is_closed else self.order.status
+
+    @property
+    def is_pending(self):
+        return self.status == 'NEW'
+
+    @property
+    def is_active(self):
+        return self.status == 'FILLED'
+
+    @property
+    def is_cancelled(self):
+        return self.status == 'CANCELLED'
+
+    @property
+    def is_closed(self):
+        if self.force_close or self.is_stopped_out:
+            return True
+        return self._is_group_stopped_out
+
+    @property
+    def is_stopped_out(self):
+        return self.stop is not None and self.stop.status == 'FILLED'
+
+    @property
+    def side(self):
+        return self.order.side
+
+    @property
+    def quantity_lots(self) -> int:
+        if self.is_cancelled or self.is_stopped_out:
+            return 0
+        return self.order.quantity_lots or 0
+
+
+class OrderQuerySet(UnitOfWorkQuerySet):
+
+    def with_state(self) -> models.QuerySet:
+        '''
+        Loads the algo orders and annotates whether the order's group has been stopped out so
+        status and is_closed can be read for every order without further queries.
+        '''
+        return self.select_related('order', 'stop').annotate(
+            state_group_stopped_out=models.Count(
+                'order_groups',
+                filter=models.Q(order_groups__stop__status__in=GROUP_STOPPED_OUT_STATUSES)
+            )
+        )
 
     def all_orders_for_side(self, side) -> models.QuerySet:
         return self.filter(order__side=side)
@@ -72,11 +139,23 @@ class OrderQuerySet(models.QuerySet):
             return order
         return self.filter(stop__order_id=order_id).first()
 
+    def by_algo_order_id(self, order_id) -> Optional['Order']:
+        return self.select_related('order', 'stop').filter(order__order_id=order_id).first()
+
+    def by_stop_order_id(self, stop_order_id) -> Optional['Order']:
+        return self.select_related('order', 'stop').filter(stop__order_id=stop_order_id).first()
+
     def all_pending_reduce_only_orders_for_side(self, side) -> models.QuerySet:
-        return self.filter(stop__status='NEW', stop__reduce_only=True, stop__side=side)
+        return self.select_related('stop').filter(stop__status='NEW', stop__reduce_only=True, stop__side=side)
 
     def all_pending_non_reduce_only_orders_for_side(self, side) -> models.QuerySet:
-        return self.filter(order__status='NEW', order__reduce_only=False, order__side=side)
+        return self.select_related('order').filter(order__status='NEW', order__reduce_only=False, order__side=side)
+
+    def all_pending_reduce_only_orders_for_group_and_side(self, group_id, side) -> models.QuerySet:
+        return self.all_pending_reduce_only_orders_for_side(side).filter(order_groups__group_id=group_id)
+
+    def all_pending_non_reduce_only_orders_for_group_and_side(self, group_id, side) -> models.QuerySet:
+        return self.all_pending_non_reduce_only_orders_for_side(side).filter(order_groups__group_id=group_id)
 
 
 class OrderManager(models.Manager):
@@ -87,6 +166,9 @@ class OrderManager(models.Manager):
     def get_all_orders_for_side(self, side) -> models.QuerySet:
         return self.get_queryset().all_orders_for_side(side)
 
+    def get_orders_with_state(self) -> models.QuerySet:
+        return self.get_queryset().with_state()
+
     def get_pending_orders(self) -> models.QuerySet:
         return self.get_queryset().pending_orders()
 
@@ -114,14 +196,26 @@ class OrderManager(models.Manager):
     def get_order_by_order_id(self, order_id) -> Optional['Order']:
         return self.get_queryset().order_by_order_id(order_id)
 
+    def get_order_by_algo_order_id(self, order_id) -> Optional['Order']:
+        return self.get_queryset().by_algo_order_id(order_id)
+
+    def get_order_by_stop_order_id(self, stop_order_id) -> Optional['Order']:
+        return self.get_queryset().by_stop_order_id(stop_order_id)
+
     def get_all_pending_reduce_only_orders_for_side(self, side) -> models.QuerySet:
         return self.get_queryset().all_pending_reduce_only_orders_for_side(side)
 
     def get_all_pending_non_reduce_only_orders_for_side(self, side) -> models.QuerySet:
         return self.get_queryset().all_pending_non_reduce_only_orders_for_side(side)
 
+    def get_all_pending_reduce_only_orders_for_group_and_side(self, group_id, side) -> models.QuerySet:
+        return self.get_queryset().all_pending_reduce_only_orders_for_group_and_side(group_id, side)
+
+    def get_all_pending_non_reduce_only_orders_for_group_and_side(self, group_id, side) -> models.QuerySet:
+        return self.get_queryset().all_pending_non_reduce_only_orders_for_group_and_side(group_id, side)
+
 
-class Order(models.Model):
+class Order(OrderStatusMixin, DirtyFieldsMixin, models.Model):
     order = models.OneToOneField(WooAlgoOrder, on_delete=models.CASCADE)
     stop = models.OneToOneField(WooAlgoOrder, on_delete=models.CASCADE, related_name='order_stop', null=True, blank=True)
     previous_indicators = models.ManyToManyField(TimeframeKlineSignal, related_name='previous_indicators', blank=True)
@@ -133,42 +227,16 @@ class Order(models.Model):
     objects = OrderManager()
 
     @property
-    def status(self):
-        return 'CLOSED' if self.is_closed else self.order.status
-
-    @property
-    def is_pending(self):
-        return self.status == 'NEW'
-
-    @property
-    def is_active(self):
-        return self.status == 'FILLED'
-
-    @property
-    def is_cancelled(self):
-        return self.status == 'CANCELLED'
-
-    @property
-    def is_closed(self):
-        if self.force_close:
-            return True
+    def _is_group_stopped_out(self):
         if self.pk is None:
             return False
-        if self.is_stopped_out:
-            return True
-        order_group = self.order_groups.first()
+        if hasattr(self, 'state_group_stopped_out'):
+            return self.state_group_stopped_out > 0
+        order_group = self.get_order_group()
         if order_group is None:
             return False
         return order_group.is_stopped_out
 
-    @property
-    def order_id(self):
-        return self.order.order_id
-
-    @property
-    def side(self):
-        return self.order.side
-
     @property
     def quantity(self):
         if self.is_cancelled or self.is_stopped_out:
@@ -183,36 +251,57 @@ class Order(models.Model):
     def trigger_time(self):
         return self.order.trigger_time
 
-    @property
-    def is_stopped_out(self):
-        return self.stop is not None and self.stop.status == 'FILLED'
-
     def update_indicator(self, indicator: TimeframeKlineSignal):
         self.previous_indicators.add(self.indicator)
         self.indicator = indicator
         self.save()
 
+    def get_order_group(self):
+        # an order is in one group at most, see validate_order_for_group
+        return load_once(
+            (ORDER_GROUP_FOR_ORDER, self.pk),
+            lambda: self.order_groups.select_related('stop', 'group__strategy_variables').first()
+        )
+
     def set_stop(self, stop: WooAlgoOrder):
         self.stop = stop
         self.save()
 
-    def clean(self):
-        if self.order.side != self.indicator.type:
+    def clear_state(self):
+        for name in ORDER_STATE_ANNOTATIONS:
+            self.__dict__.pop(name, None)
+
+    def refresh_from_db(self, *args, **kwargs):
+        self.clear_state()
+        super().refresh_from_db(*args, **kwargs)
+
+    def _has_status(self, status: str) -> bool:
+        # status without the group query is_closed makes when the algo order status rules it out
+        return self.order.status == status and not self.is_closed
+
+    def clean(self, changed_fields: Optional[set[str]] = None):
+        '''
+        With changed_fields only the rules reading one of those fields are checked.
+        '''
+        def changed(*names) -> bool:
+            return changed_fields is None or not changed_fields.isdisjoint(names)
+
+        if changed('order', 'indicator') and self.order.side != self.indicator.type:
             raise ValidationError(OrderValidationErrors.ORDER_SIDE_DOES_NOT_MATCH_INDICATOR_SIDE)
-        if self.status == 'NEW' and self.stop:
-            raise ValidationError(OrderValidationErrors.IS_PENDING_BUT_STOP_IS_NOT_NULL)
-        if self.status == 'FILLED' and not self.stop:
-            raise ValidationError(OrderValidationErrors.IS_ACTIVE_BUT_STOP_IS_NULL)
-        if self.order.reduce_only:
+        if changed('order', 'stop', 'force_close'):
+            if self.stop and self._has_status('NEW'):
+                raise ValidationError(OrderValidationErrors.IS_PENDING_BUT_STOP_IS_NOT_NULL)
+            if not self.stop and self._has_status('FILLED'):
+                raise ValidationError(OrderValidationErrors.IS_ACTIVE_BUT_STOP_IS_NULL)
+        if changed('order') and self.order.reduce_only:
             raise ValidationError(OrderValidationErrors.ORDER_IS_REDUCE_ONLY)
-        if self.stop and not self.stop.reduce_only:
+        if changed('order', 'stop') and self.stop and not self.stop.reduce_only:
             raise ValidationError(OrderValidationErrors.STOP_IS_NOT_REDUCE_ONLY)
-        if self.stop and self.stop.side == self.side:
+        if changed('order', 'stop') and self.stop and self.stop.side == self.side:
             raise ValidationError(OrderValidationErrors.STOP_SIDE_IS_THE_SAME_AS_ORDER_SIDE)
 
-    def save(self, *args, **kwargs):
-        self.clean()
-        super().save(*args, **kwargs)
+    def validate_changes(self, changed_fields: Optional[set[str]]):
+        self.clean(changed_fields)
 
     class Meta:
         verbose_name_plural = 'Orders'
@@ -227,3 +316,6 @@ class Order(models.Model):
                 name='order_unique_constraint',
             ),
         ]
+        indexes = [
+            models.Index(fields=['-created_at'], name='order_created_at_idx'),
+        ]
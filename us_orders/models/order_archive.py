@@ -0,0 +1,321 @@
+'''
+Closed order groups move here with their orders and algo orders, so the live tables only hold
+the rows the flows still read. The archive rows keep the ids of the live rows they replace.
+'''
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Optional, Type, Union
+
+from django.db import models, transaction
+from django.utils import timezone
+
+from common.util.fixed_point import lots_to_decimal
+from common.util.logging import log
+from us.models import TimeframeGroup, TimeframeKlineSignal
+from us_orders.models.order import Order, GROUP_STOPPED_OUT_STATUSES
+from us_orders.models.order_group import OrderGroup
+from woo.models import StatusChoices, WooAlgoOrder
+
+# an algo order in any other status may still be live on the exchange
+SETTLED_STATUSES = [StatusChoices.FILLED, StatusChoices.CANCELLED, StatusChoices.REJECTED]
+
+DEFAULT_ARCHIVE_AFTER = timedelta(days=7)
+DEFAULT_BATCH_SIZE = 100
+
+
+@dataclass
+class ArchiveStats:
+    batches: int = 0
+    order_groups: int = 0
+    orders: int = 0
+    algo_orders: int = 0
+    skipped: int = 0
+
+
+@dataclass
+class OrderGroupSummary:
+    id: int
+    group_id: int
+    side: str
+    created_at: datetime
+    order_count: int
+    filled_quantity: Decimal
+    stop_status: Optional[str]
+    is_archived: bool
+
+
+class ArchivedAlgoOrder(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    order_id = models.IntegerField(unique=True)
+    symbol = models.CharField(max_length=20)
+    type = models.CharField(max_length=20)
+    algo_type = models.CharField(max_length=20)
+    side = models.CharField(max_length=4)
+    quantity = models.DecimalField(max_digits=20, decimal_places=4)
+    reduce_only = models.BooleanField(default=False)
+    is_triggered = models.BooleanField(default=False)
+    trigger_price = models.DecimalField(max_digits=20, decimal_places=4)
+    trigger_price_type = models.CharField(max_length=20)
+    trigger_trade_price = models.DecimalField(max_digits=20, decimal_places=4, null=True, blank=True)
+    trigger_status = models.CharField(max_length=20, null=True, blank=True)
+    trigger_time = models.DecimalField(max_digits=20, decimal_places=4, null=True, blank=True)
+    status = models.CharField(max_length=20)
+    order_tag = models.CharField(max_length=20, null=True, blank=True)
+    trade_id = models.IntegerField(null=True, blank=True)
+    create_time = models.DecimalField(max_digits=20, decimal_places=4)
+    updated_time = models.DecimalField(max_digits=20, decimal_places=4)
+    total_executed_quantity = models.DecimalField(max_digits=20, decimal_places=4, null=True, blank=True)
+    average_executed_price = models.DecimalField(max_digits=20, decimal_places=4, null=True, blank=True)
+    realized_pnl = models.DecimalField(max_digits=20, decimal_places=4, null=True, blank=True)
+    created_at = models.DateTimeField()
+    quantity_lots = models.BigIntegerField(null=True, blank=True)
+    trigger_price_ticks = models.BigIntegerField(null=True, blank=True)
+    trigger_trade_price_ticks = models.BigIntegerField(null=True, blank=True)
+    trigger_time_ms = models.BigIntegerField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.id} - {self.order_id} - {self.side} - {self.status} - {self.reduce_only}'
+
+    class Meta:
+        verbose_name_plural = 'Archived Algo Orders'
+
+
+class ArchivedOrderGroupQuerySet(models.QuerySet):
+
+    def with_orders(self) -> models.QuerySet:
+        return self.select_related('stop').prefetch_related(
+            models.Prefetch('orders', queryset=ArchivedOrder.objects.select_related('order', 'stop'))
+        )
+
+
+class ArchivedOrderGroupManager(models.Manager):
+
+    def get_queryset(self) -> ArchivedOrderGroupQuerySet:
+        return ArchivedOrderGroupQuerySet(self.model, using=self._db, hints=self._hints)
+
+    def get_groups_with_orders(self) -> models.QuerySet:
+        return self.get_queryset().with_orders()
+
+    def archive_closed(
+        self,
+        older_than: timedelta = DEFAULT_ARCHIVE_AFTER,
+        batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> ArchiveStats:
+        '''
+        Moves the closed order groups created before now - older_than, their orders and algo
+        orders into the archive. Every batch is its own short transaction and skips the groups
+        another transaction has locked, so the flows are never held up for long.
+        '''
+        stats = ArchiveStats()
+        last_id = 0
+        while True:
+            order_group_ids = list(
+                _get_archive_candidates(timezone.now() - older_than).filter(
+                    pk__gt=last_id
+                ).order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if not order_group_ids:
+                break
+            last_id = order_group_ids[-1]
+            _archive_batch(order_group_ids, stats)
+            stats.batches += 1
+
+        if stats.order_groups > 0:
+            log('order archive', f'archived {stats.order_groups} order groups, {stats.orders} orders and {stats.algo_orders} algo orders')
+        return stats
+
+
+class ArchivedOrderGroup(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    # the archive outlives the rows it points to in other apps, so those aren't constrained
+    group = models.ForeignKey(TimeframeGroup, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    side = models.CharField(max_length=4, choices=(('BUY', 'BUY'), ('SELL', 'SELL')))
+    stop = models.OneToOneField(ArchivedAlgoOrder, on_delete=models.SET_NULL, related_name='order_group_stop', null=True, blank=True)
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ArchivedOrderGroupManager()
+
+    @property
+    def is_stopped_out(self):
+        return self.stop is not None and self.stop.status in GROUP_STOPPED_OUT_STATUSES
+
+    @property
+    def quantity_lots(self) -> int:
+        return sum(ordr.quantity_lots for ordr in self.orders.all())
+
+    def __str__(self):
+        return f'{self.id} - {self.group_id} - {self.side}'
+
+    class Meta:
+        verbose_name_plural = 'Archived Order Groups'
+        ordering = ['-created_at']
+
+
+class ArchivedOrder(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    order_group = models.ForeignKey(ArchivedOrderGroup, on_delete=models.CASCADE, related_name='orders')
+    order = models.OneToOneField(ArchivedAlgoOrder, on_delete=models.CASCADE, related_name='+')
+    stop = models.OneToOneField(ArchivedAlgoOrder, on_delete=models.CASCADE, related_name='+', null=True, blank=True)
+    indicator = models.ForeignKey(TimeframeKlineSignal, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    previous_indicator_ids = models.JSONField(default=list, blank=True)
+    force_close = models.BooleanField(default=False)
+    note = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def is_stopped_out(self):
+        return self.stop is not None and self.stop.status == 'FILLED'
+
+    @property
+    def quantity_lots(self) -> int:
+        # mirrors the filled quantity OrderGroup.with_state sums
+        if self.order.status != 'FILLED' or self.is_stopped_out:
+            return 0
+        return self.order.quantity_lots or 0
+
+    def __str__(self):
+        return f'{self.id} - {self.order_group_id} - {self.order_id}'
+
+    class Meta:
+        verbose_name_plural = 'Archived Orders'
+        ordering = ['-created_at']
+
+
+def _get_archive_candidates(created_before: datetime) -> models.QuerySet:
+    # the latest group of a (TimeframeGroup, side) is the one the flows build on, see
+    # OrderGroupStateManager.refresh, it stays live even when closed
+    newer = OrderGroup.objects.filter(
+        group_id=models.OuterRef('group_id'),
+        side=models.OuterRef('side'),
+    ).filter(
+        models.Q(created_at__gt=models.OuterRef('created_at')) |
+        models.Q(created_at=models.OuterRef('created_at'), pk__gt=models.OuterRef('pk'))
+    )
+    return OrderGroup.objects.filter(created_at__lt=created_before).filter(models.Exists(newer))
+
+
+def _get_algo_orders(order_group: OrderGroup) -> list[WooAlgoOrder]:
+    algo_orders = [order_group.stop]
+    for ordr in order_group.orders.all():
+        algo_orders += [ordr.order, ordr.stop]
+    return [algo_order for algo_order in algo_orders if algo_order is not None]
+
+
+def _is_archivable(order_group: OrderGroup) -> bool:
+    return order_group.is_closed and all(
+        algo_order.status in SETTLED_STATUSES for algo_order in _get_algo_orders(order_group)
+    )
+
+
+def _copy(archive_model: Type[models.Model], instance: models.Model, **values) -> models.Model:
+    names = {field.attname for field in archive_model._meta.concrete_fields} - {'archived_at'}
+    # copied by attname, foreign keys are copied as their ids without loading the related rows
+    return archive_model(**{name: instance.__dict__[name] for name in names if name not in values}, **values)
+
+
+def _archive_batch(order_group_ids: list[int], stats: ArchiveStats):
+    with transaction.atomic():
+        locked_ids = list(
+            OrderGroup.objects.select_for_update(skip_locked=True).filter(
+                pk__in=order_group_ids
+            ).values_list('pk', flat=True)
+        )
+        order_groups = [
+            order_group for order_group in OrderGroup.objects.get_groups_with_state().filter(
+                pk__in=locked_ids
+            ).prefetch_related(
+                models.Prefetch('orders', queryset=Order.objects.select_related('order', 'stop'))
+            )
+            if _is_archivable(order_group)
+        ]
+        stats.skipped += len(order_group_ids) - len(order_groups)
+        if not order_groups:
+            return
+
+        orders = [ordr for order_group in order_groups for ordr in order_group.orders.all()]
+        algo_orders = [algo_order for order_group in order_groups for algo_order in _get_algo_orders(order_group)]
+        previous_indicator_ids: dict[int, list[int]] = {}
+        for order_id, indicator_id in Order.previous_indicators.through.objects.filter(
+            order_id__in=[ordr.pk for ordr in orders]
+        ).order_by('pk').values_list('order_id', 'timeframeklinesignal_id'):
+            previous_indicator_ids.setdefault(order_id, []).append(indicator_id)
+
+        ArchivedAlgoOrder.objects.bulk_create([_copy(ArchivedAlgoOrder, algo_order) for algo_order in algo_orders])
+        ArchivedOrderGroup.objects.bulk_create([_copy(ArchivedOrderGroup, order_group) for order_group in order_groups])
+        ArchivedOrder.objects.bulk_create([
+            _copy(
+                ArchivedOrder,
+                ordr,
+                order_group_id=order_group.pk,
+                previous_indicator_ids=previous_indicator_ids.get(ordr.pk, [])
+            )
+            for order_group in order_groups for ordr in order_group.orders.all()
+        ])
+
+        # the routes, group memberships and previous indicators of these rows go with them
+        OrderGroup.objects.filter(pk__in=[order_group.pk for order_group in order_groups]).delete()
+        Order.objects.filter(pk__in=[ordr.pk for ordr in orders]).delete()
+        WooAlgoOrder.objects.filter(pk__in=[algo_order.pk for algo_order in algo_orders]).delete()
+
+    stats.order_groups += len(order_groups)
+    stats.orders += len(orders)
+    stats.algo_orders += len(algo_orders)
+
+
+def get_algo_order_by_order_id(order_id: int) -> Optional[Union[WooAlgoOrder, ArchivedAlgoOrder]]:
+    '''
+    Reads through to the archive when the algo order is no longer live.
+    '''
+    algo_order = WooAlgoOrder.objects.filter(order_id=order_id).first()
+    if algo_order is not None:
+        return algo_order
+    return ArchivedAlgoOrder.objects.filter(order_id=order_id).first()
+
+
+def get_order_group_summaries(
+    side: Optional[str] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None
+) -> list[OrderGroupSummary]:
+    '''
+    The live and archived order groups in one list, newest first, for reporting.
+    '''
+    filters = {}
+    if side is not None:
+        filters['side'] = side
+    if created_after is not None:
+        filters['created_at__gte'] = created_after
+    if created_before is not None:
+        filters['created_at__lt'] = created_before
+
+    summaries = [
+        OrderGroupSummary(
+            id=order_group.id,
+            group_id=order_group.group_id,
+            side=order_group.side,
+            created_at=order_group.created_at,
+            order_count=order_group.state_order_count,
+            filled_quantity=lots_to_decimal(order_group.quantity_lots),
+            stop_status=order_group.stop.status if order_group.stop is not None else None,
+            is_archived=False,
+        )
+        for order_group in OrderGroup.objects.get_groups_with_state().filter(**filters)
+    ]
+    summaries += [
+        OrderGroupSummary(
+            id=order_group.id,
+            group_id=order_group.group_id,
+            side=order_group.side,
+            created_at=order_group.created_at,
+            order_count=len(order_group.orders.all()),
+            filled_quantity=lots_to_decimal(order_group.quantity_lots),
+            stop_status=order_group.stop.status if order_group.stop is not None else None,
+            is_archived=True,
+        )
+        for order_group in ArchivedOrderGroup.objects.get_groups_with_orders().filter(**filters)
+    ]
+    return sorted(summaries, key=lambda summary: (summary.created_at, summary.id), reverse=True)
@@ -1,13 +1,15 @@
-import time
-from typing import Optional
+from typing import Iterable, Optional, Union
 
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
 from django.db.models.signals import m2m_changed
 from django.dispatch import receiver
 
+from common.util.dirty_fields import DirtyFieldsMixin
+from common.util.fixed_point import lots_to_float, MS_PER_SECOND, now_ms, to_lots, to_ticks
+from common.util.unit_of_work import UnitOfWorkQuerySet, forget, load_once
 from us.models import TimeframeGroup
-from us_orders.models.order import Order, OrderValidationErrors
+from us_orders.models.order import Order, OrderValidationErrors, GROUP_STOPPED_OUT_STATUSES, ORDER_GROUP_FOR_ORDER
 from woo.models import WooAlgoOrder
 
 
@@ -25,14 +27,118 @@ class OrderGroupValidationErrors:
     STOP_QUANTITY_IS_NOT_SUM_OF_ORDER_QUANTITY = 'Stop quantity is not sum of order quantity'
 
 
-class OrderGroupQuerySet(models.QuerySet):
+ORDER_GROUP_STATE_ANNOTATIONS = (
+    'state_order_count',
+    'state_open_count',
+    'state_pending_count',
+    'state_active_count',
+    'state_cancelled_count',
+    'state_stopped_out_count',
+    'state_filled_quantity_lots',
+    'state_last_fill_time_ms',
+)
+
+# unit of work key of OrderGroup._get_orders
+ORDERS_FOR_ORDER_GROUP = 'orders_for_order_group'
+
+NOT_FILLED_STATUSES = ['NEW', 'PARTIAL_FILLED', 'CANCELLED', 'REJECTED']
+NOT_STOPPED_OUT_STATUSES = ['NEW', 'PARTIAL_FILLED']
+
+
+class OrderGroupStatusMixin:
+    '''
+    The status rules of a group, shared by OrderGroup and OrderStateEngine's GroupEntry. Needs
+    stop, quantity_lots, max_consecutive_stops and the private properties the rules read.
+    '''
+    __slots__ = ()
+
+    @property
+    def quantity(self) -> float:
+        return lots_to_float(self.quantity_lots)
+
+    @property
+    def is_empty(self):
+        return self._has_no_orders
+
+    @property
+    def is_pending(self):
+        return not self.is_closed and self._is_pending
+
+    @property
+    def is_active(self):
+        return not self.is_closed and self._is_active
+
+    @property
+    def is_closed(self):
+        if self._is_canceled:
+            return True
+        if self.has_reached_max_consecutive_order_stops_limit:
+            return True
+        if self.is_stopped_out:
+            return True
+        return self._all_orders_closed
+
+    @property
+    def is_stopped_out(self):
+        return self.stop is not None and self.stop.status in GROUP_STOPPED_OUT_STATUSES
+
+    @property
+    def has_reached_max_consecutive_order_stops_limit(self):
+        if self._has_no_orders:
+            return False
+        return self._stopped_out_order_count >= self.max_consecutive_stops
+
+    @property
+    def has_stop(self):
+        return self.stop is not None
+
+
+class OrderGroupQuerySet(UnitOfWorkQuerySet):
+
+    def with_state(self) -> models.QuerySet:
+        '''
+        Annotates the order counts the status properties are derived from, so evaluating any
+        number of groups takes one query. Mirrors Order.status: an order is closed when it is
+        force closed, its own stop filled or the group stop was filled, cancelled or rejected.
+        '''
+        order_not_stopped_out = models.Q(orders__stop__isnull=True) | models.Q(orders__stop__status__in=NOT_FILLED_STATUSES)
+        group_not_stopped_out = models.Q(stop__isnull=True) | models.Q(stop__status__in=NOT_STOPPED_OUT_STATUSES)
+        order_is_open = models.Q(orders__force_close=False) & order_not_stopped_out & group_not_stopped_out
+        order_is_filled = models.Q(orders__order__status='FILLED')
+
+        return self.select_related('stop', 'group__strategy_variables').annotate(
+            state_order_count=models.Count('orders'),
+            state_open_count=models.Count('orders', filter=order_is_open),
+            state_pending_count=models.Count(
+                'orders',
+                filter=order_is_open & models.Q(orders__order__status__in=['NEW', 'CANCELLED'])
+            ),
+            state_active_count=models.Count('orders', filter=order_is_open & order_is_filled),
+            state_cancelled_count=models.Count(
+                'orders',
+                filter=order_is_open & models.Q(orders__order__status__in=['CANCELLED', 'REJECTED'])
+            ),
+            state_stopped_out_count=models.Count('orders', filter=models.Q(orders__stop__status='FILLED')),
+            state_filled_quantity_lots=models.Sum(
+                'orders__order__quantity_lots',
+                filter=order_is_filled & order_not_stopped_out
+            ),
+            state_last_fill_time_ms=models.Max('orders__order__trigger_time_ms', filter=order_is_filled),
+        )
+
     def current_active(self):
         # TODO Should this get the latest FILLED order and then use reverse to get its group instead?
         try:
-            order_group = self.filter(orders__order__status='FILLED').latest('created_at')
-            return [order_group, None][order_group.is_closed]
+            order_group = self.with_state().filter(
+                pk__in=self.filter(orders__order__status='FILLED').values('pk')
+            ).latest('created_at')
         except self.model.DoesNotExist:
             return None
+        if order_group.is_closed:
+            return None
+        # callers go on to change the group, don't hand them counts that will go stale
+        order_group.clear_state()
+        return order_group
 
     def current_pending(self):
         # TODO Should this get the latest NEW order and then use reverse to get its group instead?
@@ -72,6 +178,9 @@ class OrderGroupManager(models.Manager):
     def get_latest_pending_group_for_side(self, side: str) -> Optional['OrderGroup']:
         return self.get_queryset().current_pending_by_side(side)
 
+    def get_groups_with_state(self) -> models.QuerySet:
+        return self.get_queryset().with_state()
+
     def get_latest_group_for_side(self, side: str) -> Optional['OrderGroup']:
         return self.get_queryset().current_group_for_side(side)
 
@@ -82,7 +191,7 @@ class OrderGroupManager(models.Manager):
         return self.get_group_by_order(order)
 
     def get_group_by_order(self, order: Order) -> Optional['OrderGroup']:
-        return order.order_groups.first()
+        return order.get_order_group()
 
     def get_group_by_stop_order_id(self, stop_order_id: int) -> Optional['OrderGroup']:
         return self.get_queryset().by_stop_order_id(stop_order_id)
@@ -91,7 +200,7 @@ class OrderGroupManager(models.Manager):
         return self.get_queryset().by_stop_order_id(stop_order.order_id)
 
 
-class OrderGroup(models.Model):
+class OrderGroup(OrderGroupStatusMixin, DirtyFieldsMixin, models.Model):
     group = models.ForeignKey(TimeframeGroup, on_delete=models.CASCADE)
     side = models.CharField(max_length=4, choices=(('BUY', 'BUY'), ('SELL', 'SELL')), default='BUY')
     orders = models.ManyToManyField(Order, related_name='order_groups')
@@ -101,74 +210,75 @@ class OrderGroup(models.Model):
     objects = OrderGroupManager()
 
     @property
-    def quantity(self):
-        if self._has_no_orders:
-            return 0
-        filled = self.orders.filter(order__status='FILLED')
-        return round(sum(float(ordr.quantity) for ordr in filled.all()), 6)
+    def has_state(self) -> bool:
+        '''
+        True when the instance was loaded with with_state(), the properties below then read the
+        annotated counts instead of querying the orders.
+        '''
+        return 'state_order_count' in self.__dict__
 
     @property
-    def is_empty(self):
-        return self._has_no_orders
+    def quantity_lots(self) -> int:
+        if self._has_no_orders:
+            return 0
+        if self.has_state:
+            return self.state_filled_quantity_lots or 0
+        filled = self.orders.filter(order__status='FILLED').select_related('order', 'stop')
+        return sum(ordr.quantity_lots for ordr in filled)
 
     @property
     def _is_pending(self):
         if self._has_no_orders:
             return False
-        return all(ordr.status in ['NEW', 'CANCELLED'] for ordr in self.orders.all())
-
-    @property
-    def is_pending(self):
-        return not self.is_closed and self._is_pending
+        if self.has_state:
+            return self.state_pending_count == self.state_order_count
+        return all(ordr.status in ['NEW', 'CANCELLED'] for ordr in self._get_orders())
 
     @property
     def _is_active(self):
         if self._has_no_orders:
             return False
-        return any(ordr.status == 'FILLED' for ordr in self.orders.all())
-
-    @property
-    def is_active(self):
-        return not self.is_closed and self._is_active
+        if self.has_state:
+            return self.state_active_count > 0
+        return any(ordr.status == 'FILLED' for ordr in self._get_orders())
 
     @property
     def _is_canceled(self):
         if self._has_no_orders:
             return False
-        return all(ordr.status in ['CANCELLED', 'REJECTED'] for ordr in self.orders.all())
-
-    @property
-    def is_closed(self):
-        if self._is_canceled:
-            return True
-        if self.has_reached_max_consecutive_order_stops_limit:
-            return True
-        if self.is_stopped_out:
-            return True
-        return self._all_orders_closed
+        if self.has_state:
+            return self.state_cancelled_count == self.state_order_count
+        return all(ordr.status in ['CANCELLED', 'REJECTED'] for ordr in self._get_orders())
 
     @property
     def _all_orders_closed(self):
         if self._has_no_orders:
             return False
-        return all(ordr.status == 'CLOSED' for ordr in self.orders.all())
+        if self.has_state:
+            return self.state_open_count == 0
+        return all(ordr.status == 'CLOSED' for ordr in self._get_orders())
 
     @property
-    def is_stopped_out(self):
-        return self.stop is not None and self.stop.status in ['FILLED', 'CANCELLED', 'REJECTED']
+    def _stopped_out_order_count(self) -> int:
+        if self.has_state:
+            return self.state_stopped_out_count
+        return sum(1 for ordr in self._get_orders() if ordr.is_stopped_out)
 
     @property
-    def has_reached_max_consecutive_order_stops_limit(self):
-        if self._has_no_orders:
-            return False
-        count = sum(1 for ordr in self.orders.all() if ordr.is_stopped_out)
-        return count >= self.group.strategy_variables.max_consecutive_stops
+    def max_consecutive_stops(self) -> int:
+        return self.group.strategy_variables.max_consecutive_stops
+
+    @property
+    def stop_loss_difference_ticks(self) -> int:
+        return to_ticks(self.group.strategy_variables.stop_loss_difference)
 
     @property
     def has_reached_max_order_limit(self):
         if self._has_no_orders:
             return False
-        count = sum(1 for ordr in self.orders.all() if ordr.status == 'FILLED')
+        if self.has_state:
+            return self.state_active_count >= self.group.strategy_variables.max_active_orders
+        count = sum(1 for ordr in self._get_orders() if ordr.status == 'FILLED')
         return count >= self.group.strategy_variables.max_active_orders
 
     @property
@@ -177,15 +287,19 @@ class OrderGroup(models.Model):
         if self._has_no_orders:
             return True
 
-        last_filled_order = self.orders.filter(
-            order__status='FILLED',
-            order__trigger_time__isnull=False
-        ).order_by('-order__trigger_time').first()
+        if self.has_state:
+            last_fill_time_ms = self.state_last_fill_time_ms
+        else:
+            last_filled_order = self.orders.filter(
+                order__status='FILLED',
+                order__trigger_time_ms__isnull=False
+            ).select_related('order').order_by('-order__trigger_time_ms').first()
+            last_fill_time_ms = last_filled_order.order.trigger_time_ms if last_filled_order is not None else None
 
-        if last_filled_order is None:
+        if last_fill_time_ms is None:
             return True
 
-        minutes_passed = (time.time() - float(last_filled_order.trigger_time))/ 60
+        minutes_passed = (now_ms() - last_fill_time_ms) / (60 * MS_PER_SECOND)
 
         return minutes_passed > self.group.strategy_variables.minimum_minutes_since_last_order
 
@@ -195,52 +309,136 @@ class OrderGroup(models.Model):
             return None
         return self.orders.filter(order__status='NEW').order_by('-created_at').first()
 
-    @property
-    def has_stop(self):
-        return self.stop is not None
-
     @property
     def _has_no_orders(self):
-        return self.pk is None or len(self.orders.all()) == 0
+        if self.has_state:
+            return self.pk is None or self.state_order_count == 0
+        return self.pk is None or len(self._get_orders()) == 0
+
+    def _get_orders(self) -> list[Order]:
+        if 'orders' in getattr(self, '_prefetched_objects_cache', {}):
+            return list(self.orders.all())
+        # inside a unit of work the orders are loaded once, add_orders forgets them
+        return load_once(
+            (ORDERS_FOR_ORDER_GROUP, self.pk),
+            lambda: list(self.orders.select_related('order', 'stop'))
+        )
+
+    def clear_state(self):
+        for name in ORDER_GROUP_STATE_ANNOTATIONS:
+            self.__dict__.pop(name, None)
+
+    def refresh_from_db(self, *args, **kwargs):
+        self.clear_state()
+        super().refresh_from_db(*args, **kwargs)
 
     def set_stop(self, stop: Optional[WooAlgoOrder]):
         self.stop = stop
         self.save()
 
-    def clean(self):
+    def add_orders(self, orders: Iterable[Union[Order, int]]):
+        '''
+        Validates and attaches the orders in a fixed number of queries however many are added,
+        the group and orders are loaded with their state and checked in memory, then the through
+        rows go in with one insert. orders.add() still validates through verify_order_validity.
+        '''
+        order_ids = sorted({ordr.pk if isinstance(ordr, Order) else ordr for ordr in orders})
+        if not order_ids:
+            return
+
+        with transaction.atomic():
+            order_group = OrderGroup.objects.get_groups_with_state().get(pk=self.pk)
+            candidates = {
+                ordr.pk: ordr for ordr in Order.objects.get_orders_with_state().filter(pk__in=order_ids).annotate(
+                    state_group_count=models.Count('order_groups')
+                )
+            }
+            has_pending_order = order_group.orders.filter(order__status='NEW').exists()
+
+            for order_id in order_ids:
+                order = candidates.get(order_id)
+                if order is None:
+                    raise Order.DoesNotExist(f'Order {order_id} does not exist')
+                validate_order_for_group(order, order_group, order.state_group_count > 0, has_pending_order)
+                # a batch can't bring in two pending orders either
+                has_pending_order = has_pending_order or order.is_pending
+
+            through = OrderGroup.orders.through
+            through.objects.bulk_create([through(ordergroup_id=self.pk, order_id=order_id) for order_id in order_ids])
+            # orders.add() would send this, the state and route receivers rely on it
+            m2m_changed.send(
+                sender=through,
+                action='post_add',
+                instance=self,
+                reverse=False,
+                model=Order,
+                pk_set=set(order_ids),
+                using=self._state.db,
+            )
+
+        self.clear_state()
+        forget((ORDERS_FOR_ORDER_GROUP, self.pk))
+        for order_id in order_ids:
+            # inside a unit of work these are the flow's instances, see UnitOfWorkQuerySet
+            candidates[order_id].clear_state()
+            forget((ORDER_GROUP_FOR_ORDER, order_id))
+
+    def clean(self, changed_fields: Optional[set[str]] = None):
+        '''
+        With changed_fields the stop rules are only checked when the stop or side changed.
+        '''
+        if changed_fields is not None and changed_fields.isdisjoint(('stop', 'side')):
+            return
         if self.has_stop:
             if self.stop.side == self.side:
                 raise ValidationError(OrderValidationErrors.STOP_SIDE_IS_THE_SAME_AS_ORDER_SIDE)
             if not self.stop.reduce_only:
                 raise ValidationError(OrderValidationErrors.STOP_IS_NOT_REDUCE_ONLY)
-            if self.quantity != 0 and self.quantity != self.stop.quantity:
+            quantity_lots = self.quantity_lots
+            if quantity_lots != 0 and quantity_lots != to_lots(self.stop.quantity):
                 raise ValidationError(OrderGroupValidationErrors.STOP_QUANTITY_IS_NOT_SUM_OF_ORDER_QUANTITY)
             if self._is_pending:
                 raise ValidationError(OrderGroupValidationErrors.IS_PENDING_BUT_STOP_IS_NOT_NULL)
 
-    def save(self, *args, **kwargs):
-        self.clean()
-        super().save(*args, **kwargs)
+    def validate_changes(self, changed_fields: Optional[set[str]]):
+        self.clean(changed_fields)
 
     class Meta:
         verbose_name_plural = 'Order Groups'
         ordering = ['-created_at']
+        indexes = [
+            # the latest group per (TimeframeGroup, side), see OrderGroupStateManager.refresh
+            models.Index(fields=['group', 'side', '-created_at'], name='order_group_group_side_idx'),
+            models.Index(fields=['side', '-created_at'], name='order_group_side_created_idx'),
+            models.Index(fields=['-created_at'], name='order_group_created_at_idx'),
+        ]
 
 
 @receiver(m2m_changed, sender=OrderGroup.orders.through)
 def verify_order_validity(sender, action, instance, pk_set, **kwargs):
     if action != 'pre_add':
         return
+    # OrderGroup.add_orders validates in bulk, this is the per order safety net for orders.add()
+    # calls such as admin edits
     order_group = instance
     for order_id in pk_set:
         order = Order.objects.get(pk=order_id)
-        if len(order.order_groups.all()) > 0:
-            raise ValidationError(f'{OrderGroupValidationErrors.ORDER_IS_ALREADY_IN_A_GROUP} - {str(order.id)}')
-        if order.is_closed:
-            raise ValidationError(f'{OrderGroupValidationErrors.ORDER_IS_CLOSED} - {str(order.id)}')
-        if order_group.is_closed:
-            raise ValidationError(f'{OrderGroupValidationErrors.IS_CLOSED}')
-        if order.side != order_group.side:
-            raise ValidationError(f'{OrderGroupValidationErrors.ORDER_SIDE_DOES_NOT_MATCH_GROUP_SIDE} - {str(order.id)}')
-        if order.is_pending and order_group.current_pending_order is not None:
-            raise ValidationError(f'{OrderGroupValidationErrors.ONLY_ONE_PENDING_ORDER_ALLOWED} - {str(order.id)}')
+        validate_order_for_group(
+            order,
+            order_group,
+            len(order.order_groups.all()) > 0,
+            order_group.current_pending_order is not None
+        )
+
+
+def validate_order_for_group(order: Order, order_group: OrderGroup, is_in_a_group: bool, has_pending_order: bool):
+    if is_in_a_group:
+        raise ValidationError(f'{OrderGroupValidationErrors.ORDER_IS_ALREADY_IN_A_GROUP} - {str(order.id)}')
+    if order.is_closed:
+        raise ValidationError(f'{OrderGroupValidationErrors.ORDER_IS_CLOSED} - {str(order.id)}')
+    if order_group.is_closed:
+        raise ValidationError(f'{OrderGroupValidationErrors.IS_CLOSED}')
+    if order.side != order_group.side:
+        raise ValidationError(f'{OrderGroupValidationErrors.ORDER_SIDE_DOES_NOT_MATCH_GROUP_SIDE} - {str(order.id)}')
+    if order.is_pending and has_pending_order:
+        raise ValidationError(f'{OrderGroupValidationErrors.ONLY_ONE_PENDING_ORDER_ALLOWED} - {str(order.id)}')
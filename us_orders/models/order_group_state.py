@@ -0,0 +1,304 @@
+from functools import reduce
+from operator import or_
+from typing import Iterable, Optional
+
+from django.db import models, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from common.util.fixed_point import lots_to_decimal, ms_to_seconds
+from common.util.unit_of_work import UnitOfWorkQuerySet, run_after_flush
+from common.util.upsert import upsert
+from us.models import TimeframeGroup
+from us_orders.models.order import Order
+from us_orders.models.order_group import OrderGroup
+from woo.models import WooAlgoOrder
+
+
+class LifecycleStateChoices(models.TextChoices):
+    EMPTY = 'EMPTY'
+    PENDING = 'PENDING'
+    ACTIVE = 'ACTIVE'
+    INACTIVE = 'INACTIVE'
+    CLOSED = 'CLOSED'
+
+
+def get_lifecycle_state(order_group: OrderGroup) -> str:
+    if order_group.is_empty:
+        return LifecycleStateChoices.EMPTY
+    if order_group.is_closed:
+        return LifecycleStateChoices.CLOSED
+    if order_group.is_active:
+        return LifecycleStateChoices.ACTIVE
+    if order_group.is_pending:
+        return LifecycleStateChoices.PENDING
+    return LifecycleStateChoices.INACTIVE
+
+
+def get_order_group_state_values(order_group: OrderGroup) -> dict:
+    return {
+        'order_group': order_group,
+        'state': get_lifecycle_state(order_group),
+        'filled_quantity': lots_to_decimal(order_group.quantity_lots),
+        'last_fill_time': ms_to_seconds(order_group.state_last_fill_time_ms) if order_group.has_state else None,
+    }
+
+
+class OrderGroupStateQuerySet(UnitOfWorkQuerySet):
+
+    def for_group_and_side(self, group_id: int, side: str) -> Optional['OrderGroupState']:
+        return self.select_related(
+            'order_group__stop',
+            'order_group__group__strategy_variables'
+        ).filter(group_id=group_id, side=side).first()
+
+    def current_active(self) -> Optional[OrderGroup]:
+        state = self.select_related('order_group__stop', 'order_group__group__strategy_variables').filter(
+            state=LifecycleStateChoices.ACTIVE
+        ).order_by('-order_group__created_at').first()
+        return state.order_group if state is not None else None
+
+    def active_for_group_and_side(self, group_id: int, side: str) -> Optional[OrderGroup]:
+        state = self.select_related('order_group__stop', 'order_group__group__strategy_variables').filter(
+            group_id=group_id,
+            side=side,
+            state=LifecycleStateChoices.ACTIVE
+        ).first()
+        return state.order_group if state is not None else None
+
+
+class OrderGroupStateManager(models.Manager):
+
+    def get_queryset(self) -> OrderGroupStateQuerySet:
+        return OrderGroupStateQuerySet(self.model, using=self._db, hints=self._hints)
+
+    def get_state_for_group_and_side(self, group_id: int, side: str) -> Optional['OrderGroupState']:
+        state = self.get_queryset().for_group_and_side(group_id, side)
+        if state is None:
+            # rows are created lazily for groups that predate the table
+            state = self.refresh(group_id, side)
+        return state
+
+    def get_current_group_for_side(self, group_id: int, side: str) -> Optional[OrderGroup]:
+        state = self.get_state_for_group_and_side(group_id, side)
+        return state.order_group if state is not None else None
+
+    def get_current_active_group(self) -> Optional[OrderGroup]:
+        return self.get_queryset().current_active()
+
+    def get_active_group_for_side(self, group_id: int, side: str) -> Optional[OrderGroup]:
+        '''
+        The latest order group of the timeframe group on this side while it is active.
+        '''
+        return self.get_queryset().active_for_group_and_side(group_id, side)
+
+    def refresh(self, group_id: int, side: str) -> Optional['OrderGroupState']:
+        '''
+        Recomputes the row for (group_id, side) from the latest order group, callers should be
+        inside the transaction that changed the orders.
+        '''
+        order_group = OrderGroup.objects.get_groups_with_state().filter(
+            group_id=group_id,
+            side=side
+        ).order_by('-created_at', '-id').first()
+
+        if order_group is None:
+            self.filter(group_id=group_id, side=side).delete()
+            return None
+
+        values = get_order_group_state_values(order_group)
+        # inside a unit of work this is the flow's own instance, don't leave it with counts that go stale
+        order_group.clear_state()
+        return upsert(
+            self.model,
+            [self.model(group_id=group_id, side=side, **values)],
+            unique_fields=['group', 'side'],
+            update_fields=list(values),
+        )[0].instance
+
+    def refresh_many(self, group_sides: Iterable[tuple[int, str]]):
+        '''
+        refresh for several (group_id, side) pairs, with one query for their latest order groups
+        and one upsert of their rows.
+        '''
+        group_sides = set(group_sides)
+        if len(group_sides) == 0:
+            return
+        refreshed = self._refresh_latest_groups(
+            OrderGroup.objects.filter(reduce(or_, (models.Q(group_id=group_id, side=side) for group_id, side in group_sides)))
+        )
+        removed = group_sides - refreshed
+        if len(removed) > 0:
+            self.filter(reduce(or_, (models.Q(group_id=group_id, side=side) for group_id, side in removed))).delete()
+
+    def refresh_for_algo_orders(self, algo_order_ids: list[int]):
+        self._refresh_latest_groups(OrderGroup.objects.filter(
+            models.Q(stop_id__in=algo_order_ids) |
+            models.Q(orders__order_id__in=algo_order_ids) |
+            models.Q(orders__stop_id__in=algo_order_ids)
+        ))
+
+    def _refresh_latest_groups(self, order_groups: models.QuerySet) -> set[tuple[int, str]]:
+        # the latest group of every (group, side) that has one of order_groups, the pairs aren't
+        # looked up first, they are a condition of the same query
+        latest_id = OrderGroup.objects.filter(
+            group_id=models.OuterRef('group_id'),
+            side=models.OuterRef('side')
+        ).order_by('-created_at', '-id').values('id')[:1]
+        latest_groups = list(OrderGroup.objects.get_groups_with_state().filter(
+            models.Exists(order_groups.filter(group_id=models.OuterRef('group_id'), side=models.OuterRef('side'))),
+            id=models.Subquery(latest_id),
+        ))
+        if len(latest_groups) == 0:
+            return set()
+
+        states = []
+        for order_group in latest_groups:
+            values = get_order_group_state_values(order_group)
+            order_group.clear_state()
+            states.append(self.model(group_id=order_group.group_id, side=order_group.side, **values))
+        self.bulk_create(
+            states,
+            update_conflicts=True,
+            unique_fields=['group', 'side'],
+            update_fields=['order_group', 'state', 'filled_quantity', 'last_fill_time', 'updated_at'],
+        )
+        return {(order_group.group_id, order_group.side) for order_group in latest_groups}
+
+    def rebuild(self) -> int:
+        with transaction.atomic():
+            pairs = set(OrderGroup.objects.values_list('group_id', 'side').distinct())
+            self.exclude(
+                id__in=[state.id for state in self.all() if (state.group_id, state.side) in pairs]
+            ).delete()
+            self.refresh_many(pairs)
+        return len(pairs)
+
+    def verify(self) -> list[str]:
+        '''
+        Compares every row with the state computed from the order rows, returns the differences.
+        '''
+        errors = []
+        pairs = set(OrderGroup.objects.values_list('group_id', 'side').distinct())
+        states = {(state.group_id, state.side): state for state in self.all()}
+
+        for group_id, side in sorted(set(states) - pairs):
+            errors.append(f'{group_id}/{side}: has a state row but no order groups')
+
+        for group_id, side in sorted(pairs):
+            state = states.get((group_id, side))
+            if state is None:
+                errors.append(f'{group_id}/{side}: missing')
+                continue
+            order_group = OrderGroup.objects.get_groups_with_state().filter(
+                group_id=group_id,
+                side=side
+            ).order_by('-created_at', '-id').first()
+            for field, expected in get_order_group_state_values(order_group).items():
+                # the decimals compare by value, 0.1 == 0.100000
+                actual = getattr(state, field)
+                if actual != expected:
+                    errors.append(f'{group_id}/{side}: {field} is {actual}, expected {expected}')
+
+        return errors
+
+
+class OrderGroupState(models.Model):
+    '''
+    The current order group per (TimeframeGroup, side) and its derived state, kept up to date
+    in the same transaction as the order changes that affect it.
+    '''
+    group = models.ForeignKey(TimeframeGroup, on_delete=models.CASCADE)
+    side = models.CharField(max_length=4, choices=(('BUY', 'BUY'), ('SELL', 'SELL')))
+    order_group = models.OneToOneField(OrderGroup, on_delete=models.CASCADE, related_name='current_state')
+    state = models.CharField(max_length=10, choices=LifecycleStateChoices.choices, default=LifecycleStateChoices.EMPTY)
+    filled_quantity = models.DecimalField(max_digits=20, decimal_places=6, default=0)
+    last_fill_time = models.DecimalField(max_digits=20, decimal_places=4, null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = OrderGroupStateManager()
+
+    def __str__(self):
+        return f'{self.group_id} - {self.side} - {self.order_group_id} - {self.state}'
+
+    class Meta:
+        verbose_name_plural = 'Order Group States'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['group', 'side'],
+                name='order_group_state_group_side_unique_constraint',
+            ),
+        ]
+
+
+def algo_order_in_order_group() -> models.Exists:
+    '''
+    Annotates WooAlgoOrder rows with whether they are an order, order stop or stop of a group,
+    only those can change a state row.
+    '''
+    return models.Exists(OrderGroup.objects.filter(
+        models.Q(stop_id=models.OuterRef('pk')) |
+        models.Q(orders__order_id=models.OuterRef('pk')) |
+        models.Q(orders__stop_id=models.OuterRef('pk'))
+    ))
+
+
+def _get_group_sides(q: models.Q) -> list[tuple[int, str]]:
+    return list(OrderGroup.objects.filter(q).values_list('group_id', 'side').distinct())
+
+
+# saves limited to other fields can't change the state, see DirtyFieldsMixin
+ORDER_GROUP_STATE_FIELDS = {'group', 'side', 'stop'}
+ORDER_STATE_FIELDS = {'order', 'stop', 'force_close'}
+ALGO_ORDER_STATE_FIELDS = {'side', 'status', 'quantity', 'quantity_lots', 'trigger_time', 'trigger_time_ms'}
+
+
+def _can_change_state(update_fields, state_fields: set[str]) -> bool:
+    return update_fields is None or not state_fields.isdisjoint(update_fields)
+
+
+def _refresh_states(group_sides: list[tuple[int, str]]):
+    OrderGroupState.objects.refresh_many(group_sides)
+
+
+def _refresh_states_for_algo_orders(algo_order_ids: list[int]):
+    OrderGroupState.objects.refresh_for_algo_orders(sorted(set(algo_order_ids)))
+
+
+def _queue_state_refresh(group_id: int, side: str):
+    # a unit of work flushing several rows of a group refreshes its state once, after the last one
+    run_after_flush('order_group_state', _refresh_states, (group_id, side))
+
+
+@receiver(post_save, sender=OrderGroup)
+@receiver(post_delete, sender=OrderGroup)
+def refresh_state_for_order_group(sender, instance: OrderGroup, update_fields=None, **kwargs):
+    if not _can_change_state(update_fields, ORDER_GROUP_STATE_FIELDS):
+        return
+    _queue_state_refresh(instance.group_id, instance.side)
+
+
+@receiver(post_save, sender=Order)
+def refresh_state_for_order(sender, instance: Order, created: bool, update_fields=None, **kwargs):
+    if created or not _can_change_state(update_fields, ORDER_STATE_FIELDS):
+        return
+    for group_id, side in _get_group_sides(models.Q(orders=instance)):
+        _queue_state_refresh(group_id, side)
+
+
+@receiver(post_save, sender=WooAlgoOrder)
+def refresh_state_for_algo_order(sender, instance: WooAlgoOrder, created: bool, update_fields=None, **kwargs):
+    if created or not _can_change_state(update_fields, ALGO_ORDER_STATE_FIELDS):
+        return
+    run_after_flush('order_group_state_for_algo_orders', _refresh_states_for_algo_orders, instance.id)
+
+
+@receiver(m2m_changed, sender=OrderGroup.orders.through)
+def refresh_state_for_order_group_orders(sender, action, instance, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        OrderGroupState.objects.refresh(instance.group_id, instance.side)
+        return
+    for group_id, side in _get_group_sides(models.Q(pk__in=pk_set or [])):
+        OrderGroupState.objects.refresh(group_id, side)
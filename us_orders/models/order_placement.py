@@ -0,0 +1,37 @@
+from django.db import models
+
+from us.models import TimeframeKlineSignal
+from us_orders.models.order_group import OrderGroup
+
+
+class PlacementStateChoices(models.TextChoices):
+    PENDING = 'PENDING'
+    COMPLETED = 'COMPLETED'
+    COMPENSATED = 'COMPENSATED'
+    # a call went through and couldn't be undone, the exchange holds an order no group knows of
+    ORPHANED = 'ORPHANED'
+
+
+class OrderPlacement(models.Model):
+    '''
+    The exchange calls a new signal makes, written before they are sent. A row left PENDING
+    means the process died while they were in flight, reconcile_pending_placements finds the
+    orders it may have placed by the order tags in operations and undoes them at startup.
+    '''
+    signal = models.ForeignKey(TimeframeKlineSignal, on_delete=models.CASCADE, related_name='+')
+    order_group = models.ForeignKey(OrderGroup, on_delete=models.SET_NULL, related_name='+', null=True, blank=True)
+    operations = models.JSONField(default=list)
+    # step name -> exchange order id
+    results = models.JSONField(default=dict, blank=True)
+    state = models.CharField(max_length=12, choices=PlacementStateChoices.choices, default=PlacementStateChoices.PENDING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.id} - {self.signal_id} - {self.state}'
+
+    class Meta:
+        verbose_name_plural = 'Order Placements'
+        indexes = [
+            models.Index(fields=['state'], condition=~models.Q(state='COMPLETED'), name='order_placement_open_idx'),
+        ]
@@ -0,0 +1,677 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Callable, Iterable, Iterator, Optional
+
+from django.db import models, transaction
+from django.db.models import Max
+
+from common.util.fixed_point import lots_to_float, seconds_to_ms, to_lots, to_ticks
+from common.util.logging import log
+from common.util.upsert import upsert
+from common.util.write_behind import WriteBehindQueue
+from us_orders.flows.order_status_change_flow import get_new_statuses, normalise_algo_order_status
+from us_orders.models.algo_order_route import AlgoOrderRoleChoices
+from us_orders.models.order import Order, OrderStatusMixin
+from us_orders.models.order_group import OrderGroup, OrderGroupStatusMixin
+from us_orders.models.order_group_state import LifecycleStateChoices
+from us_orders.models.order_placement import OrderPlacement
+from us_orders.order_store import OrderStore
+from us_orders.routing import parse_order_tag
+from woo.algo_order_version_guard import AlgoOrderVersionGuard
+from woo.api_types import AlgoOrderResponseData, AlgoOrderStatus
+from woo.helpers import map_woo_algo_order_data
+from woo.models import WooAlgoOrder
+
+# how long a read of the db waits for the engine's writes to be applied
+FLUSH_TIMEOUT_SECONDS = 30.0
+# reports of algo orders whose rows aren't written yet are retried for this long, at most this many
+UNKNOWN_REPORT_SECONDS = 60.0
+MAX_UNKNOWN_REPORTS = 1000
+
+OPEN_STATES = [
+    LifecycleStateChoices.EMPTY,
+    LifecycleStateChoices.PENDING,
+    LifecycleStateChoices.ACTIVE,
+    LifecycleStateChoices.INACTIVE,
+]
+
+
+class AlgoOrderEntry:
+    '''
+    Prices are held in ticks, quantities in lots and times in ms, see common.util.fixed_point.
+    '''
+    __slots__ = (
+        'id', 'order_id', 'symbol', 'side', 'status', 'reduce_only', 'quantity_lots',
+        'trigger_price_ticks', 'trigger_trade_price_ticks', 'trigger_time_ms',
+    )
+
+    # model field -> (entry slot, conversion)
+    FIXED_POINT_FIELDS = {
+        'quantity': ('quantity_lots', to_lots),
+        'trigger_price': ('trigger_price_ticks', to_ticks),
+        'trigger_trade_price': ('trigger_trade_price_ticks', to_ticks),
+        'trigger_time': ('trigger_time_ms', seconds_to_ms),
+    }
+
+    def __init__(
+        self,
+        id: Optional[int],
+        order_id: int,
+        symbol: str,
+        side: str,
+        status: Optional[str],
+        reduce_only: bool,
+        quantity_lots: int,
+        trigger_price_ticks: int,
+        trigger_trade_price_ticks: Optional[int] = None,
+        trigger_time_ms: Optional[int] = None
+    ):
+        self.id = id
+        self.order_id = order_id
+        self.symbol = symbol
+        self.side = side
+        self.status = status
+        self.reduce_only = reduce_only
+        self.quantity_lots = quantity_lots
+        self.trigger_price_ticks = trigger_price_ticks
+        self.trigger_trade_price_ticks = trigger_trade_price_ticks
+        self.trigger_time_ms = trigger_time_ms
+
+    @classmethod
+    def from_fields(cls, fields: dict, id: Optional[int] = None) -> 'AlgoOrderEntry':
+        entry = cls(id, fields['order_id'], fields.get('symbol'), fields.get('side'), fields.get('status') or 'NEW',
+                    bool(fields.get('reduce_only')), 0, 0)
+        entry.update(fields)
+        return entry
+
+    @classmethod
+    def from_model(cls, algo_order: WooAlgoOrder) -> 'AlgoOrderEntry':
+        return cls(
+            algo_order.id,
+            algo_order.order_id,
+            algo_order.symbol,
+            algo_order.side,
+            algo_order.status,
+            algo_order.reduce_only,
+            to_lots(algo_order.quantity),
+            to_ticks(algo_order.trigger_price),
+            to_ticks(algo_order.trigger_trade_price),
+            seconds_to_ms(algo_order.trigger_time)
+        )
+
+    @property
+    def quantity(self) -> float:
+        return lots_to_float(self.quantity_lots)
+
+    def update(self, fields: dict):
+        for field in ('symbol', 'side', 'status', 'reduce_only'):
+            if field in fields:
+                setattr(self, field, fields[field])
+        for field, (slot, convert) in self.FIXED_POINT_FIELDS.items():
+            if field in fields:
+                setattr(self, slot, convert(fields[field]))
+
+
+class OrderEntry(OrderStatusMixin):
+    __slots__ = ('id', 'order', 'stop', 'force_close', 'group')
+
+    def __init__(
+        self,
+        id: int,
+        order: AlgoOrderEntry,
+        stop: Optional[AlgoOrderEntry] = None,
+        force_close: bool = False,
+        group: Optional['GroupEntry'] = None
+    ):
+        self.id = id
+        self.order = order
+        self.stop = stop
+        self.force_close = force_close
+        self.group = group
+
+    @property
+    def _is_group_stopped_out(self) -> bool:
+        return self.group is not None and self.group.is_stopped_out
+
+    @property
+    def quantity(self) -> float:
+        return lots_to_float(self.quantity_lots)
+
+
+class GroupEntry(OrderGroupStatusMixin):
+    __slots__ = ('id', 'group_id', 'side', 'stop', 'orders', 'max_consecutive_stops', 'stop_loss_difference_ticks')
+
+    def __init__(
+        self,
+        id: int,
+        group_id: int,
+        side: str,
+        stop: Optional[AlgoOrderEntry],
+        max_consecutive_stops: int,
+        stop_loss_difference_ticks: int
+    ):
+        self.id = id
+        self.group_id = group_id
+        self.side = side
+        self.stop = stop
+        self.orders: list[OrderEntry] = []
+        self.max_consecutive_stops = max_consecutive_stops
+        self.stop_loss_difference_ticks = stop_loss_difference_ticks
+
+    @property
+    def quantity_lots(self) -> int:
+        return sum(order.quantity_lots for order in self.orders if order.order.status == 'FILLED')
+
+    @property
+    def _has_no_orders(self) -> bool:
+        return len(self.orders) == 0
+
+    @property
+    def _is_pending(self) -> bool:
+        return not self._has_no_orders and all(order.status in ['NEW', 'CANCELLED'] for order in self.orders)
+
+    @property
+    def _is_active(self) -> bool:
+        return any(order.status == 'FILLED' for order in self.orders)
+
+    @property
+    def _is_canceled(self) -> bool:
+        return not self._has_no_orders and all(order.status in ['CANCELLED', 'REJECTED'] for order in self.orders)
+
+    @property
+    def _all_orders_closed(self) -> bool:
+        return not self._has_no_orders and all(order.status == 'CLOSED' for order in self.orders)
+
+    @property
+    def _stopped_out_order_count(self) -> int:
+        return sum(1 for order in self.orders if order.is_stopped_out)
+
+
+class OrderStateEngine(OrderStore):
+    '''
+    Open order state of the private ws consumer, held in memory so fills can be acted on without
+    reading the db.
+
+    hydrate() loads every group that is open or still has a NEW order or stop. Reports for algo
+    orders that are not tracked, e.g. orders placed by the signal flow in another process, load
+    their order and group from the db once the write-behind queue has been flushed, so every
+    change the engine made is visible to that read. When the writes aren't applied within
+    FLUSH_TIMEOUT_SECONDS nothing is read. The db is never flushed or read while the lock is
+    held, the lock only guards the entries.
+
+    The signal flow writes its rows once the exchange has taken the orders, so the NEW report
+    of an order usually arrives before its row. Such reports are kept in unknown_reports for
+    UNKNOWN_REPORT_SECONDS and their orders loaded again before the pending orders or stops
+    of a side are looked up, the kept report is then applied to the loaded entry.
+
+    The signal flows of tv and celery change the groups underneath the engine, every signal
+    that places or moves an order writes an OrderPlacement. reconcile() reloads the groups of
+    a timeframe group when it has a placement newer than the engine has seen, callers hold the
+    timeframe group's key so no signal flow of it is in between.
+
+    Writes are put on a WriteBehindQueue as ops that apply_write_ops persists in order, the
+    reports op always goes first so the rows have their new status before anything else
+    refers to it.
+
+    The engine is the OrderStore the order_status_change_flow decisions run against on this
+    path. An engine of a partitioned flow worker only holds the groups of some timeframe groups,
+    the reports of another partition's groups are passed to on_hand_off instead of being applied.
+    The cancels of pending orders and stops stay within a timeframe group, so they never need
+    the groups of another partition.
+    '''
+
+    def __init__(self, write_queue: WriteBehindQueue, version_guard: Optional[AlgoOrderVersionGuard] = None):
+        self.write_queue = write_queue
+        self.version_guard = version_guard
+        # when set only groups of the timeframe groups it owns are loaded, the reports of the
+        # others are passed to on_hand_off with their timeframe group id
+        self.owns_timeframe_group: Optional[Callable[[int], bool]] = None
+        self.on_hand_off: Optional[Callable[[int, list[AlgoOrderResponseData]], None]] = None
+        self.lock = threading.RLock()
+        self.algo_orders: dict[int, AlgoOrderEntry] = {}
+        self.orders: dict[int, OrderEntry] = {}
+        self.groups: dict[int, GroupEntry] = {}
+        self.groups_by_stop: dict[int, GroupEntry] = {}
+        # algo order id -> (monotonic time, latest report) of reports no row was found for
+        self.unknown_reports: dict[int, tuple[float, AlgoOrderResponseData]] = {}
+        # timeframe group id -> id of the latest OrderPlacement its groups were loaded after
+        self.placement_ids: dict[int, int] = {}
+        self.loads = 0
+
+    def hydrate(self, timeframe_group_ids: Optional[Iterable[int]] = None) -> int:
+        '''
+        Replaces the state with the open groups, only those of timeframe_group_ids when given.
+        '''
+        queryset = _get_open_groups()
+        placements = OrderPlacement.objects.all()
+        if timeframe_group_ids is not None:
+            timeframe_group_ids = list(timeframe_group_ids)
+            queryset = queryset.filter(group_id__in=timeframe_group_ids)
+            placements = placements.filter(order_group__group_id__in=timeframe_group_ids)
+        # read first, a placement made while the groups are read only reloads them once more
+        placement_ids = _get_latest_placement_ids(placements)
+        order_groups = _prefetch_groups(queryset)
+        with self.lock:
+            self.algo_orders = {}
+            self.orders = {}
+            self.groups = {}
+            self.groups_by_stop = {}
+            self.placement_ids = placement_ids
+            for order_group in order_groups:
+                self._add_group(order_group)
+        return len(self.groups)
+
+    def reconcile(self, timeframe_group_ids: Iterable[int]) -> list[int]:
+        '''
+        Reloads the groups of the timeframe groups a signal flow placed orders for since they
+        were loaded, returns those timeframe groups.
+        '''
+        timeframe_group_ids = list(set(timeframe_group_ids))
+        if len(timeframe_group_ids) == 0:
+            return []
+        placement_ids = _get_latest_placement_ids(
+            OrderPlacement.objects.filter(order_group__group_id__in=timeframe_group_ids)
+        )
+        changed = [
+            timeframe_group_id for timeframe_group_id, placement_id in placement_ids.items()
+            if placement_id > self.placement_ids.get(timeframe_group_id, 0)
+        ]
+        if len(changed) == 0 or not self.flush_writes():
+            return []
+        self.loads += 1
+        order_groups = _prefetch_groups(_get_open_groups().filter(group_id__in=changed))
+        with self.lock:
+            for timeframe_group_id in changed:
+                self._remove_timeframe_group(timeframe_group_id)
+                self.placement_ids[timeframe_group_id] = placement_ids[timeframe_group_id]
+            for order_group in order_groups:
+                self._add_group(order_group)
+        return changed
+
+    def flush_writes(self) -> bool:
+        if self.write_queue.flush(FLUSH_TIMEOUT_SECONDS):
+            return True
+        log('order state', f'{self.write_queue.pending} writes not applied after {FLUSH_TIMEOUT_SECONDS}s, not reading the db')
+        return False
+
+    def get_timeframe_group_id(self, order_id: int) -> Optional[int]:
+        '''
+        The timeframe group of a tracked algo order's group.
+        '''
+        order = self.orders.get(order_id)
+        group = order.group if order is not None else self.groups_by_stop.get(order_id)
+        return group.group_id if group is not None else None
+
+    def get_order(self, order_id: int) -> Optional[OrderEntry]:
+        return self.orders.get(order_id)
+
+    def get_group_by_stop_order_id(self, order_id: int, data: Optional[AlgoOrderResponseData] = None) -> Optional[GroupEntry]:
+        return self.groups_by_stop.get(order_id)
+
+    def get_order_by_order_id(self, order_id: int, data: Optional[AlgoOrderResponseData] = None) -> Optional[OrderEntry]:
+        order = self.orders.get(order_id)
+        if order is None or order.order.order_id != order_id:
+            return None
+        return order
+
+    def get_order_by_stop_order_id(self, order_id: int, data: Optional[AlgoOrderResponseData] = None) -> Optional[OrderEntry]:
+        order = self.orders.get(order_id)
+        if order is None or order.stop is None or order.stop.order_id != order_id:
+            return None
+        return order
+
+    def get_order_group(self, order: OrderEntry) -> Optional[GroupEntry]:
+        return order.group
+
+    def is_tracked(self, order_id: int) -> bool:
+        return order_id in self.algo_orders
+
+    def load(self, order_id: int, order_tag: Optional[str] = None) -> bool:
+        '''
+        Loads the order and group an algo order belongs to from the db, returns whether it is
+        tracked afterwards. Our order tags name the group or order, so those load by key.
+        '''
+        self._load(order_id, order_tag)
+        return order_id in self.algo_orders
+
+    def _load(self, order_id: int, order_tag: Optional[str]) -> Optional[int]:
+        '''
+        Returns the timeframe group of the algo order's group when the engine doesn't own it, such
+        a group is not loaded.
+        '''
+        if not self.flush_writes():
+            return None
+        self.loads += 1
+
+        route = parse_order_tag(order_tag)
+        if route is not None and route.order_group_id is not None:
+            owner = models.Q(pk=route.order_group_id)
+        elif route is not None and route.role == AlgoOrderRoleChoices.ORDER_STOP:
+            owner = models.Q(orders__stop__order_id=order_id)
+        else:
+            owner = (
+                models.Q(stop__order_id=order_id) |
+                models.Q(orders__order__order_id=order_id) |
+                models.Q(orders__stop__order_id=order_id)
+            )
+
+        order_groups = _prefetch_groups(OrderGroup.objects.filter(owner).distinct())
+        order = None
+        if not any(order_id in _get_algo_order_ids(order_group) for order_group in order_groups):
+            order = Order.objects.select_related('order', 'stop').filter(
+                models.Q(order__order_id=order_id) | models.Q(stop__order_id=order_id)
+            ).first()
+            order_group = order.order_groups.first() if order is not None else None
+            if order_group is not None:
+                order_groups += _prefetch_groups(OrderGroup.objects.filter(pk=order_group.pk))
+                order = None
+
+        if self.owns_timeframe_group is not None:
+            for order_group in order_groups:
+                if not self.owns_timeframe_group(order_group.group_id):
+                    return order_group.group_id
+
+        with self.lock:
+            for order_group in order_groups:
+                self._add_group(order_group)
+            if order is not None:
+                self._add_order(order, None)
+        return None
+
+    def apply_reports(self, data_list: list[AlgoOrderResponseData]) -> list[tuple[AlgoOrderResponseData, str]]:
+        '''
+        The in memory get_new_statuses, updates the tracked entries and puts one reports op for
+        the batch, returns the reports of tracked orders that changed their status.
+        '''
+        data_list = [data for data in data_list if data.get('algoOrderId') is not None]
+
+        if self.version_guard is not None:
+            data_list = self.version_guard.filter(data_list)
+
+        if len(data_list) == 0:
+            return []
+
+        changes = []
+
+        # loading reads the db, the untracked orders are loaded before the lock is taken
+        untracked = {}
+        for data in data_list:
+            if data.get('algoOrderId') not in self.algo_orders:
+                untracked.setdefault(data.get('algoOrderId'), data.get('orderTag'))
+        handed_off: dict[int, int] = {}
+        for order_id, order_tag in untracked.items():
+            timeframe_group_id = self._load(order_id, order_tag)
+            if timeframe_group_id is not None:
+                handed_off[order_id] = timeframe_group_id
+        self._remember_unknown([
+            data for data in data_list
+            if data.get('algoOrderId') not in self.algo_orders and data.get('algoOrderId') not in handed_off
+        ])
+        if len(handed_off) > 0:
+            # the owner applies these, its entries would miss the status change otherwise
+            self._hand_off([data for data in data_list if data.get('algoOrderId') in handed_off], handed_off)
+            data_list = [data for data in data_list if data.get('algoOrderId') not in handed_off]
+            if len(data_list) == 0:
+                return []
+
+        with self.lock:
+            for data in data_list:
+                order_id = data.get('algoOrderId')
+                new_status = normalise_algo_order_status(data)
+
+                if self.version_guard is not None:
+                    self.version_guard.record(data)
+
+                if order_id not in self.algo_orders:
+                    continue
+
+                entry = self.algo_orders[order_id]
+                current_status = entry.status
+                entry.update(map_woo_algo_order_data(data))
+
+                if current_status is None or current_status == new_status:
+                    continue
+
+                changes.append((data, new_status))
+
+            self.write_queue.put({'type': 'reports', 'reports': data_list})
+
+        return changes
+
+    def _hand_off(self, data_list: list[AlgoOrderResponseData], timeframe_group_ids: dict[int, int]):
+        batches: dict[int, list[AlgoOrderResponseData]] = {}
+        for data in data_list:
+            batches.setdefault(timeframe_group_ids[data.get('algoOrderId')], []).append(data)
+        for timeframe_group_id, reports in batches.items():
+            self.on_hand_off(timeframe_group_id, reports)
+
+    def _remember_unknown(self, data_list: list[AlgoOrderResponseData]):
+        now = time.monotonic()
+        with self.lock:
+            for data in data_list:
+                self.unknown_reports.pop(data.get('algoOrderId'), None)
+                self.unknown_reports[data.get('algoOrderId')] = (now, data)
+            while len(self.unknown_reports) > MAX_UNKNOWN_REPORTS:
+                # the oldest goes first, the dict keeps the order they were remembered in
+                del self.unknown_reports[next(iter(self.unknown_reports))]
+
+    def _load_unknown(self):
+        '''
+        Loads the orders of the kept reports again and applies the reports to the ones whose
+        rows are there now.
+        '''
+        if len(self.unknown_reports) == 0:
+            return
+        expired_before = time.monotonic() - UNKNOWN_REPORT_SECONDS
+        with self.lock:
+            unknown = list(self.unknown_reports.items())
+            for order_id, (remembered_at, _) in unknown:
+                if remembered_at < expired_before:
+                    del self.unknown_reports[order_id]
+
+        loaded = []
+        handed_off: dict[int, int] = {}
+        for order_id, (remembered_at, data) in unknown:
+            if remembered_at < expired_before:
+                continue
+            timeframe_group_id = self._load(order_id, data.get('orderTag'))
+            if timeframe_group_id is not None:
+                handed_off[order_id] = timeframe_group_id
+            elif order_id in self.algo_orders:
+                loaded.append(data)
+            else:
+                continue
+            with self.lock:
+                self.unknown_reports.pop(order_id, None)
+
+        if len(handed_off) > 0:
+            self._hand_off([data for _, (_, data) in unknown if data.get('algoOrderId') in handed_off], handed_off)
+        if len(loaded) == 0:
+            return
+        with self.lock:
+            for data in loaded:
+                self.algo_orders[data.get('algoOrderId')].update(map_woo_algo_order_data(data))
+            self.write_queue.put({'type': 'reports', 'reports': loaded})
+
+    def pending_orders_for_side(self, group_id: int, side: str) -> list[OrderEntry]:
+        self._load_unknown()
+        return [
+            order for order in self._orders_of_timeframe_group(group_id)
+            if order.order.status == 'NEW' and not order.order.reduce_only and order.order.side == side
+        ]
+
+    def pending_stops_for_side(self, group_id: int, side: str) -> list[OrderEntry]:
+        self._load_unknown()
+        return [
+            order for order in self._orders_of_timeframe_group(group_id)
+            if order.stop is not None and order.stop.status == 'NEW' and order.stop.reduce_only and order.stop.side == side
+        ]
+
+    def cancelled(self, entry: AlgoOrderEntry):
+        entry.status = AlgoOrderStatus.CANCELLED.value
+        entry.quantity_lots = 0
+        self.write_queue.put({
+            'type': 'update_algo_order',
+            'order_id': entry.order_id,
+            'fields': {'status': AlgoOrderStatus.CANCELLED.value, 'quantity': 0},
+        })
+
+    def quantity_edited(self, entry: AlgoOrderEntry, quantity_lots: int):
+        entry.quantity_lots = quantity_lots
+        self.write_queue.put({
+            'type': 'update_algo_order',
+            'order_id': entry.order_id,
+            'fields': {'quantity': lots_to_float(quantity_lots)},
+        })
+
+    def order_stop_created(self, order: OrderEntry, fields: dict) -> AlgoOrderEntry:
+        with self.lock:
+            stop = AlgoOrderEntry.from_fields(fields)
+            order.stop = stop
+            self.algo_orders[stop.order_id] = stop
+            self.orders[stop.order_id] = order
+        self.write_queue.put({'type': 'create_algo_order', 'fields': fields})
+        self.write_queue.put({'type': 'set_order_stop', 'order': order.id, 'stop_order_id': stop.order_id})
+        return stop
+
+    def group_stop_removed(self, group: GroupEntry):
+        with self.lock:
+            if group.stop is not None:
+                self.groups_by_stop.pop(group.stop.order_id, None)
+            group.stop = None
+        self.write_queue.put({'type': 'set_group_stop', 'order_group': group.id, 'stop_order_id': None})
+
+    def clear(self):
+        with self.lock:
+            self.algo_orders = {}
+            self.orders = {}
+            self.groups = {}
+            self.groups_by_stop = {}
+            self.unknown_reports = {}
+            self.placement_ids = {}
+
+    def stats(self) -> dict:
+        return {
+            'algo_orders': len(self.algo_orders),
+            'unknown_reports': len(self.unknown_reports),
+            'groups': len(self.groups),
+            'loads': self.loads,
+            'pending_writes': self.write_queue.pending,
+        }
+
+    def _orders_of_timeframe_group(self, group_id: int) -> Iterator[OrderEntry]:
+        for group in list(self.groups.values()):
+            if group.group_id == group_id:
+                yield from group.orders
+
+    def _remove_timeframe_group(self, timeframe_group_id: int):
+        for group in [group for group in self.groups.values() if group.group_id == timeframe_group_id]:
+            del self.groups[group.id]
+            if group.stop is not None:
+                self.groups_by_stop.pop(group.stop.order_id, None)
+                self.algo_orders.pop(group.stop.order_id, None)
+            for order in group.orders:
+                for algo_order in (order.order, order.stop):
+                    if algo_order is not None:
+                        self.orders.pop(algo_order.order_id, None)
+                        self.algo_orders.pop(algo_order.order_id, None)
+
+    def _add_group(self, order_group: OrderGroup):
+        previous = self.groups.get(order_group.id)
+        if previous is not None and previous.stop is not None:
+            self.groups_by_stop.pop(previous.stop.order_id, None)
+        strategy_variables = order_group.group.strategy_variables
+        group = GroupEntry(
+            order_group.id,
+            order_group.group_id,
+            order_group.side,
+            self._add_algo_order(order_group.stop),
+            strategy_variables.max_consecutive_stops,
+            to_ticks(strategy_variables.stop_loss_difference)
+        )
+        self.groups[group.id] = group
+        if group.stop is not None:
+            self.groups_by_stop[group.stop.order_id] = group
+        for order in order_group.orders.all():
+            group.orders.append(self._add_order(order, group))
+
+    def _add_order(self, order: Order, group: Optional[GroupEntry]) -> OrderEntry:
+        entry = OrderEntry(
+            order.id,
+            self._add_algo_order(order.order),
+            self._add_algo_order(order.stop),
+            order.force_close,
+            group
+        )
+        self.orders[entry.order.order_id] = entry
+        if entry.stop is not None:
+            self.orders[entry.stop.order_id] = entry
+        return entry
+
+    def _add_algo_order(self, algo_order: Optional[WooAlgoOrder]) -> Optional[AlgoOrderEntry]:
+        if algo_order is None:
+            return None
+        entry = AlgoOrderEntry.from_model(algo_order)
+        self.algo_orders[entry.order_id] = entry
+        return entry
+
+
+def apply_write_ops(ops: list[dict]):
+    '''
+    Persists a batch of OrderStateEngine ops in one transaction, every op is idempotent so a
+    batch replayed after a crash leaves the rows as they would have been.
+    '''
+    with transaction.atomic():
+        for op in ops:
+            op_type = op['type']
+            if op_type == 'reports':
+                get_new_statuses(op['reports'])
+            elif op_type == 'create_algo_order':
+                algo_order = WooAlgoOrder(**op['fields'])
+                algo_order.sync_fixed_point()
+                upsert(WooAlgoOrder, [algo_order], unique_fields=['order_id'])
+            elif op_type == 'update_algo_order':
+                algo_order = WooAlgoOrder.objects.filter(order_id=op['order_id']).first()
+                if algo_order is not None:
+                    algo_order.update(**op['fields'])
+            elif op_type == 'set_order_stop':
+                order = Order.objects.select_related('order', 'stop').get(pk=op['order'])
+                order.set_stop(WooAlgoOrder.objects.get(order_id=op['stop_order_id']))
+            elif op_type == 'set_group_stop':
+                order_group = OrderGroup.objects.get(pk=op['order_group'])
+                stop_order_id = op['stop_order_id']
+                order_group.set_stop(
+                    WooAlgoOrder.objects.get(order_id=stop_order_id) if stop_order_id is not None else None
+                )
+            else:
+                raise Exception(f'Unknown write op {op_type}')
+
+
+def _get_open_groups() -> models.QuerySet:
+    return OrderGroup.objects.filter(
+        models.Q(current_state__state__in=OPEN_STATES) |
+        models.Q(stop__status='NEW') |
+        models.Q(orders__order__status='NEW') |
+        models.Q(orders__stop__status='NEW')
+    ).distinct()
+
+
+def _get_latest_placement_ids(placements: models.QuerySet) -> dict[int, int]:
+    return dict(placements.filter(order_group__isnull=False).values('order_group__group_id').annotate(
+        latest=Max('id')
+    ).values_list('order_group__group_id', 'latest'))
+
+
+def _get_algo_order_ids(order_group: OrderGroup) -> set[int]:
+    algo_orders = [order_group.stop]
+    for order in order_group.orders.all():
+        algo_orders += [order.order, order.stop]
+    return {algo_order.order_id for algo_order in algo_orders if algo_order is not None}
+
+
+def _prefetch_groups(queryset: models.QuerySet) -> list[OrderGroup]:
+    return list(queryset.select_related('stop', 'group__strategy_variables').prefetch_related(
+        models.Prefetch('orders', queryset=Order.objects.select_related('order', 'stop'))
+    ))
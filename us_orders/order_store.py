@@ -0,0 +1,133 @@
+'''
+What the order status change decisions read and change, so the same decisions run against the db
+and against an OrderStateEngine. The orders and groups a store hands out have the status rules of
+OrderStatusMixin and OrderGroupStatusMixin, their algo orders an order_id, side, status and the
+fixed point fields of WooAlgoOrder.
+'''
+from typing import Optional
+
+from common.util.fixed_point import lots_to_float
+from common.util.unit_of_work import load_once
+from us_orders.models.algo_order_route import AlgoOrderRoleChoices
+from us_orders.models.order import Order
+from us_orders.models.order_group import OrderGroup
+from us_orders.routing import OrderRoute, get_route
+from woo.api_types import AlgoOrderResponseData, AlgoOrderStatus
+from woo.models import WooAlgoOrder
+
+# unit of work key of DbOrderStore._get_route
+ROUTE_FOR_ALGO_ORDER = 'route_for_algo_order'
+
+
+class OrderStore:
+
+    def get_order_by_order_id(self, order_id: int, data: Optional[AlgoOrderResponseData] = None):
+        '''
+        The order a filled non reduce only algo order was placed for.
+        '''
+        raise Exception(f'{type(self).__name__} does not look up orders')
+
+    def get_order_by_stop_order_id(self, order_id: int, data: Optional[AlgoOrderResponseData] = None):
+        '''
+        The order a filled reduce only algo order was the stop of.
+        '''
+        raise Exception(f'{type(self).__name__} does not look up orders')
+
+    def get_group_by_stop_order_id(self, order_id: int, data: Optional[AlgoOrderResponseData] = None):
+        '''
+        The group a filled reduce only algo order was the group stop of.
+        '''
+        raise Exception(f'{type(self).__name__} does not look up group stops')
+
+    def get_order_group(self, order):
+        raise Exception(f'{type(self).__name__} does not look up groups')
+
+    def pending_orders_for_side(self, group_id: int, side: str) -> list:
+        '''
+        The pending orders on this side of the groups of the TimeframeGroup group_id.
+        '''
+        raise Exception(f'{type(self).__name__} does not look up pending orders')
+
+    def pending_stops_for_side(self, group_id: int, side: str) -> list:
+        '''
+        The orders with a pending stop on this side in the groups of the TimeframeGroup group_id.
+        '''
+        raise Exception(f'{type(self).__name__} does not look up pending stops')
+
+    def cancelled(self, algo_order):
+        raise Exception(f'{type(self).__name__} does not record cancels')
+
+    def quantity_edited(self, algo_order, quantity_lots: int):
+        raise Exception(f'{type(self).__name__} does not record edits')
+
+    def order_stop_created(self, order, fields: dict):
+        raise Exception(f'{type(self).__name__} does not record new stops')
+
+    def group_stop_removed(self, order_group):
+        raise Exception(f'{type(self).__name__} does not record group stops')
+
+
+class DbOrderStore(OrderStore):
+    '''
+    Reads and writes the rows, inside a unit of work the writes are deferred with the flow's.
+    '''
+
+    def get_order_by_order_id(self, order_id: int, data: Optional[AlgoOrderResponseData] = None) -> Optional[Order]:
+        route = self._get_route(order_id, data)
+        if route is None:
+            return Order.objects.get_order_by_order_id(order_id)
+        if route.role == AlgoOrderRoleChoices.ORDER:
+            return Order.objects.get_order_by_algo_order_id(order_id)
+        return None
+
+    def get_order_by_stop_order_id(self, order_id: int, data: Optional[AlgoOrderResponseData] = None) -> Optional[Order]:
+        route = self._get_route(order_id, data)
+        if route is None:
+            # untagged orders from before the route table, find out what the order is from the db
+            return Order.objects.get_order_by_order_id(order_id)
+        if route.role == AlgoOrderRoleChoices.ORDER_STOP:
+            return get_order_for_route(route, order_id)
+        return None
+
+    def get_group_by_stop_order_id(self, order_id: int, data: Optional[AlgoOrderResponseData] = None) -> Optional[OrderGroup]:
+        route = self._get_route(order_id, data)
+        if route is not None and route.role != AlgoOrderRoleChoices.GROUP_STOP:
+            return None
+        if route is not None and route.order_group_id is not None:
+            # group stop tags name the group
+            return OrderGroup.objects.select_related('stop').filter(pk=route.order_group_id).first()
+        return OrderGroup.objects.get_group_by_stop_order_id(order_id)
+
+    def get_order_group(self, order: Order) -> Optional[OrderGroup]:
+        return OrderGroup.objects.get_group_by_order(order)
+
+    def pending_orders_for_side(self, group_id: int, side: str) -> list[Order]:
+        return list(Order.objects.get_all_pending_non_reduce_only_orders_for_group_and_side(group_id, side))
+
+    def pending_stops_for_side(self, group_id: int, side: str) -> list[Order]:
+        return list(Order.objects.get_all_pending_reduce_only_orders_for_group_and_side(group_id, side))
+
+    def cancelled(self, algo_order: WooAlgoOrder):
+        algo_order.update(status=AlgoOrderStatus.CANCELLED.value, quantity=0)
+
+    def quantity_edited(self, algo_order: WooAlgoOrder, quantity_lots: int):
+        algo_order.update(quantity=lots_to_float(quantity_lots))
+
+    def order_stop_created(self, order: Order, fields: dict):
+        order.set_stop(WooAlgoOrder.objects.create(**fields))
+
+    def group_stop_removed(self, order_group: OrderGroup):
+        order_group.set_stop(None)
+
+    def _get_route(self, order_id: int, data: Optional[AlgoOrderResponseData]) -> Optional[OrderRoute]:
+        order_tag = (data or {}).get('orderTag')
+        return load_once((ROUTE_FOR_ALGO_ORDER, order_id, order_tag), lambda: get_route(order_id, order_tag))
+
+
+def get_order_for_route(route: OrderRoute, stop_order_id: int) -> Optional[Order]:
+    if route.order_pk is not None:
+        return Order.objects.select_related('order', 'stop').filter(pk=route.order_pk).first()
+    return Order.objects.get_order_by_stop_order_id(stop_order_id)
+
+
+db_order_store = DbOrderStore()
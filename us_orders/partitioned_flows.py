@@ -0,0 +1,137 @@
+'''
+Runs the order flows on partitioned workers, see common.util.partitions. Work is keyed by
+TimeframeGroup id, every partition has its own OrderStateEngine and write-behind journal in
+the worker owning it, so the groups of a timeframe group are only ever changed by one process.
+
+The signal flows of tv and celery change the same groups from other processes, their entry
+points live outside this package and call handle_new_signal directly rather than submitting
+to the partitions. The engines take the keys of the timeframe groups an event touches while
+they handle it, like the db execution report flow, see us_orders.locks, and reload the groups a
+signal flow placed orders for since, see OrderStateEngine.reconcile. Partitions own different
+timeframe groups so their keys never collide, workers only wait for the signal flows of their
+own timeframe groups.
+
+The cancels of pending orders and stops stay within the timeframe group of the fill, so the
+partition handling a report has every group its decisions change.
+'''
+from __future__ import annotations
+
+import os
+from typing import Any, Optional
+
+from django.db import connections
+
+from common.util.partitions import PartitionHandler, PartitionedWorkers, get_partition
+from common.util.write_behind import WriteBehindQueue
+from us.models import TimeframeGroup
+from us_orders.flows import order_state_flow
+from us_orders.order_state import OrderStateEngine, apply_write_ops
+from us_orders.routing import get_route, get_timeframe_group_id, get_timeframe_group_id_for_algo_order
+from woo.algo_order_version_guard import AlgoOrderVersionGuard
+from woo.api_types import AlgoOrderResponseData
+
+# key of the reports no timeframe group could be found for, e.g. orders placed outside the flows,
+# their partition loads them from the db and hands off any that turn out to have a group
+UNROUTED_KEY = 'unrouted'
+MAX_CACHED_ROUTES = 10000
+
+
+def get_partition_timeframe_group_ids(partition: int, partition_count: int) -> list[int]:
+    return [
+        timeframe_group_id for timeframe_group_id in TimeframeGroup.objects.values_list('id', flat=True)
+        if get_partition(timeframe_group_id, partition_count) == partition
+    ]
+
+
+class FlowPartitionHandler(PartitionHandler):
+
+    def __init__(self, journal_dir: str, partition_count: int):
+        self.journal_dir = journal_dir
+        self.partition_count = partition_count
+        self.engines: dict[int, OrderStateEngine] = {}
+
+    def assign(self, partition: int):
+        write_queue = WriteBehindQueue(
+            os.path.join(self.journal_dir, f'partition-{partition}'),
+            apply_write_ops,
+            name=f'order-write-behind-{partition}'
+        )
+        # writes journaled by the previous owner are applied before the state is read
+        replayed = write_queue.start()
+        engine = OrderStateEngine(write_queue)
+        # reports that reach the wrong partition go to the owner of their group, not into this engine
+        engine.owns_timeframe_group = lambda timeframe_group_id: (
+            get_partition(timeframe_group_id, self.partition_count) == partition
+        )
+        engine.on_hand_off = lambda timeframe_group_id, reports: self.submit(
+            timeframe_group_id, {'type': 'reports', 'reports': reports}
+        )
+        groups = engine.hydrate(get_partition_timeframe_group_ids(partition, self.partition_count))
+        self.engines[partition] = engine
+        print(f'partition {partition}: replayed {replayed} writes, hydrated {groups} groups')
+
+    def release(self, partition: int):
+        engine = self.engines.pop(partition)
+        engine.write_queue.stop(drain=True)
+
+    def handle(self, partition: int, event: dict):
+        engine = self.engines[partition]
+        event_type = event['type']
+        if event_type == 'reports':
+            order_state_flow.handle_algo_order_updates_with_locks(engine, event['reports'])
+        else:
+            raise Exception(f'Unknown flow event {event_type}')
+
+    def close(self):
+        connections.close_all()
+
+
+class PartitionedFlowDispatcher:
+    '''
+    Runs in the process owning the workers, the private ws consumer, and submits the flow work
+    keyed by timeframe group. Resent reports are dropped here, before they are routed.
+    '''
+
+    def __init__(self, workers: PartitionedWorkers, version_guard: Optional[AlgoOrderVersionGuard] = None):
+        self.workers = workers
+        self.version_guard = version_guard
+        self._timeframe_group_ids: dict[Any, int] = {}
+
+    def handle_algo_order_updates(self, data_list: list[AlgoOrderResponseData]):
+        data_list = [data for data in data_list if data.get('algoOrderId') is not None]
+
+        if self.version_guard is not None:
+            data_list = self.version_guard.filter(data_list)
+            for data in data_list:
+                self.version_guard.record(data)
+
+        # a push is split by timeframe group, each part keeps the order the reports came in
+        batches: dict[Any, list[AlgoOrderResponseData]] = {}
+        for data in data_list:
+            batches.setdefault(self.get_key(data), []).append(data)
+
+        for key, reports in batches.items():
+            self.workers.submit(key, {'type': 'reports', 'reports': reports})
+
+    def get_key(self, data: AlgoOrderResponseData) -> Any:
+        order_id = data.get('algoOrderId')
+        route = get_route(order_id, data.get('orderTag'))
+
+        # stop-for routes carry no ids, their order is found by the stop's own id, orders without
+        # a route by their own id too
+        cache_key = route
+        if route is None or (route.order_group_id is None and route.order_pk is None):
+            cache_key = order_id
+        timeframe_group_id = self._timeframe_group_ids.get(cache_key)
+        if timeframe_group_id is None:
+            if route is not None:
+                timeframe_group_id = get_timeframe_group_id(route, order_id)
+            if timeframe_group_id is None:
+                timeframe_group_id = get_timeframe_group_id_for_algo_order(order_id)
+            if timeframe_group_id is None:
+                # not cached, the group may not have been written yet
+                return UNROUTED_KEY
+            if len(self._timeframe_group_ids) >= MAX_CACHED_ROUTES:
+                self._timeframe_group_ids = {}
+            self._timeframe_group_ids[cache_key] = timeframe_group_id
+        return timeframe_group_id
@@ -0,0 +1,105 @@
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+from django.db.models import Q
+
+from us_orders.models.algo_order_route import AlgoOrderRoleChoices, AlgoOrderRoute
+from us_orders.models.order_group import OrderGroup
+from woo.api_types import AlgoOrderResponseData
+
+GROUP_ORDER_TAG = 'group-{}-order'
+GROUP_STOP_TAG = 'group-{}-closer'
+ORDER_STOP_TAG = 'stop-for-{}'
+
+ORDER_TAG_PATTERN = re.compile(r'^(?:group-(?P<group>\d+)-(?P<kind>order|closer)|stop-for-(?P<order>\d+))$')
+
+
+@dataclass(frozen=True)
+class OrderRoute:
+    '''
+    Where an execution report belongs. From a group tag only the group id is known, a stop-for
+    tag only gives the role, the order is the one whose stop has the report's algoOrderId.
+    Stop-for tags placed before the exchange id was used name the order's WooAlgoOrder pk.
+    '''
+    role: str
+    order_group_id: Optional[int] = None
+    order_pk: Optional[int] = None
+
+
+def get_group_order_tag(order_group_id: int) -> str:
+    return GROUP_ORDER_TAG.format(order_group_id)
+
+
+def get_group_stop_tag(order_group_id: int) -> str:
+    return GROUP_STOP_TAG.format(order_group_id)
+
+
+def get_order_stop_tag(algo_order_id: int) -> str:
+    return ORDER_STOP_TAG.format(algo_order_id)
+
+
+def parse_order_tag(order_tag: Optional[str]) -> Optional[OrderRoute]:
+    if not order_tag:
+        return None
+    match = ORDER_TAG_PATTERN.match(order_tag)
+    if match is None:
+        return None
+    if match.group('order') is not None:
+        return OrderRoute(AlgoOrderRoleChoices.ORDER_STOP)
+    role = AlgoOrderRoleChoices.ORDER if match.group('kind') == 'order' else AlgoOrderRoleChoices.GROUP_STOP
+    return OrderRoute(role, order_group_id=int(match.group('group')))
+
+
+def get_route(algo_order_id: int, order_tag: Optional[str] = None) -> Optional[OrderRoute]:
+    '''
+    Routes from the tag when it is one of ours, otherwise from the AlgoOrderRoute table.
+    '''
+    route = parse_order_tag(order_tag)
+    if route is not None:
+        return route
+
+    row = AlgoOrderRoute.objects.get_route_by_algo_order_id(algo_order_id)
+    if row is None:
+        return None
+    return OrderRoute(row.role, order_group_id=row.order_group_id, order_pk=row.order_id)
+
+
+def get_timeframe_group_id(route: OrderRoute, algo_order_id: int) -> Optional[int]:
+    '''
+    The TimeframeGroup of the order group a route leads to, the key flow work is partitioned by.
+    '''
+    if route.order_group_id is not None:
+        order_groups = OrderGroup.objects.filter(pk=route.order_group_id)
+    elif route.order_pk is not None:
+        order_groups = OrderGroup.objects.filter(orders__pk=route.order_pk)
+    elif route.role == AlgoOrderRoleChoices.ORDER_STOP:
+        order_groups = OrderGroup.objects.filter(orders__stop__order_id=algo_order_id)
+    else:
+        return None
+    return order_groups.values_list('group_id', flat=True).first()
+
+
+def get_timeframe_group_id_for_algo_order(algo_order_id: int) -> Optional[int]:
+    '''
+    The TimeframeGroup of the order group an algo order without a route belongs to, found by
+    its exchange id.
+    '''
+    return OrderGroup.objects.filter(
+        Q(stop__order_id=algo_order_id) |
+        Q(orders__order__order_id=algo_order_id) |
+        Q(orders__stop__order_id=algo_order_id)
+    ).values_list('group_id', flat=True).first()
+
+
+def get_timeframe_group_id_for_report(data: AlgoOrderResponseData) -> Optional[int]:
+    '''
+    The TimeframeGroup of the order group an execution report's algo order belongs to.
+    '''
+    algo_order_id = data.get('algoOrderId')
+    route = get_route(algo_order_id, data.get('orderTag'))
+    if route is not None:
+        timeframe_group_id = get_timeframe_group_id(route, algo_order_id)
+        if timeframe_group_id is not None:
+            return timeframe_group_id
+    return get_timeframe_group_id_for_algo_order(algo_order_id)
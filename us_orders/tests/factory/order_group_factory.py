@@ -29,16 +29,15 @@ class OrderGroupFactory(DjangoModelFactory):
         trigger_time = kwargs.get('order__trigger_time', None)
 
         if extracted is not None:
-            obj.orders.set(extracted)
+            obj.add_orders(extracted)
         else:
-            for i in range(count):
-                obj.orders.add(OrderFactory(
-                    direction=obj.side,
-                    order__status=status,
-                    order__quantity=quantity,
-                    order__trigger_price=trigger_price,
-                    order__trigger_time=trigger_time
-                ))
+            obj.add_orders([OrderFactory(
+                direction=obj.side,
+                order__status=status,
+                order__quantity=quantity,
+                order__trigger_price=trigger_price,
+                order__trigger_time=trigger_time
+            ) for i in range(count)])
 
         if not with_matching_stop:
             return
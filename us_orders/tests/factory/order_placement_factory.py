@@ -0,0 +1,16 @@
+from factory import LazyFunction, SubFactory
+from factory.django import DjangoModelFactory
+
+from us.tests.factory.timeframe_kline_signal_factory import TimeframeKlineSignalFactory
+from us_orders.tests.factory.order_group_factory import OrderGroupFactory
+
+
+class OrderPlacementFactory(DjangoModelFactory):
+    signal = SubFactory(TimeframeKlineSignalFactory)
+    order_group = SubFactory(OrderGroupFactory)
+    operations = LazyFunction(list)
+    results = LazyFunction(dict)
+    state = 'COMPLETED'
+
+    class Meta:
+        model = 'us_orders.OrderPlacement'
@@ -1,22 +1,32 @@
+import threading
 from datetime import datetime, timedelta
 from unittest.mock import patch
 
 from django.test import TestCase
 from django.utils.timezone import make_aware
 
+from common.util.advisory_locks import get_current_lock_scope
+from common.util.saga import run_saga
 from us.tests.factory.timeframe_group_factory import TimeframeGroupFactory
 from us.tests.factory.timeframe_kline_signal_factory import TimeframeKlineSignalFactory
-from us_orders.flows.new_order_flow import create_or_update_stop_order_for_group, handle_new_signal, \
-    create_or_update_order
+from us_orders.flows.new_order_flow import ORDER_STEP, STOP_STEP, get_order_placement, get_stop_placement, \
+    handle_new_signal, place_orders, reconcile_pending_placements
+from us_orders.helpers import get_attributes_for_order
+from us_orders.locks import get_timeframe_group_key
 from us_orders.models.order import Order
 from us_orders.models.order_group import OrderGroup
+from us_orders.models.order_placement import OrderPlacement, PlacementStateChoices
+from us_orders.routing import get_group_order_tag, get_group_stop_tag
 from us_orders.tests.factory.order_factory import OrderFactory
 from us_orders.tests.factory.order_group_factory import OrderGroupFactory
+from us_orders.tests.factory.order_placement_factory import OrderPlacementFactory
 from us_orders.tests.helpers import MockResponse, create_order_for_test
 from us_orders.tests.mock_data.send_algo_order_return_mock import send_algo_order_return_mock
 from woo.api_types import OrderSide, AlgoOrderStatus
+from woo.helpers import create_algo_order_params
 from woo.tests.factory.woo_algo_order_factory import WooAlgoOrderFactory
-from woo.tests.mock_data.algo_order_mock import edit_sent_success_response
+from woo.tests.mock_data.algo_order_mock import cancel_sent_success_response, edit_sent_success_response, \
+    get_mock_algo_order_data
 
 
 class NewOrderFlowTests(TestCase):
@@ -86,10 +96,12 @@ class NewOrderFlowTests(TestCase):
         tf_group = order_group.group
         strategy_vars = tf_group.strategy_variables
 
-        self.mock_request.side_effect = [
-            MockResponse(json_data=send_algo_order_return_mock(456, quantity=order_group.quantity)),
-            MockResponse(json_data=send_algo_order_return_mock(123))
-        ]
+        # the stop and the order are sent at the same time, the responses go by what was asked for
+        responses = {
+            True: MockResponse(json_data=send_algo_order_return_mock(456, quantity=quantity)),
+            False: MockResponse(json_data=send_algo_order_return_mock(123))
+        }
+        self.mock_request.side_effect = lambda *args, **kwargs: responses[kwargs['json']['reduceOnly']]
 
         self.assertEqual(OrderGroup.objects.count(), 1)
         self.assertEqual(Order.objects.count(), 1)
@@ -112,71 +124,237 @@ class NewOrderFlowTests(TestCase):
         self.assertIsNotNone(sell_order)
         self.assertEqual(sell_order.status, AlgoOrderStatus.NEW)
 
-    def test_create_or_update_order__when_the_group_has_an_existing_pending_order(self):
+    def create_active_group_and_opposite_signal(self):
+        order_group = OrderGroupFactory(
+            side=OrderSide.BUY.value,
+            orders__order__status=AlgoOrderStatus.FILLED,
+            orders__order__quantity=0.2,
+        )
+        return order_group, TimeframeKlineSignalFactory(direction=OrderSide.SELL.value)
+
+    def test_handle_new_signal__sends_the_order_and_the_stop_at_the_same_time(self):
+        order_group, signal = self.create_active_group_and_opposite_signal()
+        # each call waits here for the other, sent one after the other the first would time out
+        barrier = threading.Barrier(2, timeout=5)
+        # the mock runs on the saga threads, which must not touch the test database
+        quantity = order_group.quantity
+
+        def request(method, url, **kwargs):
+            barrier.wait()
+            order_id = 456 if kwargs['json']['reduceOnly'] else 123
+            return MockResponse(json_data=send_algo_order_return_mock(order_id, quantity=quantity))
+
+        self.mock_request.side_effect = request
+
+        handle_new_signal(order_group.group_id, signal, order_group.group.strategy_variables)
+
+        order_group.refresh_from_db()
+        self.assertEqual(order_group.stop.order_id, 456)
+        self.assertEqual(Order.objects.get_last_pending_order_for_side(OrderSide.SELL.value).order.order_id, 123)
+        placement = OrderPlacement.objects.get()
+        self.assertEqual(placement.state, PlacementStateChoices.COMPLETED)
+        self.assertEqual(placement.results, {'order': 123, 'stop': 456})
+        self.assertEqual([operation['action'] for operation in placement.operations], ['create', 'create'])
+
+    def test_handle_new_signal__holds_the_locks_of_the_groups_it_places_orders_for(self):
+        order_group, signal = self.create_active_group_and_opposite_signal()
+        quantity = order_group.quantity
+        self.mock_request.side_effect = lambda method, url, **kwargs: MockResponse(
+            json_data=send_algo_order_return_mock(456 if kwargs['json']['reduceOnly'] else 123, quantity=quantity)
+        )
+        held = []
+
+        def capture(steps):
+            held.extend(get_current_lock_scope().held)
+            return run_saga(steps)
+
+        with patch('us_orders.flows.new_order_flow.run_saga', side_effect=capture):
+            handle_new_signal(order_group.group_id, signal, order_group.group.strategy_variables)
+
+        self.assertEqual(held, [(get_timeframe_group_key(order_group.group_id), False)])
+        self.assertIsNone(get_current_lock_scope())
+
+    def test_handle_new_signal__when_the_active_group_is_in_another_timeframe_group__only_places_the_order(self):
+        active_group, signal = self.create_active_group_and_opposite_signal()
+        tf_group = TimeframeGroupFactory()
+        self.mock_request.return_value = MockResponse(json_data=send_algo_order_return_mock(123))
+
+        handle_new_signal(tf_group.id, signal, tf_group.strategy_variables)
+
+        self.assertEqual(self.mock_request.call_count, 1)
+        self.assertFalse(self.mock_request.call_args.kwargs['json']['reduceOnly'])
+        active_group.refresh_from_db()
+        self.assertIsNone(active_group.stop)
+        self.assertEqual(OrderPlacement.objects.get().results, {'order': 123})
+
+    def test_handle_new_signal__when_the_order_fails__cancels_the_stop(self):
+        order_group, signal = self.create_active_group_and_opposite_signal()
+        quantity = order_group.quantity
+
+        def request(method, url, **kwargs):
+            if method == 'delete':
+                return MockResponse(json_data=cancel_sent_success_response)
+            if kwargs['json']['reduceOnly']:
+                return MockResponse(json_data=send_algo_order_return_mock(456, quantity=quantity))
+            return MockResponse(json_data={}, status_code=400)
+
+        self.mock_request.side_effect = request
+
+        # the api error rows are written on the saga threads' own connections, outside the test's
+        # transaction, they would outlive the test
+        with patch('woo.api_rest.WooAPIError.objects.create'):
+            handle_new_signal(order_group.group_id, signal, order_group.group.strategy_variables)
+
+        order_group.refresh_from_db()
+        self.assertIsNone(order_group.stop)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertTrue(any(
+            call.args[0] == 'delete' and call.args[1].endswith('/456') for call in self.mock_request.call_args_list
+        ))
+        placement = OrderPlacement.objects.get()
+        self.assertEqual(placement.state, PlacementStateChoices.COMPENSATED)
+        self.assertEqual(placement.results, {'stop': 456})
+
+    def test_handle_new_signal__when_the_stop_fails_and_the_order_cannot_be_cancelled__is_orphaned(self):
+        order_group, signal = self.create_active_group_and_opposite_signal()
+
+        def request(method, url, **kwargs):
+            if method == 'post' and not kwargs['json']['reduceOnly']:
+                return MockResponse(json_data=send_algo_order_return_mock(123))
+            return MockResponse(json_data={}, status_code=400)
+
+        self.mock_request.side_effect = request
+
+        with patch('woo.api_rest.WooAPIError.objects.create'):
+            handle_new_signal(order_group.group_id, signal, order_group.group.strategy_variables)
+
+        self.assertEqual(Order.objects.count(), 1)
+        placement = OrderPlacement.objects.get()
+        self.assertEqual(placement.state, PlacementStateChoices.ORPHANED)
+        self.assertEqual(placement.results, {'order': 123})
+
+    def create_pending_placement(self, order_group: OrderGroup) -> OrderPlacement:
+        params = create_algo_order_params(
+            'PERP_BTC_USDT', OrderSide.BUY.value, '0.1', False, '35000', get_group_order_tag(order_group.id)
+        )
+        return OrderPlacementFactory(
+            order_group=order_group,
+            operations=[{'step': ORDER_STEP, 'action': 'create', 'params': params}],
+            state=PlacementStateChoices.PENDING
+        )
+
+    def mock_open_algo_orders(self, rows: list[dict]):
+        def request(method, url, **kwargs):
+            if method == 'delete':
+                return MockResponse(json_data=cancel_sent_success_response)
+            return MockResponse(json_data={'rows': rows, 'meta': {}})
+
+        self.mock_request.side_effect = request
+
+    def test_reconcile_pending_placements__when_the_order_was_placed__cancels_it(self):
+        order_group = OrderGroupFactory(side=OrderSide.BUY.value, orders__order__status=AlgoOrderStatus.FILLED)
+        placement = self.create_pending_placement(order_group)
+        placed = {**get_mock_algo_order_data(order_id=789, status='NEW'), 'orderTag': get_group_order_tag(order_group.id)}
+        # the group's own order carries the same tag and is left alone
+        existing = {
+            **get_mock_algo_order_data(order_id=order_group.orders.first().order.order_id, status='NEW'),
+            'orderTag': get_group_order_tag(order_group.id)
+        }
+        self.mock_open_algo_orders([existing, placed])
+
+        self.assertEqual(reconcile_pending_placements(), 1)
+
+        placement.refresh_from_db()
+        self.assertEqual(placement.state, PlacementStateChoices.COMPENSATED)
+        self.assertEqual(placement.results, {ORDER_STEP: 789})
+        deletes = [call.args[1] for call in self.mock_request.call_args_list if call.args[0] == 'delete']
+        self.assertEqual(len(deletes), 1)
+        self.assertTrue(deletes[0].endswith('/789'))
+
+    def test_reconcile_pending_placements__when_nothing_was_placed__marks_it_compensated(self):
+        placement = self.create_pending_placement(OrderGroupFactory(side=OrderSide.BUY.value))
+        self.mock_open_algo_orders([])
+
+        self.assertEqual(reconcile_pending_placements(), 1)
+
+        placement.refresh_from_db()
+        self.assertEqual(placement.state, PlacementStateChoices.COMPENSATED)
+        self.assertEqual(placement.results, {})
+        self.assertFalse(any(call.args[0] == 'delete' for call in self.mock_request.call_args_list))
+
+    def test_reconcile_pending_placements__when_none_are_pending__does_not_call_the_exchange(self):
+        OrderPlacementFactory()
+
+        self.assertEqual(reconcile_pending_placements(), 0)
+
+        self.mock_request.assert_not_called()
+
+    def test_get_order_placement__when_the_group_has_an_existing_pending_order(self):
         trigger_price = 23000.0
         order_group = OrderGroupFactory(
             side=OrderSide.BUY.value,
             orders__order__trigger_price=trigger_price
         )
         order = order_group.orders.first()
-        group = order_group.group
         signal = order.indicator
+        order_attributes = get_attributes_for_order(signal, order_group.group.strategy_variables)
 
-        self.assertTrue(order_group.current_pending_order, order)
-        self.assertEqual(order.order.trigger_price, trigger_price)
+        self.assertEqual(order_group.current_pending_order, order)
+        self.assertNotEqual(order_attributes['trigger_price'], trigger_price)
 
-        self.mock_request.return_value = MockResponse(json_data=edit_sent_success_response)
+        operation, step = get_order_placement(order_attributes, order_group.id, order_group.current_pending_order)
+        self.assertEqual(operation['action'], 'edit')
+        self.assertEqual(operation['order_id'], order.order.order_id)
+        self.assertEqual(operation['params'], {'triggerPrice': order_attributes['trigger_price']})
+        self.assertEqual(operation['previous_params'], {'triggerPrice': trigger_price})
 
-        pending_order, created = create_or_update_order(
-            signal,
-            group.strategy_variables,
-            order_group.id,
-            order_group.current_pending_order
-        )
+        self.mock_request.return_value = MockResponse(json_data=edit_sent_success_response)
+        saga = place_orders(signal, order_group, [(operation, step)])
 
-        order.refresh_from_db()
         self.assertTrue(self.mock_request.called)
-        self.assertNotEquals(order.order.trigger_price, trigger_price)
-        self.assertIsNotNone(pending_order)
-        self.assertFalse(created)
+        self.assertTrue(saga.succeeded)
+        self.assertEqual(saga.results[ORDER_STEP], {'triggerPrice': order_attributes['trigger_price']})
+        self.assertEqual(OrderPlacement.objects.get().state, PlacementStateChoices.COMPLETED)
+
+    def test_get_order_placement__when_the_trigger_price_is_unchanged(self):
+        order_group = OrderGroupFactory(side=OrderSide.BUY.value)
+        order = order_group.orders.first()
+        order_attributes = get_attributes_for_order(order.indicator, order_group.group.strategy_variables)
+        order.order.trigger_price = order_attributes['trigger_price']
+
+        self.assertIsNone(get_order_placement(order_attributes, order_group.id, order))
 
-    def test_create_or_update_order__when_the_group_has_no_existing_pending_order(self):
+    def test_get_order_placement__when_the_group_has_no_existing_pending_order(self):
         side = OrderSide.BUY.value
         signal = TimeframeKlineSignalFactory(direction=side)
-        order_group = OrderGroupFactory(
-            side=OrderSide.BUY.value,
-            orders=[]
-        )
-        group = order_group.group
+        order_group = OrderGroupFactory(side=side, orders=[])
+        order_attributes = get_attributes_for_order(signal, order_group.group.strategy_variables)
 
         self.assertIsNone(order_group.current_pending_order)
 
-        self.mock_request.return_value = MockResponse(
-            json_data=send_algo_order_return_mock(
-                quantity=order_group.quantity
-            )
-        )
+        operation, step = get_order_placement(order_attributes, order_group.id, order_group.current_pending_order)
+        self.assertEqual(operation['action'], 'create')
+        self.assertEqual(operation['params']['orderTag'], get_group_order_tag(order_group.id))
+        self.assertFalse(operation['params']['reduceOnly'])
 
-        pending_order, created = create_or_update_order(
-            signal,
-            group.strategy_variables,
-            order_group.id,
-            order_group.current_pending_order
-        )
+        self.mock_request.return_value = MockResponse(json_data=send_algo_order_return_mock(123))
+        saga = place_orders(signal, order_group, [(operation, step)])
 
-        self.assertIsNotNone(pending_order)
-        self.assertTrue(created)
+        self.assertTrue(saga.succeeded)
+        self.assertEqual(saga.results[ORDER_STEP]['order_id'], 123)
+        self.assertEqual(OrderPlacement.objects.get().results, {ORDER_STEP: 123})
 
-    def test_create_or_update_stop_order_for_group__when_group_does_not_contain_order(self):
+    def test_get_stop_placement__when_group_does_not_contain_order(self):
         order_group = OrderGroupFactory(side=OrderSide.BUY.value)
         order = OrderFactory(indicator__type=OrderSide.BUY.value)
+        order_attributes = get_attributes_for_order(order.indicator, order_group.group.strategy_variables)
         try:
-            create_or_update_stop_order_for_group(order_group, order.indicator, order_group.group.strategy_variables)
+            get_stop_placement(order_attributes, order_group)
             self.fail('Should have raised an exception')
         except Exception as e:
             self.assertEqual(str(e), 'Order must be on the opposite side to the group')
 
-    def test_create_or_update_stop_order_for_group__when_order_group_has_stop(self):
+    def test_get_stop_placement__when_order_group_has_stop(self):
         trigger_price = 10000.0
         stop_loss_difference = 200.0
         quantity = 0.3
@@ -195,23 +373,23 @@ class NewOrderFlowTests(TestCase):
         ))
 
         order2 = OrderFactory(indicator__type=OrderSide.SELL.value)
+        order_attributes = get_attributes_for_order(order2.indicator, order_group.group.strategy_variables)
 
         self.assertTrue(order_group.has_stop)
         self.assertEqual(order_group.stop.trigger_price, trigger_price)
 
-        self.mock_request.return_value = MockResponse(json_data=edit_sent_success_response)
+        operation, step = get_stop_placement(order_attributes, order_group)
+        self.assertEqual(operation['action'], 'edit')
+        self.assertEqual(operation['order_id'], order_group.stop.order_id)
 
-        stop, created = create_or_update_stop_order_for_group(
-            order_group,
-            order2.indicator,
-            order_group.group.strategy_variables
-        )
+        self.mock_request.return_value = MockResponse(json_data=edit_sent_success_response)
+        saga = place_orders(order2.indicator, order_group, [(operation, step)])
 
         self.assertTrue(self.mock_request.called)
-        self.assertIsNotNone(stop)
-        self.assertFalse(created)
+        self.assertTrue(saga.succeeded)
+        self.assertIn(STOP_STEP, saga.results)
 
-    def test_create_or_update_stop_order_for_group__when_order_group_does_not_have_stop(self):
+    def test_get_stop_placement__when_order_group_does_not_have_stop(self):
         trigger_price = 10000.0
         stop_loss_difference = 200.0
         quantity = 0.3
@@ -228,19 +406,21 @@ class NewOrderFlowTests(TestCase):
             indicator__type=OrderSide.SELL.value,
             order__trigger_price=new_trigger_price
         )
+        order_attributes = get_attributes_for_order(order2.indicator, order_group.group.strategy_variables)
 
         self.assertFalse(order_group.has_stop)
         self.assertEqual(order_group.quantity, quantity)
 
-        self.mock_request.return_value = MockResponse(json_data=send_algo_order_return_mock(quantity=order_group.quantity))
+        operation, step = get_stop_placement(order_attributes, order_group)
+        self.assertEqual(operation['action'], 'create')
+        self.assertEqual(operation['params']['orderTag'], get_group_stop_tag(order_group.id))
+        self.assertTrue(operation['params']['reduceOnly'])
+        self.assertEqual(float(operation['params']['quantity']), quantity)
 
-        stop, created = create_or_update_stop_order_for_group(
-            order_group,
-            order2.indicator,
-            order_group.group.strategy_variables
-        )
+        self.mock_request.return_value = MockResponse(json_data=send_algo_order_return_mock(456, quantity=quantity))
+        saga = place_orders(order2.indicator, order_group, [(operation, step)])
 
         self.assertTrue(self.mock_request.called)
-        self.assertIsNotNone(stop)
-        self.assertTrue(created)
-        self.assertEqual(stop.quantity, quantity)
+        self.assertTrue(saga.succeeded)
+        self.assertEqual(saga.results[STOP_STEP]['order_id'], 456)
+        self.assertEqual(float(saga.results[STOP_STEP]['quantity']), quantity)
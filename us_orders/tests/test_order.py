@@ -63,6 +63,19 @@ class OrderModelTests(TestCase):
         self.assertTrue(order1.is_closed)
         self.assertTrue(order2.is_closed)
 
+    def test_with_state__when_order_group_has_stopped_out(self):
+        side = 'SELL'
+        order1 = OrderFactory(indicator__type=side, order__status='FILLED')
+        order2 = OrderFactory(indicator__type=side, order__status='FILLED')
+        group = OrderGroupFactory(side=side, orders=[order1, order2], orders__with_matching_stop=True)
+        with self.assertNumQueries(1):
+            self.assertEqual([order.status for order in Order.objects.get_orders_with_state()], ['FILLED', 'FILLED'])
+        group.stop.status = 'FILLED'
+        group.stop.save()
+        with self.assertNumQueries(1):
+            orders = list(Order.objects.get_orders_with_state())
+            self.assertTrue(all(order.is_closed and order.status == 'CLOSED' for order in orders))
+
     def test_is_closed_when_order_is_force_closed(self):
         order = OrderFactory(order__status='CANCELLED')
         self.assertFalse(order.is_closed)
@@ -136,6 +149,21 @@ class OrderModelTests(TestCase):
         order.set_stop(stop_order)
         self.assertEqual(order.stop, stop_order)
 
+    def test_save__when_nothing_changed__skips_the_query(self):
+        order = OrderFactory()
+        order = Order.objects.get(pk=order.pk)
+        with self.assertNumQueries(0):
+            order.save()
+
+    def test_save__when_only_the_note_changed__skips_validation_and_state_refresh(self):
+        order = Order.objects.get(pk=OrderGroupFactory().orders.first().pk)
+        order.note = 'note'
+        # savepoint, update, release - no algo order loads for clean() and no group state refresh
+        with self.assertNumQueries(3):
+            order.save()
+        order.refresh_from_db()
+        self.assertEqual(order.note, 'note')
+
 
 class OrderModelValidationTests(TestCase):
 
@@ -0,0 +1,103 @@
+from datetime import timedelta
+
+from django.utils import timezone
+from django.test import TestCase
+
+from us_orders.models.algo_order_route import AlgoOrderRoute
+from us_orders.models.order import Order
+from us_orders.models.order_archive import ArchivedAlgoOrder, ArchivedOrder, ArchivedOrderGroup, \
+    get_algo_order_by_order_id, get_order_group_summaries
+from us_orders.models.order_group import OrderGroup
+from us_orders.models.order_group_state import LifecycleStateChoices, OrderGroupState
+from us_orders.tests.factory.order_factory import OrderFactory
+from us_orders.tests.factory.order_group_factory import OrderGroupFactory
+from woo.models import WooAlgoOrder
+from woo.tests.factory.woo_algo_order_factory import WooAlgoOrderFactory
+
+
+class OrderArchiveTests(TestCase):
+
+    def make_old(self, order_group: OrderGroup, days: int = 30):
+        OrderGroup.objects.filter(pk=order_group.pk).update(created_at=timezone.now() - timedelta(days=days))
+
+    def create_closed_group(self, **kwargs) -> OrderGroup:
+        order_group = OrderGroupFactory(orders__order__status='CANCELLED', **kwargs)
+        self.make_old(order_group)
+        return order_group
+
+    def test_archive_closed__moves_the_group_its_orders_and_algo_orders(self):
+        order = OrderFactory(direction='BUY', order__status='FILLED')
+        order_group = OrderGroupFactory(orders=[order])
+        order.stop.update(status='FILLED')
+        self.make_old(order_group)
+        latest_group = OrderGroupFactory(group=order_group.group)
+
+        stats = ArchivedOrderGroup.objects.archive_closed()
+
+        self.assertEqual((stats.order_groups, stats.orders, stats.algo_orders), (1, 1, 2))
+        self.assertFalse(OrderGroup.objects.filter(pk=order_group.pk).exists())
+        self.assertFalse(Order.objects.filter(pk=order.pk).exists())
+        self.assertFalse(WooAlgoOrder.objects.filter(pk__in=[order.order.pk, order.stop.pk]).exists())
+        self.assertFalse(AlgoOrderRoute.objects.filter(order_id=order.pk).exists())
+
+        archived_order = ArchivedOrder.objects.select_related('order', 'stop').get(pk=order.pk)
+        self.assertEqual(archived_order.order_group_id, order_group.pk)
+        self.assertEqual(archived_order.order.order_id, order.order.order_id)
+        self.assertEqual(archived_order.stop.status, 'FILLED')
+        self.assertEqual(archived_order.indicator_id, order.indicator_id)
+
+        state = OrderGroupState.objects.get(group_id=latest_group.group_id, side='BUY')
+        self.assertEqual(state.order_group, latest_group)
+        self.assertEqual(state.state, LifecycleStateChoices.PENDING)
+
+    def test_archive_closed__when_the_group_is_the_latest_for_its_side__keeps_it(self):
+        order_group = self.create_closed_group()
+        stats = ArchivedOrderGroup.objects.archive_closed()
+        self.assertEqual(stats.order_groups, 0)
+        self.assertTrue(OrderGroup.objects.filter(pk=order_group.pk).exists())
+
+    def test_archive_closed__when_the_group_is_newer_than_the_cutoff__keeps_it(self):
+        order_group = self.create_closed_group()
+        OrderGroupFactory(group=order_group.group)
+        stats = ArchivedOrderGroup.objects.archive_closed(older_than=timedelta(days=60))
+        self.assertEqual(stats.order_groups, 0)
+        self.assertTrue(OrderGroup.objects.filter(pk=order_group.pk).exists())
+
+    def test_archive_closed__when_an_algo_order_is_still_open__skips_the_group(self):
+        stop = WooAlgoOrderFactory(side='SELL', reduce_only=True, quantity=0.1)
+        order_group = OrderGroupFactory(orders__order__status='FILLED', stop=stop)
+        stop.update(status='FILLED')
+        self.make_old(order_group)
+        OrderGroupFactory(group=order_group.group)
+
+        # the group is stopped out but the stop of its order hasn't been cancelled yet
+        stats = ArchivedOrderGroup.objects.archive_closed()
+        self.assertEqual((stats.order_groups, stats.skipped), (0, 1))
+        self.assertTrue(OrderGroup.objects.filter(pk=order_group.pk).exists())
+
+    def test_archive_closed__moves_every_batch(self):
+        order_groups = [self.create_closed_group() for _ in range(3)]
+        for order_group in order_groups:
+            OrderGroupFactory(group=order_group.group)
+
+        stats = ArchivedOrderGroup.objects.archive_closed(batch_size=2)
+
+        self.assertEqual((stats.batches, stats.order_groups), (2, 3))
+        self.assertEqual(
+            set(ArchivedOrderGroup.objects.values_list('pk', flat=True)),
+            {order_group.pk for order_group in order_groups}
+        )
+
+    def test_read_through__returns_live_and_archived_rows(self):
+        order_group = self.create_closed_group()
+        algo_order_id = order_group.orders.first().order.order_id
+        latest_group = OrderGroupFactory(group=order_group.group)
+        ArchivedOrderGroup.objects.archive_closed()
+
+        self.assertIsInstance(get_algo_order_by_order_id(algo_order_id), ArchivedAlgoOrder)
+        self.assertIsInstance(get_algo_order_by_order_id(latest_group.orders.first().order.order_id), WooAlgoOrder)
+
+        summaries = get_order_group_summaries(side='BUY')
+        self.assertEqual([summary.id for summary in summaries], [latest_group.pk, order_group.pk])
+        self.assertEqual([summary.is_archived for summary in summaries], [False, True])
+        self.assertEqual(summaries[1].order_count, 1)
@@ -7,8 +7,10 @@ from django.core.exceptions import ValidationError
 from django.test import TestCase
 from django.utils.timezone import make_aware
 
+from common.util.unit_of_work import UnitOfWork
 from us_orders.models.order import OrderValidationErrors
 from us_orders.models.order_group import OrderGroupValidationErrors, OrderGroup
+from us_orders.models.order_group_state import LifecycleStateChoices, OrderGroupState
 from us_orders.tests.factory.order_factory import OrderFactory
 from us_orders.tests.factory.order_group_factory import OrderGroupFactory
 from woo.tests.factory.woo_algo_order_factory import WooAlgoOrderFactory
@@ -513,6 +515,62 @@ class OrderGroupModelValidationTests(TestCase):
             self.assertEqual(e.message, f'{OrderGroupValidationErrors.ORDER_IS_CLOSED} - {str(order.id)}')
 
 
+class OrderGroupAddOrdersTests(TestCase):
+
+    def test_add_orders__query_count_does_not_grow_with_the_number_of_orders(self):
+        group = OrderGroupFactory(orders=[])
+        orders = [OrderFactory(direction='BUY', order__status='FILLED') for _ in range(2)]
+        # savepoint, group, orders, pending check, insert, group state select and upsert, routes, release
+        with self.assertNumQueries(9):
+            group.add_orders(orders)
+
+        group = OrderGroupFactory(orders=[])
+        orders = [OrderFactory(direction='BUY', order__status='FILLED') for _ in range(6)]
+        with self.assertNumQueries(9):
+            group.add_orders(orders)
+
+        self.assertEqual(set(group.orders.all()), set(orders))
+
+    def test_add_orders__refreshes_the_group_state(self):
+        group = OrderGroupFactory(orders=[])
+        self.assertEqual(OrderGroupState.objects.get(order_group=group).state, LifecycleStateChoices.EMPTY)
+        group.add_orders([OrderFactory(direction='BUY', order__status='FILLED')])
+        self.assertEqual(OrderGroupState.objects.get(order_group=group).state, LifecycleStateChoices.ACTIVE)
+
+    def test_add_orders__when_batch_has_two_pending_orders__validation_error(self):
+        group = OrderGroupFactory(orders=[])
+        order1 = OrderFactory(direction='BUY')
+        order2 = OrderFactory(direction='BUY')
+        try:
+            group.add_orders([order1, order2])
+            self.fail('Should have raised ValidationError')
+        except ValidationError as e:
+            self.assertEqual(e.message, f'{OrderGroupValidationErrors.ONLY_ONE_PENDING_ORDER_ALLOWED} - {str(order2.id)}')
+        self.assertEqual(group.orders.count(), 0)
+
+    def test_add_orders__when_the_pending_order_was_cancelled_in_the_same_flow(self):
+        group = OrderGroupFactory(orders__order__status='FILLED')
+        pending_order = OrderFactory(direction=group.side)
+        group.add_orders([pending_order])
+        new_order = OrderFactory(direction=group.side)
+        with UnitOfWork('test'):
+            pending_order.order.update(status='CANCELLED')
+            self.assertIsNone(OrderGroup.objects.get_groups_with_state().get(pk=group.pk).current_pending_order)
+            group.add_orders([new_order])
+            self.assertEqual(OrderGroup.objects.get_groups_with_state().get(pk=group.pk).current_pending_order, new_order)
+        self.assertEqual(group.orders.count(), 3)
+
+    def test_add_orders__when_group_is_closed__validation_error(self):
+        group = OrderGroupFactory(orders__order__status='FILLED', orders__with_matching_stop=True)
+        group.stop.status = 'FILLED'
+        group.stop.save()
+        try:
+            group.add_orders([OrderFactory(direction=group.side).id])
+            self.fail('Should have raised ValidationError')
+        except ValidationError as e:
+            self.assertEqual(e.message, OrderGroupValidationErrors.IS_CLOSED)
+
+
 class OrderGroupManagerTests(TestCase):
 
     def test_get_current_active_group__when_there_are_no_active_groups(self):
@@ -645,4 +703,65 @@ class OrderGroupManagerTests(TestCase):
             stop=stop_order
         )
         self.assertEqual(OrderGroup.objects.get_group_by_stop_order(stop_order), group)
-        self.assertIsNone(OrderGroup.objects.get_group_by_stop_order(WooAlgoOrderFactory()))
\ No newline at end of file
+        self.assertIsNone(OrderGroup.objects.get_group_by_stop_order(WooAlgoOrderFactory()))
+
+
+class OrderGroupWithStateTests(TestCase):
+
+    def assert_state_matches(self, order_group: OrderGroup):
+        annotated = OrderGroup.objects.get_groups_with_state().get(pk=order_group.pk)
+        self.assertTrue(annotated.has_state)
+        for name in [
+            'quantity', 'is_empty', 'is_pending', 'is_active', 'is_closed', 'is_stopped_out',
+            'has_reached_max_order_limit', 'has_reached_max_consecutive_order_stops_limit',
+            'has_exceeded_allowed_minutes_since_last_filled_order'
+        ]:
+            self.assertEqual(getattr(annotated, name), getattr(order_group, name), name)
+
+    def test_with_state__when_group_has_no_orders(self):
+        self.assert_state_matches(OrderGroupFactory(orders=[]))
+
+    def test_with_state__when_group_only_has_pending_orders(self):
+        self.assert_state_matches(OrderGroupFactory())
+
+    def test_with_state__when_group_has_mixed_status_orders(self):
+        side = 'SELL'
+        order1 = OrderFactory(indicator__type=side, order__quantity=3)
+        order2 = OrderFactory(indicator__type=side, order__quantity=2, order__status='FILLED')
+        order3 = OrderFactory(indicator__type=side, order__quantity=10, order__status='FILLED')
+        order_group = OrderGroupFactory(side=side, orders=[order1, order2, order3])
+        self.assert_state_matches(order_group)
+
+    def test_with_state__when_group_has_stopped_out_orders(self):
+        side = 'SELL'
+        orders = [OrderFactory(indicator__type=side, order__quantity=q, order__status='FILLED') for q in (3, 2, 10)]
+        order_group = OrderGroupFactory(side=side, orders=orders)
+        orders[0].stop.status = 'FILLED'
+        orders[0].stop.save()
+        self.assert_state_matches(order_group)
+
+    def test_with_state__when_group_stop_is_filled(self):
+        order_group = OrderGroupFactory(
+            orders__count=2,
+            orders__order__status='FILLED',
+            orders__with_matching_stop=True
+        )
+        order_group.stop.status = 'FILLED'
+        order_group.stop.save()
+        self.assert_state_matches(order_group)
+
+    def test_with_state__when_all_orders_are_cancelled(self):
+        self.assert_state_matches(OrderGroupFactory(orders__count=2, orders__order__status='CANCELLED'))
+
+    def test_with_state__evaluates_many_groups_in_one_query(self):
+        for _ in range(5):
+            OrderGroupFactory(orders__count=3, orders__order__status='FILLED')
+        with self.assertNumQueries(1):
+            groups = list(OrderGroup.objects.get_groups_with_state())
+            for group in groups:
+                group.quantity, group.is_active, group.is_pending, group.is_closed, group.has_reached_max_order_limit
+
+    def test_with_state__refresh_from_db_drops_annotations(self):
+        order_group = OrderGroup.objects.get_groups_with_state().get(pk=OrderGroupFactory().pk)
+        order_group.refresh_from_db()
+        self.assertFalse(order_group.has_state)
@@ -0,0 +1,104 @@
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from us.tests.factory.timeframe_group_factory import TimeframeGroupFactory
+from us_orders.flows.order_status_change_flow import get_new_statuses
+from us_orders.helpers import get_or_create_latest_order_group_for_side
+from us_orders.models.order_group_state import LifecycleStateChoices, OrderGroupState
+from us_orders.tests.factory.order_factory import OrderFactory
+from us_orders.tests.factory.order_group_factory import OrderGroupFactory
+from us_orders.tests.mock_data.algo_order_mock import get_mock_algo_order_data
+from woo.api_types import AlgoOrderStatus
+from woo.tests.factory.woo_algo_order_factory import WooAlgoOrderFactory
+
+
+class OrderGroupStateTests(TestCase):
+
+    def get_state(self, order_group) -> OrderGroupState:
+        return OrderGroupState.objects.get(group_id=order_group.group_id, side=order_group.side)
+
+    def test_state__when_group_is_created__is_empty(self):
+        order_group = get_or_create_latest_order_group_for_side('BUY', TimeframeGroupFactory().pk)
+        state = self.get_state(order_group)
+        self.assertEqual(state.order_group, order_group)
+        self.assertEqual(state.state, LifecycleStateChoices.EMPTY)
+
+    def test_state__when_pending_order_is_added__is_pending(self):
+        order_group = OrderGroupFactory()
+        self.assertEqual(self.get_state(order_group).state, LifecycleStateChoices.PENDING)
+
+    def test_state__when_order_is_filled_through_status_change__is_active(self):
+        order_group = OrderGroupFactory()
+        order = order_group.orders.first()
+        get_new_statuses([
+            get_mock_algo_order_data(order_id=order.order.order_id, status=AlgoOrderStatus.FILLED, quantity='2')
+        ])
+
+        state = self.get_state(order_group)
+        self.assertEqual(state.state, LifecycleStateChoices.ACTIVE)
+        self.assertEqual(float(state.filled_quantity), 2)
+        self.assertIsNotNone(state.last_fill_time)
+        self.assertEqual(OrderGroupState.objects.get_current_active_group(), order_group)
+
+    def test_state__when_group_stop_is_filled__is_closed_and_next_group_replaces_it(self):
+        stop = WooAlgoOrderFactory(side='SELL', reduce_only=True, quantity=0.2)
+        order_group = OrderGroupFactory(orders__count=2, orders__order__status='FILLED', stop=stop)
+        self.assertEqual(self.get_state(order_group).state, LifecycleStateChoices.ACTIVE)
+
+        stop.update(status=AlgoOrderStatus.FILLED.value)
+        self.assertEqual(self.get_state(order_group).state, LifecycleStateChoices.CLOSED)
+        self.assertIsNone(OrderGroupState.objects.get_current_active_group())
+
+        next_group = get_or_create_latest_order_group_for_side('BUY', order_group.group_id)
+        self.assertNotEqual(next_group, order_group)
+        self.assertEqual(self.get_state(order_group).order_group, next_group)
+
+    def test_state__when_orders_of_several_groups_fill__query_count_does_not_grow_with_the_groups(self):
+        queries = []
+        for group_count in (1, 3):
+            order_groups = OrderGroupFactory.create_batch(group_count)
+            data_list = [
+                get_mock_algo_order_data(order_id=order_group.orders.first().order.order_id, status=AlgoOrderStatus.FILLED)
+                for order_group in order_groups
+            ]
+            with CaptureQueriesContext(connection) as context:
+                get_new_statuses(data_list)
+            queries.append(len(context.captured_queries))
+            for order_group in order_groups:
+                self.assertEqual(self.get_state(order_group).state, LifecycleStateChoices.ACTIVE)
+
+        self.assertEqual(queries[0], queries[1])
+        self.assertEqual(OrderGroupState.objects.verify(), [])
+
+    def test_state__when_order_is_removed__is_refreshed(self):
+        order = OrderFactory(direction='BUY')
+        order_group = OrderGroupFactory(orders=[order])
+        order.order_groups.remove(order_group)
+        self.assertEqual(self.get_state(order_group).state, LifecycleStateChoices.EMPTY)
+
+    def test_state__when_latest_group_is_deleted__falls_back_to_previous_group(self):
+        order_group = OrderGroupFactory()
+        later_group = OrderGroupFactory(group=order_group.group)
+        self.assertEqual(self.get_state(order_group).order_group, later_group)
+        later_group.delete()
+        self.assertEqual(self.get_state(order_group).order_group, order_group)
+
+    def test_get_state_for_group_and_side__when_row_is_missing__creates_it(self):
+        order_group = OrderGroupFactory()
+        OrderGroupState.objects.all().delete()
+        state = OrderGroupState.objects.get_state_for_group_and_side(order_group.group_id, 'BUY')
+        self.assertEqual(state.order_group, order_group)
+        self.assertIsNone(OrderGroupState.objects.get_state_for_group_and_side(order_group.group_id, 'SELL'))
+
+    def test_verify__when_rows_are_stale__reports_and_rebuild_fixes_them(self):
+        order_group = OrderGroupFactory(orders__order__status='FILLED')
+        self.assertEqual(OrderGroupState.objects.verify(), [])
+
+        OrderGroupState.objects.update(state=LifecycleStateChoices.PENDING)
+        self.assertEqual(len(OrderGroupState.objects.verify()), 1)
+
+        call_command('check_order_group_state', rebuild=True)
+        self.assertEqual(self.get_state(order_group).state, LifecycleStateChoices.ACTIVE)
+        self.assertEqual(OrderGroupState.objects.verify(), [])
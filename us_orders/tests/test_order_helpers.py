@@ -61,43 +61,43 @@ class HelpersTests(TestCase):
         trigger_price = 10000.0
         stop_loss_difference = 200.0
         quantity = 0.3
-        order, _ = create_order_for_test(OrderSide.BUY, trigger_price, stop_loss_difference, quantity=quantity)
-        self.assertEqual(get_trigger_price_for_stop_order(order), trigger_price - stop_loss_difference)
+        order, group = create_order_for_test(OrderSide.BUY, trigger_price, stop_loss_difference, quantity=quantity)
+        self.assertEqual(get_trigger_price_for_stop_order(order, group), trigger_price - stop_loss_difference)
 
     def test_get_trigger_price_for_stop_order__when_order_is_BUY_and_has_trigger_trade_price_set(self):
         trigger_price = 10000.0
         trigger_trade_price = 10050.0
         stop_loss_difference = 200.0
         quantity = 0.3
-        order, _ = create_order_for_test(
+        order, group = create_order_for_test(
             OrderSide.BUY,
             trigger_price,
             stop_loss_difference,
             quantity=quantity,
             trigger_trade_price=trigger_trade_price
         )
-        self.assertEqual(get_trigger_price_for_stop_order(order), trigger_trade_price - stop_loss_difference)
+        self.assertEqual(get_trigger_price_for_stop_order(order, group), trigger_trade_price - stop_loss_difference)
 
     def test_get_trigger_price_for_stop_order__when_order_is_SELL(self):
         trigger_price = 10000.0
         stop_loss_difference = 200.0
         quantity = 0.3
-        order, _ = create_order_for_test(OrderSide.SELL, trigger_price, stop_loss_difference, quantity=quantity)
-        self.assertEqual(get_trigger_price_for_stop_order(order), trigger_price + stop_loss_difference)
+        order, group = create_order_for_test(OrderSide.SELL, trigger_price, stop_loss_difference, quantity=quantity)
+        self.assertEqual(get_trigger_price_for_stop_order(order, group), trigger_price + stop_loss_difference)
 
     def test_get_trigger_price_for_stop_order__when_order_is_SELL_and_has_trigger_trade_price_set(self):
         trigger_price = 10000.0
         trigger_trade_price = 10050.0
         stop_loss_difference = 200.0
         quantity = 0.3
-        order, _ = create_order_for_test(
+        order, group = create_order_for_test(
             OrderSide.SELL,
             trigger_price,
             stop_loss_difference,
             quantity=quantity,
             trigger_trade_price=trigger_trade_price
         )
-        self.assertEqual(get_trigger_price_for_stop_order(order), trigger_trade_price + stop_loss_difference)
+        self.assertEqual(get_trigger_price_for_stop_order(order, group), trigger_trade_price + stop_loss_difference)
 
     def test_get_or_create_latest_order_group_for_side__when_order_group_does_not_exist_should_create_new_group(self):
         tf_group = TimeframeGroupFactory()
@@ -130,6 +130,12 @@ class HelpersTests(TestCase):
         self.assertEqual(order_group.side, OrderSide.BUY.value)
         self.assertNotEquals(order_group.pk, closed_order_group.pk)
 
+    def test_get_or_create_latest_order_group_for_side__when_another_timeframe_group_has_a_later_group(self):
+        order_group = OrderGroupFactory(side=OrderSide.BUY.value)
+        OrderGroupFactory(side=OrderSide.BUY.value)
+        res = get_or_create_latest_order_group_for_side(OrderSide.BUY.value, order_group.group.pk)
+        self.assertEqual(order_group, res)
+
     def test_get_or_create_latest_order_group_for_side__when_order_group_exists(self):
         side = OrderSide.BUY.value
         order_group = OrderGroupFactory(side=side)
@@ -220,7 +226,7 @@ class HelpersTests(TestCase):
             stop_side,
             order.quantity,
             '9800.0',
-            f'stop-for-{order.order_id}'
+            f'stop-for-{order.order.order_id}'
         )
 
         self.mock_request.return_value = MockResponse(json_data=send_algo_order_return_mock(123))
@@ -246,7 +252,7 @@ class HelpersTests(TestCase):
             stop_side,
             order.quantity,
             '10200.0',
-            f'stop-for-{order.order_id}'
+            f'stop-for-{order.order.order_id}'
         )
 
         self.mock_request.return_value = MockResponse(json_data=send_algo_order_return_mock(123))
@@ -306,8 +312,9 @@ class HelpersTests(TestCase):
         self.assertEqual(result_dict['trigger_time'], 1699477397.398)
 
     def test_cancel_all_pending_stop_orders_for_side(self):
-        OrderFactory.create_batch(4, indicator__type='BUY', order__status='FILLED')
-        OrderFactory.create_batch(3, indicator__type='SELL', order__status='FILLED')
+        tf_group = TimeframeGroupFactory()
+        OrderGroupFactory(group=tf_group, side='BUY', orders=OrderFactory.create_batch(4, indicator__type='BUY', order__status='FILLED'))
+        OrderGroupFactory(group=tf_group, side='SELL', orders=OrderFactory.create_batch(3, indicator__type='SELL', order__status='FILLED'))
 
         self.assertEqual(len(Order.objects.all()), 7)
 
@@ -315,21 +322,31 @@ class HelpersTests(TestCase):
 
         self.assertEqual(get_count_of_stop_orders_on_side_with_status(OrderSide.SELL, AlgoOrderStatus.CANCELLED), 0)
 
-        cancel_all_pending_stop_orders_for_side('SELL')
+        cancel_all_pending_stop_orders_for_side(tf_group.id, 'SELL')
 
         self.assertEqual(self.mock_request.call_count, 4)
         self.assertEqual(get_count_of_stop_orders_on_side_with_status(OrderSide.SELL, AlgoOrderStatus.CANCELLED), 4)
 
         self.assertEqual(get_count_of_stop_orders_on_side_with_status(OrderSide.BUY, AlgoOrderStatus.CANCELLED), 0)
 
-        cancel_all_pending_stop_orders_for_side('BUY')
+        cancel_all_pending_stop_orders_for_side(tf_group.id, 'BUY')
 
         self.assertEqual(self.mock_request.call_count, 7)
         self.assertEqual(get_count_of_stop_orders_on_side_with_status(OrderSide.BUY, AlgoOrderStatus.CANCELLED), 3)
 
+    def test_cancel_all_pending_stop_orders_for_side__when_the_stops_are_in_another_timeframe_group(self):
+        OrderGroupFactory(side='BUY', orders=OrderFactory.create_batch(2, indicator__type='BUY', order__status='FILLED'))
+
+        cancel_all_pending_stop_orders_for_side(TimeframeGroupFactory().id, 'SELL')
+
+        self.assertEqual(self.mock_request.call_count, 0)
+        self.assertEqual(get_count_of_stop_orders_on_side_with_status(OrderSide.SELL, AlgoOrderStatus.CANCELLED), 0)
+
     def test_cancel_all_pending_orders_for_side(self):
-        OrderFactory.create_batch(4, indicator__type='BUY')
-        OrderFactory.create_batch(3, indicator__type='SELL')
+        tf_group = TimeframeGroupFactory()
+        # a group takes one pending order
+        OrderGroupFactory.create_batch(4, group=tf_group, side='BUY')
+        OrderGroupFactory.create_batch(3, group=tf_group, side='SELL')
 
         self.assertEqual(len(Order.objects.all()), 7)
 
@@ -337,18 +354,26 @@ class HelpersTests(TestCase):
 
         self.assertEqual(get_count_of_orders_on_side_with_status(OrderSide.BUY, AlgoOrderStatus.CANCELLED), 0)
 
-        cancel_all_pending_orders_for_side('BUY')
+        cancel_all_pending_orders_for_side(tf_group.id, 'BUY')
 
         self.assertEqual(self.mock_request.call_count, 4)
         self.assertEqual(get_count_of_orders_on_side_with_status(OrderSide.BUY, AlgoOrderStatus.CANCELLED), 4)
 
         self.assertEqual(get_count_of_orders_on_side_with_status(OrderSide.SELL, AlgoOrderStatus.CANCELLED), 0)
 
-        cancel_all_pending_orders_for_side('SELL')
+        cancel_all_pending_orders_for_side(tf_group.id, 'SELL')
 
         self.assertEqual(self.mock_request.call_count, 7)
         self.assertEqual(get_count_of_orders_on_side_with_status(OrderSide.SELL, AlgoOrderStatus.CANCELLED), 3)
 
+    def test_cancel_all_pending_orders_for_side__when_the_orders_are_in_another_timeframe_group(self):
+        OrderGroupFactory.create_batch(2, side='BUY')
+
+        cancel_all_pending_orders_for_side(TimeframeGroupFactory().id, 'BUY')
+
+        self.assertEqual(self.mock_request.call_count, 0)
+        self.assertEqual(get_count_of_orders_on_side_with_status(OrderSide.BUY, AlgoOrderStatus.CANCELLED), 0)
+
     def test_cancel_pending_order_group_stop(self):
         order_group = OrderGroupFactory(orders__order__status='FILLED')
         stop = WooAlgoOrderFactory(side=['SELL', 'BUY'][order_group.side == 'SELL'], reduce_only=True)
@@ -0,0 +1,308 @@
+import threading
+import time
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase
+
+from common.util.advisory_locks import get_current_lock_scope, lock_scope
+from us_orders.flows import order_state_flow
+from us_orders.locks import get_timeframe_group_key
+from us_orders.models.order_group_state import LifecycleStateChoices, OrderGroupState
+from us_orders.order_state import UNKNOWN_REPORT_SECONDS, OrderStateEngine, apply_write_ops
+from us_orders.tests.factory.order_factory import OrderFactory
+from us_orders.tests.factory.order_group_factory import OrderGroupFactory
+from us_orders.tests.factory.order_placement_factory import OrderPlacementFactory
+from us_orders.tests.helpers import MockResponse, create_order_for_test
+from us_orders.tests.mock_data.algo_order_mock import get_mock_algo_order_data
+from us_orders.tests.mock_data.send_algo_order_return_mock import send_algo_order_return_mock
+from woo.api_types import AlgoOrderStatus, OrderSide
+from woo.models import WooAlgoOrder
+from woo.tests.mock_data.algo_order_mock import cancel_sent_success_response
+
+
+class RecordingQueue:
+    '''
+    Stands in for WriteBehindQueue, the ops are applied on the test thread by apply().
+    '''
+
+    def __init__(self):
+        self.ops = []
+
+    @property
+    def pending(self) -> int:
+        return len(self.ops)
+
+    def put(self, op: dict):
+        self.ops.append(op)
+
+    def flush(self, timeout=None) -> bool:
+        self.apply()
+        return True
+
+    def apply(self):
+        ops, self.ops = self.ops, []
+        apply_write_ops(ops)
+
+
+class OrderStateEngineTests(TestCase):
+
+    def setUp(self):
+        self.queue = RecordingQueue()
+        self.engine = OrderStateEngine(self.queue)
+
+    def test_hydrate__loads_open_groups_only(self):
+        open_group = OrderGroupFactory()
+        closed_group = OrderGroupFactory(side='SELL', orders__order__status='CANCELLED')
+        self.assertEqual(OrderGroupState.objects.get(order_group=closed_group).state, LifecycleStateChoices.CLOSED)
+
+        self.assertEqual(self.engine.hydrate(), 1)
+        self.assertIn(open_group.id, self.engine.groups)
+        self.assertTrue(self.engine.is_tracked(open_group.orders.first().order.order_id))
+
+    @patch('requests.request', side_effect=[
+        MockResponse(json_data=cancel_sent_success_response),
+        MockResponse(json_data=send_algo_order_return_mock(555, quantity=0.1)),
+    ])
+    def test_handle_algo_order_updates__when_order_is_filled__places_stop_without_queries(self, mock_request):
+        order, group = create_order_for_test(OrderSide.BUY, 100, 10)
+        pending_sell = OrderFactory(direction='SELL')
+        OrderGroupFactory(group=group.group, side='SELL', orders=[pending_sell])
+        # pending orders of other timeframe groups aren't cancelled
+        other_sell = OrderGroupFactory(side='SELL').orders.first()
+        self.engine.hydrate()
+
+        data = get_mock_algo_order_data(order_id=order.order.order_id, status=AlgoOrderStatus.FILLED, quantity='0.1')
+        with self.assertNumQueries(0):
+            order_state_flow.handle_algo_order_updates(self.engine, [data])
+
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertEqual(self.engine.get_order(555).id, order.id)
+        self.assertEqual(self.engine.get_order(pending_sell.order.order_id).order.status, AlgoOrderStatus.CANCELLED)
+        self.assertEqual(self.engine.get_order(other_sell.order.order_id).order.status, AlgoOrderStatus.NEW)
+        self.assertEqual([op['type'] for op in self.queue.ops], ['reports', 'update_algo_order', 'create_algo_order', 'set_order_stop'])
+
+        self.queue.apply()
+        order.refresh_from_db()
+        pending_sell.refresh_from_db()
+        self.assertEqual(order.order.status, AlgoOrderStatus.FILLED)
+        self.assertEqual(order.stop.order_id, 555)
+        self.assertTrue(order.stop.reduce_only)
+        self.assertEqual(pending_sell.order.status, AlgoOrderStatus.CANCELLED)
+        self.assertEqual(OrderGroupState.objects.get(order_group=group).state, LifecycleStateChoices.ACTIVE)
+
+    def test_apply_reports__when_order_is_not_tracked__loads_it_from_the_db(self):
+        order_group = OrderGroupFactory()
+        order = order_group.orders.first()
+
+        data = get_mock_algo_order_data(order_id=order.order.order_id, status=AlgoOrderStatus.CANCELLED)
+        changes = self.engine.apply_reports([data])
+
+        self.assertEqual([status for _, status in changes], [AlgoOrderStatus.CANCELLED])
+        self.assertEqual(self.engine.loads, 1)
+        self.assertIn(order_group.id, self.engine.groups)
+
+    def test_apply_reports__when_order_is_not_tracked__reads_the_db_without_the_lock(self):
+        order = OrderGroupFactory().orders.first()
+        lock_held = []
+
+        def record_lock(execute, sql, params, many, context):
+            lock_held.append(self.engine.lock._is_owned())
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record_lock):
+            self.engine.apply_reports([get_mock_algo_order_data(order_id=order.order.order_id, status=AlgoOrderStatus.CANCELLED)])
+
+        self.assertGreater(len(lock_held), 0)
+        self.assertNotIn(True, lock_held)
+
+    @patch.object(RecordingQueue, 'flush', return_value=False)
+    def test_apply_reports__when_writes_are_not_applied_in_time__does_not_read_the_db(self, mock_flush):
+        order = OrderGroupFactory().orders.first()
+        data = get_mock_algo_order_data(order_id=order.order.order_id, status=AlgoOrderStatus.CANCELLED)
+
+        with self.assertNumQueries(0):
+            changes = self.engine.apply_reports([data])
+
+        self.assertEqual(changes, [])
+        self.assertEqual([op['type'] for op in self.queue.ops], ['reports'])
+
+    @patch('requests.request', return_value=MockResponse(json_data=cancel_sent_success_response))
+    def test_cancel_pending_orders_for_side__when_the_new_report_came_before_the_row__cancels_the_order(self, mock_request):
+        timeframe_group = OrderGroupFactory(orders__order__status='FILLED').group
+        self.engine.hydrate()
+        data = get_mock_algo_order_data(order_id=777, status=AlgoOrderStatus.NEW, side='SELL', quantity='0.3')
+
+        self.assertEqual(self.engine.apply_reports([data]), [])
+        self.assertFalse(self.engine.is_tracked(777))
+        self.assertIn(777, self.engine.unknown_reports)
+
+        # the signal flow writes the row once the exchange has the order
+        order_group = OrderGroupFactory(group=timeframe_group, side='SELL', orders=[
+            OrderFactory(direction='SELL', order__order_id=777, order__quantity=0.1)
+        ])
+        order_state_flow.cancel_pending_orders_for_side(self.engine, timeframe_group.id, 'SELL')
+
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual(self.engine.unknown_reports, {})
+        self.assertEqual(self.engine.get_order(777).order.status, AlgoOrderStatus.CANCELLED)
+        self.assertIn(order_group.id, self.engine.groups)
+        self.queue.apply()
+        self.assertEqual(WooAlgoOrder.objects.get(order_id=777).status, AlgoOrderStatus.CANCELLED)
+
+    def test_pending_orders_for_side__when_a_kept_report_has_expired__does_not_load_it(self):
+        self.engine.apply_reports([get_mock_algo_order_data(order_id=777, status=AlgoOrderStatus.NEW)])
+        loads = self.engine.loads
+
+        with patch('us_orders.order_state.time.monotonic', return_value=time.monotonic() + UNKNOWN_REPORT_SECONDS + 1):
+            self.assertEqual(self.engine.pending_orders_for_side(1, 'BUY'), [])
+
+        self.assertEqual(self.engine.loads, loads)
+        self.assertEqual(self.engine.unknown_reports, {})
+
+    def test_reconcile__when_a_signal_flow_placed_orders__reloads_the_timeframe_groups_groups(self):
+        order_group = OrderGroupFactory(orders__order__status='FILLED')
+        other_group = OrderGroupFactory()
+        self.engine.hydrate()
+        self.assertEqual(self.engine.reconcile([order_group.group_id, other_group.group_id]), [])
+
+        # a signal flow in another process adds an order to a new group of the timeframe group
+        sell_group = OrderGroupFactory(group=order_group.group, side='SELL')
+        OrderPlacementFactory(order_group=sell_group)
+
+        self.assertEqual(self.engine.reconcile([order_group.group_id, other_group.group_id]), [order_group.group_id])
+        self.assertIn(sell_group.id, self.engine.groups)
+        self.assertTrue(self.engine.is_tracked(sell_group.orders.first().order.order_id))
+        self.assertIn(other_group.id, self.engine.groups)
+        self.assertEqual(self.engine.reconcile([order_group.group_id]), [])
+
+    def test_handle_algo_order_updates_with_locks__cancels_an_order_a_signal_flow_placed_since_hydrate(self):
+        order, order_group = create_order_for_test(OrderSide.BUY, 100, 10)
+        self.engine.hydrate()
+        pending_sell = OrderGroupFactory(group=order_group.group, side='SELL').orders.first()
+        OrderPlacementFactory(order_group=pending_sell.order_groups.first())
+        data = get_mock_algo_order_data(order_id=order.order.order_id, status=AlgoOrderStatus.FILLED, quantity='0.1')
+
+        with patch('requests.request', side_effect=[
+            MockResponse(json_data=cancel_sent_success_response),
+            MockResponse(json_data=send_algo_order_return_mock(555, quantity=0.1)),
+        ]):
+            order_state_flow.handle_algo_order_updates_with_locks(self.engine, [data])
+
+        self.assertEqual(self.engine.get_order(pending_sell.order.order_id).order.status, AlgoOrderStatus.CANCELLED)
+
+    def test_apply_reports__when_group_is_owned_by_another_engine__hands_the_report_off(self):
+        order_group = OrderGroupFactory()
+        order = order_group.orders.first()
+        handed_off = []
+        self.engine.owns_timeframe_group = lambda timeframe_group_id: timeframe_group_id != order_group.group_id
+        self.engine.on_hand_off = lambda timeframe_group_id, reports: handed_off.append((timeframe_group_id, reports))
+
+        data = get_mock_algo_order_data(order_id=order.order.order_id, status=AlgoOrderStatus.CANCELLED)
+        changes = self.engine.apply_reports([data, get_mock_algo_order_data(order_id=1, status=AlgoOrderStatus.FILLED)])
+
+        self.assertEqual(changes, [])
+        self.assertNotIn(order_group.id, self.engine.groups)
+        self.assertEqual(handed_off, [(order_group.group_id, [data])])
+        self.assertEqual([[report['algoOrderId'] for report in op['reports']] for op in self.queue.ops], [[1]])
+
+    def test_apply_reports__when_order_is_unknown__only_persists_the_report(self):
+        changes = self.engine.apply_reports([get_mock_algo_order_data(order_id=1, status=AlgoOrderStatus.FILLED)])
+        self.assertEqual(changes, [])
+        self.assertEqual([op['type'] for op in self.queue.ops], ['reports'])
+
+    def test_apply_write_ops__when_replayed__leaves_rows_unchanged(self):
+        order, _ = create_order_for_test(OrderSide.BUY, 100, 10)
+        ops = [
+            {'type': 'reports', 'reports': [
+                get_mock_algo_order_data(order_id=order.order.order_id, status=AlgoOrderStatus.FILLED)
+            ]},
+            {'type': 'create_algo_order', 'fields': {
+                'order_id': 777, 'symbol': 'PERP_BTC_USDT', 'side': 'SELL', 'reduce_only': True,
+                'quantity': 0.1, 'trigger_price': 90,
+            }},
+            {'type': 'set_order_stop', 'order': order.id, 'stop_order_id': 777},
+        ]
+        apply_write_ops(ops)
+        apply_write_ops(ops)
+        order.refresh_from_db()
+        self.assertEqual(order.stop.order_id, 777)
+        self.assertEqual(order.order.status, AlgoOrderStatus.FILLED)
+
+    def test_group_entry__has_the_status_of_its_order_group(self):
+        stopped_out = OrderGroupFactory(side='SELL', orders__order__status='FILLED', orders__with_matching_stop=True)
+        stopped_out.stop.update(status=AlgoOrderStatus.FILLED)
+        order_groups = [
+            OrderGroupFactory(),
+            OrderGroupFactory(orders__order__status='FILLED', orders__count=2),
+            OrderGroupFactory(orders__order__status='CANCELLED'),
+            stopped_out,
+        ]
+        for order_group in order_groups:
+            self.engine.load(order_group.orders.first().order.order_id)
+
+        for order_group in order_groups:
+            order_group.refresh_from_db()
+            entry = self.engine.groups[order_group.id]
+            for name in ('is_empty', 'is_pending', 'is_active', 'is_closed', 'is_stopped_out', 'quantity_lots',
+                         'has_reached_max_consecutive_order_stops_limit', 'stop_loss_difference_ticks'):
+                self.assertEqual(getattr(entry, name), getattr(order_group, name), f'{name} of {order_group.id}')
+            for order in order_group.orders.all():
+                self.assertEqual(self.engine.get_order(order.order.order_id).status, order.status)
+
+    def test_handle_algo_order_updates_with_locks__waits_for_the_timeframe_groups_signal_flow_and_leaves_the_writes_queued(self):
+        order, order_group = create_order_for_test(OrderSide.BUY, 100, 10)
+        self.engine.hydrate()
+        key = get_timeframe_group_key(order_group.group_id)
+        held, released = threading.Event(), threading.Event()
+        calls = []
+
+        def hold_timeframe_group_lock():
+            with lock_scope(exclusive=[key]):
+                held.set()
+                time.sleep(0.2)
+                released.set()
+
+        def send(*args, **kwargs):
+            calls.append(released.is_set())
+            return MockResponse(json_data=send_algo_order_return_mock(555, quantity=0.1))
+
+        holder = threading.Thread(target=hold_timeframe_group_lock)
+        holder.start()
+        held.wait()
+        data = get_mock_algo_order_data(order_id=order.order.order_id, status=AlgoOrderStatus.FILLED, quantity='0.1')
+        with patch('requests.request', side_effect=send), patch.object(self.queue, 'flush') as mock_flush:
+            order_state_flow.handle_algo_order_updates_with_locks(self.engine, [data])
+        holder.join()
+
+        self.assertEqual(calls, [True])
+        # tracked orders read nothing, so the fill never waits for the db
+        self.assertFalse(mock_flush.called)
+        self.assertEqual([op['type'] for op in self.queue.ops], ['reports', 'create_algo_order', 'set_order_stop'])
+        self.queue.apply()
+        order.refresh_from_db()
+        self.assertEqual(order.stop.order_id, 555)
+
+    def test_handle_algo_order_updates_with_locks__runs_next_to_the_signal_flows_of_other_timeframe_groups(self):
+        order, _ = create_order_for_test(OrderSide.SELL, 100, 10)
+        self.engine.hydrate()
+        other_group = OrderGroupFactory()
+        data = get_mock_algo_order_data(order_id=order.order.order_id, status=AlgoOrderStatus.CANCELLED)
+        done = threading.Event()
+
+        def handle():
+            order_state_flow.handle_algo_order_updates_with_locks(self.engine, [data])
+            done.set()
+
+        # the worker thread can't read the test database, nothing was placed to reconcile anyway
+        with lock_scope(exclusive=[get_timeframe_group_key(other_group.group_id)]), \
+                patch.object(self.engine, 'reconcile', return_value=[]):
+            worker = threading.Thread(target=handle)
+            worker.start()
+            self.assertTrue(done.wait(5))
+        worker.join()
+        # the writes are applied on the test thread
+        self.queue.apply()
+
+        order.refresh_from_db()
+        self.assertEqual(order.order.status, AlgoOrderStatus.CANCELLED)
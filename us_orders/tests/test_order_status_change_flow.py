@@ -2,15 +2,22 @@ from unittest.mock import patch
 
 from django.test import TestCase
 
+from common.util.advisory_locks import get_current_lock_scope
+from common.util.unit_of_work import get_flow_query_stats, reset_flow_query_stats
 from us_orders.flows.order_status_change_flow import get_new_status, handle_algo_order_update, create_stop_for_order, \
+    get_new_statuses, handle_algo_order_updates, \
     handle_filled_reduce_only_order_update, handle_filled_non_reduce_only_order_update, \
     handle_filled_stop_for_order_group, handle_filled_stop_for_individual_order
-
+from us_orders.models.order_group_state import OrderGroupState
+from us_orders.order_store import db_order_store
 from us_orders.tests.factory.order_factory import OrderFactory
 from us_orders.tests.factory.order_group_factory import OrderGroupFactory
-from us_orders.tests.helpers import MockResponse
+from us_orders.locks import get_timeframe_group_key
+from us_orders.routing import get_group_stop_tag
+from us_orders.tests.helpers import MockResponse, create_order_for_test
 from us_orders.tests.mock_data.algo_order_mock import get_mock_algo_order_data
 from us_orders.tests.mock_data.send_algo_order_return_mock import send_algo_order_return_mock
+from woo.algo_order_version_guard import algo_order_version_guard
 from woo.api_types import AlgoOrderStatus, OrderSide
 from woo.tests.factory.woo_algo_order_factory import WooAlgoOrderFactory
 from woo.tests.mock_data.algo_order_mock import cancel_sent_success_response, edit_sent_success_response
@@ -18,6 +25,9 @@ from woo.tests.mock_data.algo_order_mock import cancel_sent_success_response, ed
 
 class OrderStatusChangeFlowTests(TestCase):
 
+    def setUp(self):
+        algo_order_version_guard.clear()
+
     def test_get_new_status__when_no_algoOrderId_in_data(self):
         self.assertIsNone(get_new_status({}))
 
@@ -116,6 +126,88 @@ class OrderStatusChangeFlowTests(TestCase):
 
     #######################################################################################################
 
+    def test_get_new_statuses__when_batch_has_multiple_orders(self):
+        orders = [WooAlgoOrderFactory(order_id=order_id) for order_id in (1, 2, 3)]
+        data_list = [
+            get_mock_algo_order_data(order_id=1, status=AlgoOrderStatus.FILLED),
+            get_mock_algo_order_data(order_id=2, status=AlgoOrderStatus.NEW, quantity='0.5'),
+            get_mock_algo_order_data(order_id=3, status=AlgoOrderStatus.CANCELLED),
+            get_mock_algo_order_data(order_id=4, status=AlgoOrderStatus.FILLED),
+        ]
+        with self.assertNumQueries(2):
+            changes = get_new_statuses(data_list)
+        self.assertEqual(
+            [(data.get('algoOrderId'), status) for data, status in changes],
+            [(1, AlgoOrderStatus.FILLED), (3, AlgoOrderStatus.CANCELLED)]
+        )
+        for order in orders:
+            order.refresh_from_db()
+        self.assertEqual([order.status for order in orders], ['FILLED', 'NEW', 'CANCELLED'])
+        self.assertEqual(str(orders[1].quantity), '0.5000')
+
+    def test_get_new_statuses__when_order_changes_twice_in_one_batch__applies_in_order(self):
+        order = WooAlgoOrderFactory(order_id=1)
+        data_list = [
+            get_mock_algo_order_data(order_id=1, status=AlgoOrderStatus.FILLED),
+            get_mock_algo_order_data(order_id=1, status=AlgoOrderStatus.FILLED),
+            get_mock_algo_order_data(order_id=1, status=AlgoOrderStatus.CANCELLED),
+        ]
+        changes = get_new_statuses(data_list)
+        self.assertEqual([status for _, status in changes], [AlgoOrderStatus.FILLED, AlgoOrderStatus.CANCELLED])
+        order.refresh_from_db()
+        self.assertEqual(order.status, AlgoOrderStatus.CANCELLED)
+
+    def test_get_new_statuses__when_batch_size_grows__query_count_is_constant(self):
+        for order_id in range(1, 21):
+            WooAlgoOrderFactory(order_id=order_id)
+        data_list = [get_mock_algo_order_data(order_id=order_id, status=AlgoOrderStatus.NEW) for order_id in range(1, 21)]
+        with self.assertNumQueries(2):
+            get_new_statuses(data_list)
+
+    @patch('us_orders.flows.order_status_change_flow.handle_filled_order')
+    def test_handle_algo_order_updates__handles_every_entry(self, mock_handle_filled_order):
+        WooAlgoOrderFactory(order_id=1)
+        WooAlgoOrderFactory(order_id=2)
+        handle_algo_order_updates([
+            get_mock_algo_order_data(order_id=1, status=AlgoOrderStatus.FILLED),
+            get_mock_algo_order_data(order_id=2, status=AlgoOrderStatus.FILLED),
+        ])
+        self.assertEqual([call.args[0] for call in mock_handle_filled_order.call_args_list], [1, 2])
+
+    @patch('us_orders.flows.order_status_change_flow.handle_filled_order')
+    def test_handle_algo_order_updates__when_report_is_resent__skips_db(self, mock_handle_filled_order):
+        WooAlgoOrderFactory(order_id=1)
+        data = get_mock_algo_order_data(order_id=1, status=AlgoOrderStatus.FILLED)
+        handle_algo_order_updates([data])
+        with self.assertNumQueries(0):
+            handle_algo_order_updates([get_mock_algo_order_data(order_id=1, status=AlgoOrderStatus.FILLED)])
+        self.assertEqual(mock_handle_filled_order.call_count, 1)
+        self.assertEqual(algo_order_version_guard.duplicates, 1)
+
+    @patch('us_orders.flows.order_status_change_flow.handle_filled_order')
+    def test_handle_algo_order_updates__holds_the_keys_of_the_reports_timeframe_groups(self, mock_handle_filled_order):
+        first_group = OrderGroupFactory()
+        second_group = OrderGroupFactory()
+        ungrouped = WooAlgoOrderFactory(order_id=999)
+        held = []
+        mock_handle_filled_order.side_effect = lambda *args: held.append(get_current_lock_scope().held)
+
+        handle_algo_order_updates([
+            get_mock_algo_order_data(order_id=first_group.orders.first().order.order_id, status=AlgoOrderStatus.FILLED),
+            get_mock_algo_order_data(order_id=second_group.orders.first().order.order_id, status=AlgoOrderStatus.FILLED),
+            get_mock_algo_order_data(order_id=ungrouped.order_id, status=AlgoOrderStatus.FILLED),
+        ])
+
+        self.assertEqual(held[0], sorted([
+            (get_timeframe_group_key(first_group.group_id), False),
+            (get_timeframe_group_key(second_group.group_id), False),
+        ]))
+        self.assertIsNone(get_current_lock_scope())
+
+    def test_handle_algo_order_updates__when_empty(self):
+        with self.assertNumQueries(0):
+            handle_algo_order_updates([])
+
     def test_handle_algo_order_update__when_no_algoOrderId_in_data(self):
         self.assertIsNone(handle_algo_order_update({}))
 
@@ -160,12 +252,107 @@ class OrderStatusChangeFlowTests(TestCase):
     def test_handle_filled_reduce_only_order_update__when_order_id_matches_a_stop_for_a_group(self):
         pass
 
+    @patch('us_orders.flows.order_status_change_flow.cancel_all_pending_stop_orders_for_side')
+    def test_handle_filled_reduce_only_order_update__when_tagged_as_group_stop__skips_discovery_queries(self, mock_cancel):
+        order_group = OrderGroupFactory(side=OrderSide.BUY.value, orders__order__status='FILLED', orders__with_matching_stop=True)
+        data = get_mock_algo_order_data(order_id=order_group.stop.order_id, reduce_only=True, side=OrderSide.SELL.value)
+        data['orderTag'] = get_group_stop_tag(order_group.id)
+        # the timeframe group to lock and the group named by the tag are the only reads
+        with self.assertNumQueries(2):
+            handle_filled_reduce_only_order_update(order_group.stop.order_id, data)
+        mock_cancel.assert_called_once_with(order_group.group_id, OrderSide.SELL.value, db_order_store)
+
+    @patch('us_orders.flows.order_status_change_flow.handle_filled_stop_for_individual_order')
+    @patch('requests.request', return_value=MockResponse(json_data=send_algo_order_return_mock(123)))
+    def test_handle_filled_reduce_only_order_update__when_stop_is_tagged_by_create_stop_for_order(
+        self,
+        mock_request,
+        mock_handle_stop
+    ):
+        order, _ = create_order_for_test(OrderSide.BUY, 10000.0, 200.0, AlgoOrderStatus.FILLED)
+        create_stop_for_order(order)
+        data = get_mock_algo_order_data(order_id=123, reduce_only=True, side=OrderSide.SELL.value)
+        data['orderTag'] = mock_request.call_args.kwargs.get('json')['orderTag']
+
+        handle_filled_reduce_only_order_update(123, data)
+
+        self.assertEqual(data['orderTag'], f'stop-for-{order.order.order_id}')
+        mock_handle_stop.assert_called_once_with(order, db_order_store)
+
     @patch('requests.request', return_value=None)
     def test_handle_filled_non_reduce_only_order_update__when_no_matching_order_exists(self, mock_request):
         order_id = 123
         handle_filled_non_reduce_only_order_update(order_id)
         self.assertFalse(mock_request.called)
 
+    @patch('requests.request')
+    def test_handle_filled_non_reduce_only_order_update__query_count_does_not_grow_with_pending_orders(self, mock_request):
+        algo_order_ids = iter(range(1000, 1100))
+        mock_request.side_effect = lambda *args, **kwargs: MockResponse(
+            json_data={**send_algo_order_return_mock(next(algo_order_ids)), **cancel_sent_success_response}
+        )
+        reset_flow_query_stats()
+
+        queries = []
+        for pending_count in (1, 3):
+            order, order_group = create_order_for_test(OrderSide.BUY, 100.0, 10.0, AlgoOrderStatus.FILLED)
+            pending_orders = [
+                pending_group.orders.first()
+                for pending_group in OrderGroupFactory.create_batch(pending_count, group=order_group.group, side=OrderSide.SELL.value)
+            ]
+
+            handle_filled_non_reduce_only_order_update(order.order.order_id)
+
+            queries.append(get_flow_query_stats()['handle_filled_non_reduce_only_order_update'].last_queries)
+            order.refresh_from_db()
+            self.assertIsNotNone(order.stop)
+            for pending_order in pending_orders:
+                pending_order.order.refresh_from_db()
+                self.assertEqual(pending_order.order.status, AlgoOrderStatus.CANCELLED)
+
+        # the cancels are written with one update however many orders were pending
+        self.assertEqual(queries[0], queries[1])
+        self.assertEqual(OrderGroupState.objects.verify(), [])
+
+    @patch('requests.request', return_value=MockResponse(json_data=cancel_sent_success_response))
+    def test_handle_filled_non_reduce_only_order_update__when_order_has_no_group__cancels_nothing(self, mock_request):
+        order = OrderFactory(direction=OrderSide.BUY.value, order__status=AlgoOrderStatus.FILLED)
+        pending_order = OrderFactory(direction=OrderSide.SELL.value)
+
+        handle_filled_non_reduce_only_order_update(order.order.order_id)
+
+        # without a group there is no timeframe group to cancel in, nor a stop loss difference
+        self.assertFalse(mock_request.called)
+        pending_order.order.refresh_from_db()
+        self.assertEqual(pending_order.order.status, AlgoOrderStatus.NEW)
+
+    @patch('requests.request', return_value=MockResponse(json_data=send_algo_order_return_mock(123)))
+    def test_handle_filled_non_reduce_only_order_update__leaves_the_orders_of_other_timeframe_groups(self, mock_request):
+        order, _ = create_order_for_test(OrderSide.BUY, 10000.0, 200.0, AlgoOrderStatus.FILLED)
+        other_group = OrderGroupFactory(side=OrderSide.SELL.value)
+
+        handle_filled_non_reduce_only_order_update(order.order.order_id)
+
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertTrue(mock_request.call_args.kwargs.get('json')['reduceOnly'])
+        self.assertEqual(other_group.orders.first().order.status, AlgoOrderStatus.NEW)
+
+    @patch('requests.request', side_effect=[
+        MockResponse(json_data=cancel_sent_success_response),
+        MockResponse(json_data=send_algo_order_return_mock(123)),
+    ])
+    def test_handle_filled_non_reduce_only_order_update__cancels_the_pending_orders_before_placing_the_stop(self, mock_request):
+        order, order_group = create_order_for_test(OrderSide.BUY, 10000.0, 200.0, AlgoOrderStatus.FILLED)
+        pending_order = OrderGroupFactory(group=order_group.group, side=OrderSide.SELL.value).orders.first()
+
+        handle_filled_non_reduce_only_order_update(order.order.order_id)
+
+        self.assertTrue(mock_request.call_args_list[1].kwargs.get('json')['reduceOnly'])
+        order.refresh_from_db()
+        pending_order.order.refresh_from_db()
+        self.assertEqual(order.stop.order_id, 123)
+        self.assertEqual(pending_order.order.status, AlgoOrderStatus.CANCELLED)
+
     @patch('requests.request', return_value=MockResponse(json_data=send_algo_order_return_mock(123)))
     def test_handle_filled_non_reduce_only_order_update(self, mock_requests):
         # HAPPY PATH
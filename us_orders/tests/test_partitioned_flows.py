@@ -0,0 +1,251 @@
+import itertools
+import os
+import queue
+import shutil
+import tempfile
+import time
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from common.util.advisory_locks import get_current_lock_scope
+from common.util.partitions import PartitionedWorkers, get_partition
+from us.tests.factory.timeframe_group_factory import TimeframeGroupFactory
+from us_orders.flows import order_state_flow
+from us_orders.locks import get_timeframe_group_key
+from us_orders.models.algo_order_route import AlgoOrderRoute
+from us_orders.partitioned_flows import UNROUTED_KEY, FlowPartitionHandler, PartitionedFlowDispatcher
+from us_orders.routing import get_group_order_tag, get_order_stop_tag
+from us_orders.tests.factory.order_factory import OrderFactory
+from us_orders.tests.factory.order_group_factory import OrderGroupFactory
+from us_orders.tests.helpers import MockResponse, create_order_for_test
+from us_orders.tests.mock_data.algo_order_mock import get_mock_algo_order_data
+from us_orders.tests.mock_data.send_algo_order_return_mock import send_algo_order_return_mock
+from us_orders.tests.test_order_state import RecordingQueue
+from woo.api_types import AlgoOrderStatus, OrderSide
+from woo.models import WooAlgoOrder
+from woo.tests.mock_data.algo_order_mock import cancel_sent_success_response
+
+PARTITION_COUNT = 16
+# a fill cancels the opposite pending order and places a stop, the exchange calls sleep this long
+EXCHANGE_SECONDS = 0.02
+LOAD_TEST_TIMEFRAME_GROUPS = 48
+# the load test compares wall clock throughput of forked workers sharing a postgres database, it
+# is only run when asked for, e.g. RUN_LOAD_TESTS=1 python manage.py test us_orders.tests.test_partitioned_flows
+RUN_LOAD_TESTS = os.environ.get('RUN_LOAD_TESTS') == '1'
+
+
+class PartitionQueue(RecordingQueue):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+
+    def start(self) -> int:
+        return 0
+
+    def stop(self, drain: bool = True):
+        self.apply()
+
+
+class RecordingWorkers:
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, key, event):
+        self.submitted.append((key, event))
+
+
+class FlowPartitionHandlerTests(TestCase):
+
+    def setUp(self):
+        patcher = patch('us_orders.partitioned_flows.WriteBehindQueue', PartitionQueue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.handler = FlowPartitionHandler('/tmp', PARTITION_COUNT)
+        self.handler._outbox = queue.Queue()
+
+        timeframe_groups = [TimeframeGroupFactory() for _ in range(4)]
+        self.partition = get_partition(timeframe_groups[0].id, PARTITION_COUNT)
+        self.local_group = OrderGroupFactory(group=timeframe_groups[0], side='SELL')
+        remote_group = next(
+            timeframe_group for timeframe_group in timeframe_groups
+            if get_partition(timeframe_group.id, PARTITION_COUNT) != self.partition
+        )
+        self.remote_group = OrderGroupFactory(group=remote_group, side='SELL')
+
+    def test_assign__hydrates_the_groups_of_the_partition_only(self):
+        self.handler.assign(self.partition)
+        engine = self.handler.engines[self.partition]
+        self.assertIn(self.local_group.id, engine.groups)
+        self.assertNotIn(self.remote_group.id, engine.groups)
+
+    @patch('requests.request', return_value=MockResponse(json_data=cancel_sent_success_response))
+    def test_cancel_pending_orders_for_side__cancels_the_orders_of_the_timeframe_group_only(self, mock_request):
+        self.handler.assign(self.partition)
+        order_state_flow.cancel_pending_orders_for_side(self.handler.engines[self.partition], self.local_group.group_id, 'SELL')
+
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertTrue(self.handler._outbox.empty())
+        self.handler.release(self.partition)
+        self.assertEqual(WooAlgoOrder.objects.get(pk=self.local_group.orders.first().order.pk).status, 'CANCELLED')
+        self.assertEqual(WooAlgoOrder.objects.get(pk=self.remote_group.orders.first().order.pk).status, 'NEW')
+
+    def test_handle__reports__hands_the_reports_of_other_partitions_to_their_owner(self):
+        self.handler.assign(self.partition)
+        order = self.remote_group.orders.first()
+        report = get_mock_algo_order_data(order_id=order.order.order_id, status=AlgoOrderStatus.CANCELLED)
+
+        self.handler.handle(self.partition, {'type': 'reports', 'reports': [report]})
+
+        self.assertNotIn(self.remote_group.id, self.handler.engines[self.partition].groups)
+        self.assertEqual(
+            self.handler._outbox.get_nowait(),
+            ('submit', self.remote_group.group_id, {'type': 'reports', 'reports': [report]})
+        )
+
+    def test_handle__reports__holds_the_timeframe_group_key(self):
+        self.handler.assign(self.partition)
+        engine = self.handler.engines[self.partition]
+        order = self.local_group.orders.first()
+        report = get_mock_algo_order_data(order_id=order.order.order_id, status=AlgoOrderStatus.CANCELLED)
+        held = []
+        apply_reports = engine.apply_reports
+
+        def capture(data_list):
+            held.append(get_current_lock_scope().held)
+            return apply_reports(data_list)
+
+        with patch.object(engine, 'apply_reports', side_effect=capture):
+            self.handler.handle(self.partition, {'type': 'reports', 'reports': [report]})
+
+        self.assertEqual(held, [[(get_timeframe_group_key(self.local_group.group_id), False)]])
+        self.handler.release(self.partition)
+        self.assertEqual(WooAlgoOrder.objects.get(pk=order.order.pk).status, 'CANCELLED')
+
+
+class PartitionedFlowDispatcherTests(TestCase):
+
+    def setUp(self):
+        self.workers = RecordingWorkers()
+        self.dispatcher = PartitionedFlowDispatcher(self.workers)
+
+    def report(self, order_id: int, order_tag: str = 'default') -> dict:
+        return {**get_mock_algo_order_data(order_id=order_id, status=AlgoOrderStatus.FILLED), 'orderTag': order_tag}
+
+    def test_handle_algo_order_updates__submits_the_reports_by_timeframe_group(self):
+        first_group = OrderGroupFactory()
+        second_group = OrderGroupFactory()
+        untagged_order = OrderFactory(direction='SELL')
+        OrderGroupFactory(group=first_group.group, side='SELL', orders=[untagged_order])
+        reports = [
+            self.report(1, get_group_order_tag(first_group.id)),
+            self.report(2, get_group_order_tag(second_group.id)),
+            self.report(untagged_order.order.order_id),
+            self.report(3),
+        ]
+
+        self.dispatcher.handle_algo_order_updates(reports)
+
+        self.assertEqual(
+            [(key, [report['algoOrderId'] for report in event['reports']]) for key, event in self.workers.submitted],
+            [
+                (first_group.group_id, [1, untagged_order.order.order_id]),
+                (second_group.group_id, [2]),
+                (UNROUTED_KEY, [3]),
+            ]
+        )
+
+    def test_handle_algo_order_updates__when_order_has_no_route__submits_it_by_its_group(self):
+        order_group = OrderGroupFactory()
+        order = order_group.orders.first()
+        AlgoOrderRoute.objects.filter(algo_order_id=order.order.order_id).delete()
+
+        self.dispatcher.handle_algo_order_updates([self.report(order.order.order_id)])
+
+        self.assertEqual([key for key, _ in self.workers.submitted], [order_group.group_id])
+
+    def test_handle_algo_order_updates__routes_an_order_stop_by_the_stop_id(self):
+        order = OrderFactory(direction='SELL', order__status=AlgoOrderStatus.FILLED)
+        order_group = OrderGroupFactory(side='SELL', orders=[order])
+        legacy_order = OrderFactory(direction='SELL', order__status=AlgoOrderStatus.FILLED)
+        legacy_order_group = OrderGroupFactory(side='SELL', orders=[legacy_order])
+
+        self.dispatcher.handle_algo_order_updates([
+            self.report(order.stop.order_id, get_order_stop_tag(order.order.order_id)),
+            # stop-for tags placed before the exchange id was used name the WooAlgoOrder pk
+            self.report(legacy_order.stop.order_id, get_order_stop_tag(legacy_order.order.pk)),
+        ])
+
+        self.assertEqual(
+            [key for key, _ in self.workers.submitted],
+            [order_group.group_id, legacy_order_group.group_id]
+        )
+
+
+@skipUnless(RUN_LOAD_TESTS, 'set RUN_LOAD_TESTS=1 to run the load tests')
+class FlowPartitionLoadTests(TransactionTestCase):
+
+    def setUp(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('the workers only share a postgres database')
+        self.journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.journal_dir, True)
+        # the workers are forked with the patch in place, ids are unique per process
+        algo_order_ids = itertools.count(1)
+
+        def exchange(*args, **kwargs):
+            time.sleep(EXCHANGE_SECONDS)
+            order_id = os.getpid() * 1000000 + next(algo_order_ids)
+            return MockResponse(json_data={**send_algo_order_return_mock(order_id, quantity=0.1), **cancel_sent_success_response})
+
+        patcher = patch('requests.request', side_effect=exchange)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_fills(self) -> list[tuple]:
+        '''
+        A filled buy order and a pending sell order in each of the timeframe groups.
+        '''
+        fills = []
+        for _ in range(LOAD_TEST_TIMEFRAME_GROUPS):
+            order, order_group = create_order_for_test(OrderSide.BUY, 100.0, 10.0, quantity=0.1)
+            pending_sell = OrderGroupFactory(group=order_group.group, side=OrderSide.SELL.value).orders.first()
+            fills.append((order, order_group, pending_sell))
+        return fills
+
+    def measure_throughput(self, worker_count: int) -> float:
+        fills = self.create_fills()
+        workers = PartitionedWorkers(
+            lambda: FlowPartitionHandler(os.path.join(self.journal_dir, str(worker_count)), PARTITION_COUNT),
+            worker_count,
+            PARTITION_COUNT,
+            ack_timeout=60
+        )
+        workers.start()
+        workers.drain()
+
+        started = time.monotonic()
+        for order, order_group, _ in fills:
+            report = get_mock_algo_order_data(order_id=order.order.order_id, status=AlgoOrderStatus.FILLED, quantity='0.1')
+            workers.submit(order_group.group_id, {'type': 'reports', 'reports': [report]})
+        workers.drain()
+        elapsed = time.monotonic() - started
+        # releasing the partitions applies the engines' writes
+        workers.stop()
+
+        for order, _, pending_sell in fills:
+            order.refresh_from_db()
+            pending_sell.order.refresh_from_db()
+            self.assertIsNotNone(order.stop)
+            self.assertEqual(pending_sell.order.status, AlgoOrderStatus.CANCELLED)
+        return len(fills) / elapsed
+
+    def test_load__throughput_scales_with_the_worker_count(self):
+        throughputs = {worker_count: self.measure_throughput(worker_count) for worker_count in (1, 2, 4)}
+
+        # the fills of different timeframe groups share no lock, so the workers don't wait on each other
+        self.assertGreater(throughputs[2], throughputs[1] * 1.6, throughputs)
+        self.assertGreater(throughputs[4], throughputs[1] * 2.5, throughputs)
@@ -0,0 +1,162 @@
+from django.db import connection
+from django.test import TestCase
+
+from common.util.query_plans import analyze, explain_queries
+from us.tests.factory.timeframe_group_factory import TimeframeGroupFactory
+from us.tests.factory.timeframe_kline_signal_factory import TimeframeKlineSignalFactory
+from us_orders.models.algo_order_route import AlgoOrderRoleChoices, AlgoOrderRoute
+from us_orders.models.order import Order
+from us_orders.models.order_group import OrderGroup
+from us_orders.models.order_group_state import OrderGroupState
+from woo.models import WooAlgoOrder
+
+ORDERS_PER_GROUP = 4
+TIMEFRAME_GROUPS = 4
+
+# postgres costs of lookups that go through an index hardly move when the tables grow 8 times,
+# a plan that reads the tables grows with them
+SMALL_GROUP_COUNT = 60
+LARGE_GROUP_COUNT = 480
+MAX_COST_GROWTH = 2.0
+
+LARGE_TABLES = {
+    WooAlgoOrder._meta.db_table,
+    Order._meta.db_table,
+    OrderGroup._meta.db_table,
+    OrderGroup.orders.through._meta.db_table,
+    AlgoOrderRoute._meta.db_table,
+}
+
+
+class QueryPlanTests(TestCase):
+    '''
+    Explains the queries behind the manager methods on a seeded dataset shaped like production,
+    mostly closed history and a few live rows. Methods that return a large share of a table,
+    get_all_orders_for_side and friends or with_state() without a filter, are left out, reading
+    the table is the right plan for them.
+    '''
+
+    def setUp(self):
+        self.timeframe_groups = [TimeframeGroupFactory() for _ in range(TIMEFRAME_GROUPS)]
+        self.signals = {side: TimeframeKlineSignalFactory(direction=side) for side in ('BUY', 'SELL')}
+        self.group_count = 0
+
+    def seed(self, group_count: int):
+        '''
+        Adds order groups up to group_count, every 20th holds a pending order with a live stop,
+        the others filled orders that were stopped out or cancelled orders.
+        '''
+        algo_orders, orders, order_groups = [], [], []
+        for index in range(self.group_count, group_count):
+            side = ['BUY', 'SELL'][index % 2]
+            is_live = index % 20 == 0
+            order_groups.append(OrderGroup(group=self.timeframe_groups[index % TIMEFRAME_GROUPS], side=side))
+            for position in range(ORDERS_PER_GROUP):
+                number = index * ORDERS_PER_GROUP + position
+                status = 'NEW' if is_live and position == 0 else ['FILLED', 'CANCELLED'][number % 3 == 0]
+                order = WooAlgoOrder(
+                    order_id=2 * number + 1, symbol='PERP_BTC_USDT', side=side, status=status, quantity=0.1, trigger_price=100
+                )
+                stop = None
+                if status == 'FILLED':
+                    stop = WooAlgoOrder(
+                        order_id=2 * number + 2, symbol='PERP_BTC_USDT', side=['BUY', 'SELL'][side == 'BUY'],
+                        status=['FILLED', 'NEW'][is_live], reduce_only=True, quantity=0.1, trigger_price=90
+                    )
+                algo_orders += [order] + ([stop] if stop is not None else [])
+                orders.append(Order(order=order, stop=stop, indicator=self.signals[side]))
+
+        WooAlgoOrder.objects.bulk_create(algo_orders)
+        for order in orders:
+            order.order_id = order.order.pk
+            order.stop_id = order.stop.pk if order.stop is not None else None
+        Order.objects.bulk_create(orders)
+        OrderGroup.objects.bulk_create(order_groups)
+
+        through = OrderGroup.orders.through
+        through.objects.bulk_create([
+            through(ordergroup_id=order_groups[position // ORDERS_PER_GROUP].pk, order_id=order.pk)
+            for position, order in enumerate(orders)
+        ])
+        routes = []
+        for position, order in enumerate(orders):
+            order_group = order_groups[position // ORDERS_PER_GROUP]
+            routes.append(AlgoOrderRoute(algo_order_id=order.order.order_id, role=AlgoOrderRoleChoices.ORDER, order=order, order_group=order_group))
+            if order.stop is not None:
+                routes.append(AlgoOrderRoute(algo_order_id=order.stop.order_id, role=AlgoOrderRoleChoices.ORDER_STOP, order=order, order_group=order_group))
+        AlgoOrderRoute.objects.bulk_create(routes)
+
+        self.group_count = group_count
+        OrderGroupState.objects.rebuild()
+        analyze(WooAlgoOrder, Order, OrderGroup, through, AlgoOrderRoute, OrderGroupState)
+
+    def get_checks(self) -> dict:
+        # the latest live rows are the ones the flows look up
+        pending_order = Order.objects.select_related('order').filter(order__status='NEW').order_by('-pk').first()
+        stopped_order = Order.objects.select_related('stop').filter(stop__isnull=False).order_by('-pk').first()
+        order_group = pending_order.order_groups.first()
+        timeframe_group_id = order_group.group_id
+
+        return {
+            'Order.get_pending_orders': lambda: list(Order.objects.get_pending_orders()),
+            'Order.get_last_pending_order': lambda: Order.objects.get_last_pending_order(),
+            'Order.get_last_pending_order_for_side': lambda: Order.objects.get_last_pending_order_for_side('BUY'),
+            'Order.get_last_active_order': lambda: Order.objects.get_last_active_order(),
+            'Order.get_last_active_order_for_side': lambda: Order.objects.get_last_active_order_for_side('BUY'),
+            'Order.get_last_order': lambda: Order.objects.get_last_order(),
+            'Order.get_last_order_for_side': lambda: Order.objects.get_last_order_for_side('BUY'),
+            'Order.get_order_by_order_id': lambda: Order.objects.get_order_by_order_id(stopped_order.stop.order_id),
+            'Order.get_order_by_algo_order_id': lambda: Order.objects.get_order_by_algo_order_id(pending_order.order.order_id),
+            'Order.get_order_by_stop_order_id': lambda: Order.objects.get_order_by_stop_order_id(stopped_order.stop.order_id),
+            'Order.get_all_pending_reduce_only_orders_for_side': lambda: list(
+                Order.objects.get_all_pending_reduce_only_orders_for_side('SELL')
+            ),
+            'Order.get_all_pending_non_reduce_only_orders_for_side': lambda: list(
+                Order.objects.get_all_pending_non_reduce_only_orders_for_side('BUY')
+            ),
+            'Order.get_orders_with_state': lambda: list(Order.objects.get_orders_with_state().filter(pk=pending_order.pk)),
+            'Order.get_order_group': lambda: Order.objects.get(pk=pending_order.pk).get_order_group(),
+            'OrderGroup.get_latest_pending_group': lambda: OrderGroup.objects.get_latest_pending_group(),
+            'OrderGroup.get_latest_pending_group_for_side': lambda: OrderGroup.objects.get_latest_pending_group_for_side('BUY'),
+            'OrderGroup.get_latest_group_for_side': lambda: OrderGroup.objects.get_latest_group_for_side('BUY'),
+            'OrderGroup.get_groups_with_state': lambda: list(OrderGroup.objects.get_groups_with_state().filter(pk=order_group.pk)),
+            'OrderGroup.get_group_by_order_id': lambda: OrderGroup.objects.get_group_by_order_id(pending_order.order.order_id),
+            'OrderGroup.get_group_by_stop_order_id': lambda: OrderGroup.objects.get_group_by_stop_order_id(stopped_order.stop.order_id),
+            'OrderGroupState.get_state_for_group_and_side': lambda: OrderGroupState.objects.get_state_for_group_and_side(
+                timeframe_group_id, 'BUY'
+            ),
+            'OrderGroupState.get_current_active_group': lambda: OrderGroupState.objects.get_current_active_group(),
+            'OrderGroupState.refresh': lambda: OrderGroupState.objects.refresh(timeframe_group_id, 'BUY'),
+            'AlgoOrderRoute.get_route_by_algo_order_id': lambda: AlgoOrderRoute.objects.get_route_by_algo_order_id(
+                pending_order.order.order_id
+            ),
+            'WooAlgoOrder.get_by_order_id': lambda: WooAlgoOrder.objects.filter(order_id=pending_order.order.order_id).first(),
+        }
+
+    def explain_checks(self) -> dict:
+        return {name: explain_queries(check) for name, check in self.get_checks().items()}
+
+    def test_manager_queries__do_not_scan_the_order_tables(self):
+        self.seed(LARGE_GROUP_COUNT)
+        errors = []
+        for name, plans in self.explain_checks().items():
+            for plan in plans:
+                scans = plan.sequential_scans + ([] if ' LIMIT ' in plan.sql else plan.full_index_scans)
+                scans = sorted(LARGE_TABLES.intersection(scans))
+                if scans:
+                    errors.append(f'{name} scans {", ".join(scans)}: {plan.sql}')
+        self.assertEqual(errors, [], '\n'.join(errors))
+
+    def test_manager_queries__cost_does_not_grow_with_the_history(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('only postgres reports plan costs')
+        self.seed(SMALL_GROUP_COUNT)
+        small = self.explain_checks()
+        self.seed(LARGE_GROUP_COUNT)
+        errors = []
+        for name, plans in self.explain_checks().items():
+            small_cost = sum(plan.cost for plan in small[name])
+            large_cost = sum(plan.cost for plan in plans)
+            if large_cost > small_cost * MAX_COST_GROWTH:
+                errors.append(f'{name} cost grew from {small_cost} to {large_cost}')
+        self.assertEqual(errors, [], '\n'.join(errors))
@@ -0,0 +1,43 @@
+from django.test import TestCase
+
+from us_orders.models.algo_order_route import AlgoOrderRoleChoices, AlgoOrderRoute
+from us_orders.routing import OrderRoute, get_route, parse_order_tag
+from us_orders.tests.factory.order_factory import OrderFactory
+from us_orders.tests.factory.order_group_factory import OrderGroupFactory
+from woo.tests.factory.woo_algo_order_factory import WooAlgoOrderFactory
+
+
+class RoutingTests(TestCase):
+
+    def test_parse_order_tag(self):
+        self.assertEqual(parse_order_tag('group-12-order'), OrderRoute(AlgoOrderRoleChoices.ORDER, order_group_id=12))
+        self.assertEqual(parse_order_tag('group-12-closer'), OrderRoute(AlgoOrderRoleChoices.GROUP_STOP, order_group_id=12))
+        self.assertEqual(parse_order_tag('stop-for-2650645'), OrderRoute(AlgoOrderRoleChoices.ORDER_STOP))
+        for tag in (None, '', 'default', 'group-x-order', 'group-12-order-2'):
+            self.assertIsNone(parse_order_tag(tag))
+
+    def test_get_route__when_tag_is_ours__does_not_query(self):
+        with self.assertNumQueries(0):
+            route = get_route(1, 'group-3-closer')
+        self.assertEqual(route.order_group_id, 3)
+
+    def test_get_route__when_tag_is_missing__uses_the_route_table(self):
+        order = OrderFactory(order__status='FILLED')
+        order_group = OrderGroupFactory(orders=[order])
+
+        with self.assertNumQueries(1):
+            route = get_route(order.order.order_id, 'default')
+        self.assertEqual(route, OrderRoute(AlgoOrderRoleChoices.ORDER, order_group_id=order_group.id, order_pk=order.id))
+
+        route = get_route(order.stop.order_id)
+        self.assertEqual(route.role, AlgoOrderRoleChoices.ORDER_STOP)
+        self.assertEqual(route.order_pk, order.id)
+
+    def test_route_table__when_group_stop_is_set(self):
+        order_group = OrderGroupFactory(orders__order__status='FILLED', orders__order__quantity=0.1)
+        stop = WooAlgoOrderFactory(side='SELL', reduce_only=True, quantity=0.1)
+        order_group.set_stop(stop)
+        route = AlgoOrderRoute.objects.get_route_by_algo_order_id(stop.order_id)
+        self.assertEqual(route.role, AlgoOrderRoleChoices.GROUP_STOP)
+        self.assertEqual(route.order_group, order_group)
+        self.assertIsNone(get_route(123456))
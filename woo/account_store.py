@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Callable, Mapping, Optional
+
+from common.util.logging import log
+from woo.api_rest import get_account_info, get_balances, get_position_info
+
+
+@dataclass(frozen=True)
+class Position:
+    symbol: str
+    holding: float = 0.0
+    pending_long_qty: float = 0.0
+    pending_short_qty: float = 0.0
+    average_open_price: float = 0.0
+    mark_price: float = 0.0
+    version: int = 0
+    updated_at: int = 0
+
+
+@dataclass(frozen=True)
+class Balance:
+    token: str
+    holding: float = 0.0
+    frozen: float = 0.0
+    version: int = 0
+    updated_at: int = 0
+
+
+@dataclass(frozen=True)
+class AccountSnapshot:
+    positions: Mapping[str, Position]
+    balances: Mapping[str, Balance]
+    account: Mapping[str, object] = field(default_factory=lambda: MappingProxyType({}))
+    version: int = 0
+
+
+class AccountStore:
+    '''
+    Process resident copy of the account's positions and balances, seeded over REST and kept
+    current by the private ws position and balance topics.
+
+    Updates build a new immutable AccountSnapshot under a lock and swap it in, so readers never
+    lock and a snapshot they hold never changes under them.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = AccountSnapshot(MappingProxyType({}), MappingProxyType({}))
+        self._listeners: list[Callable[[AccountSnapshot], None]] = []
+
+    @property
+    def snapshot(self) -> AccountSnapshot:
+        return self._snapshot
+
+    def get_position(self, symbol: str) -> Optional[Position]:
+        return self._snapshot.positions.get(symbol)
+
+    def get_holding(self, symbol: str) -> float:
+        position = self._snapshot.positions.get(symbol)
+        return position.holding if position is not None else 0.0
+
+    def get_balance(self, token: str) -> Optional[Balance]:
+        return self._snapshot.balances.get(token)
+
+    def add_listener(self, listener: Callable[[AccountSnapshot], None]):
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[AccountSnapshot], None]):
+        try:
+            self._listeners.remove(listener)
+        except ValueError:
+            pass
+
+    def seed(self) -> bool:
+        position_info = get_position_info()
+        balances = get_balances()
+        account_info = get_account_info()
+
+        if position_info is None or balances is None or account_info is None:
+            log('ERROR: account store', 'could not seed positions and balances from REST')
+            return False
+
+        self._apply(
+            positions=_map_rows(position_info.get('positions'), 'symbol', _to_position),
+            balances=_map_rows(balances.get('holding'), 'token', _to_balance),
+            account=account_info,
+            replace=True
+        )
+        return True
+
+    def seed_in_background(self) -> threading.Thread:
+        '''
+        Seeds on its own thread, so the REST calls don't hold up the caller, e.g. the ws thread
+        when it reconnects.
+        '''
+        thread = threading.Thread(target=self.seed, name='account-store-seed', daemon=True)
+        thread.start()
+        return thread
+
+    def update_positions(self, data: dict):
+        '''
+        Handler for the ws position topic, {"positions": {"PERP_BTC_USDT": {...}}}.
+        '''
+        positions = (data or {}).get('positions') or {}
+        self._apply(positions={symbol: _to_position(symbol, values) for symbol, values in positions.items()})
+
+    def update_balances(self, data: dict):
+        '''
+        Handler for the ws balance topic, {"balances": {"USDT": {...}}}.
+        '''
+        balances = (data or {}).get('balances') or {}
+        self._apply(balances={token: _to_balance(token, values) for token, values in balances.items()})
+
+    def clear(self):
+        with self._lock:
+            self._snapshot = AccountSnapshot(MappingProxyType({}), MappingProxyType({}))
+
+    def _apply(
+        self,
+        positions: Optional[dict[str, Position]] = None,
+        balances: Optional[dict[str, Balance]] = None,
+        account: Optional[dict] = None,
+        replace: bool = False
+    ):
+        with self._lock:
+            current = self._snapshot
+            snapshot = AccountSnapshot(
+                positions=_merge(current.positions, positions, replace),
+                balances=_merge(current.balances, balances, replace),
+                account=MappingProxyType(dict(account)) if account is not None else current.account,
+                version=current.version + 1
+            )
+            self._snapshot = snapshot
+
+        for listener in self._listeners:
+            try:
+                listener(snapshot)
+            except Exception as e:
+                log('ERROR: account store listener failed', e)
+
+
+def _merge(current: Mapping, updates: Optional[dict], replace: bool) -> Mapping:
+    if updates is None:
+        return current
+    merged = {} if replace else dict(current)
+    for key, value in updates.items():
+        existing = current.get(key)
+        # a ws push can be newer than the REST seed that follows it, keep whichever is newer
+        if existing is not None and 0 < value.version < existing.version:
+            value = existing
+        merged[key] = value
+    return MappingProxyType(merged)
+
+
+def _map_rows(rows: Optional[list[dict]], key: str, mapper: Callable) -> dict:
+    return {row[key]: mapper(row[key], row) for row in rows or [] if row.get(key) is not None}
+
+
+def _to_position(symbol: str, values: dict) -> Position:
+    return Position(
+        symbol=symbol,
+        holding=float(values.get('holding') or 0),
+        pending_long_qty=float(values.get('pendingLongQty') or 0),
+        pending_short_qty=float(values.get('pendingShortQty') or 0),
+        average_open_price=float(values.get('averageOpenPrice') or 0),
+        mark_price=float(values.get('markPrice') or 0),
+        version=int(values.get('version') or 0),
+        updated_at=time.time_ns()
+    )
+
+
+def _to_balance(token: str, values: dict) -> Balance:
+    return Balance(
+        token=token,
+        holding=float(values.get('holding') or 0),
+        frozen=float(values.get('frozen') or 0),
+        version=int(values.get('version') or 0),
+        updated_at=time.time_ns()
+    )
+
+
+account_store = AccountStore()
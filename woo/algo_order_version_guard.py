@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import threading
+import time
+from decimal import Decimal, InvalidOperation
+from typing import Optional
+
+from django.db.models import Q
+
+from woo.api_types import AlgoOrderResponseData, AlgoOrderStatus
+from woo.models import WooAlgoOrder
+
+DEFAULT_WARM_MAX_AGE = 24 * 60 * 60
+
+# a report can only move an order forward, each final status outranks the ones a late report
+# could still bring, a fill wins over a cancel that raced it. normalise_algo_order_status handles
+# a partial fill as a fill, later partial fills are ordered by their time
+STATUS_RANKS = {
+    AlgoOrderStatus.NEW.value: 0,
+    AlgoOrderStatus.REPLACED.value: 0,
+    AlgoOrderStatus.CANCELLED.value: 1,
+    AlgoOrderStatus.REJECTED.value: 2,
+    AlgoOrderStatus.PARTIAL_FILLED.value: 3,
+    AlgoOrderStatus.FILLED.value: 3,
+}
+
+
+class AlgoOrderVersionGuard:
+    '''
+    Remembers the last applied (status, time) of every algo order so resent and out of order
+    execution reports can be dropped before they reach the db.
+
+    Versions are ordered by status rank first so a late NEW can never undo a fill, the time
+    only orders reports of the same rank. It is the timestamp of ws reports, or the updatedTime
+    of rest responses, in ms. A report is a duplicate when its version equals the last applied
+    one and stale when it is older. Reports without either time are always let through.
+    '''
+
+    def __init__(self):
+        self._versions: dict[int, tuple[int, int]] = {}
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.duplicates = 0
+        self.stale = 0
+
+    def __len__(self) -> int:
+        return len(self._versions)
+
+    def filter(self, data_list: list[AlgoOrderResponseData]) -> list[AlgoOrderResponseData]:
+        accepted = []
+        pending: dict[int, tuple[int, int]] = {}
+
+        with self._lock:
+            for data in data_list:
+                order_id = data.get('algoOrderId')
+                version = _get_version(get_report_time_ms(data), data.get('algoStatus'), data.get('isTriggered'))
+
+                if order_id is not None and version is not None:
+                    last_version = pending.get(order_id) or self._versions.get(order_id)
+                    if last_version is not None and version == last_version:
+                        self.duplicates += 1
+                        continue
+                    if last_version is not None and version < last_version:
+                        self.stale += 1
+                        continue
+                    pending[order_id] = version
+
+                accepted.append(data)
+
+            self.accepted += len(accepted)
+
+        return accepted
+
+    def record(self, data: AlgoOrderResponseData):
+        order_id = data.get('algoOrderId')
+        version = _get_version(get_report_time_ms(data), data.get('algoStatus'), data.get('isTriggered'))
+        if order_id is None or version is None:
+            return
+        with self._lock:
+            last_version = self._versions.get(order_id)
+            if last_version is None or version > last_version:
+                self._versions[order_id] = version
+
+    def warm(self, max_age: Optional[float] = DEFAULT_WARM_MAX_AGE):
+        '''
+        Loads the versions of recently updated orders, reports for older orders are still let
+        through once and remembered from then on. The time is the report_time_ms of the last
+        ws report applied, or the updated_time of orders only ever written from rest.
+        '''
+        queryset = WooAlgoOrder.objects.all()
+        if max_age is not None:
+            since = time.time() - max_age
+            queryset = queryset.filter(Q(report_time_ms__gte=since * 1000) | Q(updated_time__gte=since))
+
+        with self._lock:
+            for order_id, report_time_ms, updated_time, status, is_triggered in queryset.values_list(
+                'order_id', 'report_time_ms', 'updated_time', 'status', 'is_triggered'
+            ):
+                time_ms = report_time_ms if report_time_ms is not None else _seconds_to_ms(updated_time)
+                version = _get_version(time_ms, status, is_triggered)
+                if version is not None:
+                    self._versions[order_id] = version
+
+    def clear(self):
+        with self._lock:
+            self._versions = {}
+            self.accepted = 0
+            self.duplicates = 0
+            self.stale = 0
+
+    def stats(self) -> dict:
+        return {
+            'orders': len(self._versions),
+            'accepted': self.accepted,
+            'duplicates': self.duplicates,
+            'stale': self.stale,
+        }
+
+
+def get_report_time_ms(data: AlgoOrderResponseData) -> Optional[int]:
+    timestamp = data.get('timestamp')
+    if timestamp is not None:
+        return _to_int(timestamp)
+    return _seconds_to_ms(data.get('updatedTime'))
+
+
+def _seconds_to_ms(seconds) -> Optional[int]:
+    if seconds is None:
+        return None
+    try:
+        return int(Decimal(str(seconds)) * 1000)
+    except InvalidOperation:
+        return None
+
+
+def _to_int(value) -> Optional[int]:
+    try:
+        return int(Decimal(str(value)))
+    except InvalidOperation:
+        return None
+
+
+def _get_version(time_ms: Optional[int], status: Optional[str], is_triggered: Optional[bool]) -> Optional[tuple[int, int]]:
+    if time_ms is None:
+        return None
+    rank = STATUS_RANKS.get(status, 0)
+    # matches the status fix in normalise_algo_order_status, a triggered NEW order is treated as FILLED
+    if is_triggered and rank == STATUS_RANKS[AlgoOrderStatus.NEW.value]:
+        rank = STATUS_RANKS[AlgoOrderStatus.FILLED.value]
+    return rank, time_ms
+
+
+algo_order_version_guard = AlgoOrderVersionGuard()
@@ -36,6 +36,7 @@ CLIENT_TRADES = f'{CLIENT}/trades'
 GET_TRANSACTION_HISTORY = f'{CLIENT}/transaction_history'
 GET_POSITION_INFO = '/v3/positions'
 GET_ACCOUNT_INFO = '/v3/accountinfo'
+GET_BALANCES = '/v3/balances'
 GET_CREDENTIALS = '/usercenter/api/enabled_credential'
 GET_IP_RESTRICTION = '/v1/sub_account/ip_restriction'
 
@@ -176,8 +177,12 @@ def get_algo_order(order_id: int):
     return _api_request(f'{ALGO_ORDER}/{order_id}', data={"realizedPnl": True}, is_signed=True)
 
 
-def get_algo_orders():
-    return _api_request(ALGO_ORDERS, data={"algoType": "STOP", "realizedPnl": True}, is_signed=True)
+def get_algo_orders(status: Optional[str] = None):
+    data = {"algoType": "STOP", "realizedPnl": True}
+    if status is not None:
+        # INCOMPLETE or COMPLETED
+        data['status'] = status
+    return _api_request(ALGO_ORDERS, data=data, is_signed=True)
 
 
 def send_algo_order(params: AlgoOrderRequestParams):
@@ -220,6 +225,10 @@ def get_account_info():
     return _api_request(GET_ACCOUNT_INFO, is_signed=True)
 
 
+def get_balances():
+    return _api_request(GET_BALANCES, is_signed=True)
+
+
 def get_transaction_history():
     return _api_request(GET_TRANSACTION_HISTORY, data={"size": 100}, is_signed=True)
 
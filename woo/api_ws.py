@@ -9,7 +9,9 @@ import websocket
 import rel
 import time
 
+from common.util.conflating_queue import ConflatingHandler, ConflationStats
 from common.util.logging import log
+from common.util.tape import TapeRecorder
 from woo.api_helpers import get_timestamp_unix, generate_signature
 
 MARKET_DATA_WS = 'wss://wss.woo.org/ws/stream/'
@@ -18,6 +20,7 @@ PRIVATE_WS = 'wss://wss.woo.org/v2/ws/private/stream/'
 
 class MessageTypes(str, Enum):
     SUBSCRIBE = 'subscribe'
+    UNSUBSCRIBE = 'unsubscribe'
     PING = 'ping'
     PONG = 'pong'
     KLINE_1M = 'PERP_BTC_USDT@kline_1m'
@@ -30,6 +33,16 @@ class MessageTypes(str, Enum):
     BALANCE = 'balance'
 
 
+# key used to conflate latest-value topics, messages with different keys are never conflated with each other
+CONFLATION_KEYS: dict[str, Callable] = {
+    # an update for the next bar must not replace the final update of the previous one
+    MessageTypes.KLINE_1M.value: lambda data: (data or {}).get('startTime'),
+    # a push only supersedes an earlier one carrying the same symbols or tokens
+    MessageTypes.POSITION.value: lambda data: tuple(sorted((data or {}).get('positions') or {})),
+    MessageTypes.BALANCE.value: lambda data: tuple(sorted((data or {}).get('balances') or {})),
+}
+
+
 class WSKlineData(TypedDict):
     startTime: int
     endTime: int
@@ -46,6 +59,7 @@ class WooWSKwargs(TypedDict):
     connect_callback: Optional[Callable]
     error_callback: Optional[Callable]
     close_callback: Optional[Callable]
+    recorder: Optional[TapeRecorder]
 
 
 class WooWSClient:
@@ -59,6 +73,8 @@ class WooWSClient:
     _error_callback: Optional[Callable]
     _close_callback: Optional[Callable]
     _message_callback_map: dict[str, list[Callable]]
+    _conflating_handlers: dict[tuple[str, Callable], ConflatingHandler]
+    _recorder: Optional[TapeRecorder]
 
     def __init__(
         self,
@@ -83,8 +99,13 @@ class WooWSClient:
         self._error_callback = kwargs.get('error_callback')
         self._close_callback = kwargs.get('close_callback')
         self._message_callback_map = {}
+        self._conflating_handlers = {}
+        self._recorder = kwargs.get('recorder')
 
-    def connect(self):
+    def attach_recorder(self, recorder: Optional[TapeRecorder]):
+        self._recorder = recorder
+
+    def connect(self, dispatch: bool = True):
         url = f'{PRIVATE_WS if self._private else MARKET_DATA_WS}{self._app_id}'
         try:
             self._ws = websocket.WebSocketApp(
@@ -96,15 +117,17 @@ class WooWSClient:
             )
 
             self._ws.run_forever(dispatcher=rel, reconnect=5)
-            rel.signal(2, rel.abort)
-            rel.dispatch()
+            # dispatch=False lets several clients share one rel loop, the caller runs rel.dispatch()
+            if dispatch:
+                rel.signal(2, rel.abort)
+                rel.dispatch()
         except ConnectionResetError as e:
             log('ConnectionResetError', e)
             time.sleep(1)
-            self.connect()
+            self.connect(dispatch)
         
-    def subscribe_to_1m_kline(self, handler: Optional[Callable] = None):
-        self._subscribe(MessageTypes.KLINE_1M, handler)
+    def subscribe_to_1m_kline(self, handler: Optional[Callable] = None, conflate: bool = False):
+        self._subscribe(MessageTypes.KLINE_1M, handler, conflate=conflate)
 
     def subscribe_to_execution_report(self, handler: Optional[Callable] = None):
         self._subscribe(MessageTypes.EXECUTION_REPORT, handler)
@@ -112,24 +135,40 @@ class WooWSClient:
     def subscribe_to_algo_execution_report_v2(self, handler: Optional[Callable] = None):
         self._subscribe(MessageTypes.ALGO_EXECUTION_REPORT_V2, handler)
 
-    def subscribe_to_position(self, handler: Optional[Callable] = None):
-        self._subscribe(MessageTypes.POSITION, handler)
+    def subscribe_to_position(self, handler: Optional[Callable] = None, conflate: bool = False):
+        self._subscribe(MessageTypes.POSITION, handler, conflate=conflate)
 
-    def subscribe_to_order_book_update(self, symbol: str, handler: Optional[Callable] = None):
-        self._subscribe(MessageTypes.ORDER_BOOK_UPDATE, handler, [('symbol', symbol)])
+    def subscribe_to_order_book_update(self, symbol: str, handler: Optional[Callable] = None, conflate: bool = False):
+        self._subscribe(MessageTypes.ORDER_BOOK_UPDATE, handler, [('symbol', symbol)], conflate=conflate)
 
     def subscribe_to_trade(self, symbol: str, handler: Optional[Callable] = None):
         self._subscribe(MessageTypes.TRADE, handler, [('symbol', symbol)])
 
-    def subscribe_to_balance(self, handler: Optional[Callable] = None):
-        self._subscribe(MessageTypes.BALANCE, handler)
+    def subscribe_to_balance(self, handler: Optional[Callable] = None, conflate: bool = False):
+        self._subscribe(MessageTypes.BALANCE, handler, conflate=conflate)
+
+    def conflation_stats(self) -> dict[str, ConflationStats]:
+        stats = {}
+        for (topic, _), conflating_handler in self._conflating_handlers.items():
+            topic_stats = stats.setdefault(topic, ConflationStats())
+            topic_stats.received += conflating_handler.stats.received
+            topic_stats.delivered += conflating_handler.stats.delivered
+            topic_stats.conflated += conflating_handler.stats.conflated
+        return stats
 
     def _subscribe(
         self,
         msg_type: MessageTypes,
         handler: Optional[Callable] = None,
-        params: list[tuple[str, str]] = None
+        params: list[tuple[str, str]] = None,
+        conflate: bool = False
     ):
+        '''
+        conflate=True marks the subscription latest-value, the handler runs on its own thread and
+        only gets the newest message per CONFLATION_KEYS key that arrived while it was busy.
+        Only use it for topics where each message supersedes the previous one, order sensitive
+        topics like algoexecutionreportv2 must stay on the default in order dispatch.
+        '''
         if self._ws is None:
             raise Exception('Cannot subscribe before connecting')
 
@@ -138,6 +177,13 @@ class WooWSClient:
         if params is not None:
             topic = topic.format(**dict(params))
 
+        if handler is not None and conflate:
+            conflating_handler = self._conflating_handlers.get((topic, handler))
+            if conflating_handler is None:
+                conflating_handler = ConflatingHandler(handler, CONFLATION_KEYS.get(msg_type.value), f'woo-{topic}')
+                self._conflating_handlers[(topic, handler)] = conflating_handler
+            handler = conflating_handler
+
         if handler is not None:
             self._register_message_callback(topic, handler)
 
@@ -147,6 +193,39 @@ class WooWSClient:
             "event": "subscribe"
         }))
 
+    def _unsubscribe(
+        self,
+        msg_type: MessageTypes,
+        handler: Optional[Callable] = None,
+        params: list[tuple[str, str]] = None
+    ):
+        if self._ws is None:
+            raise Exception('Cannot unsubscribe before connecting')
+
+        topic = msg_type.value
+
+        if params is not None:
+            topic = topic.format(**dict(params))
+
+        if handler is not None:
+            conflating_handler = self._conflating_handlers.pop((topic, handler), None)
+            if conflating_handler is not None:
+                conflating_handler.stop()
+                handler = conflating_handler
+            self._deregister_message_callback(topic, handler)
+            if len(self._message_callback_map.get(topic) or []) > 0:
+                return
+
+        self._message_callback_map.pop(topic, None)
+        for key in [key for key in self._conflating_handlers if key[0] == topic]:
+            self._conflating_handlers.pop(key).stop()
+
+        self._ws.send(json.dumps({
+            "id": self._get_private_app_id(),
+            "topic": topic,
+            "event": MessageTypes.UNSUBSCRIBE.value
+        }))
+
     def _register_message_callback(self, type: str, callback: Callable):
         cb_list = self._message_callback_map.get(type) or []
         if callback in cb_list:
@@ -172,15 +251,21 @@ class WooWSClient:
             self._connect_callback()
 
     def _on_message(self, ws: websocket.WebSocketApp, message: str):
+        if self._recorder is not None:
+            self._recorder.record(message)
+
         msg = json.loads(message)
         type = msg.get('event') or msg.get('topic')
 
         try:
             m_type = MessageTypes(type)
         except ValueError:
-            if self._debug:
-                log('ERROR: no type for message', message)
-            return
+            m_type = None
+            # symbol topics like PERP_BTC_USDT@orderbookupdate are only known by their subscribed name
+            if type not in self._message_callback_map:
+                if self._debug:
+                    log('ERROR: no type for message', message)
+                return
 
         if m_type == MessageTypes.AUTH:
             auth_success = msg.get('success')
@@ -190,14 +275,13 @@ class WooWSClient:
         if m_type == MessageTypes.PING:
             self._pong()
 
-        cb_list = self._message_callback_map.get(m_type.value) or []
+        cb_list = self._message_callback_map.get(type) or []
 
-        if cb_list is not None:
-            for cb in cb_list:
-                cb(msg.get('data'))
+        for cb in cb_list:
+            cb(msg.get('data'))
 
         if self._debug:
-            log(m_type.value, message)
+            log(type, message)
 
     def _on_error(self, ws: websocket.WebSocketApp, error):
         if self._debug:
@@ -206,12 +290,17 @@ class WooWSClient:
             self._error_callback(error)
 
     def _on_close(self, ws, close_status_code, close_msg):
+        if self._recorder is not None:
+            self._recorder.flush()
         if self._debug:
             log('closed', f'close_status_code: {close_status_code} - close_msg: {close_msg}')
         if self._close_callback is not None:
             self._close_callback(close_status_code, close_msg)
 
     def _pong(self):
+        # no socket when frames are being replayed from a tape
+        if self._ws is None:
+            return
         self._ws.send(json.dumps({
             "ts": str(get_timestamp_unix()),
             "event": MessageTypes.PONG.value
@@ -1,27 +1,26 @@
 from typing import Optional
 
-from common.util.cls import map_data_to_class
+from common.util.cls import compile_field_mapper
 
-from woo.api_rest import send_algo_order, edit_algo_order, cancel_algo_order as cancel_algo_order_api
-from woo.api_types import AlgoOrderRequestParams, AlgoOrderUpdateRequestParams, OrderSide, OrderType, AlgoType
+from woo.api_rest import send_algo_order, edit_algo_order, cancel_algo_order as cancel_algo_order_api, get_algo_orders
+from woo.api_types import AlgoOrderRequestParams, AlgoOrderResponseData, AlgoOrderUpdateRequestParams, OrderSide, \
+    OrderType, AlgoType
 from woo.models import WooAlgoOrder
 
 
-def _value_converter(k, v):
-    if k == 'trigger_time':
-        return v / 1000
-    if k == 'trigger_price':
-        return float(v)
-    return v
+def _ms_to_s(v):
+    return v / 1000
+
+
+_woo_algo_order_mapper = compile_field_mapper(
+    WooAlgoOrder,
+    {'algoStatus': 'status', 'createdTime': 'create_time', 'timestamp': 'report_time_ms'},
+    {'trigger_time': _ms_to_s, 'trigger_price': float}
+)
 
 
 def map_woo_algo_order_data(data: dict) -> dict:
-    return map_data_to_class(
-        WooAlgoOrder,
-        data,
-        {'algoStatus': 'status', 'createdTime': 'create_time'},
-        _value_converter
-    )
+    return _woo_algo_order_mapper(data)
 
 
 def create_algo_order(
@@ -33,7 +32,7 @@ def create_algo_order(
     order_tag: Optional[str] = None
 ) -> Optional[WooAlgoOrder]:
 
-    params = create_algo_order_params(
+    order_data = send_new_algo_order(
         symbol,
         side,
         quantity,
@@ -42,6 +41,34 @@ def create_algo_order(
         order_tag
     )
 
+    if order_data is None:
+        return None
+
+    return WooAlgoOrder.objects.create(**order_data)
+
+
+def send_new_algo_order(
+    symbol: str,
+    side: OrderSide,
+    quantity: str,
+    reduce_only: bool,
+    trigger_price: str,
+    order_tag: Optional[str] = None
+) -> Optional[dict]:
+    '''
+    Places the order without saving it, returns the WooAlgoOrder fields for the new order.
+    '''
+    return send_new_algo_order_with_params(create_algo_order_params(
+        symbol,
+        side,
+        quantity,
+        reduce_only,
+        trigger_price,
+        order_tag
+    ))
+
+
+def send_new_algo_order_with_params(params: AlgoOrderRequestParams) -> Optional[dict]:
     order = send_algo_order(params)
 
     if order is None:
@@ -55,9 +82,7 @@ def create_algo_order(
 
     order_data = rows[0]
 
-    return WooAlgoOrder.objects.create(
-        **map_woo_algo_order_data({**params, **order_data})
-    )
+    return map_woo_algo_order_data({**params, **order_data})
 
 
 def create_algo_order_params(
@@ -87,9 +112,7 @@ def create_algo_order_params(
 
 
 def update_algo_order(algo_order: WooAlgoOrder, params: AlgoOrderUpdateRequestParams) -> Optional[WooAlgoOrder]:
-    order_data = edit_algo_order(algo_order.order_id, params)
-
-    if order_data is None or order_data.get('status') != 'EDIT_SENT':
+    if not send_algo_order_edit(algo_order.order_id, params):
         return None
 
     algo_order.update(**params)
@@ -97,9 +120,25 @@ def update_algo_order(algo_order: WooAlgoOrder, params: AlgoOrderUpdateRequestPa
     return algo_order
 
 
+def send_algo_order_edit(order_id: int, params: AlgoOrderUpdateRequestParams) -> bool:
+    order_data = edit_algo_order(order_id, params)
+    return order_data is not None and order_data.get('status') == 'EDIT_SENT'
+
+
 def cancel_algo_order(algo_order: WooAlgoOrder) -> Optional[WooAlgoOrder]:
-    res = cancel_algo_order_api(algo_order.order_id)
-    if res is None or not res.get('success'):
+    if not send_algo_order_cancel(algo_order.order_id):
         return
     algo_order.update(status='CANCELLED', quantity=0)
     return algo_order
+
+
+def get_open_algo_orders() -> Optional[list[AlgoOrderResponseData]]:
+    data = get_algo_orders('INCOMPLETE')
+    if data is None:
+        return None
+    return data.get('rows', [])
+
+
+def send_algo_order_cancel(order_id: int) -> bool:
+    res = cancel_algo_order_api(order_id)
+    return res is not None and bool(res.get('success'))
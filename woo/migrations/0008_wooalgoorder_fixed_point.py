@@ -0,0 +1,44 @@
+from django.db import migrations, models
+
+from common.util.fixed_point import MS_PER_SECOND, PRICE_SCALE, QUANTITY_SCALE, ToFixed
+
+
+def fill_fixed_point_fields(apps, schema_editor):
+    WooAlgoOrder = apps.get_model('woo', 'WooAlgoOrder')
+    WooAlgoOrder.objects.update(
+        quantity_lots=ToFixed('quantity', QUANTITY_SCALE),
+        trigger_price_ticks=ToFixed('trigger_price', PRICE_SCALE),
+        trigger_trade_price_ticks=ToFixed('trigger_trade_price', PRICE_SCALE),
+        trigger_time_ms=ToFixed('trigger_time', MS_PER_SECOND),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('woo', '0007_alter_wooalgoorder_realized_pnl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wooalgoorder',
+            name='quantity_lots',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='wooalgoorder',
+            name='trigger_price_ticks',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='wooalgoorder',
+            name='trigger_trade_price_ticks',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='wooalgoorder',
+            name='trigger_time_ms',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(fill_fixed_point_fields, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.4 on 2026-10-19 19:05
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the table is large, the indexes are built without blocking the writes of the running flows
+    atomic = False
+
+    dependencies = [
+        ('woo', '0008_wooalgoorder_fixed_point'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='wooalgoorder',
+            index=models.Index(condition=models.Q(('status', 'NEW')), fields=['side', 'reduce_only'], name='woo_algo_order_new_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='wooalgoorder',
+            index=models.Index(fields=['status', 'side', 'reduce_only'], name='woo_algo_order_status_side_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='wooalgoorder',
+            index=models.Index(fields=['-created_at'], name='woo_algo_order_created_at_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-19 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('woo', '0009_wooalgoorder_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wooalgoorder',
+            name='report_time_ms',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
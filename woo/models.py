@@ -1,9 +1,14 @@
 import time
+from typing import Optional
 
 from django.db import models
 from django.db.models import Q
 from inflection import underscore
 
+from common.util.dirty_fields import DirtyFieldsMixin
+from common.util.fixed_point import seconds_to_ms, to_lots, to_ticks
+from common.util.unit_of_work import UnitOfWorkQuerySet
+
 
 class StatusChoices(models.TextChoices):
     NEW = 'NEW'
@@ -30,7 +35,16 @@ class SideChoices(models.TextChoices):
     SELL = 'SELL'
 
 
-class WooAlgoOrderQuerySet(models.QuerySet):
+# decimal field, the integer field mirroring it and the conversion between them
+FIXED_POINT_FIELDS = (
+    ('quantity', 'quantity_lots', to_lots),
+    ('trigger_price', 'trigger_price_ticks', to_ticks),
+    ('trigger_trade_price', 'trigger_trade_price_ticks', to_ticks),
+    ('trigger_time', 'trigger_time_ms', seconds_to_ms),
+)
+
+
+class WooAlgoOrderQuerySet(UnitOfWorkQuerySet):
 
     def all_orders_for_side(self, side) -> models.QuerySet:
         return self.filter(side=side)
@@ -57,7 +71,7 @@ class WooAlgoOrderManager(models.Manager):
         return self.get_queryset().all_non_reduce_only_orders_for_side(side)
 
 
-class WooAlgoOrder(models.Model):
+class WooAlgoOrder(DirtyFieldsMixin, models.Model):
     order_id = models.IntegerField()
     symbol = models.CharField(max_length=20)
     type = models.CharField(max_length=20, choices=TypeChoices.choices, default=TypeChoices.MARKET)
@@ -82,25 +96,58 @@ class WooAlgoOrder(models.Model):
     average_executed_price = models.DecimalField(max_digits=20, decimal_places=4, null=True, blank=True)
 
     realized_pnl = models.DecimalField(max_digits=20, decimal_places=4, null=True, blank=True)
+    # timestamp of the last ws report applied, in ms, the algo order version guard is warmed from it
+    report_time_ms = models.BigIntegerField(null=True, blank=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # fixed-point mirrors of the decimal fields, written by sync_fixed_point on every save
+    quantity_lots = models.BigIntegerField(null=True, blank=True, editable=False)
+    trigger_price_ticks = models.BigIntegerField(null=True, blank=True, editable=False)
+    trigger_trade_price_ticks = models.BigIntegerField(null=True, blank=True, editable=False)
+    trigger_time_ms = models.BigIntegerField(null=True, blank=True, editable=False)
+
     objects = WooAlgoOrderManager()
 
+    # api payload key -> field name, the same few keys arrive with every report
+    _field_names_by_key: dict[str, Optional[str]] = {}
+
+    @classmethod
+    def get_field_name(cls, key: str) -> Optional[str]:
+        try:
+            return cls._field_names_by_key[key]
+        except KeyError:
+            pass
+        names = {field.name for field in cls._meta.concrete_fields}
+        name = key if key in names else underscore(key)
+        cls._field_names_by_key[key] = name if name in names else None
+        return cls._field_names_by_key[key]
+
     def update(self, **kwargs):
         for key, value in kwargs.items():
-            ky = key
-            try:
-                getattr(self, ky)
-            except AttributeError as e:
-                try:
-                    ky = underscore(ky)
-                    getattr(self, ky)
-                except AttributeError:
-                    continue
-            setattr(self, ky, value)
+            name = self.get_field_name(key)
+            if name is not None:
+                setattr(self, name, value)
+        if not self.is_dirty:
+            return
         self.save()
 
+    def sync_fixed_point(self):
+        for decimal_field, fixed_field, convert in FIXED_POINT_FIELDS:
+            if decimal_field in self.__dict__:
+                setattr(self, fixed_field, convert(self.__dict__[decimal_field]))
+
+    def prepare_save(self):
+        self.sync_fixed_point()
+
+    def get_changed_fields_for_save(self, save_kwargs: dict) -> Optional[set[str]]:
+        changed_fields = super().get_changed_fields_for_save(save_kwargs)
+        if changed_fields is None or save_kwargs.get('update_fields') is None:
+            return changed_fields
+        return changed_fields | {
+            fixed_field for decimal_field, fixed_field, _ in FIXED_POINT_FIELDS if decimal_field in changed_fields
+        }
+
     def __str__(self):
         return f'{self.id} - {self.order_id} - {self.side} - {self.status} - {self.reduce_only}'
 
@@ -117,6 +164,12 @@ class WooAlgoOrder(models.Model):
                 name='woo_algo_order_order_id_unique_constraint',
             ),
         ]
+        indexes = [
+            # the live orders the flows look up are a handful of rows among years of filled ones
+            models.Index(fields=['side', 'reduce_only'], condition=Q(status='NEW'), name='woo_algo_order_new_idx'),
+            models.Index(fields=['status', 'side', 'reduce_only'], name='woo_algo_order_status_side_idx'),
+            models.Index(fields=['-created_at'], name='woo_algo_order_created_at_idx'),
+        ]
 
 
 class WooAPIError(models.Model):
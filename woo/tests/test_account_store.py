@@ -0,0 +1,85 @@
+import threading
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from woo.account_store import AccountStore
+
+
+def position_push(holding: float, version: int, symbol: str = 'PERP_BTC_USDT'):
+    return {'positions': {symbol: {'holding': holding, 'averageOpenPrice': 30000, 'markPrice': 30100, 'version': version}}}
+
+
+class TestAccountStore(TestCase):
+
+    def setUp(self):
+        self.store = AccountStore()
+
+    def test_update_positions(self):
+        self.store.update_positions(position_push(0.5, 1))
+        position = self.store.get_position('PERP_BTC_USDT')
+        self.assertEqual(position.holding, 0.5)
+        self.assertEqual(position.average_open_price, 30000)
+        self.assertEqual(self.store.get_holding('PERP_BTC_USDT'), 0.5)
+        self.assertEqual(self.store.get_holding('PERP_ETH_USDT'), 0.0)
+
+    def test_update_positions__when_push_is_older__keeps_newer(self):
+        self.store.update_positions(position_push(0.5, 2))
+        self.store.update_positions(position_push(0.1, 1))
+        self.assertEqual(self.store.get_holding('PERP_BTC_USDT'), 0.5)
+
+    def test_update_balances(self):
+        self.store.update_balances({'balances': {'USDT': {'holding': 1000, 'frozen': 10, 'version': 3}}})
+        balance = self.store.get_balance('USDT')
+        self.assertEqual((balance.holding, balance.frozen), (1000, 10))
+
+    def test_snapshot__is_not_changed_by_later_updates(self):
+        self.store.update_positions(position_push(0.5, 1))
+        snapshot = self.store.snapshot
+        self.store.update_positions(position_push(0.7, 2))
+        self.assertEqual(snapshot.positions['PERP_BTC_USDT'].holding, 0.5)
+        self.assertEqual(self.store.snapshot.positions['PERP_BTC_USDT'].holding, 0.7)
+        self.assertEqual(self.store.snapshot.version, snapshot.version + 1)
+
+    def test_listener__gets_every_snapshot(self):
+        snapshots = []
+        self.store.add_listener(snapshots.append)
+        self.store.update_positions(position_push(0.5, 1))
+        self.store.update_balances({'balances': {'USDT': {'holding': 1000}}})
+        self.assertEqual([snapshot.version for snapshot in snapshots], [1, 2])
+
+    @patch('woo.account_store.get_account_info', return_value={'totalCollateral': 1000})
+    @patch('woo.account_store.get_balances', return_value={'holding': [{'token': 'USDT', 'holding': 1000, 'frozen': 0}]})
+    @patch('woo.account_store.get_position_info', return_value={'positions': [{'symbol': 'PERP_BTC_USDT', 'holding': 0.2, 'version': 5}]})
+    def test_seed(self, *mocks):
+        self.store.update_positions(position_push(0.9, 1, symbol='PERP_ETH_USDT'))
+        self.assertTrue(self.store.seed())
+        self.assertEqual(self.store.get_holding('PERP_BTC_USDT'), 0.2)
+        self.assertIsNone(self.store.get_position('PERP_ETH_USDT'))
+        self.assertEqual(self.store.get_balance('USDT').holding, 1000)
+        self.assertEqual(self.store.snapshot.account['totalCollateral'], 1000)
+
+    @patch('woo.account_store.get_account_info', return_value={'totalCollateral': 1000})
+    @patch('woo.account_store.get_balances', return_value={'holding': []})
+    @patch('woo.account_store.get_position_info', return_value={'positions': [{'symbol': 'PERP_BTC_USDT', 'holding': 0.2, 'version': 5}]})
+    def test_seed_in_background__seeds_on_another_thread(self, *mocks):
+        thread = self.store.seed_in_background()
+        self.assertNotEqual(thread.ident, threading.get_ident())
+        thread.join(timeout=5)
+        self.assertEqual(self.store.get_holding('PERP_BTC_USDT'), 0.2)
+
+    @patch('woo.account_store.get_account_info', return_value={})
+    @patch('woo.account_store.get_balances', return_value={'holding': []})
+    @patch('woo.account_store.get_position_info', return_value={'positions': [{'symbol': 'PERP_BTC_USDT', 'holding': 0.2, 'version': 5}]})
+    def test_seed__when_ws_push_is_newer__keeps_push(self, *mocks):
+        self.store.update_positions(position_push(0.4, 6))
+        self.store.seed()
+        self.assertEqual(self.store.get_holding('PERP_BTC_USDT'), 0.4)
+
+    @patch('woo.account_store.get_account_info', return_value=None)
+    @patch('woo.account_store.get_balances', return_value=None)
+    @patch('woo.account_store.get_position_info', return_value=None)
+    def test_seed__when_rest_fails(self, *mocks):
+        self.store.update_positions(position_push(0.5, 1))
+        self.assertFalse(self.store.seed())
+        self.assertEqual(self.store.get_holding('PERP_BTC_USDT'), 0.5)
@@ -0,0 +1,122 @@
+import time
+
+from django.test import TestCase
+
+from woo.algo_order_version_guard import AlgoOrderVersionGuard
+from woo.api_types import AlgoOrderStatus
+from woo.helpers import map_woo_algo_order_data
+from woo.tests.factory.woo_algo_order_factory import WooAlgoOrderFactory
+
+
+def make_report(
+    order_id: int = 2829113,
+    status: str = 'NEW',
+    timestamp: int = 1700757205224,
+    is_triggered: bool = False,
+    reduce_only: bool = True
+):
+    # shaped like the algoexecutionreportv2 reports in us_orders/tests/mock_data/ws_23_11_23.txt
+    return {
+        'symbol': 'PERP_BTC_USDT', 'rootAlgoOrderId': order_id, 'parentAlgoOrderId': 0, 'algoOrderId': order_id,
+        'clientOrderId': 0, 'orderTag': 'default', 'algoType': 'STOP_LOSS', 'side': 'SELL', 'quantity': 0.0002,
+        'triggerPrice': 37380, 'triggerStatus': 'USELESS', 'price': 0, 'type': 'MARKET', 'triggerTradePrice': 0,
+        'triggerTime': 0, 'tradeId': 0, 'executedPrice': 0,
+        'executedQuantity': 0.0002 if status == AlgoOrderStatus.FILLED else 0, 'fee': 0, 'reason': '',
+        'feeAsset': '', 'totalExecutedQuantity': 0, 'averageExecutedPrice': 0, 'totalFee': 0,
+        'timestamp': timestamp, 'visibleQuantity': 0.0002, 'reduceOnly': reduce_only,
+        'triggerPriceType': 'MARKET_PRICE', 'maker': False, 'activated': False, 'triggered': is_triggered,
+        'isTriggered': is_triggered, 'isMaker': False, 'isActivated': False, 'rootAlgoStatus': status,
+        'algoStatus': status,
+    }
+
+
+# order 2829113 of the capture, placed, triggered, reported twice more and filled
+CAPTURED_FILL = [
+    make_report(timestamp=1700757205224),
+    make_report(timestamp=1700758010305, is_triggered=True),
+    make_report(timestamp=1700758010333, is_triggered=True),
+    make_report(status=AlgoOrderStatus.FILLED, timestamp=1700758010360, is_triggered=True),
+]
+
+
+class TestAlgoOrderVersionGuard(TestCase):
+
+    def setUp(self):
+        self.guard = AlgoOrderVersionGuard()
+
+    def test_filter__when_order_is_unknown__accepts(self):
+        reports = [make_report(1), make_report(2)]
+        self.assertEqual(self.guard.filter(reports), reports)
+        self.assertEqual(self.guard.accepted, 2)
+
+    def test_filter__when_report_was_already_applied__drops_duplicate(self):
+        self.guard.record(CAPTURED_FILL[3])
+        self.assertEqual(self.guard.filter([dict(CAPTURED_FILL[3])]), [])
+        self.assertEqual(self.guard.duplicates, 1)
+
+    def test_filter__when_report_is_older__drops_stale(self):
+        self.guard.record(make_report(status=AlgoOrderStatus.REPLACED, timestamp=1700755583113))
+        self.assertEqual(self.guard.filter([make_report(timestamp=1700753784511)]), [])
+        self.assertEqual(self.guard.stale, 1)
+
+    def test_filter__when_new_arrives_after_fill__drops_stale(self):
+        self.guard.record(CAPTURED_FILL[3])
+        self.assertEqual(self.guard.filter([make_report(timestamp=1700758010400)]), [])
+        self.assertEqual(self.guard.stale, 1)
+
+    def test_filter__when_cancel_arrives_after_fill__drops_stale(self):
+        self.guard.record(CAPTURED_FILL[3])
+        self.assertEqual(self.guard.filter([make_report(status=AlgoOrderStatus.CANCELLED, timestamp=1700758010836)]), [])
+        self.assertEqual(self.guard.stale, 1)
+
+    def test_filter__when_fill_arrives_after_triggered_new__accepts(self):
+        self.guard.record(CAPTURED_FILL[1])
+        self.assertEqual(self.guard.filter(CAPTURED_FILL[2:]), CAPTURED_FILL[2:])
+
+    def test_filter__when_capture_arrives_in_reverse__only_accepts_the_fill(self):
+        self.assertEqual(self.guard.filter(CAPTURED_FILL[::-1]), [CAPTURED_FILL[3]])
+        self.assertEqual(self.guard.stale, 3)
+
+    def test_filter__when_report_is_newer__accepts(self):
+        self.guard.record(make_report(timestamp=1700753784511))
+        report = make_report(status=AlgoOrderStatus.REPLACED, timestamp=1700755583113)
+        self.assertEqual(self.guard.filter([report]), [report])
+
+    def test_filter__when_batch_repeats_a_report__drops_repeat(self):
+        reports = [CAPTURED_FILL[0], dict(CAPTURED_FILL[0]), CAPTURED_FILL[3]]
+        self.assertEqual(self.guard.filter(reports), [reports[0], reports[2]])
+        self.assertEqual(self.guard.stats(), {'orders': 0, 'accepted': 2, 'duplicates': 1, 'stale': 0})
+
+    def test_filter__when_report_only_has_updated_time__compares_in_ms(self):
+        self.guard.record(make_report(timestamp=1700753784511))
+        report = {'algoOrderId': 2829113, 'algoStatus': 'NEW', 'updatedTime': '1700753784.511'}
+        self.assertEqual(self.guard.filter([report]), [])
+        self.assertEqual(self.guard.duplicates, 1)
+
+    def test_filter__when_report_has_no_time__accepts(self):
+        self.guard.record(make_report())
+        report = {'algoOrderId': 2829113, 'algoStatus': 'NEW'}
+        self.assertEqual(self.guard.filter([report]), [report])
+
+    def test_warm__loads_recently_updated_orders(self):
+        WooAlgoOrderFactory(order_id=1, status=AlgoOrderStatus.FILLED, updated_time=time.time())
+        WooAlgoOrderFactory(order_id=2, updated_time=time.time() - 10 * 24 * 60 * 60)
+        with self.assertNumQueries(1):
+            self.guard.warm()
+        self.assertEqual(len(self.guard), 1)
+        self.assertEqual(self.guard.filter([make_report(order_id=1, timestamp=int(time.time() * 1000))]), [])
+
+    def test_warm__when_order_was_updated_by_a_report__drops_the_resent_report(self):
+        report = make_report(order_id=1, timestamp=int(time.time() * 1000))
+        algo_order = WooAlgoOrderFactory(order_id=1)
+        algo_order.update(**map_woo_algo_order_data(report))
+        self.guard.warm()
+        self.assertEqual(self.guard.filter([dict(report)]), [])
+        self.assertEqual(self.guard.duplicates, 1)
+
+    def test_warm__when_order_was_updated_by_a_report__leaves_its_updated_time(self):
+        algo_order = WooAlgoOrderFactory(order_id=1, updated_time=1700000000)
+        algo_order.update(**map_woo_algo_order_data(make_report(order_id=1, timestamp=1700757205224)))
+        algo_order.refresh_from_db()
+        self.assertEqual(algo_order.updated_time, 1700000000)
+        self.assertEqual(algo_order.report_time_ms, 1700757205224)
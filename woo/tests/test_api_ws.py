@@ -0,0 +1,91 @@
+import json
+import threading
+from unittest.mock import MagicMock
+
+from django.test import TestCase
+
+from common.util.conflating_queue import ConflatingHandler
+from woo.api_ws import MessageTypes, WooWSClient
+
+
+class TestWooWSClient(TestCase):
+
+    def setUp(self):
+        self.client = WooWSClient(app_id='app-id', app_key='key')
+        self.client._ws = MagicMock()
+
+    def message(self, topic: str, data: dict) -> str:
+        return json.dumps({'topic': topic, 'ts': 1, 'data': data})
+
+    def test_on_message__when_topic_has_a_symbol__calls_handler(self):
+        handler = MagicMock()
+        self.client.subscribe_to_order_book_update('PERP_BTC_USDT', handler)
+        self.client._on_message(None, self.message('PERP_BTC_USDT@orderbookupdate', {'asks': [], 'bids': []}))
+        handler.assert_called_once_with({'asks': [], 'bids': []})
+
+    def test_subscribe__when_conflate__handler_gets_latest_value_per_bar(self):
+        received = []
+        release = threading.Event()
+        started = threading.Event()
+
+        def handler(data):
+            started.set()
+            release.wait(5)
+            received.append(data)
+
+        self.client.subscribe_to_1m_kline(handler, conflate=True)
+        self.client._on_message(None, self.message('PERP_BTC_USDT@kline_1m', {'startTime': 0, 'close': 1}))
+        started.wait(5)
+        for close in range(2, 5):
+            self.client._on_message(None, self.message('PERP_BTC_USDT@kline_1m', {'startTime': 0, 'close': close}))
+        self.client._on_message(None, self.message('PERP_BTC_USDT@kline_1m', {'startTime': 60000, 'close': 5}))
+        release.set()
+
+        conflating_handler: ConflatingHandler = self.client._conflating_handlers[('PERP_BTC_USDT@kline_1m', handler)]
+        conflating_handler.stop(drain=True)
+
+        self.assertEqual([data['close'] for data in received], [1, 4, 5])
+        stats = self.client.conflation_stats()['PERP_BTC_USDT@kline_1m']
+        self.assertEqual((stats.received, stats.delivered, stats.conflated), (5, 3, 2))
+
+    def test_subscribe__when_conflate__handler_gets_latest_position_per_symbols(self):
+        received = []
+        release = threading.Event()
+        started = threading.Event()
+
+        def handler(data):
+            started.set()
+            release.wait(5)
+            received.append(data)
+
+        self.client.subscribe_to_position(handler, conflate=True)
+        self.client._on_message(None, self.message('position', {'positions': {'PERP_BTC_USDT': {'holding': 1}}}))
+        started.wait(5)
+        for holding in range(2, 4):
+            self.client._on_message(None, self.message('position', {'positions': {'PERP_BTC_USDT': {'holding': holding}}}))
+        self.client._on_message(None, self.message('position', {'positions': {'PERP_ETH_USDT': {'holding': 4}}}))
+        release.set()
+
+        self.client._conflating_handlers[('position', handler)].stop(drain=True)
+
+        self.assertEqual(
+            [holding['holding'] for data in received for holding in data['positions'].values()],
+            [1, 3, 4]
+        )
+
+    def test_subscribe__when_not_conflated__dispatches_every_message_in_order(self):
+        received = []
+        self.client.subscribe_to_algo_execution_report_v2(received.append)
+        for i in range(3):
+            self.client._on_message(None, self.message('algoexecutionreportv2', [{'algoOrderId': i}]))
+        self.assertEqual(received, [[{'algoOrderId': 0}], [{'algoOrderId': 1}], [{'algoOrderId': 2}]])
+        self.assertEqual(self.client.conflation_stats(), {})
+
+    def test_unsubscribe__when_conflated__stops_handler(self):
+        handler = MagicMock()
+        self.client.subscribe_to_position(handler, conflate=True)
+        conflating_handler = self.client._conflating_handlers[('position', handler)]
+        self.client._unsubscribe(MessageTypes.POSITION, handler)
+        self.assertEqual(self.client._conflating_handlers, {})
+        self.assertFalse(conflating_handler._thread.is_alive())
+
@@ -30,4 +30,32 @@ class WooAlgoOrderModelTests(TestCase):
         order_id = 1234567
         order = WooAlgoOrderFactory(order_id=order_id)
         data = get_mock_algo_order_data(order_id=order_id)
-        order.update(**data)
\ No newline at end of file
+        order.update(**data)
+
+    def test_update__writes_only_the_changed_fields(self):
+        order = WooAlgoOrderFactory(status='NEW')
+        with self.assertNumQueries(0):
+            order.update(status='NEW', unknownKey=1)
+        # savepoint, update, release - order_tag can't change any group state
+        with self.assertNumQueries(3) as context:
+            order.update(orderTag='tag', status='NEW')
+        self.assertIn('order_tag', context.captured_queries[1]['sql'])
+        self.assertNotIn('symbol', context.captured_queries[1]['sql'])
+        order.refresh_from_db()
+        self.assertEqual(order.order_tag, 'tag')
+        self.assertEqual(order.get_dirty_fields(), set())
+
+    def test_get_dirty_fields__compares_decimals_by_value(self):
+        order = WooAlgoOrderFactory(quantity=0.1)
+        order.refresh_from_db()
+        order.quantity = '0.1'
+        self.assertEqual(order.get_dirty_fields(), set())
+        order.quantity = '0.2'
+        self.assertEqual(order.get_dirty_fields(), {'quantity'})
+
+    def test_save__keeps_the_fixed_point_fields_in_sync(self):
+        order = WooAlgoOrderFactory(quantity=0.1, trigger_price=91.25, trigger_time=1699477397.398)
+        self.assertEqual((order.quantity_lots, order.trigger_price_ticks, order.trigger_time_ms), (1000, 912500, 1699477397398))
+        order.update(quantity='0.3')
+        order.refresh_from_db()
+        self.assertEqual(order.quantity_lots, 3000)